@@ -0,0 +1,285 @@
+"""Append-only file persistence.
+
+Every write command that reaches the replicas is also fed to the AOF as
+RESP. Fed commands collect in a buffer, and flush() writes the buffer out
+right before replies leave: once per event-loop iteration, or once per read
+batch with threads. Under appendfsync always, flush() also fsyncs, and
+concurrent flushes share one write and fsync. A caller that finds a flush
+in progress waits for it and only flushes again if its commands came too
+late to be included. Under everysec a background thread fsyncs once a
+second, and under no the kernel decides.
+
+A rewrite forks a child that writes the dataset as an RDB preamble to a
+temp file, while the parent keeps appending to the old file and copies
+every command fed since the fork into a rewrite buffer. Once the child
+exits, the parent appends the buffer to the temp file, fsyncs it and
+renames it over the AOF. The result is the hybrid format Redis writes with
+aof-use-rdb-preamble: an RDB image followed by RESP commands.
+"""
+import mmap
+import os
+import threading
+import time
+from typing import Callable, List, Optional
+
+from app import rdb_loader
+from app.resp_parser import RespParser
+
+APPENDFSYNC = ("always", "everysec", "no")
+DEFAULT_APPENDFSYNC = "everysec"
+DEFAULT_FILENAME = "appendonly.aof"
+
+EVERYSEC_INTERVAL = 1.0
+# Bytes handed to the RESP parser at a time while replaying
+REPLAY_CHUNK = 1 << 20
+
+# Relative SET expiries are logged as the absolute time they resolved to, so
+# a replay long after the write doesn't extend the TTL. The EXPIRE family
+# propagates PEXPIREAT itself.
+_RELATIVE_SET_OPTIONS = (b"EX", b"PX", b"EXAT")
+
+
+class AofError(Exception):
+    pass
+
+
+def absolute_expiry(command: List[bytes], expiry_of: Callable[[bytes], Optional[int]]) -> List[bytes]:
+    """command with SET's EX/PX/EXAT as PXAT; expiry_of(key) is the key's
+    expiry in ms after the command ran"""
+    if command[0] == b"SET":
+        when = expiry_of(command[1])
+        for i in range(3, len(command) - 1):
+            if command[i].upper() in _RELATIVE_SET_OPTIONS and when is not None:
+                return command[:i] + [b"PXAT", b"%d" % when] + command[i + 2:]
+    return command
+
+
+class AppendOnlyFile:
+    def __init__(self, path: str, fsync_policy: str = DEFAULT_APPENDFSYNC):
+        if fsync_policy not in APPENDFSYNC:
+            raise ValueError(f"unknown appendfsync policy: {fsync_policy}")
+        self.path = path
+        self.fsync_policy = fsync_policy
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.current_size = os.fstat(self.fd).st_size
+        self.base_size = self.current_size
+        self.buf = bytearray()  # fed, not yet written
+        self.fed = 0  # commands fed so far
+        self.written = 0  # commands written out (and fsynced under always)
+        self.flushing = False
+        self.cond = threading.Condition()
+        self.fsync_lock = threading.Lock()  # held around fsync and fd swaps
+        self.unsynced = False  # written since the last fsync
+        self.last_write_ok = True
+        self.rewrite_buffer: Optional[bytearray] = None
+        self.rewrite_pid: Optional[int] = None
+        self.rewrite_start = 0.0
+        self.rewrite_scheduled = False
+        self.last_rewrite_ok = True
+        self.last_rewrite_seconds = -1
+        if fsync_policy == "everysec":
+            threading.Thread(target=self._fsync_every_second, daemon=True).start()
+
+    def feed(self, encoded: bytes):
+        with self.cond:
+            self.buf += encoded
+            self.fed += 1
+            if self.rewrite_buffer is not None:
+                self.rewrite_buffer += encoded
+
+    def flush(self):
+        """Write everything fed so far, fsyncing it under always"""
+        with self.cond:
+            target = self.fed
+            while self.written < target:
+                if self.flushing:
+                    self.cond.wait()
+                    continue
+                self.flushing = True
+                data, self.buf = self.buf, bytearray()
+                upto = self.fed
+                self.cond.release()
+                try:
+                    ok = self._write(bytes(data), self.fsync_policy == "always")
+                finally:
+                    self.cond.acquire()
+                    self.flushing = False
+                    self.cond.notify_all()
+                if not ok:
+                    # Keep the data for the next flush rather than lose it
+                    self.buf[:0] = data
+                    return
+                self.written = upto
+
+    def _write(self, data: bytes, fsync: bool) -> bool:
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(self.fd, view):]
+            if fsync:
+                with self.fsync_lock:
+                    os.fsync(self.fd)
+            else:
+                self.unsynced = True
+        except OSError as e:
+            if self.last_write_ok:
+                print(f"Error writing to the AOF file: {e}")
+            self.last_write_ok = False
+            return False
+        self.last_write_ok = True
+        self.current_size += len(data)
+        return True
+
+    def _fsync_every_second(self):
+        while True:
+            time.sleep(EVERYSEC_INTERVAL)
+            if not self.unsynced:
+                continue
+            self.unsynced = False
+            with self.fsync_lock:
+                try:
+                    os.fsync(self.fd)
+                except OSError as e:
+                    print(f"Error syncing the AOF file: {e}")
+
+    def temp_path(self, pid: int) -> str:
+        return os.path.join(os.path.dirname(self.path) or ".", f"temp-rewriteaof-bg-{pid}.aof")
+
+    def start_rewrite(self, write_base: Callable[[str], None]) -> bool:
+        """BGREWRITEAOF: fork a child running write_base(temp path); False
+        if a rewrite is already running. Writes must be held off meanwhile,
+        or one could reach both the base and the rewrite buffer"""
+        if self.rewrite_pid is not None:
+            return False
+        self.rewrite_start = time.time()
+        with self.cond:
+            self.rewrite_buffer = bytearray()
+        if not hasattr(os, "fork"):
+            # No fork: write the base here, as BGSAVE does without one
+            try:
+                write_base(self.temp_path(os.getpid()))
+                ok = True
+            except OSError as e:
+                print(f"Error rewriting the AOF file: {e}")
+                ok = False
+            self._rewrite_done(os.getpid(), ok)
+            return True
+        pid = os.fork()
+        if pid == 0:
+            try:
+                write_base(self.temp_path(os.getpid()))
+                code = 0
+            except BaseException:
+                code = 1
+            os._exit(code)
+        self.rewrite_pid = pid
+        return True
+
+    def check_rewrite(self):
+        """Reap a finished rewrite child and install its file"""
+        pid, status = os.waitpid(self.rewrite_pid, os.WNOHANG)
+        if pid == 0:
+            return
+        self.rewrite_pid = None
+        self._rewrite_done(pid, os.waitstatus_to_exitcode(status) == 0)
+
+    def _rewrite_done(self, pid: int, ok: bool):
+        temp_path = self.temp_path(pid)
+        if ok:
+            try:
+                self._install(temp_path)
+            except OSError as e:
+                print(f"Error installing the rewritten AOF file: {e}")
+                ok = False
+        if not ok:
+            with self.cond:
+                self.rewrite_buffer = None
+            try:
+                os.unlink(temp_path)
+            except OSError:
+                pass
+        self.last_rewrite_ok = ok
+        self.last_rewrite_seconds = int(time.time() - self.rewrite_start)
+
+    def _install(self, temp_path: str):
+        with self.cond:
+            while self.flushing:
+                self.cond.wait()
+            base_size = os.path.getsize(temp_path)
+            fd = os.open(temp_path, os.O_WRONLY | os.O_APPEND)
+            try:
+                # Everything fed since the fork, including what is still
+                # unwritten, goes after the base instead of into the old file
+                tail = bytes(self.rewrite_buffer)
+                view = memoryview(tail)
+                while view:
+                    view = view[os.write(fd, view):]
+                os.fsync(fd)
+                os.replace(temp_path, self.path)
+            except OSError:
+                os.close(fd)
+                raise
+            with self.fsync_lock:
+                os.close(self.fd)
+                self.fd = fd
+            self.buf.clear()
+            self.written = self.fed
+            self.rewrite_buffer = None
+            self.base_size = base_size
+            self.current_size = base_size + len(tail)
+
+    def info_lines(self) -> List[str]:
+        in_progress = self.rewrite_pid is not None
+        return [
+            "aof_enabled:1",
+            f"aof_rewrite_in_progress:{int(in_progress)}",
+            f"aof_rewrite_scheduled:{int(self.rewrite_scheduled)}",
+            f"aof_last_rewrite_time_sec:{self.last_rewrite_seconds}",
+            f"aof_current_rewrite_time_sec:{int(time.time() - self.rewrite_start) if in_progress else -1}",
+            f"aof_last_bgrewrite_status:{'ok' if self.last_rewrite_ok else 'err'}",
+            f"aof_last_write_status:{'ok' if self.last_write_ok else 'err'}",
+            f"aof_current_size:{self.current_size}",
+            f"aof_base_size:{self.base_size}",
+            f"aof_buffer_length:{len(self.buf)}",
+        ]
+
+
+def replay(
+    path: str,
+    load_snapshot: Callable[[rdb_loader.Snapshot], None],
+    execute: Callable[[List[bytes]], None],
+) -> int:
+    """Load the AOF at path: its RDB preamble, if any, through
+    load_snapshot(), then every command through execute(); returns the
+    number of commands replayed.
+
+    A command cut off at the end of the file (a crash mid-write) is
+    truncated away, as Redis does with aof-load-truncated.
+    """
+    start = time.monotonic()
+    commands = 0
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            offset = 0
+            if buf[:5] == b"REDIS":
+                snapshot = rdb_loader.parse(buf)
+                load_snapshot(snapshot)
+                offset = snapshot.end
+            parser = RespParser()
+            for chunk_start in range(offset, size, REPLAY_CHUNK):
+                parser.feed(buf[chunk_start:chunk_start + REPLAY_CHUNK])
+                for value in parser.commands():
+                    if not isinstance(value, list) or not value:
+                        raise AofError(f"not a command at byte {offset + parser.offset} of the AOF")
+                    execute(value)
+                    commands += 1
+    complete = offset + parser.offset
+    if complete < size:
+        print(f"AOF ends with an incomplete command: truncating {size - complete} bytes")
+        os.truncate(path, complete)
+    seconds = time.monotonic() - start
+    print(f"Done loading AOF: {commands} commands replayed in {seconds:.2f} seconds")
+    return commands
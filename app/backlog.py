@@ -0,0 +1,48 @@
+"""Replication backlog: the tail of the replication stream.
+
+A fixed-size circular buffer holding the last `size` bytes propagated to
+replicas, addressed by stream offset. A replica that reconnects asks for
+the offset after the last byte it processed; if that offset is still in the
+buffer the master sends just the missing bytes (+CONTINUE) instead of a
+full snapshot.
+"""
+
+DEFAULT_SIZE = 1024 * 1024
+
+
+class ReplicationBacklog:
+    def __init__(self, size: int = DEFAULT_SIZE):
+        self.size = size
+        self.buf = bytearray(size)
+        self.end = 0  # stream offset just past the newest byte
+        self.histlen = 0  # bytes held, at most size
+
+    @property
+    def start(self) -> int:
+        """Stream offset of the oldest byte held"""
+        return self.end - self.histlen
+
+    def append(self, data: bytes):
+        n = len(data)
+        if n > self.size:
+            self.end += n - self.size
+            data = data[n - self.size:]
+            n = self.size
+        pos = self.end % self.size
+        first = min(n, self.size - pos)
+        self.buf[pos:pos + first] = data[:first]
+        self.buf[:n - first] = data[first:]
+        self.end += n
+        self.histlen = min(self.size, self.histlen + n)
+
+    def covers(self, offset: int) -> bool:
+        """Whether every byte from offset on is still held"""
+        return self.start <= offset <= self.end
+
+    def read_from(self, offset: int) -> bytes:
+        """The stream from offset to the end; offset must be covered"""
+        n = self.end - offset
+        pos = offset % self.size
+        first = min(n, self.size - pos)
+        return bytes(self.buf[pos:pos + first]) + bytes(self.buf[:n - first])
+
@@ -0,0 +1,136 @@
+"""Command table.
+
+Every command is registered once with its handler, arity, flags and key
+positions. Dispatch is a single dict lookup on the upper-cased name, and the
+flags decide in one place whether a command is propagated to replicas,
+queued inside MULTI or allowed while the client is subscribed.
+
+Arity follows the Redis convention: a positive arity is the exact argument
+count including the command name, a negative one is a minimum.
+
+Keys are found from first/last/step, except for commands whose keys move
+with their arguments (MOVABLE_KEYS): those register a getkeys function that
+parses the arguments, so options and numbers are never taken for keys.
+"""
+import dataclasses
+from typing import Callable, Dict, FrozenSet, Iterable, List, Optional
+
+WRITE = "write"
+READONLY = "readonly"
+BLOCKING = "blocking"
+PUBSUB_ALLOWED = "pubsub-allowed"
+NO_MULTI = "no-multi"  # runs immediately instead of being queued by MULTI
+ADMIN = "admin"
+MOVABLE_KEYS = "movablekeys"
+DENY_OOM = "denyoom"  # may grow the dataset, so refused while over maxmemory
+
+
+@dataclasses.dataclass
+class Command:
+    name: bytes
+    handler: Callable
+    arity: int
+    flags: FrozenSet[str]
+    first_key: int = 0
+    last_key: int = 0
+    step: int = 0
+    getkeys: Optional[Callable[[List], List]] = None
+
+    @property
+    def is_write(self) -> bool:
+        return WRITE in self.flags
+
+    def check_arity(self, argc: int) -> bool:
+        return argc == self.arity if self.arity >= 0 else argc >= -self.arity
+
+    def keys(self, argv: List) -> List:
+        """Key arguments of argv, according to getkeys or first/last/step"""
+        if self.getkeys is not None:
+            return self.getkeys(argv)
+        if not self.first_key:
+            return []
+        last = self.last_key if self.last_key >= 0 else len(argv) + self.last_key
+        return argv[self.first_key:last + 1:self.step]
+
+    def info(self) -> list:
+        """COMMAND INFO reply for this command"""
+        return [
+            self.name.lower(),
+            self.arity,
+            sorted(self.flags),
+            self.first_key,
+            self.last_key,
+            self.step,
+        ]
+
+
+COMMANDS: Dict[bytes, Command] = {}
+
+
+def command(
+    name: bytes,
+    arity: int,
+    flags: Iterable[str] = (),
+    first_key: int = 0,
+    last_key: int = 0,
+    step: int = 0,
+    getkeys: Optional[Callable[[List], List]] = None,
+) -> Callable[[Callable], Callable]:
+    """Register the decorated function as the handler for name"""
+
+    def register(handler: Callable) -> Callable:
+        COMMANDS[name] = Command(
+            name=name,
+            handler=handler,
+            arity=arity,
+            flags=frozenset(flags),
+            first_key=first_key,
+            last_key=last_key,
+            step=step,
+            getkeys=getkeys,
+        )
+        return handler
+
+    return register
+
+
+def lookup(name) -> Optional[Command]:
+    if not isinstance(name, bytes):
+        return None
+    cmd = COMMANDS.get(name)
+    if cmd is None:
+        cmd = COMMANDS.get(name.upper())
+    return cmd
+
+
+def numkeys_keys(numkeys_index: int) -> Callable[[List], List]:
+    """getkeys for numkeys key [key ...] with numkeys at numkeys_index"""
+
+    def getkeys(argv: List) -> List:
+        try:
+            numkeys = int(argv[numkeys_index])
+        except (IndexError, ValueError):
+            return []
+        if numkeys <= 0:
+            return []
+        return argv[numkeys_index + 1:numkeys_index + 1 + numkeys]
+
+    return getkeys
+
+
+def streams_keys(argv: List) -> List:
+    """getkeys for XREAD and XREADGROUP: the first half of the arguments
+    after STREAMS, skipping the options and their values before it"""
+    i = 1
+    while i < len(argv):
+        option = argv[i].upper()
+        if option in (b"COUNT", b"BLOCK"):
+            i += 2
+        elif option == b"GROUP":
+            i += 3
+        elif option == b"STREAMS":
+            rest = argv[i + 1:]
+            return rest[:len(rest) // 2] if len(rest) % 2 == 0 else []
+        else:
+            i += 1
+    return []
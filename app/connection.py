@@ -0,0 +1,73 @@
+"""Buffered client connection for the threaded server.
+
+Replies are appended to a per-connection output buffer. While the owning
+thread is working through a read batch the connection is corked and the
+buffer is written with one ``sendall`` when the batch ends; a send from
+another thread (a blocking-command wakeup, a published message) while the
+connection is idle is written straight away. Every write goes through the
+same buffer under one lock, so replies keep the order they were produced in.
+"""
+import socket
+import threading
+from typing import Optional
+
+from app.stats import Stats
+
+
+class ThreadedConnection:
+    def __init__(self, sock: socket.socket, stats: Optional[Stats] = None):
+        self.sock = sock
+        self.stats = stats
+        self.out = bytearray()
+        self.corked = False
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def fileno(self) -> int:
+        return self.sock.fileno()
+
+    def getpeername(self):
+        return self.sock.getpeername()
+
+    def recv_into(self, buffer, nbytes: int = 0) -> int:
+        return self.sock.recv_into(buffer, nbytes)
+
+    def send(self, data: bytes) -> int:
+        with self.lock:
+            if not self.closed:
+                self.out += data
+                if not self.corked:
+                    self._flush_locked()
+        return len(data)
+
+    def cork(self):
+        """Hold replies in the buffer until uncork()"""
+        with self.lock:
+            self.corked = True
+
+    def uncork(self):
+        with self.lock:
+            self.corked = False
+            self._flush_locked()
+
+    def flush(self):
+        with self.lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        if not self.out or self.closed:
+            return
+        data, self.out = self.out, bytearray()
+        try:
+            self.sock.sendall(data)
+        except OSError:
+            self.closed = True
+            return
+        if self.stats is not None:
+            self.stats.total_net_output_bytes += len(data)
+
+    def close(self):
+        with self.lock:
+            self._flush_locked()
+            self.closed = True
+        self.sock.close()
@@ -1,3 +1,10 @@
+from typing import List, Sequence, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # optional: the *_many helpers fall back to plain loops
+    np = None
+
 MIN_LATITUDE = -85.05112878
 MAX_LATITUDE = 85.05112878
 MIN_LONGITUDE = -180
@@ -64,6 +71,38 @@ def decode(geo_code: int) -> tuple[float, float]:
 
     return (longitude, latitude)
 
+def decode_many(geo_codes: Sequence[int]) -> List[Tuple[float, float]]:
+    """decode() over a sequence of scores, (longitude, latitude) each"""
+    if np is None:
+        return [decode(int(geo_code)) for geo_code in geo_codes]
+    codes = np.asarray(geo_codes, dtype=np.float64).astype(np.uint64)
+    grid_latitude_number = _compact_many(codes)
+    grid_longitude_number = _compact_many(codes >> np.uint64(1))
+
+    # Same arithmetic as decode(), element-wise
+    scale_factor = float(2**26)
+    latitude = (
+        (MIN_LATITUDE + LATITUDE_RANGE * (grid_latitude_number / scale_factor))
+        + (MIN_LATITUDE + LATITUDE_RANGE * ((grid_latitude_number + 1) / scale_factor))
+    ) * 0.5
+    longitude = (
+        (MIN_LONGITUDE + LONGITUDE_RANGE * (grid_longitude_number / scale_factor))
+        + (MIN_LONGITUDE + LONGITUDE_RANGE * ((grid_longitude_number + 1) / scale_factor))
+    ) * 0.5
+    return list(zip(longitude.tolist(), latitude.tolist()))
+
+
+def _compact_many(v):
+    v = v & np.uint64(0x5555555555555555)
+
+    v = (v | (v >> np.uint64(1))) & np.uint64(0x3333333333333333)
+    v = (v | (v >> np.uint64(2))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    v = (v | (v >> np.uint64(4))) & np.uint64(0x00FF00FF00FF00FF)
+    v = (v | (v >> np.uint64(8))) & np.uint64(0x0000FFFF0000FFFF)
+    v = (v | (v >> np.uint64(16))) & np.uint64(0x00000000FFFFFFFF)
+
+    return v.astype(np.float64)
+
 if __name__ == "__main__":
     # Test cases from encode.py to verify decoding
     # The latitude and longitude in test cases are the actual responses from redis server
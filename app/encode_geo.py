@@ -1,3 +1,10 @@
+from typing import List, Sequence
+
+try:
+    import numpy as np
+except ImportError:  # optional: the *_many helpers fall back to plain loops
+    np = None
+
 MIN_LATITUDE = -85.05112878
 MAX_LATITUDE = 85.05112878
 MIN_LONGITUDE = -180
@@ -6,6 +13,8 @@ MAX_LONGITUDE = 180
 LATITUDE_RANGE = MAX_LATITUDE - MIN_LATITUDE
 LONGITUDE_RANGE = MAX_LONGITUDE - MIN_LONGITUDE
 
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+
 
 def encode(latitude: float, longitude: float) -> int:
     # Normalize to the range 0-2^26
@@ -19,6 +28,21 @@ def encode(latitude: float, longitude: float) -> int:
     return interleave(normalized_latitude, normalized_longitude)
 
 
+def geohash_string(latitude: float, longitude: float) -> str:
+    """11-character base32 geohash of a point, as GEOHASH replies it.
+
+    Standard geohashes span latitudes -90..90 rather than the Web Mercator
+    limits used for scores, so the point is encoded again on that grid.
+    """
+    grid_latitude = int((latitude + 90) / 180 * 2**26)
+    grid_longitude = int((longitude + 180) / 360 * 2**26)
+    bits = interleave(grid_latitude, grid_longitude)
+    # 52 bits fill ten characters; the eleventh is always "0"
+    return "".join(
+        GEOHASH_ALPHABET[(bits >> (52 - (i + 1) * 5)) & 0x1F] for i in range(10)
+    ) + "0"
+
+
 def interleave(x: int, y: int) -> int:
     x = spread_int32_to_int64(x)
     y = spread_int32_to_int64(y)
@@ -36,4 +60,28 @@ def spread_int32_to_int64(v: int) -> int:
     v = (v | (v << 2)) & 0x3333333333333333
     v = (v | (v << 1)) & 0x5555555555555555
 
-    return v
\ No newline at end of file
+    return v
+
+
+def encode_many(latitudes: Sequence[float], longitudes: Sequence[float]) -> List[int]:
+    """encode() over equal-length sequences of coordinates"""
+    if np is None:
+        return [encode(lat, lon) for lat, lon in zip(latitudes, longitudes)]
+    lat = np.asarray(latitudes, dtype=np.float64)
+    lon = np.asarray(longitudes, dtype=np.float64)
+    # Same expression as encode() so the truncated grid numbers are identical
+    grid_lat = (2**26 * (lat - MIN_LATITUDE) / LATITUDE_RANGE).astype(np.uint64)
+    grid_lon = (2**26 * (lon - MIN_LONGITUDE) / LONGITUDE_RANGE).astype(np.uint64)
+    return (_spread_many(grid_lat) | (_spread_many(grid_lon) << np.uint64(1))).tolist()
+
+
+def _spread_many(v):
+    v = v & np.uint64(0xFFFFFFFF)
+
+    v = (v | (v << np.uint64(16))) & np.uint64(0x0000FFFF0000FFFF)
+    v = (v | (v << np.uint64(8))) & np.uint64(0x00FF00FF00FF00FF)
+    v = (v | (v << np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    v = (v | (v << np.uint64(2))) & np.uint64(0x3333333333333333)
+    v = (v | (v << np.uint64(1))) & np.uint64(0x5555555555555555)
+
+    return v
@@ -0,0 +1,177 @@
+"""Single-threaded event loop built on ``selectors``.
+
+Sockets are non-blocking and registered with one selector; blocking
+commands, replication links and WAIT become timers and callbacks on the
+loop instead of threads. Replies are appended to a per-connection output
+buffer and flushed before the loop goes back to sleep.
+"""
+import heapq
+import itertools
+import selectors
+import socket
+import time
+from collections import deque
+from typing import Any, Callable, Deque, List, Optional, Set
+
+from app.stats import Stats
+
+
+class TimerHandle:
+    def __init__(self, when: float, seq: int, callback: Callable, args: tuple):
+        self.when = when
+        self.seq = seq
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __lt__(self, other: "TimerHandle") -> bool:
+        return (self.when, self.seq) < (other.when, other.seq)
+
+
+class Connection:
+    """A non-blocking client socket with a buffered send"""
+
+    def __init__(self, loop: "EventLoop", sock: socket.socket, stats: Optional[Stats] = None):
+        self.loop = loop
+        self.sock = sock
+        self.stats = stats
+        self.out = bytearray()
+        self.closed = False
+
+    def fileno(self) -> int:
+        return self.sock.fileno()
+
+    def getpeername(self):
+        return self.sock.getpeername()
+
+    def send(self, data: bytes) -> int:
+        if not self.closed:
+            self.out += data
+            self.loop.pending_writes.add(self)
+        return len(data)
+
+    def flush(self):
+        """Write as much of the output buffer as the socket accepts"""
+        if self.closed or not self.out:
+            return
+        try:
+            n = self.sock.send(self.out)
+        except BlockingIOError:
+            n = 0
+        except OSError:
+            self.close()
+            return
+        del self.out[:n]
+        if self.stats is not None:
+            self.stats.total_net_output_bytes += n
+        if self.out:
+            self.loop.add_writer(self.sock, self.flush)
+        else:
+            self.loop.remove_writer(self.sock)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.loop.unregister(self.sock)
+        self.sock.close()
+
+
+class EventLoop:
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.timers: List[TimerHandle] = []
+        self.ready: Deque[TimerHandle] = deque()
+        self.pending_writes: Set[Connection] = set()
+        self.before_sleep_hooks: List[Callable[[], None]] = []
+        self._seq = itertools.count()
+
+    def call_at(self, when: float, callback: Callable, *args: Any) -> TimerHandle:
+        handle = TimerHandle(when, next(self._seq), callback, args)
+        heapq.heappush(self.timers, handle)
+        return handle
+
+    def call_later(self, delay: float, callback: Callable, *args: Any) -> TimerHandle:
+        return self.call_at(time.monotonic() + delay, callback, *args)
+
+    def call_soon(self, callback: Callable, *args: Any) -> TimerHandle:
+        handle = TimerHandle(0, next(self._seq), callback, args)
+        self.ready.append(handle)
+        return handle
+
+    def _set_callbacks(self, sock: socket.socket, reader: Optional[Callable], writer: Optional[Callable]):
+        events = (selectors.EVENT_READ if reader else 0) | (selectors.EVENT_WRITE if writer else 0)
+        try:
+            key = self.selector.get_key(sock)
+        except KeyError:
+            if events:
+                self.selector.register(sock, events, (reader, writer))
+            return
+        if events:
+            self.selector.modify(sock, events, (reader, writer))
+        else:
+            self.selector.unregister(sock)
+
+    def _callbacks(self, sock: socket.socket):
+        try:
+            return self.selector.get_key(sock).data
+        except KeyError:
+            return None, None
+
+    def add_reader(self, sock: socket.socket, callback: Callable):
+        self._set_callbacks(sock, callback, self._callbacks(sock)[1])
+
+    def remove_reader(self, sock: socket.socket):
+        self._set_callbacks(sock, None, self._callbacks(sock)[1])
+
+    def add_writer(self, sock: socket.socket, callback: Callable):
+        self._set_callbacks(sock, self._callbacks(sock)[0], callback)
+
+    def remove_writer(self, sock: socket.socket):
+        if self._callbacks(sock)[1] is not None:
+            self._set_callbacks(sock, self._callbacks(sock)[0], None)
+
+    def unregister(self, sock: socket.socket):
+        try:
+            self.selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+
+    def _before_sleep(self):
+        for hook in self.before_sleep_hooks:
+            hook()
+        while self.pending_writes:
+            self.pending_writes.pop().flush()
+
+    def _timeout(self) -> Optional[float]:
+        if self.ready:
+            return 0
+        while self.timers and self.timers[0].cancelled:
+            heapq.heappop(self.timers)
+        if not self.timers:
+            return None
+        return max(0.0, self.timers[0].when - time.monotonic())
+
+    def run_once(self):
+        self._before_sleep()
+        for key, mask in self.selector.select(self._timeout()):
+            reader, writer = key.data
+            if mask & selectors.EVENT_READ and reader is not None:
+                reader()
+            if mask & selectors.EVENT_WRITE and writer is not None:
+                writer()
+
+        now = time.monotonic()
+        while self.timers and self.timers[0].when <= now:
+            self.ready.append(heapq.heappop(self.timers))
+        for _ in range(len(self.ready)):
+            handle = self.ready.popleft()
+            if not handle.cancelled:
+                handle.callback(*handle.args)
+
+    def run_forever(self):
+        while True:
+            self.run_once()
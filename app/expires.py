@@ -0,0 +1,114 @@
+"""Key expiry: a monotonic millisecond clock and the expires index.
+
+Expiry times are absolute Unix times in milliseconds, as Redis keeps them,
+but "now" is time.monotonic_ns() anchored to the wall clock once at startup,
+so a wall-clock jump neither expires keys early nor keeps them alive.
+
+Keys are expired lazily when a command touches them, and actively by
+active_expire_cycle(), which like Redis' activeExpireCycle samples a few
+keys with a TTL at a time, deletes the expired ones, and goes on only while
+the samples keep turning up expired keys and the cycle's CPU budget lasts.
+"""
+import random
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+# Sample size per round, and the share of expired keys in a sample (in %)
+# below which the cycle assumes the rest of the index is mostly live
+ACTIVE_EXPIRE_CYCLE_KEYS = 20
+ACTIVE_EXPIRE_CYCLE_STALE = 10
+# A cycle runs every PERIOD seconds and may use up to BUDGET seconds of CPU
+ACTIVE_EXPIRE_CYCLE_PERIOD = 0.1
+ACTIVE_EXPIRE_CYCLE_BUDGET = 0.025
+
+_EPOCH_OFFSET_MS = time.time_ns() // 1_000_000 - time.monotonic_ns() // 1_000_000
+
+
+def mstime() -> int:
+    """Unix time in milliseconds that never goes backwards"""
+    return _EPOCH_OFFSET_MS + time.monotonic_ns() // 1_000_000
+
+
+class SampledKeys:
+    """A set of keys that can hand out a random sample in O(sample size)"""
+
+    def __init__(self):
+        self.keys: List[Any] = []
+        self.positions: Dict[Any, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def add(self, key):
+        if key not in self.positions:
+            self.positions[key] = len(self.keys)
+            self.keys.append(key)
+
+    def discard(self, key):
+        position = self.positions.pop(key, None)
+        if position is None:
+            return
+        # Move the last key into the hole so the key list stays dense
+        last = self.keys.pop()
+        if last != key:
+            self.keys[position] = last
+            self.positions[last] = position
+
+    def sample(self, count: int) -> List[Any]:
+        return random.sample(self.keys, min(count, len(self.keys)))
+
+
+class ExpireIndex:
+    """key -> expiry time in ms, with O(1) updates and random sampling"""
+
+    def __init__(self):
+        self.when: Dict[Any, int] = {}
+        self.sampled = SampledKeys()
+
+    def __len__(self) -> int:
+        return len(self.when)
+
+    def __contains__(self, key) -> bool:
+        return key in self.when
+
+    def get(self, key) -> Optional[int]:
+        return self.when.get(key)
+
+    def set(self, key, when: int):
+        self.when[key] = when
+        self.sampled.add(key)
+
+    def remove(self, key) -> bool:
+        if self.when.pop(key, None) is None:
+            return False
+        self.sampled.discard(key)
+        return True
+
+    def is_expired(self, key, now: int) -> bool:
+        when = self.when.get(key)
+        return when is not None and when <= now
+
+    def sample(self, count: int) -> List[Any]:
+        return self.sampled.sample(count)
+
+
+def active_expire_cycle(
+    index: ExpireIndex,
+    expire: Callable[[Any], None],
+    budget: float = ACTIVE_EXPIRE_CYCLE_BUDGET,
+) -> int:
+    """Delete sampled expired keys through expire(); returns how many went"""
+    start = time.thread_time()
+    total = 0
+    while len(index):
+        now = mstime()
+        sample = index.sample(ACTIVE_EXPIRE_CYCLE_KEYS)
+        expired = [key for key in sample if index.is_expired(key, now)]
+        for key in expired:
+            expire(key)
+        total += len(expired)
+        if len(expired) * 100 <= len(sample) * ACTIVE_EXPIRE_CYCLE_STALE:
+            break
+        if time.thread_time() - start >= budget:
+            break
+    return total
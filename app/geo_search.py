@@ -0,0 +1,242 @@
+"""Radius and box searches over a geo sorted set.
+
+Members of a geo key are stored with their 52-bit interleaved geohash as the
+score, so every geohash cell is one contiguous score range of the sorted set.
+A search picks the cell size from the search radius (the same estimate Redis
+uses), takes the cell holding the center plus its eight neighbours, drops the
+neighbours that cannot touch the search area, and only decodes and measures
+the members whose scores fall inside those nine ranges.
+"""
+import dataclasses
+import functools
+import heapq
+from math import cos, degrees, radians
+from typing import Iterator, List, Optional, Tuple
+
+from app import decode_geo, encode_geo
+from app.haversine import EARTH_RADIUS_METERS, haversine, haversine_many
+from app.sorted_set import ScoreRange, SortedSet
+
+GEO_STEP_MAX = 26  # 26 bits per coordinate, 52 bits per score
+MERCATOR_MAX = 20037726.37
+# Candidate count from which decoding and measuring switch to the batch
+# helpers; below it building the arrays costs more than it saves
+BATCH_MIN = 64
+# Decoded coordinates of recently used scores
+COORDINATE_CACHE_SIZE = 4096
+
+UNITS = {
+    b"m": 1.0,
+    b"km": 1000.0,
+    b"ft": 0.3048,
+    b"mi": 1609.34,
+}
+
+
+@dataclasses.dataclass
+class GeoShape:
+    """Search area around (longitude, latitude); sizes are in meters"""
+    longitude: float
+    latitude: float
+    radius: float = 0.0
+    width: float = 0.0
+    height: float = 0.0
+    by_box: bool = False
+
+    def half_extents(self) -> Tuple[float, float]:
+        if self.by_box:
+            return self.width / 2, self.height / 2
+        return self.radius, self.radius
+
+    def bounding_box(self) -> Tuple[float, float, float, float]:
+        """(min_lon, min_lat, max_lon, max_lat) enclosing the shape"""
+        half_width, half_height = self.half_extents()
+        lat_delta = degrees(half_height / EARTH_RADIUS_METERS)
+        if abs(self.latitude) + lat_delta >= 90:
+            # Reaching over a pole covers every longitude
+            return -180.0, self.latitude - lat_delta, 180.0, self.latitude + lat_delta
+        lon_delta_top = degrees(
+            half_width / EARTH_RADIUS_METERS / cos(radians(self.latitude + lat_delta))
+        )
+        lon_delta_bottom = degrees(
+            half_width / EARTH_RADIUS_METERS / cos(radians(self.latitude - lat_delta))
+        )
+        # The poleward edge spans the most degrees of longitude
+        lon_delta = min(180.0, lon_delta_bottom if self.latitude < 0 else lon_delta_top)
+        return (
+            self.longitude - lon_delta,
+            self.latitude - lat_delta,
+            self.longitude + lon_delta,
+            self.latitude + lat_delta,
+        )
+
+    def distance_if_inside(self, longitude: float, latitude: float) -> Optional[float]:
+        """Distance from the center in meters, or None outside the shape"""
+        if not self.by_box:
+            distance = haversine(self.latitude, self.longitude, latitude, longitude)
+            return distance if distance <= self.radius else None
+        # Latitude distance is the cheap test, so it goes first
+        lat_distance = EARTH_RADIUS_METERS * abs(radians(latitude) - radians(self.latitude))
+        if lat_distance > self.height / 2:
+            return None
+        if haversine(latitude, self.longitude, latitude, longitude) > self.width / 2:
+            return None
+        return haversine(self.latitude, self.longitude, latitude, longitude)
+
+    def distances_if_inside(
+        self, longitudes: List[float], latitudes: List[float]
+    ) -> List[Optional[float]]:
+        """distance_if_inside() over many points at once"""
+        distances = haversine_many(self.latitude, self.longitude, latitudes, longitudes)
+        if not self.by_box:
+            return [distance if distance <= self.radius else None for distance in distances]
+        half_height = self.height / 2
+        half_width = self.width / 2
+        center_lat = radians(self.latitude)
+        lon_distances = haversine_many(latitudes, self.longitude, latitudes, longitudes)
+        return [
+            distance
+            if EARTH_RADIUS_METERS * abs(radians(latitude) - center_lat) <= half_height
+            and lon_distance <= half_width
+            else None
+            for distance, lon_distance, latitude in zip(distances, lon_distances, latitudes)
+        ]
+
+
+def estimate_step(range_meters: float, latitude: float) -> int:
+    """Geohash precision whose cells are about as large as range_meters"""
+    if range_meters == 0:
+        return GEO_STEP_MAX
+    step = 1
+    while range_meters < MERCATOR_MAX:
+        range_meters *= 2
+        step += 1
+    step -= 2  # make sure the range is included in most of the base cases
+    # Cells get narrower towards the poles
+    if latitude > 66 or latitude < -66:
+        step -= 1
+        if latitude > 80 or latitude < -80:
+            step -= 1
+    return max(1, min(GEO_STEP_MAX, step))
+
+
+def cell_bounds(lat_index: int, lon_index: int, step: int) -> Tuple[float, float, float, float]:
+    """(min_lon, min_lat, max_lon, max_lat) of a cell at the given step"""
+    cells = 1 << step
+    return (
+        encode_geo.MIN_LONGITUDE + encode_geo.LONGITUDE_RANGE * lon_index / cells,
+        encode_geo.MIN_LATITUDE + encode_geo.LATITUDE_RANGE * lat_index / cells,
+        encode_geo.MIN_LONGITUDE + encode_geo.LONGITUDE_RANGE * (lon_index + 1) / cells,
+        encode_geo.MIN_LATITUDE + encode_geo.LATITUDE_RANGE * (lat_index + 1) / cells,
+    )
+
+
+def covering_ranges(shape: GeoShape) -> List[Tuple[int, int]]:
+    """Half-open score ranges [low, high) that hold every member in shape"""
+    min_lon, min_lat, max_lon, max_lat = shape.bounding_box()
+    min_lat = max(min_lat, encode_geo.MIN_LATITUDE)
+    max_lat = min(max_lat, encode_geo.MAX_LATITUDE)
+    step = estimate_step(max(shape.half_extents()), shape.latitude)
+    center = encode_geo.encode(shape.latitude, shape.longitude)
+
+    while True:
+        cell = center >> (2 * (GEO_STEP_MAX - step))
+        lat_index = decode_geo.compact_int64_to_int32(cell)
+        lon_index = decode_geo.compact_int64_to_int32(cell >> 1)
+        # The 3x3 block must reach the bounding box on every side, otherwise
+        # members just outside the neighbours would be missed
+        west, south, _, _ = cell_bounds(lat_index - 1, lon_index - 1, step)
+        _, _, east, north = cell_bounds(lat_index + 1, lon_index + 1, step)
+        if step == 1 or (west <= min_lon and south <= min_lat
+                         and east >= max_lon and north >= max_lat):
+            break
+        step -= 1
+
+    cells = 1 << step
+    shift = 2 * (GEO_STEP_MAX - step)
+    ranges = set()
+    for d_lat in (-1, 0, 1):
+        neighbour_lat = lat_index + d_lat
+        if not 0 <= neighbour_lat < cells:
+            continue
+        for d_lon in (-1, 0, 1):
+            neighbour_lon = (lon_index + d_lon) % cells
+            if step >= 2 and (d_lat or d_lon):
+                west, south, east, north = cell_bounds(neighbour_lat, lon_index + d_lon, step)
+                if north < min_lat or south > max_lat or east < min_lon or west > max_lon:
+                    continue
+            neighbour = encode_geo.interleave(neighbour_lat, neighbour_lon)
+            ranges.add((neighbour << shift, (neighbour + 1) << shift))
+    return sorted(ranges)
+
+
+@functools.lru_cache(maxsize=COORDINATE_CACHE_SIZE)
+def decode_score(score: float) -> Tuple[float, float]:
+    """decode_geo.decode() of a stored score, cached for hot members"""
+    return decode_geo.decode(int(score))
+
+
+def decode_scores(scores: List[float]) -> List[Tuple[float, float]]:
+    """(longitude, latitude) of each score, batched when there are many"""
+    if len(scores) >= BATCH_MIN:
+        # Large scans go around the cache instead of flushing it
+        return decode_geo.decode_many(scores)
+    return [decode_score(score) for score in scores]
+
+
+def candidates(zset: SortedSet, shape: GeoShape) -> Iterator[Tuple[bytes, float]]:
+    for low, high in covering_ranges(shape):
+        yield from zset.range_by_score(ScoreRange(low, high, maxex=True))
+
+
+def search(
+    zset: SortedSet,
+    shape: GeoShape,
+    count: int = 0,
+    any_match: bool = False,
+    descending: Optional[bool] = None,
+) -> List[Tuple[bytes, float, float]]:
+    """(member, distance in meters, score) of the members inside shape.
+
+    count keeps the count nearest (or farthest when descending) with a
+    bounded heap; with any_match the scan stops after the first count hits
+    instead. descending=None leaves the matches in index order, except that
+    a plain count is nearest first: the nearest count only mean something
+    once sorted.
+    """
+    if count and not any_match and descending is None:
+        descending = False
+    matches = []
+    if any_match:
+        for member, score in candidates(zset, shape):
+            longitude, latitude = decode_score(score)
+            distance = shape.distance_if_inside(longitude, latitude)
+            if distance is not None:
+                matches.append((member, distance, score))
+                if len(matches) == count:
+                    break
+    else:
+        found = list(candidates(zset, shape))
+        if len(found) >= BATCH_MIN:
+            coordinates = decode_scores([score for _, score in found])
+            distances = shape.distances_if_inside(
+                [longitude for longitude, _ in coordinates],
+                [latitude for _, latitude in coordinates],
+            )
+        else:
+            distances = [
+                shape.distance_if_inside(*decode_score(score)) for _, score in found
+            ]
+        matches = [
+            (member, distance, score)
+            for (member, score), distance in zip(found, distances)
+            if distance is not None
+        ]
+
+    if count and not any_match and count < len(matches):
+        select = heapq.nlargest if descending else heapq.nsmallest
+        return select(count, matches, key=lambda match: match[1])
+    if descending is not None:
+        matches.sort(key=lambda match: match[1], reverse=descending)
+    return matches
+
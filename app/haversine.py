@@ -1,4 +1,11 @@
+from itertools import repeat
 from math import radians, sin, cos, asin, sqrt
+from typing import List, Sequence, Union
+
+try:
+    import numpy as np
+except ImportError:  # optional: haversine_many falls back to a plain loop
+    np = None
 
 EARTH_RADIUS_METERS = 6372797.560856
 def haversine(lat1, lon1, lat2, lon2):
@@ -22,4 +29,45 @@ def haversine(lat1, lon1, lat2, lon2):
     # Calculate distance
     distance = EARTH_RADIUS_METERS * c
 
-    return distance
\ No newline at end of file
+    return distance
+
+
+def haversine_many(
+    lat: Union[float, Sequence[float]],
+    lon: Union[float, Sequence[float]],
+    lats: Sequence[float],
+    lons: Sequence[float],
+) -> List[float]:
+    """Distances in meters from (lat, lon) to every (lats[i], lons[i]).
+
+    lat and lon are normally one point; sequences the length of lats are
+    accepted too and are paired element-wise.
+    """
+    if np is not None:
+        lat1_rad = np.radians(np.asarray(lat, dtype=np.float64))
+        lon1_rad = np.radians(np.asarray(lon, dtype=np.float64))
+        lat2_rad = np.radians(np.asarray(lats, dtype=np.float64))
+        lon2_rad = np.radians(np.asarray(lons, dtype=np.float64))
+        a = (
+            np.sin((lat2_rad - lat1_rad) / 2) ** 2
+            + np.cos(lat1_rad) * np.cos(lat2_rad) * np.sin((lon2_rad - lon1_rad) / 2) ** 2
+        )
+        return (EARTH_RADIUS_METERS * 2 * np.arcsin(np.sqrt(a))).tolist()
+
+    if not isinstance(lat, (int, float)) or not isinstance(lon, (int, float)):
+        lat = repeat(lat) if isinstance(lat, (int, float)) else lat
+        lon = repeat(lon) if isinstance(lon, (int, float)) else lon
+        return [haversine(*point) for point in zip(lat, lon, lats, lons)]
+    # One center: its radians and cosine are computed once
+    lat1_rad = radians(lat)
+    lon1_rad = radians(lon)
+    cos_lat1 = cos(lat1_rad)
+    distances = []
+    for lat2, lon2 in zip(lats, lons):
+        lat2_rad = radians(lat2)
+        a = (
+            sin((lat2_rad - lat1_rad) / 2) ** 2
+            + cos_lat1 * cos(lat2_rad) * sin((radians(lon2) - lon1_rad) / 2) ** 2
+        )
+        distances.append(EARTH_RADIUS_METERS * 2 * asin(sqrt(a)))
+    return distances
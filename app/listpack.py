@@ -0,0 +1,129 @@
+"""Listpack encoding, the compact list format RDB files use inside lists,
+streams and small collections.
+
+A listpack is a 6-byte header (total bytes, element count), the elements,
+and a 0xFF terminator. Each element is its encoding byte(s), its data, and
+a backwards length so the list can be walked from either end. Integers get
+the smallest of seven integer encodings; everything else is a string.
+decode() reads the same format back, whichever encodings the writer chose.
+"""
+import struct
+from typing import Iterable, List, Union
+
+Element = Union[bytes, int]
+
+EOF = 0xFF
+UNKNOWN_COUNT = 0xFFFF
+
+
+def _backlen(length: int) -> bytes:
+    """The entry length written after an entry, 7 bits per byte"""
+    if length <= 127:
+        return bytes([length])
+    if length < 16383:
+        return bytes([length >> 7, (length & 127) | 128])
+    if length < 2097151:
+        return bytes([length >> 14, ((length >> 7) & 127) | 128, (length & 127) | 128])
+    if length < 268435455:
+        return bytes([length >> 21, ((length >> 14) & 127) | 128,
+                      ((length >> 7) & 127) | 128, (length & 127) | 128])
+    return bytes([length >> 28, ((length >> 21) & 127) | 128, ((length >> 14) & 127) | 128,
+                  ((length >> 7) & 127) | 128, (length & 127) | 128])
+
+
+def _backlen_size(length: int) -> int:
+    if length <= 127:
+        return 1
+    if length < 16383:
+        return 2
+    if length < 2097151:
+        return 3
+    if length < 268435455:
+        return 4
+    return 5
+
+
+def _encode_int(value: int) -> bytes:
+    if 0 <= value <= 127:
+        return bytes([value])
+    if -4096 <= value <= 4095:
+        value &= 0x1FFF
+        return bytes([(value >> 8) | 0xC0, value & 0xFF])
+    if -(1 << 15) <= value < (1 << 15):
+        return b"\xf1" + struct.pack("<h", value)
+    if -(1 << 23) <= value < (1 << 23):
+        return b"\xf2" + (value & 0xFFFFFF).to_bytes(3, "little")
+    if -(1 << 31) <= value < (1 << 31):
+        return b"\xf3" + struct.pack("<i", value)
+    return b"\xf4" + struct.pack("<q", value)
+
+
+def _encode_string(value: bytes) -> bytes:
+    length = len(value)
+    if length < 64:
+        return bytes([0x80 | length]) + value
+    if length < 4096:
+        return bytes([0xE0 | (length >> 8), length & 0xFF]) + value
+    return b"\xf0" + struct.pack("<I", length) + value
+
+
+def encode(elements: Iterable[Element]) -> bytes:
+    """Listpack holding elements; ints use integer encodings, bytes strings"""
+    body = bytearray()
+    count = 0
+    for element in elements:
+        entry = _encode_int(element) if isinstance(element, int) else _encode_string(element)
+        body += entry
+        body += _backlen(len(entry))
+        count += 1
+    total = 6 + len(body) + 1
+    return struct.pack("<IH", total, min(count, UNKNOWN_COUNT)) + bytes(body) + bytes([EOF])
+
+
+def decode(data: bytes) -> List[Element]:
+    """Elements of a listpack, integers as int and strings as bytes"""
+    elements: List[Element] = []
+    pos = 6
+    end = len(data)
+    while True:
+        encoding = data[pos]
+        if encoding == EOF:
+            return elements
+        if encoding < 0x80:  # 7-bit unsigned
+            value: Element = encoding
+            size = 1
+        elif encoding < 0xC0:  # string up to 63 bytes
+            length = encoding & 0x3F
+            value = data[pos + 1:pos + 1 + length]
+            size = 1 + length
+        elif encoding < 0xE0:  # 13-bit signed
+            value = ((encoding & 0x1F) << 8) | data[pos + 1]
+            if value >= 1 << 12:
+                value -= 1 << 13
+            size = 2
+        elif encoding < 0xF0:  # string up to 4095 bytes
+            length = ((encoding & 0x0F) << 8) | data[pos + 1]
+            value = data[pos + 2:pos + 2 + length]
+            size = 2 + length
+        elif encoding == 0xF0:
+            length = struct.unpack_from("<I", data, pos + 1)[0]
+            value = data[pos + 5:pos + 5 + length]
+            size = 5 + length
+        elif encoding == 0xF1:
+            value = struct.unpack_from("<h", data, pos + 1)[0]
+            size = 3
+        elif encoding == 0xF2:
+            value = int.from_bytes(data[pos + 1:pos + 4], "little", signed=True)
+            size = 4
+        elif encoding == 0xF3:
+            value = struct.unpack_from("<i", data, pos + 1)[0]
+            size = 5
+        elif encoding == 0xF4:
+            value = struct.unpack_from("<q", data, pos + 1)[0]
+            size = 9
+        else:
+            raise ValueError(f"bad listpack encoding byte {encoding:#x} at {pos}")
+        if pos + size >= end:
+            raise ValueError(f"truncated listpack entry at {pos}")
+        elements.append(value)
+        pos += size + (1 if size <= 127 else _backlen_size(size))
@@ -1,35 +1,64 @@
 import dataclasses
+import os
 import socket
 import threading
-import datetime
 import argparse
+import bisect
+import itertools
+import math
 import time
 from datetime import timedelta
-from typing import Any, Dict, Optional, List, Tuple
-
-from app import encode_geo, haversine, rdb_parser
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Optional, List, Set, Tuple
+
+from app import commands, encode_geo, geo_search, haversine, rdb_loader, rdb_parser, rdb_writer
+from app import aof as aof_module
+from app.aof import APPENDFSYNC, DEFAULT_APPENDFSYNC, AppendOnlyFile
+from app.backlog import ReplicationBacklog
+from app.commands import command
+from app.connection import ThreadedConnection
 from app import decode_geo
 from app.decode_geo import decode
-from app.rdb_parser import XADDValue
-import heapq
+from app import stream as stream_module
+from app.stream import Consumer, ConsumerGroup, Stream, StreamError, StreamID
+from app import expires as expires_module
+from app.event_loop import Connection, EventLoop, TimerHandle
+from app.maxmemory import DEFAULT_POLICY, DEFAULT_SAMPLES, POLICIES, KeyUsage, MaxMemory, format_memory, parse_memory
+from app.quicklist import QuickList
+from app.replica import OutputBufferLimit, Replica, parse_output_buffer_limit
+from app.rdb_writer import Persistence, parse_save_points
+from app.resp_parser import DEFAULT_QUERY_BUFFER_LIMIT, ProtocolError, RespParser
+from app.sorted_set import SortedSet, clamp_rank_range, format_score, parse_score_range
+from app.slowlog import DEFAULT_LOG_SLOWER_THAN, DEFAULT_MAX_LEN, Slowlog
+from app.stats import Stats, start_metrics_server
+from app.timers import TimerThread
 
-EMPTY_RDB = bytes.fromhex(
-    "524544495330303131fa0972656469732d76657205372e322e30fa0a72656469732d62697473c040fa056374696d65c26d08bc65fa08757365642d6d656dc2b0c41000fa08616f662d62617365c000fff06e3bfec0ff5aa2"
-)
 transaction_enabled = {}
 transactions = {}
-bl_pop_queue = {} # {key: [conn,...] }
+executing_transaction: Set[Any] = set() # clients inside EXEC, whose blocking commands must not block
+WRONGTYPE = "-WRONGTYPE Operation against a key holding the wrong kind of value"
+bl_pop_queue: Dict[bytes, Deque["BlockedPop"]] = {} # {key: deque([BlockedPop, ...])}, oldest first
 bl_pop_lock = threading.Lock()
-xread_block_queue = {} # {key: [{'conn': conn, 'keys': keys, 'expiry': time, 'event': threading.Event()}, ...]}
+ready_lists: Deque[bytes] = deque() # pushed-to keys whose waiters are served after the command
+xread_block_queue: Dict[bytes, List[Tuple[StreamID, int, "BlockedRead"]]] = {} # {key: [(last seen ID, seq, BlockedRead), ...]}, sorted
 xread_lock = threading.Lock()
-processed_bytes = 0
-sorted_set_dict = {} # {key: [], ...}
+ready_streams: Deque[Tuple[bytes, StreamID]] = deque() # (key, added ID) whose readers are served after the command
+# Held from a write's first change to its propagation, and by PSYNC around the
+# fork, so a full sync's snapshot never holds half of a write
+write_lock = threading.RLock()
+sorted_set_dict: Dict[bytes, SortedSet] = {} # {key: SortedSet, ...}
+expires = expires_module.ExpireIndex() # {key: unix time in ms} for keys with a TTL, db and sorted sets alike
+key_usage = KeyUsage() # estimated size and access stats of every key
+maxmemory = MaxMemory()
+persistence = Persistence()
+aof: Optional[AppendOnlyFile] = None # set with --appendonly yes
 subscribe_dict = {} # {channel: [conn, ...]}
 subscriber_dict = {} # {conn: [channel, ...]}
-replica_ack_counter = 0
-replica_ack_lock = threading.Lock()
-prev_command = ""
-subscriber_allowed_commands = [b"SUBSCRIBE", b"UNSUBSCRIBE", b"PUBLISH", b"PSUBSCRIBE", b"PUNSUBSCRIBE", b"PING", b"QUIT"]
+client_write_offsets: Dict[Any, int] = {} # {conn: replication offset just past the client's last write}
+event_loop: Optional[EventLoop] = None # set when serving with --event-loop
+timer_thread = TimerThread() # deadlines of blocked clients when serving with threads
+slowlog = Slowlog()
+stats = Stats()
 
 @dataclasses.dataclass
 class Args:
@@ -37,100 +66,33 @@ class Args:
     replicaof: Optional[str]
     dir: str
     dbfilename: str
+    query_buffer_limit: int = DEFAULT_QUERY_BUFFER_LIMIT
+    event_loop: bool = False
+    slowlog_log_slower_than: int = DEFAULT_LOG_SLOWER_THAN
+    slowlog_max_len: int = DEFAULT_MAX_LEN
+    maxclients: int = 10000
+    metrics_port: Optional[int] = None
+    maxmemory: int = 0
+    maxmemory_policy: str = DEFAULT_POLICY
+    maxmemory_samples: int = DEFAULT_SAMPLES
+    save: List[Tuple[int, int]] = dataclasses.field(default_factory=list)
+    appendonly: bool = False
+    appendfilename: str = aof_module.DEFAULT_FILENAME
+    appendfsync: str = DEFAULT_APPENDFSYNC
+    replica_output_buffer_limit: OutputBufferLimit = dataclasses.field(default_factory=OutputBufferLimit)
 
 @dataclasses.dataclass
 class NullArray:
     type: Optional[str]
 
 
-def parse_single(data: bytes):
-    """Parse a single RESP command from data"""
-    if not data:
-        raise ValueError("Not enough data")
-
-    first_byte = data[0:1]
-
-    match first_byte:
-        case b"*":
-            # Array - find the first \r\n
-            if b"\r\n" not in data:
-                raise ValueError("Not enough data")
-            first_line, remaining = data.split(b"\r\n", 1)
-            count = int(first_line[1:].decode())
-
-            value = []
-            for _ in range(count):
-                item, remaining = parse_single(remaining)
-                value.append(item)
-            return value, remaining
-
-        case b"$":
-            # Bulk string - find the first \r\n
-            if b"\r\n" not in data:
-                raise ValueError("Not enough data")
-            first_line, remaining = data.split(b"\r\n", 1)
-            length = int(first_line[1:].decode())
-
-            if length == -1:  # Null bulk string
-                return None, remaining
-            if len(remaining) < length:  # Not enough data for content
-                raise ValueError("Not enough data for bulk string")
-
-            blk = remaining[:length]
-            remaining = remaining[length:]
-
-            # Check if next 2 bytes are \r\n and consume them if present
-            if remaining.startswith(b"\r\n"):
-                remaining = remaining[2:]
-
-            return blk, remaining
-
-        case b"+":
-            # Simple string - find the first \r\n
-            if b"\r\n" not in data:
-                raise ValueError("Not enough data")
-            first_line, remaining = data.split(b"\r\n", 1)
-            return first_line[1:].decode(), remaining
-
-        case b":":
-            # Integer - find the first \r\n
-            if b"\r\n" not in data:
-                raise ValueError("Not enough data")
-            first_line, remaining = data.split(b"\r\n", 1)
-            return int(first_line[1:].decode()), remaining
-
-        case b"-":
-            # Error - find the first \r\n
-            if b"\r\n" not in data:
-                raise ValueError("Not enough data")
-            first_line, remaining = data.split(b"\r\n", 1)
-            return first_line[1:].decode(), remaining
-
-        case _:
-            raise RuntimeError(f"Parse not implemented: {first_byte}")
-
-def parse_next(data: bytes):
-    """Parse all RESP commands from data and return list of commands"""
-    print("next_data", data[:100] + b"..." if len(data) > 100 else data)
-    commands = []
-    remaining_data = data
-
-    while remaining_data:
-        if not remaining_data:
-            break
-        first_byte = remaining_data[0:1]
-        if first_byte not in [b"*", b"$", b"+", b":", b"-"]:
-            print(f"Unknown command start: {first_byte}, remaining: {remaining_data[:20]}...")
-            break
-        try:
-            command, remaining_data = parse_single(remaining_data)
-            commands.append(command)
-            # print(f"Parsed command: {command}")
-        except (ValueError, IndexError) as e:
-            print(f"Parse error: {e}, stopping parse")
-            break
-
-    return commands, remaining_data
+@dataclasses.dataclass
+class Propagated:
+    """A write's reply, with the commands replicas and the AOF get instead of
+    the command as received: none when it changed nothing, or its effect
+    spelled out when replaying the command itself could come out differently"""
+    reply: Any
+    commands: List[List[bytes]]
 
 
 def encode_resp(
@@ -167,106 +129,727 @@ db: Dict[Any, rdb_parser.Value] = {}
 @dataclasses.dataclass
 class Replication:
     master_replid: str
-    master_repl_offset: int
-    connected_replicas: List[socket.socket]
+    master_repl_offset: int # on a replica: bytes of the master's stream processed
+    connected_replicas: Dict[Any, Replica] # {conn: Replica}, in attach order
+    backlog: Optional[ReplicationBacklog] = None # created when the first replica attaches
+    master_synced: bool = False # a replica that synced once can ask for a partial resync
+    master_link_up: bool = False
+    lock: threading.Lock = dataclasses.field(default_factory=threading.Lock)
+    listening_ports: Dict[Any, int] = dataclasses.field(default_factory=dict) # {conn: port} until PSYNC
+    eof_capable: Set[Any] = dataclasses.field(default_factory=set) # sent REPLCONF capa eof, until PSYNC
+    output_buffer_limit: OutputBufferLimit = dataclasses.field(default_factory=OutputBufferLimit)
+    waiters: List["BlockedWait"] = dataclasses.field(default_factory=list) # clients parked by WAIT
+    getack_wanted: bool = False # a GETACK goes out with the next flush_replicas()
+    getack_offset: int = 0 # stream offset the last GETACK asked replicas to confirm
+    master_conn: Any = None # on a replica: the link to the master, for periodic ACKs
+    is_replica: bool = False # set with --replicaof: only the master's stream reaches our replicas
+    last_ack_sent: float = 0.0
 
 
 replication = Replication(
-    master_replid="8371b4fb1155b71f4a04d3e1bc3e18c4a990aeeb",
+    master_replid=os.urandom(20).hex(),
     master_repl_offset=0,
-    connected_replicas=[],
+    connected_replicas={},
 )
+REPLICA_RECONNECT_DELAY = 1.0
+REPLICA_ACK_PERIOD = 1.0 # replicas report their offset this often, in seconds
 
 
-def handle_conn(args: Args, conn: socket.socket, is_replica_conn: bool = False):
-    data = b""
-    global transaction_enabled, transactions, processed_bytes, prev_command
+def handle_conn(
+    args: Args,
+    conn: ThreadedConnection,
+    is_replica_conn: bool = False,
+    parser: Optional[RespParser] = None,
+):
+    if parser is None:
+        parser = RespParser(args.query_buffer_limit)
 
-    while data or (data := conn.recv(65536)):
-        # FIX: Does not differentiate between separate client and master connection
-        if is_replica_conn:
-            processed_bytes += len(data)
-        commands, data = parse_next(data)
+    try:
+        while True:
+            depth = 0
+            # Replies of one read batch leave in a single write
+            conn.cork()
+            for value, size in parser.frames():
+                process_frame(args, value, conn, is_replica_conn)
+                if is_replica_conn:
+                    # After the command, so a GETACK reports the bytes before it
+                    replication.master_repl_offset += size
+                depth += 1
+            if aof is not None:
+                # The batch's writes reach the AOF before its replies leave
+                aof.flush()
+            flush_replicas()
+            conn.uncork()
+            stats.record_read_batch(depth)
+
+            n = parser.recv_into(conn)
+            if not n:
+                return
+            stats.total_net_input_bytes += n
+    except ProtocolError as e:
+        print(f"Protocol error, closing connection: {e}")
+        conn.send(encode_resp(f"-ERR Protocol error: {e}"))
+        conn.close()
+    finally:
+        if not is_replica_conn:
+            stats.connected_clients -= 1
+        client_write_offsets.pop(conn, None)
+        drop_replica(conn)
+        # Closed first, so a push racing with this skips conn
+        conn.close()
+        unblock_client(conn)
+
+
+def process_command(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    global transaction_enabled, transactions
+    trailing_crlf = True
 
-        for value in commands:
-            trailing_crlf = True
+    if not is_command_frame(value):
+        # A command is a non-empty array of bulk strings; nothing else reaches dispatch
+        if not is_replica_conn:
+            stats.total_error_replies += 1
+            conn.send(encode_resp("-ERR Protocol error: expected a non-empty array of bulk strings"))
+        return
+    if conn not in transaction_enabled.keys():
+        transaction_enabled[conn] = False
+        transactions[conn] = []
+    cmd = commands.lookup(value[0])
+    start = time.perf_counter_ns()
+    try:
+        response = handle_command(args, value, conn, is_replica_conn, trailing_crlf)
+    except Exception as e:
+        # A failing command gets an error reply; with the event loop it would
+        # otherwise take every client down with it
+        response = f"-ERR {type(e).__name__}: {e}"
+    duration_us = (time.perf_counter_ns() - start) // 1000
+    if is_replica_conn and (cmd is None or cmd.name != b"REPLCONF"):
+        # Commands streamed from the master are applied without a reply
+        response = "custom"
+    if slowlog.is_slow(duration_us):
+        slowlog.record(value, duration_us, peer_name(conn))
+    failed = isinstance(response, str) and response.startswith("-")
+    if cmd is not None:
+        stats.record_command(cmd.name.decode().lower(), duration_us, failed)
 
-            if conn not in transaction_enabled.keys():
-                transaction_enabled[conn] = False
-                transactions[conn] = []
-            print("handle_conn, command: ", value)
-            response = handle_command(args, value, conn, is_replica_conn, trailing_crlf)
-            prev_command = value[0]
+    if response != "custom":
+        if failed:
+            stats.total_error_replies += 1
+        conn.send(encode_resp(response, trailing_crlf))
 
-            if not transaction_enabled[conn] and response !="custom":
-                encoded_resp = encode_resp(response, trailing_crlf)
-                print("Encoded_response", encoded_resp)
-                conn.send(encoded_resp)
 
+def is_command_frame(value: Any) -> bool:
+    return isinstance(value, list) and len(value) > 0 and all(isinstance(arg, bytes) for arg in value)
 
-def handle_neg_index(s: int, e: int, list_len: int):
-    if s < 0:
-        if abs(s) <= list_len:
-            s = list_len + s
-        else:
-            s = 0
-    if e < 0:
-        if abs(e) <= list_len:
-            e = list_len + e
-        else:
-            e = 0
-    if e >= list_len:
-        e = list_len - 1
 
-    if s >= list_len:
-        s = list_len - 1
+def process_frame(args: Args, value: Any, conn, is_replica_conn: bool):
+    """process_command() for one parsed frame; whatever goes wrong with it,
+    even past the handler, costs that frame an error reply and nothing more"""
+    try:
+        process_command(args, value, conn, is_replica_conn)
+    except Exception as e:
+        if not is_replica_conn:
+            stats.total_error_replies += 1
+            conn.send(encode_resp(f"-ERR {type(e).__name__}: {e}"))
 
-    return s, e
 
-def handle_blpop(k:str, t:datetime.datetime, conn: socket.socket):
-    while True:
-        if datetime.datetime.now() > t:
-            conn.send(encode_resp(None))
+def accept_client(args: Args, conn: socket.socket) -> bool:
+    """Count a new client, refusing it once maxclients are connected"""
+    stats.total_connections_received += 1
+    if stats.connected_clients >= args.maxclients:
+        stats.rejected_connections += 1
+        try:
+            conn.send(encode_resp("-ERR max number of clients reached"))
+        except OSError:
+            pass
+        conn.close()
+        return False
+    stats.connected_clients += 1
+    return True
+
+
+def peer_name(conn: socket.socket) -> bytes:
+    try:
+        peer = conn.getpeername()
+    except OSError:
+        return b""
+    if isinstance(peer, tuple):
+        return f"{peer[0]}:{peer[1]}".encode()
+    # A Unix socket's path, empty for an unbound one such as a socketpair
+    return peer.encode() if isinstance(peer, str) else peer
+
+
+def serve_event_loop(args: Args, server_socket: socket.socket):
+    """Serve every client, and the link with the master, from one thread
+    with non-blocking sockets"""
+    global event_loop
+    event_loop = EventLoop()
+    if aof is not None:
+        # Before replies are written: one AOF write (and fsync) per iteration
+        event_loop.before_sleep_hooks.append(aof.flush)
+    # One send per replica for everything propagated in an iteration
+    event_loop.before_sleep_hooks.append(flush_replicas)
+    server_cron()
+    server_socket.setblocking(False)
+
+    def register(
+        sock: socket.socket, parser: RespParser, is_replica_conn: bool, conn: Optional[Connection] = None
+    ):
+        sock.setblocking(False)
+        if conn is None:
+            conn = Connection(event_loop, sock, stats)
+
+        def on_readable():
+            try:
+                n = parser.recv_into(sock)
+            except BlockingIOError:
+                return
+            except OSError:
+                n = 0
+            if not n:
+                close()
+                return
+            stats.total_net_input_bytes += n
+            process_frames()
+
+        def process_frames():
+            depth = 0
+            try:
+                for value, size in parser.frames():
+                    process_frame(args, value, conn, is_replica_conn)
+                    if is_replica_conn:
+                        replication.master_repl_offset += size
+                    depth += 1
+            except ProtocolError as e:
+                print(f"Protocol error, closing connection: {e}")
+                conn.send(encode_resp(f"-ERR Protocol error: {e}"))
+                conn.flush()
+                close()
+            stats.record_read_batch(depth)
+
+        def close():
+            if conn.closed:
+                return
+            if is_replica_conn:
+                replication.master_link_up = False
+                replication.master_conn = None
+                event_loop.call_later(REPLICA_RECONNECT_DELAY, connect_master)
+            else:
+                stats.connected_clients -= 1
+            client_write_offsets.pop(conn, None)
+            drop_replica(conn)
+            unblock_client(conn)
+            conn.close()
+
+        if is_replica_conn:
+            replication.master_conn = conn
+        event_loop.add_reader(sock, on_readable)
+        # Frames already buffered (e.g. pipelined after the RDB payload) are
+        # served without waiting for the socket to become readable.
+        event_loop.call_soon(process_frames)
+
+    def connect_master():
+        """Connect to the master and sync with it from readable callbacks,
+        then serve the link like any other connection"""
+        (host, port) = args.replicaof.split(" ")
+        parser = RespParser(args.query_buffer_limit)
+        handshake = MasterHandshake(args, parser)
+        try:
+            family, kind, proto, _, address = socket.getaddrinfo(host, int(port), type=socket.SOCK_STREAM)[0]
+            sock = socket.socket(family, kind, proto)
+        except OSError as e:
+            print(f"Error syncing with master: {e}")
+            event_loop.call_later(REPLICA_RECONNECT_DELAY, connect_master)
             return
+        sock.setblocking(False)
+        conn = Connection(event_loop, sock, stats)
+
+        def fail(e: Exception):
+            print(f"Error syncing with master: {e}")
+            conn.close()
+            event_loop.call_later(REPLICA_RECONNECT_DELAY, connect_master)
+
+        def on_connected():
+            event_loop.remove_writer(sock)
+            error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                fail(OSError(error, os.strerror(error)))
+                return
+            conn.send(handshake.request())
+            event_loop.add_reader(sock, on_readable)
+
+        def on_readable():
+            try:
+                n = parser.recv_into(sock)
+            except BlockingIOError:
+                return
+            except OSError as e:
+                fail(e)
+                return
+            if not n:
+                fail(ConnectionError("master closed the connection during the handshake"))
+                return
+            stats.total_net_input_bytes += n
+            try:
+                for reply, _ in parser.frames():
+                    request = handshake.on_reply(reply)
+                    if request is not None:
+                        conn.send(request)
+                    if handshake.done:
+                        break
+            except MASTER_SYNC_ERRORS as e:
+                fail(e)
+                return
+            if handshake.done:
+                register(sock, parser, True, conn)
+
+        try:
+            sock.connect(address)
+        except BlockingIOError:
+            event_loop.add_writer(sock, on_connected)
+        except OSError as e:
+            fail(e)
         else:
-            with bl_pop_lock:
-                if k in db.keys() and len(db[k].value) > 0:
-                    conn = bl_pop_queue[k].pop(0)
-                    conn.send(encode_resp([k,db[k].value[0]]))
-                    db[k].value = db[k].value[1:]
-                    return
-
-def generate_sequence(key, m_second, seq) -> Tuple[int, int]:
-    global db
-
-    if m_second == "":
-        return round(time.time() * 1000), 0
-
-    if key in db.keys():
-        if db[key].value[-1].milliseconds == int(m_second):
-            if seq == "*":
-                return db[key].value[-1].milliseconds, db[key].value[-1].sequence + 1
-            return db[key].value[-1].milliseconds, int(seq)
-        else:
-            if seq != "*":
-                return int(m_second), int(seq)
-            return int(m_second), 0
+            on_connected()
+
+    def on_accept():
+        try:
+            sock, _ = server_socket.accept()
+        except BlockingIOError:
+            return
+        if accept_client(args, sock):
+            register(sock, RespParser(args.query_buffer_limit), False)
+
+    if args.replicaof is not None:
+        connect_master()
+    event_loop.add_reader(server_socket, on_accept)
+    event_loop.run_forever()
+
+
+INFO_DEFAULT_SECTIONS = ["server", "clients", "memory", "persistence", "stats", "replication", "keyspace"]
+INFO_ALL_SECTIONS = INFO_DEFAULT_SECTIONS + ["commandstats", "latencystats"]
+
+
+def build_info(args: Args, sections: List[str]) -> bytes:
+    if not sections or "default" in sections:
+        sections = INFO_DEFAULT_SECTIONS
+    elif "all" in sections or "everything" in sections:
+        sections = INFO_ALL_SECTIONS
+
+    blocks = []
+    for section in sections:
+        match section:
+            case "server":
+                lines = [
+                    "redis_version:7.2.0",
+                    f"process_id:{os.getpid()}",
+                    f"tcp_port:{args.port}",
+                    f"uptime_in_seconds:{int(time.time() - stats.start_time)}",
+                    f"io_mode:{'event-loop' if args.event_loop else 'threaded'}",
+                ]
+            case "clients":
+                lines = [
+                    f"connected_clients:{stats.connected_clients}",
+                    f"maxclients:{args.maxclients}",
+                    f"blocked_clients:{count_blocked_clients()}",
+                    f"pubsub_clients:{len(subscriber_dict)}",
+                ]
+            case "memory":
+                lines = [
+                    f"used_memory:{key_usage.used}",
+                    f"used_memory_human:{format_memory(key_usage.used)}",
+                    f"used_memory_peak:{key_usage.peak}",
+                    f"used_memory_peak_human:{format_memory(key_usage.peak)}",
+                    f"used_memory_rss:{process_rss()}",
+                    f"maxmemory:{maxmemory.limit}",
+                    f"maxmemory_human:{format_memory(maxmemory.limit)}",
+                    f"maxmemory_policy:{maxmemory.policy}",
+                    f"maxmemory_samples:{maxmemory.samples}",
+                ]
+            case "persistence":
+                lines = persistence.info_lines()
+                lines += aof.info_lines() if aof is not None else ["aof_enabled:0"]
+            case "stats":
+                lines = stats.stats_lines()
+            case "replication":
+                if args.replicaof is None:
+                    backlog = replication.backlog
+                    lines = [
+                        "role:master",
+                        f"connected_slaves:{len(replication.connected_replicas)}",
+                    ]
+                    lines += [
+                        replica.info(i)
+                        for i, replica in enumerate(list(replication.connected_replicas.values()))
+                    ]
+                    lines += [
+                        f"master_replid:{replication.master_replid}",
+                        f"master_repl_offset:{replication.master_repl_offset}",
+                        f"repl_backlog_active:{int(backlog is not None)}",
+                        f"repl_backlog_size:{backlog.size if backlog else 0}",
+                        f"repl_backlog_first_byte_offset:{backlog.start + 1 if backlog else 0}",
+                        f"repl_backlog_histlen:{backlog.histlen if backlog else 0}",
+                    ]
+                else:
+                    host, port = args.replicaof.split(" ")
+                    lines = [
+                        "role:slave",
+                        f"master_host:{host}",
+                        f"master_port:{port}",
+                        f"master_link_status:{'up' if replication.master_link_up else 'down'}",
+                        f"master_replid:{replication.master_replid}",
+                        f"master_repl_offset:{replication.master_repl_offset}",
+                        f"slave_repl_offset:{replication.master_repl_offset}",
+                    ]
+            case "commandstats":
+                lines = stats.commandstats_lines()
+            case "latencystats":
+                lines = stats.latencystats_lines()
+            case "keyspace":
+                keys = len(db) + len(sorted_set_dict)
+                lines = [f"db0:keys={keys},expires={len(expires)},avg_ttl=0"] if keys else []
+            case _:
+                continue
+        blocks.append("\r\n".join([f"# {section.capitalize()}"] + lines))
+    if not blocks:
+        return b""
+    return ("\r\n\r\n".join(blocks) + "\r\n").encode()
+
+
+def count_blocked_clients() -> int:
+    blocked = set()
+    for waiters in list(bl_pop_queue.values()):
+        blocked.update(waiter.conn for waiter in waiters)
+    for waiters in list(xread_block_queue.values()):
+        blocked.update(waiter.conn for _, _, waiter in waiters)
+    return len(blocked)
+
+
+def render_metrics() -> str:
+    return stats.prometheus({
+        "connected_clients": stats.connected_clients,
+        "blocked_clients": count_blocked_clients(),
+        "connected_slaves": len(replication.connected_replicas),
+        "db_keys": len(db) + len(sorted_set_dict),
+        "used_memory_bytes": key_usage.used,
+        "maxmemory_bytes": maxmemory.limit,
+    })
+
+
+def process_rss() -> int:
+    """Resident set size in bytes, 0 where /proc is missing"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def key_exists(k) -> bool:
+    return k in db or k in sorted_set_dict
+
+
+def delete_key(k) -> bool:
+    """Remove k whatever its type, with its TTL"""
+    existed = db.pop(k, None) is not None
+    existed = sorted_set_dict.pop(k, None) is not None or existed
+    expires.remove(k)
+    key_usage.remove(k)
+    return existed
+
+
+def track_key(k):
+    """Re-estimate the size of k after a write"""
+    existing = db.get(k)
+    key_usage.update(k, existing.value if existing is not None else sorted_set_dict.get(k))
+
+
+def evict_key(k):
+    delete_key(k)
+    stats.evicted_keys += 1
+    propagate([b"DEL", k])
+
+
+def expire_key(k):
+    """Delete k now that its TTL has passed; call with write_lock held.
+
+    Replicas and the AOF get a DEL, as from evict_key(): they must not rely
+    on expiring the key at the same moment themselves.
+    """
+    delete_key(k)
+    stats.expired_keys += 1
+    persistence.dirty += 1
+    if not replication.is_replica:
+        propagate([b"DEL", k])
+    elif aof is not None:
+        feed_append_only_file([b"DEL", k])
+
+
+def expire_if_needed(k) -> bool:
+    """Delete k if its TTL has passed; every command runs this on its keys first"""
+    if not expires.is_expired(k, expires_module.mstime()):
+        return False
+    # Reads don't hold write_lock, so a key can expire under two threads at once
+    with write_lock:
+        if not expires.is_expired(k, expires_module.mstime()):
+            return False
+        expire_key(k)
+    return True
+
+
+def server_cron():
+    """Periodic housekeeping: active expiry, background saves and save points"""
+    # With threads this runs on the timer thread, beside the clients' writes
+    with write_lock:
+        expired = expires_module.active_expire_cycle(expires, expire_key)
+    if expired and event_loop is None:
+        # No read batch ends on this thread to send the DELs on
+        if aof is not None:
+            aof.flush()
+        flush_replicas()
+    if persistence.bgsave_pid is not None:
+        check_background_save()
+    elif aof is not None and aof.rewrite_pid is not None:
+        aof.check_rewrite()
+    elif aof is not None and aof.rewrite_scheduled:
+        aof.rewrite_scheduled = False
+        rewrite_append_only_file()
+    elif persistence.save_point_due(time.time()):
+        background_save()
+    if replication.master_conn is not None:
+        send_replica_ack()
+    call_later(expires_module.ACTIVE_EXPIRE_CYCLE_PERIOD, server_cron)
+
+
+def save_snapshot() -> bool:
+    """SAVE: write the snapshot from the serving thread"""
+    try:
+        # With threads, other clients' writes wait rather than change the
+        # dataset under the writer
+        with write_lock:
+            size = rdb_writer.save(persistence.path, db, sorted_set_dict, expires)
+    except OSError as e:
+        print(f"Error saving DB on disk: {e}")
+        return False
+    persistence.saved(size, persistence.dirty)
+    return True
+
+
+def background_save() -> bool:
+    """Start a BGSAVE in a forked child; False if a child is already running"""
+    if persistence.bgsave_pid is not None or (aof is not None and aof.rewrite_pid is not None):
+        return False
+    persistence.bgsave_start = persistence.last_bgsave_try = time.time()
+    if not hasattr(os, "fork"):
+        # No fork: serialize here, only the disk write leaves the serving path
+        persistence.dirty_at_bgsave = persistence.dirty
+        persistence.last_bgsave_ok = save_snapshot()
+        persistence.last_bgsave_seconds = int(time.time() - persistence.bgsave_start)
+        return True
+    # Forked between writes, so the image holds no half-applied one
+    with write_lock:
+        persistence.dirty_at_bgsave = persistence.dirty
+        pid = os.fork()
+    if pid == 0:
+        # The child sees a copy-on-write image of the dataset at fork time
+        try:
+            rdb_writer.save(persistence.path, db, sorted_set_dict, expires)
+            code = 0
+        except BaseException:
+            code = 1
+        os._exit(code)
+    persistence.bgsave_pid = pid
+    return True
+
+
+def rewrite_append_only_file() -> bool:
+    """Start a BGREWRITEAOF; False if a child is already running"""
+    if persistence.bgsave_pid is not None:
+        return False
+    # The rewrite buffer starts and the child forks between two writes, so
+    # each write lands either in the base or in the buffer, never in both
+    with write_lock:
+        return aof.start_rewrite(lambda path: rdb_writer.save(path, db, sorted_set_dict, expires))
+
+
+def check_background_save():
+    pid, status = os.waitpid(persistence.bgsave_pid, os.WNOHANG)
+    if pid == 0:
+        return
+    persistence.bgsave_pid = None
+    persistence.last_bgsave_seconds = int(time.time() - persistence.bgsave_start)
+    persistence.last_bgsave_ok = os.waitstatus_to_exitcode(status) == 0
+    if persistence.last_bgsave_ok:
+        persistence.saved(os.path.getsize(persistence.path), persistence.dirty_at_bgsave)
+
+
+@dataclasses.dataclass(eq=False)
+class BlockedPop:
+    """A client parked by BLPOP and friends on one or more list keys"""
+    conn: Any
+    keys: List[bytes]
+    serve: Callable[[bytes], Any]  # pops from a non-empty key, returns the reply
+    target: Optional[bytes] = None  # BLMOVE destination, which serving fills
+    timer: Optional[TimerHandle] = None
+    done: bool = False
+
+
+def call_later(delay: float, callback: Callable, *args) -> TimerHandle:
+    """Run callback after delay seconds on the event loop or the timer thread"""
+    if event_loop is not None:
+        return event_loop.call_later(delay, callback, *args)
+    return timer_thread.call_later(delay, callback, *args)
+
+
+def parse_timeout(timeout: bytes) -> Optional[float]:
+    """Blocking timeout in seconds; 0 blocks forever, None means invalid"""
+    try:
+        seconds = float(timeout)
+    except ValueError:
+        return None
+    if math.isnan(seconds) or math.isinf(seconds):
+        return None
+    return seconds
+
+
+def block_for_lists(conn, keys: List[bytes], timeout: float, serve: Callable,
+                    target: Optional[bytes] = None) -> Optional[str]:
+    """Park conn until a push onto one of keys lets serve run; call with bl_pop_lock held.
+
+    Inside EXEC nothing may wait, so there the reply is nil at once, as if
+    the timeout had passed.
+    """
+    if conn in executing_transaction:
+        return None
+    blocked = BlockedPop(conn, keys, serve, target)
+    for k in keys:
+        bl_pop_queue.setdefault(k, deque()).append(blocked)
+    if timeout:
+        blocked.timer = call_later(timeout, expire_blocked_pop, blocked)
+    return "custom"
+
+
+def unblock_pop(blocked: BlockedPop):
+    blocked.done = True
+    if blocked.timer is not None:
+        blocked.timer.cancel()
+    for k in blocked.keys:
+        waiters = bl_pop_queue.get(k)
+        if waiters is None:
+            continue
+        try:
+            waiters.remove(blocked)
+        except ValueError:
+            pass
+        if not waiters:
+            del bl_pop_queue[k]
+
+
+def expire_blocked_pop(blocked: BlockedPop):
+    with bl_pop_lock:
+        if blocked.done:
+            return
+        unblock_pop(blocked)
+    blocked.conn.send(encode_resp(None))
+
+
+def signal_list_ready(k: bytes):
+    """Mark k for serve_blocked_list_pops() once the pushing command has propagated"""
+    with bl_pop_lock:
+        if k in bl_pop_queue:
+            ready_lists.append(k)
+
+
+def serve_blocked_list_pops():
+    """Hand pushed elements to clients blocked on the ready keys, oldest first"""
+    with bl_pop_lock:
+        while ready_lists:
+            k = ready_lists.popleft()
+            waiters = bl_pop_queue.get(k)
+            while waiters and list_length(k) > 0:
+                blocked = waiters[0]
+                unblock_pop(blocked)
+                if blocked.conn.closed:
+                    continue
+                blocked.conn.send(encode_resp(blocked.serve(k)))
+                track_key(k)
+                if blocked.target is not None:
+                    track_key(blocked.target)
+                    if blocked.target in bl_pop_queue:
+                        ready_lists.append(blocked.target)
+
+
+def unblock_client(conn):
+    """Drop whatever conn is blocked on, so nothing is served to it once it disconnects"""
+    with bl_pop_lock:
+        pops = {blocked for waiters in bl_pop_queue.values() for blocked in waiters if blocked.conn is conn}
+        for blocked in pops:
+            unblock_pop(blocked)
+    with xread_lock:
+        reads = {blocked for waiters in xread_block_queue.values() for _, _, blocked in waiters if blocked.conn is conn}
+        for blocked in reads:
+            blocked.done = True
+            if blocked.timer is not None:
+                blocked.timer.cancel()
+            unregister_read(blocked)
+    with replication.lock:
+        for blocked in replication.waiters:
+            if blocked.conn is conn:
+                blocked.done = True
+                if blocked.timer is not None:
+                    blocked.timer.cancel()
+        replication.waiters = [blocked for blocked in replication.waiters if blocked.conn is not conn]
+
+
+def lookup_list(k: bytes):
+    """List stored at k, None when missing, or the WRONGTYPE error reply"""
+    existing = db.get(k)
+    if existing is None:
+        return WRONGTYPE if k in sorted_set_dict else None
+    if not isinstance(existing.value, QuickList):
+        return WRONGTYPE
+    return existing.value
+
+
+def wrong_list_type(keys: List[bytes]) -> Optional[str]:
+    for k in keys:
+        if lookup_list(k) is WRONGTYPE:
+            return WRONGTYPE
+    return None
+
+
+def list_length(k: bytes) -> int:
+    existing = db.get(k)
+    if existing is None or not isinstance(existing.value, QuickList):
+        return 0
+    return len(existing.value)
+
+
+def list_pop(k: bytes, left: bool = True, count: int = 1) -> List[bytes]:
+    """Pop up to count elements from one end; the key goes once the list is empty"""
+    items = db[k].value
+    pop = items.pop_left if left else items.pop_right
+    popped = [pop() for _ in range(min(count, len(items)))]
+    if not items:
+        delete_key(k)
+    return popped
+
+
+def list_push(k: bytes, elements: List[bytes], left: bool) -> int:
+    existing = db.get(k)
+    if existing is None:
+        existing = db[k] = rdb_parser.Value(value=QuickList())
+    if left:
+        existing.value.extend_left(elements)
     else:
-        if m_second == "0":
-            if seq != "*":
-                return int(m_second), int(seq)
-            return 0, 1
-        if seq != "*":
-            return int(m_second), int(seq)
-        return int(m_second), 0
-
-def handle_subscriber_command(value: List, conn: socket.socket):
-    global subscriber_dict, subscriber_allowed_commands
-    response = "custom"
-    if conn in subscriber_dict:
-        if value[0] not in subscriber_allowed_commands:
-            response = f"-ERR Can't execute '{value[0].decode()}' in subscribed mode"
-    return response
+        existing.value.extend_right(elements)
+    return len(existing.value)
+
+
+def list_move(source: bytes, destination: bytes, wherefrom: bytes, whereto: bytes) -> bytes:
+    element = list_pop(source, wherefrom == b"LEFT")[0]
+    list_push(destination, [element], whereto == b"LEFT")
+    return element
+
 
 def validate_latitude_longitude(latitude: str, longitude: str) -> bool:
     if float(latitude) > 85.05112878 or float(latitude) < -85.05112878:
@@ -275,6 +858,71 @@ def validate_latitude_longitude(latitude: str, longitude: str) -> bool:
         return False
     return True
 
+def propagate(command: List):
+    """Send a write command to every connected replica and the AOF"""
+    encoded = encode_resp(command)
+    replicate(encoded)
+    if aof is not None:
+        feed_append_only_file(command, encoded)
+
+
+def replicate(encoded: bytes):
+    """Append to the replication stream: the backlog and every replica's
+    queue, which flush_replicas() hands to the sockets"""
+    with replication.lock:
+        if replication.backlog is not None:
+            replication.backlog.append(encoded)
+            replication.master_repl_offset = replication.backlog.end
+        if not replication.connected_replicas:
+            return
+        now = time.monotonic()
+        for conn, replica in list(replication.connected_replicas.items()):
+            replica.feed(encoded)
+            if replica.over_limit(replication.output_buffer_limit, now):
+                print(f"Replica {peer_name(conn).decode()} scheduled to be closed for overcoming of output buffer limits")
+                del replication.connected_replicas[conn]
+                replica.disconnect()
+
+
+def flush_replicas():
+    with replication.lock:
+        getack, replication.getack_wanted = replication.getack_wanted, False
+        if getack:
+            replication.getack_offset = replication.master_repl_offset
+    if getack:
+        # One GETACK for every WAIT since the last flush. Through the
+        # stream, so replicas count it in their offsets like the master
+        replicate(encode_resp([b"REPLCONF", b"GETACK", b"*"]))
+    with replication.lock:
+        for replica in replication.connected_replicas.values():
+            replica.flush()
+
+
+def send_replica_ack():
+    """On a replica: report the processed offset to the master every
+    REPLICA_ACK_PERIOD, so its WAITs rarely need a GETACK round trip"""
+    now = time.monotonic()
+    if now - replication.last_ack_sent < REPLICA_ACK_PERIOD or not replication.master_link_up:
+        return
+    replication.last_ack_sent = now
+    conn = replication.master_conn
+    if conn is not None:
+        conn.send(encode_resp([b"REPLCONF", b"ACK", str(replication.master_repl_offset).encode()]))
+
+
+def drop_replica(conn):
+    with replication.lock:
+        replication.listening_ports.pop(conn, None)
+        replication.eof_capable.discard(conn)
+        replica = replication.connected_replicas.pop(conn, None)
+    if replica is not None:
+        replica.stop()
+
+
+def feed_append_only_file(command: List, encoded: Optional[bytes] = None):
+    logged = aof_module.absolute_expiry(command, expires.get)
+    aof.feed(encoded if logged is command and encoded is not None else encode_resp(logged))
+
 def handle_command(
     args: Args,
     value: List,
@@ -282,626 +930,1885 @@ def handle_command(
     is_replica_conn: bool = False,
     trailing_crlf: bool = True,
 ) -> bytes | str | None | List[Any]:
-    global transaction_enabled, transactions, sorted_set_dict, subscribe_dict, subscriber_dict, replica_ack_counter, replica_ack_lock
-    response = "custom"
-    print("handle_command", value, is_replica_conn)
+    cmd = commands.lookup(value[0])
+    if cmd is None:
+        name = value[0].decode(errors="replace") if isinstance(value[0], bytes) else str(value[0])
+        args_preview = " ".join(f"'{a.decode(errors='replace')}'" for a in value[1:] if isinstance(a, bytes))
+        return f"-ERR unknown command '{name}', with args beginning with: {args_preview}"
+    value[0] = cmd.name
+    if not cmd.check_arity(len(value)):
+        stats.record_rejected(cmd.name.decode().lower())
+        return f"-ERR wrong number of arguments for '{cmd.name.decode().lower()}' command"
+
+    if conn in subscriber_dict and commands.PUBSUB_ALLOWED not in cmd.flags:
+        return f"-ERR Can't execute '{cmd.name.decode().lower()}' in subscribed mode"
+
+    if transaction_enabled.get(conn) and commands.NO_MULTI not in cmd.flags:
+        transactions[conn].append(value)
+        return "QUEUED"
+
+    # Eviction propagates DELs, so any command may write once maxmemory is set
+    if cmd.is_write or maxmemory.limit:
+        with write_lock:
+            return run_command(args, cmd, value, conn, is_replica_conn)
+    return run_command(args, cmd, value, conn, is_replica_conn)
+
+
+def run_command(args: Args, cmd: commands.Command, value: List, conn: socket.socket, is_replica_conn: bool):
+    keys = cmd.keys(value)
+    if len(expires):
+        for k in keys:
+            expire_if_needed(k)
+    # Replicas leave eviction to their master, which sends the DELs
+    if maxmemory.limit and args.replicaof is None and not is_replica_conn:
+        if not maxmemory.free(key_usage, expires, evict_key) and commands.DENY_OOM in cmd.flags:
+            return "-OOM command not allowed when used memory > 'maxmemory'."
+    for k in keys:
+        key_usage.touch(k)
+    response = cmd.handler(args, value, conn, is_replica_conn)
+    propagated = [value]
+    if isinstance(response, Propagated):
+        response, propagated = response.reply, response.commands
+    if cmd.is_write:
+        for k in keys:
+            track_key(k)
+        if propagated and not (isinstance(response, str) and response.startswith("-")):
+            persistence.dirty += 1
+    if cmd.is_write and commands.BLOCKING not in cmd.flags:
+        if not (isinstance(response, str) and response.startswith("-")):
+            for propagated_command in propagated:
+                if not is_replica_conn:
+                    propagate(propagated_command)
+                elif aof is not None:
+                    feed_append_only_file(propagated_command)
+    if ready_lists or ready_streams:
+        if aof is not None and event_loop is None:
+            # Served clients are answered right away, not at the end of this
+            # connection's batch, so the push has to be logged first
+            aof.flush()
+        # After propagation, so replicas see the push before the pops it
+        # serves, and an XADD before the group reads it serves
+        serve_blocked_list_pops()
+        serve_blocked_stream_reads()
+    if cmd.is_write and not is_replica_conn:
+        # What a WAIT from this client waits for the replicas to reach
+        client_write_offsets[conn] = replication.master_repl_offset
+    return response
 
-    response = handle_subscriber_command(value, conn)
-    if response != "custom":
-        return response
-
-    match value:
-        case [b"PING"]:
-            if conn in subscriber_dict:
-                response = [b'pong',b'']
-            elif not is_replica_conn:
-                response = "PONG"
-        case [b"ECHO", s]:
-            response = s
-        case [b"GET", k]:
-            if not queue_transaction(value, conn):
-                now = datetime.datetime.now()
-                value = db.get(k)
-                if value is None:
-                    response = None
-                elif value.expiry is not None and now >= value.expiry:
-                    db.pop(k)
-                    response = None
-                else:
-                    response = value.value
-        case [b"INFO", b"replication"]:
-            if args.replicaof is None:
-                response = f"""\
-role:master
-master_replid:{replication.master_replid}
-master_repl_offset:{replication.master_repl_offset}
-""".encode()
-            else:
-                response = b"""role:slave\n"""
-        case [b"REPLCONF", b"listening-port", port]:
-            response = "OK"
-        case [b"REPLCONF", b"capa", b"psync2"]:
-            response = "OK"
-        case [b"REPLCONF", b"GETACK", b"*"]:
-            response = [b'REPLCONF', b'ACK', str(get_processed_bytes()).encode()]
-        case [b"REPLCONF", b"ACK", ack_value]:
-            with replica_ack_lock:
-                replica_ack_counter += 1
-            response = "custom"
-        case [b"PSYNC", replid, offset]:
-            response = "custom"
-            conn.send (encode_resp(
-                f"FULLRESYNC "
-                f"{replication.master_replid} " 
-                f"{replication.master_repl_offset}"
-            ))
-            conn.send(encode_resp(EMPTY_RDB, False))
-            # conn.send(b'*3\r\n$8\r\nREPLCONF\r\n$6\r\nGETACK\r\n$1\r\n*\r\n')
-            replication.connected_replicas.append(conn)
-        case [b"WAIT", min_replicas, timeout]:
-            if prev_command != b"SET":
-                response = len(replication.connected_replicas)
-            else:
-                min_replicas = int(min_replicas.decode())
-                timeout_ms = int(timeout.decode())
-                
-                for replica_conn in replication.connected_replicas:
-                    replica_conn.send(encode_resp([b"REPLCONF", b"GETACK", b"*"]))
-                
-                time.sleep(timeout_ms / 1000)
-                
-                with replica_ack_lock:
-                    ack_count = replica_ack_counter
-                    replica_ack_counter = 0
-                
-                response = ack_count
-        case [b"DISCARD"]:
-            if transaction_enabled[conn]:
-                transaction_enabled[conn] = False
-                transactions[conn] = []
-                response = "OK"
-            else:
-                response = "-ERR DISCARD without MULTI"
-        case [b"MULTI"]:
-            transaction_enabled[conn] = True
-            conn.send(encode_resp("OK"))
-        case [b"EXEC"]:
-            if not transaction_enabled[conn]:
-                response = "-ERR EXEC without MULTI"
-            else:
-                transaction_enabled[conn] = False
-                if len(transactions[conn]) == 0:
-                    return []
-                response = handle_transaction(args, conn, is_replica_conn)
-                transactions[conn] = []
-        case [b"TYPE",k]:
-            if k in db.keys():
-                if isinstance(db[k].value, list) and len(db[k].value) > 0 and isinstance(db[k].value[-1], XADDValue):
-                    response = "stream"
-                else:
-                    response = "string"
+
+@command(b"COMMAND", -1, [commands.READONLY])
+def cmd_command(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    match [v.upper() for v in value[1:2]] + value[2:]:
+        case []:
+            return [c.info() for c in commands.COMMANDS.values()]
+        case [b"COUNT"]:
+            return len(commands.COMMANDS)
+        case [b"INFO", *names]:
+            if not names:
+                return [c.info() for c in commands.COMMANDS.values()]
+            infos = []
+            for name in names:
+                c = commands.lookup(name)
+                infos.append(c.info() if c is not None else NullArray(type=None))
+            return infos
+        case [b"DOCS", *_]:
+            return []
+        case [b"GETKEYS", name, *_]:
+            c = commands.lookup(name)
+            if c is None:
+                return "-ERR Invalid command specified"
+            if not c.check_arity(len(value) - 2):
+                return "-ERR Invalid number of arguments specified for command"
+            keys = c.keys([c.name] + value[3:])
+            return keys if keys else "-ERR The command has no key arguments"
+        case _:
+            return "-ERR unknown subcommand or wrong number of arguments for 'command' command"
+
+
+@command(b"PING", -1, [commands.PUBSUB_ALLOWED])
+def cmd_ping(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    if conn in subscriber_dict:
+        return [b'pong', value[1] if len(value) > 1 else b'']
+    if len(value) > 1:
+        return value[1]
+    return "PONG"
+
+
+@command(b"ECHO", 2)
+def cmd_echo(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    return value[1]
+
+
+@command(b"GET", 2, [commands.READONLY], 1, 1, 1)
+def cmd_get(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    return lookup_string(value[1])
+
+
+@command(b"INFO", -1)
+def cmd_info(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    return build_info(args, [s.decode(errors="replace").lower() for s in value[1:]])
+
+
+@command(b"REPLCONF", -1, [commands.ADMIN, commands.NO_MULTI])
+def cmd_replconf(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    match [value[1].upper()] + value[2:] if len(value) > 1 else []:
+        case [b"LISTENING-PORT", port]:
+            if not port.isdigit():
+                return "-ERR value is not an integer or out of range"
+            with replication.lock:
+                replication.listening_ports[conn] = int(port)
+            return "OK"
+        case [b"CAPA", *capabilities]:
+            if b"eof" in [c.lower() for c in capabilities]:
+                with replication.lock:
+                    replication.eof_capable.add(conn)
+            return "OK"
+        case [b"GETACK", b"*"]:
+            return [b'REPLCONF', b'ACK', str(replication.master_repl_offset).encode()]
+        case [b"ACK", ack_value]:
+            replica = replication.connected_replicas.get(conn)
+            if replica is not None and ack_value.isdigit():
+                replica.acked(int(ack_value))
+                serve_blocked_waits()
+            return "custom"
+        case _:
+            return "-ERR Unrecognized REPLCONF option"
+
+
+@command(b"PSYNC", 3, [commands.ADMIN, commands.NO_MULTI])
+def cmd_psync(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    replid, offset = value[1].decode(errors="replace"), value[2]
+    try:
+        # The replica asks for the offset of the first byte it is missing, 1-based
+        next_offset = int(offset) - 1
+    except ValueError:
+        next_offset = -1
+    # write_lock first, as writes take it before replication.lock
+    with write_lock, replication.lock:
+        backlog = replication.backlog
+        port = replication.listening_ports.pop(conn, 0)
+        eof_capable = conn in replication.eof_capable
+        replication.eof_capable.discard(conn)
+        replica = replication.connected_replicas[conn] = Replica(conn, port, event_loop)
+        if replid == replication.master_replid and backlog is not None and backlog.covers(next_offset):
+            conn.send(encode_resp(f"CONTINUE {replication.master_replid}"))
+            conn.send(backlog.read_from(next_offset))
+            return "custom"
+        if backlog is None:
+            backlog = replication.backlog = ReplicationBacklog()
+            backlog.end = replication.master_repl_offset
+        conn.send(encode_resp(f"FULLRESYNC {replication.master_replid} {replication.master_repl_offset}"))
+        # Streamed from a child holding the dataset as of this offset; writes
+        # from here on wait in the replica's queue until it is through
+        eof_mark = os.urandom(20).hex().encode() if eof_capable else None
+        replica.start_full_sync(
+            lambda out: rdb_writer.write_sync_payload(out, db, sorted_set_dict, expires, eof_mark)
+        )
+    return "custom"
+
+
+@command(b"SAVE", 1, [commands.ADMIN, commands.NO_MULTI])
+def cmd_save(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    if persistence.bgsave_pid is not None:
+        return "-ERR Background save already in progress"
+    return "OK" if save_snapshot() else "-ERR"
+
+
+@command(b"BGSAVE", -1, [commands.ADMIN])
+def cmd_bgsave(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    if aof is not None and aof.rewrite_pid is not None:
+        return "-ERR Another child process is active (AOF?): can't BGSAVE right now"
+    if not background_save():
+        return "-ERR Background save already in progress"
+    return "Background saving started"
+
+
+@command(b"BGREWRITEAOF", 1, [commands.ADMIN, commands.NO_MULTI])
+def cmd_bgrewriteaof(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    if aof is None:
+        return "-ERR Background append only file rewriting needs appendonly yes"
+    if aof.rewrite_pid is not None:
+        return "-ERR Background append only file rewriting already in progress"
+    if persistence.bgsave_pid is not None:
+        aof.rewrite_scheduled = True
+        return "Background append only file rewriting scheduled"
+    rewrite_append_only_file()
+    return "Background append only file rewriting started"
+
+
+@command(b"LASTSAVE", 1)
+def cmd_lastsave(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    return persistence.last_save
+
+
+@command(b"WAIT", 3, [commands.NO_MULTI])
+def cmd_wait(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    if args.replicaof is not None:
+        return "-ERR WAIT cannot be used with replica instances."
+    try:
+        min_replicas = int(value[1])
+        timeout_ms = int(value[2])
+    except ValueError:
+        return "-ERR value is not an integer or out of range"
+    if timeout_ms < 0:
+        return "-ERR timeout is negative"
+    offset = client_write_offsets.get(conn, 0)
+    with replication.lock:
+        acked = count_acked_replicas(offset)
+        if acked >= min_replicas:
+            return acked
+        blocked = BlockedWait(conn, offset, min_replicas)
+        replication.waiters.append(blocked)
+        # A GETACK already on its way covers writes up to where it was sent
+        if offset > replication.getack_offset:
+            replication.getack_wanted = True
+        if timeout_ms:
+            blocked.timer = call_later(timeout_ms / 1000, expire_blocked_wait, blocked)
+    return "custom"
+
+
+@command(b"SLOWLOG", -2, [commands.ADMIN])
+def cmd_slowlog(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    match [value[1].upper()] + value[2:]:
+        case [b"GET"]:
+            return slowlog.get()
+        case [b"GET", count]:
+            try:
+                count = int(count)
+            except ValueError:
+                return "-ERR value is not an integer or out of range"
+            if count < -1:
+                return "-ERR count should be greater than or equal to -1"
+            return slowlog.get(count)
+        case [b"LEN"]:
+            return len(slowlog)
+        case [b"RESET"]:
+            slowlog.reset()
+            return "OK"
+        case _:
+            return "-ERR unknown subcommand or wrong number of arguments for 'slowlog' command"
+
+
+@command(b"MULTI", 1, [commands.NO_MULTI])
+def cmd_multi(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    if transaction_enabled[conn]:
+        return "-ERR MULTI calls can not be nested"
+    transaction_enabled[conn] = True
+    return "OK"
+
+
+@command(b"DISCARD", 1, [commands.NO_MULTI])
+def cmd_discard(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    if not transaction_enabled[conn]:
+        return "-ERR DISCARD without MULTI"
+    transaction_enabled[conn] = False
+    transactions[conn] = []
+    return "OK"
+
+
+@command(b"EXEC", 1, [commands.NO_MULTI])
+def cmd_exec(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    if not transaction_enabled[conn]:
+        return "-ERR EXEC without MULTI"
+    transaction_enabled[conn] = False
+    executing_transaction.add(conn)
+    try:
+        response = handle_transaction(args, conn, is_replica_conn)
+    finally:
+        executing_transaction.discard(conn)
+    transactions[conn] = []
+    return response
+
+
+@command(b"TYPE", 2, [commands.READONLY], 1, 1, 1)
+def cmd_type(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    k = value[1]
+    if k in db.keys():
+        if isinstance(db[k].value, Stream):
+            return "stream"
+        if isinstance(db[k].value, QuickList):
+            return "list"
+        if isinstance(db[k].value, set):
+            return "set"
+        if isinstance(db[k].value, dict):
+            return "hash"
+        return "string"
+    if k in sorted_set_dict:
+        return "zset"
+    return "none"
+
+
+@command(b"LLEN", 2, [commands.READONLY], 1, 1, 1)
+def cmd_llen(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    items = lookup_list(value[1])
+    if items is None:
+        return 0
+    if items is WRONGTYPE:
+        return items
+    return len(items)
+
+
+@command(b"LINDEX", 3, [commands.READONLY], 1, 1, 1)
+def cmd_lindex(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    try:
+        index = int(value[2])
+    except ValueError:
+        return "-ERR value is not an integer or out of range"
+    items = lookup_list(value[1])
+    if items is None or items is WRONGTYPE:
+        return items
+    try:
+        return items[index]
+    except IndexError:
+        return None
+
+
+@command(b"LSET", 4, [commands.WRITE, commands.DENY_OOM], 1, 1, 1)
+def cmd_lset(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    try:
+        index = int(value[2])
+    except ValueError:
+        return "-ERR value is not an integer or out of range"
+    items = lookup_list(value[1])
+    if items is None:
+        return "-ERR no such key"
+    if items is WRONGTYPE:
+        return items
+    try:
+        items[index] = value[3]
+    except IndexError:
+        return "-ERR index out of range"
+    return "OK"
+
+
+@command(b"LTRIM", 4, [commands.WRITE], 1, 1, 1)
+def cmd_ltrim(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    k = value[1]
+    try:
+        start, stop = int(value[2]), int(value[3])
+    except ValueError:
+        return "-ERR value is not an integer or out of range"
+    items = lookup_list(k)
+    if items is None:
+        return "OK"
+    if items is WRONGTYPE:
+        return items
+    items.trim(*clamp_rank_range(start, stop, len(items)))
+    if not items:
+        delete_key(k)
+    return "OK"
+
+
+@command(b"LINSERT", 5, [commands.WRITE, commands.DENY_OOM], 1, 1, 1)
+def cmd_linsert(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    k, where, pivot, element = value[1], value[2].upper(), value[3], value[4]
+    if where not in (b"BEFORE", b"AFTER"):
+        return "-ERR syntax error"
+    items = lookup_list(k)
+    if items is None:
+        return 0
+    if items is WRONGTYPE:
+        return items
+    position = items.index(pivot)
+    if position < 0:
+        return -1
+    items.insert(position if where == b"BEFORE" else position + 1, element)
+    return len(items)
+
+
+@command(b"LREM", 4, [commands.WRITE], 1, 1, 1)
+def cmd_lrem(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    k = value[1]
+    try:
+        count = int(value[2])
+    except ValueError:
+        return "-ERR value is not an integer or out of range"
+    items = lookup_list(k)
+    if items is None:
+        return 0
+    if items is WRONGTYPE:
+        return items
+    removed = items.remove(value[3], count)
+    if not items:
+        delete_key(k)
+    return removed
+
+
+@command(b"LPOS", -3, [commands.READONLY], 1, 1, 1)
+def cmd_lpos(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    k, element = value[1], value[2]
+    rank, count, maxlen = 1, None, 0
+    options = value[3:]
+    if len(options) % 2:
+        return "-ERR syntax error"
+    try:
+        for option, argument in zip(options[0::2], options[1::2]):
+            option = option.upper()
+            if option == b"RANK":
+                rank = int(argument)
+                if rank == 0:
+                    return ("-ERR RANK can't be zero: use 1 to start from the first match, "
+                            "2 from the second ... or use negative to start from the end of the list")
+            elif option == b"COUNT":
+                count = int(argument)
+                if count < 0:
+                    return "-ERR COUNT can't be negative"
+            elif option == b"MAXLEN":
+                maxlen = int(argument)
+                if maxlen < 0:
+                    return "-ERR MAXLEN can't be negative"
             else:
-                response = "none"
+                return "-ERR syntax error"
+    except ValueError:
+        return "-ERR value is not an integer or out of range"
+    items = lookup_list(k)
+    if items is WRONGTYPE:
+        return items
+    matches = []
+    if items is not None:
+        if rank > 0:
+            scan = enumerate(items)
+        else:
+            scan = ((len(items) - 1 - i, candidate) for i, candidate in enumerate(reversed(items)))
+        skip = abs(rank) - 1
+        for scanned, (position, candidate) in enumerate(scan):
+            if maxlen and scanned >= maxlen:
+                break
+            if candidate != element:
+                continue
+            if skip:
+                skip -= 1
+                continue
+            matches.append(position)
+            if count != 0 and len(matches) == (count or 1):
+                break
+    if count is None:
+        return matches[0] if matches else None
+    return matches
+
+
+@command(b"LPOP", -2, [commands.WRITE], 1, 1, 1)
+def cmd_lpop(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    return pop_generic(value, left=True)
+
+
+@command(b"RPOP", -2, [commands.WRITE], 1, 1, 1)
+def cmd_rpop(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    return pop_generic(value, left=False)
+
+
+@command(b"LMOVE", 5, [commands.WRITE, commands.DENY_OOM], 1, 2, 1)
+def cmd_lmove(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    source, destination, wherefrom, whereto = value[1], value[2], value[3].upper(), value[4].upper()
+    if wherefrom not in (b"LEFT", b"RIGHT") or whereto not in (b"LEFT", b"RIGHT"):
+        return "-ERR syntax error"
+    error = wrong_list_type([source, destination])
+    if error:
+        return error
+    if not list_length(source):
+        return None
+    element = list_move(source, destination, wherefrom, whereto)
+    signal_list_ready(destination)
+    return element
+
+
+@command(b"LMPOP", -4, [commands.WRITE, commands.MOVABLE_KEYS], getkeys=commands.numkeys_keys(1))
+def cmd_lmpop(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    parsed = parse_lmpop(value[1:])
+    if isinstance(parsed, str):
+        return parsed
+    keys, left, count = parsed
+    error = wrong_list_type(keys)
+    if error:
+        return error
+    for k in keys:
+        if list_length(k):
+            return [k, list_pop(k, left, count)]
+    return None
+
+
+@command(b"BLPOP", -3, [commands.WRITE, commands.BLOCKING], 1, -2, 1)
+def cmd_blpop(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    return blocking_pop_generic(value, conn, left=True)
+
+
+@command(b"BRPOP", -3, [commands.WRITE, commands.BLOCKING], 1, -2, 1)
+def cmd_brpop(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    return blocking_pop_generic(value, conn, left=False)
+
+
+@command(b"BLMOVE", 6, [commands.WRITE, commands.DENY_OOM, commands.BLOCKING], 1, 2, 1)
+def cmd_blmove(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    source, destination, wherefrom, whereto = value[1], value[2], value[3].upper(), value[4].upper()
+    if wherefrom not in (b"LEFT", b"RIGHT") or whereto not in (b"LEFT", b"RIGHT"):
+        return "-ERR syntax error"
+    return blocking_move_generic(conn, source, destination, wherefrom, whereto, value[5])
+
+
+@command(b"BRPOPLPUSH", 4, [commands.WRITE, commands.DENY_OOM, commands.BLOCKING], 1, 2, 1)
+def cmd_brpoplpush(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    return blocking_move_generic(conn, value[1], value[2], b"RIGHT", b"LEFT", value[3])
+
+
+@command(b"BLMPOP", -5, [commands.WRITE, commands.BLOCKING, commands.MOVABLE_KEYS],
+         getkeys=commands.numkeys_keys(2))
+def cmd_blmpop(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    timeout = parse_timeout(value[1])
+    if timeout is None:
+        return "-ERR timeout is not a float or out of range"
+    if timeout < 0:
+        return "-ERR timeout is negative"
+    parsed = parse_lmpop(value[2:])
+    if isinstance(parsed, str):
+        return parsed
+    keys, left, count = parsed
+    error = wrong_list_type(keys)
+    if error:
+        return error
+    direction = b"LEFT" if left else b"RIGHT"
+
+    def serve(k: bytes):
+        propagate([b"LMPOP", b"1", k, direction, b"COUNT", str(count).encode()])
+        return [k, list_pop(k, left, count)]
+
+    with bl_pop_lock:
+        for k in keys:
+            if list_length(k):
+                return serve(k)
+        return block_for_lists(conn, keys, timeout, serve)
+
+
+@command(b"LPUSH", -3, [commands.WRITE, commands.DENY_OOM], 1, 1, 1)
+def cmd_lpush(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    k, v = value[1], value[2:]
+    if lookup_list(k) is WRONGTYPE:
+        return WRONGTYPE
+    response = list_push(k, v, left=True)
+    signal_list_ready(k)
+    return response
+
+
+@command(b"RPUSH", -3, [commands.WRITE, commands.DENY_OOM], 1, 1, 1)
+def cmd_rpush(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    k, v = value[1], value[2:]
+    if lookup_list(k) is WRONGTYPE:
+        return WRONGTYPE
+    response = list_push(k, v, left=False)
+    signal_list_ready(k)
+    return response
+
 
-        case [b'LLEN',k]:
-            if k in db.keys():
-                response = len(db[k].value)
+@command(b"LRANGE", 4, [commands.READONLY], 1, 1, 1)
+def cmd_lrange(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    k = value[1]
+    try:
+        start, stop = int(value[2]), int(value[3])
+    except ValueError:
+        return "-ERR value is not an integer or out of range"
+    items = lookup_list(k)
+    if items is None:
+        return []
+    if items is WRONGTYPE:
+        return items
+    return items.range(*clamp_rank_range(start, stop, len(items)))
+
+
+@command(b"INCR", 2, [commands.WRITE, commands.DENY_OOM], 1, 1, 1)
+def cmd_incr(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    k = value[1]
+    current = lookup_string(k)
+    if current is WRONGTYPE:
+        return current
+    if current is None:
+        new_value = 1
+    else:
+        try:
+            current_int = int(current)
+            new_value = current_int + 1
+        except ValueError:
+            return "-ERR value is not an integer or out of range"
+
+    db[k] = rdb_parser.Value(value=str(new_value).encode())
+    return new_value
+
+
+@command(b"SET", -3, [commands.WRITE, commands.DENY_OOM], 1, 1, 1)
+def cmd_set(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    k, v = value[1], value[2]
+    condition = expire_option = None
+    get = keepttl = False
+    when = None
+    options = value[3:]
+    i = 0
+    try:
+        while i < len(options):
+            option = options[i].upper()
+            if option in (b"NX", b"XX") and condition in (None, option):
+                condition = option
+            elif option == b"GET":
+                get = True
+            elif option == b"KEEPTTL" and expire_option is None:
+                keepttl = True
+            elif (option in (b"EX", b"PX", b"EXAT", b"PXAT") and expire_option is None
+                  and not keepttl and i + 1 < len(options)):
+                expire_option = option
+                i += 1
+                when = int(options[i])
             else:
-                response = 0
-        case [b'LPOP', k, *v]:
-            if k in db.keys():
-                if len(db.keys()) == 0:
-                    response = None
-                else:
-                    if len(v) == 0:
-                        response = db[k].value[0]
-                        db[k].value = db[k].value[1:]
-                    else:
-                        if int(v[0]) >= len(db[k].value):
-                            response = db[k].value
-                            db[k].value = []
-                        else:
-                            response = db[k].value[:int(v[0])]
-                            db[k].value = db[k].value[int(v[0]):]
-
-        case [b'BLPOP', k, t]:
-            global bl_pop_queue
-            if k in bl_pop_queue.keys() or k not in db.keys() or (k in db.keys() and len(db[k].value) == 0):
-                if k in bl_pop_queue.keys():
-                    bl_pop_queue[k].append(conn)
-                else:
-                    bl_pop_queue[k] = [conn]
-
-                dt = datetime.datetime.now()
-                td = timedelta(seconds=float(t))
-                if float(t) == 0:
-                    td = timedelta(days=1)
-                dt = dt.__add__(td)
-                threading.Thread(
-                    target=handle_blpop,
-                    args=(k,dt,conn,),
-                ).start()
-                response = "custom"
-                # once the list is empty make sure to destory the key from dict
+                return "-ERR syntax error"
+            i += 1
+    except ValueError:
+        return "-ERR value is not an integer or out of range"
+    if expire_option is not None:
+        if when <= 0:
+            return "-ERR invalid expire time in 'set' command"
+        when = expire_at_ms(when, expire_option)
+
+    old = lookup_string(k)
+    if old is WRONGTYPE and get:
+        return old
+    exists = key_exists(k)
+    if (condition == b"NX" and exists) or (condition == b"XX" and not exists):
+        return old if get else None
+    sorted_set_dict.pop(k, None)
+    db[k] = rdb_parser.Value(value=v)
+    if when is not None:
+        expires.set(k, when)
+    elif not keepttl:
+        expires.remove(k)
+    return old if get else "OK"
+
+
+@command(b"DEL", -2, [commands.WRITE], 1, -1, 1)
+def cmd_del(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    return sum(1 for k in value[1:] if delete_key(k))
+
+
+@command(b"OBJECT", -2, [commands.READONLY])
+def cmd_object(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    # No key positions: looking a key up here must not count as an access
+    match [value[1].upper()] + value[2:]:
+        case [b"IDLETIME", k]:
+            expire_if_needed(k)
+            return key_usage.idle_seconds(k)
+        case [b"FREQ", k]:
+            expire_if_needed(k)
+            return key_usage.frequency(k)
+        case [b"HELP"]:
+            return [
+                b"OBJECT <subcommand> [<arg> [value] [opt] ...]. Subcommands are:",
+                b"FREQ <key>",
+                b"    Return the access frequency index of the key <key>.",
+                b"IDLETIME <key>",
+                b"    Return the idle time of the key <key>.",
+            ]
+        case _:
+            return f"-ERR unknown subcommand '{value[1].decode(errors='replace')}'. Try OBJECT HELP."
+
+
+@command(b"EXPIRE", -3, [commands.WRITE], 1, 1, 1)
+def cmd_expire(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    return expire_generic(value, b"EX")
+
+
+@command(b"PEXPIRE", -3, [commands.WRITE], 1, 1, 1)
+def cmd_pexpire(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    return expire_generic(value, b"PX")
+
+
+@command(b"EXPIREAT", -3, [commands.WRITE], 1, 1, 1)
+def cmd_expireat(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    return expire_generic(value, b"EXAT")
+
+
+@command(b"PEXPIREAT", -3, [commands.WRITE], 1, 1, 1)
+def cmd_pexpireat(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    return expire_generic(value, b"PXAT")
+
+
+@command(b"TTL", 2, [commands.READONLY], 1, 1, 1)
+def cmd_ttl(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    remaining = ttl_ms(value[1])
+    return remaining if remaining < 0 else (remaining + 500) // 1000
+
+
+@command(b"PTTL", 2, [commands.READONLY], 1, 1, 1)
+def cmd_pttl(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    return ttl_ms(value[1])
+
+
+@command(b"PERSIST", 2, [commands.WRITE], 1, 1, 1)
+def cmd_persist(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    return 1 if expires.remove(value[1]) else 0
+
+
+@command(b"XADD", -5, [commands.WRITE, commands.DENY_OOM], 1, 1, 1)
+def cmd_xadd(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    key = value[1]
+    nomkstream = False
+    trim = None
+    try:
+        i = 2
+        while i < len(value):
+            option = value[i].upper()
+            if option == b"NOMKSTREAM":
+                nomkstream = True
+                i += 1
+            elif option in (b"MAXLEN", b"MINID"):
+                trim, i = stream_module.parse_trim(value, i)
             else:
-                response = db[k].value[0]
-                db[k].value = db[k].value[1:]
-
-        case [b"LPUSH", k, *v]:
-            if not queue_transaction(value, conn):
-                for rep in replication.connected_replicas:
-                    rep.send(encode_resp(value))
-                if k in db.keys():
-                    v = v[::-1]
-                    v.extend(db[k].value)
-                    db[k].value = v
-                else:
-                    db[k] = rdb_parser.Value(value=v[::-1], expiry=None)
-                if not is_replica_conn:
-                    response = len(db[k].value)
-
-        case [b"RPUSH", k, *v]:
-            if not queue_transaction(value, conn):
-                for rep in replication.connected_replicas:
-                    rep.send(encode_resp(value))
-                if k in db.keys():
-                    db[k].value.extend(v)
-                else:
-                    db[k] = rdb_parser.Value(value=v, expiry=None)
-                if not is_replica_conn:
-                    response = len(db[k].value)
-        case [b"LRANGE", k, s, e]:
-            if k in db.keys():
-                int_s, int_e = handle_neg_index(int(s), int(e), len(db[k].value))
-                response = db[k].value[int_s : int_e + 1]
+                break
+        fields = value[i + 1:]
+        if not fields or len(fields) % 2:
+            return "-ERR wrong number of arguments for 'xadd' command"
+        stream = lookup_stream(key)
+        if stream is None:
+            if nomkstream:
+                return Propagated(None, [])
+            stream = Stream()
+        entry_id = stream.next_id(value[i])
+    except StreamError as e:
+        return str(e)
+
+    stream.add(entry_id, dict(zip(fields[0::2], fields[1::2])))
+    # Replicas and the AOF get the ID this made, not * or ms-* to fill in again
+    propagated = [b"XADD", key]
+    if trim is not None:
+        trim.apply(stream)
+        propagated += trim.exact_args(stream)
+    if key not in db:
+        db[key] = rdb_parser.Value(value=stream)
+
+    signal_stream_ready(key, entry_id)
+
+    formatted_id = stream_module.format_id(entry_id)
+    return Propagated(formatted_id, [propagated + [formatted_id] + fields])
+
+
+@command(b"XRANGE", -4, [commands.READONLY], 1, 1, 1)
+def cmd_xrange(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    return xrange_generic(value[1], value[2], value[3], value[4:], reverse=False)
+
+
+@command(b"XREVRANGE", -4, [commands.READONLY], 1, 1, 1)
+def cmd_xrevrange(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    return xrange_generic(value[1], value[3], value[2], value[4:], reverse=True)
+
+
+@command(b"XLEN", 2, [commands.READONLY], 1, 1, 1)
+def cmd_xlen(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    try:
+        stream = lookup_stream(value[1])
+    except StreamError as e:
+        return str(e)
+    return len(stream) if stream is not None else 0
+
+
+@command(b"XDEL", -3, [commands.WRITE], 1, 1, 1)
+def cmd_xdel(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    try:
+        entry_ids = [stream_module.parse_id(entry_id) for entry_id in value[2:]]
+        stream = lookup_stream(value[1])
+    except StreamError as e:
+        return str(e)
+    return stream.delete(entry_ids) if stream is not None else 0
+
+
+@command(b"XTRIM", -4, [commands.WRITE], 1, 1, 1)
+def cmd_xtrim(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    try:
+        if value[2].upper() not in (b"MAXLEN", b"MINID"):
+            return "-ERR syntax error"
+        trim, i = stream_module.parse_trim(value, 2)
+        if i != len(value):
+            return "-ERR syntax error"
+        stream = lookup_stream(value[1])
+    except StreamError as e:
+        return str(e)
+    if stream is None:
+        return Propagated(0, [])
+    return Propagated(trim.apply(stream), [[b"XTRIM", value[1]] + trim.exact_args(stream)])
+
+
+@command(b"XREAD", -4, [commands.READONLY, commands.BLOCKING, commands.MOVABLE_KEYS],
+         getkeys=commands.streams_keys)
+def cmd_xread(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    count = None
+    expiry_ms = None
+    i = 1
+    try:
+        while i < len(value):
+            option = value[i].upper()
+            if option == b"COUNT" and i + 1 < len(value):
+                count = int(value[i + 1])
+                count = count if count > 0 else None
+                i += 2
+            elif option == b"BLOCK" and i + 1 < len(value):
+                expiry_ms = int(value[i + 1])
+                if expiry_ms < 0:
+                    return "-ERR timeout is negative"
+                i += 2
+            elif option == b"STREAMS":
+                i += 1
+                break
             else:
-                response = []
-        case [b"INCR", k]:
-            if not queue_transaction(value, conn):
-                db_value = db.get(k)
-                if db_value is None:
-                    new_value = 1
-                else:
-                    try:
-                        current_int = int(db_value.value.decode())
-                        new_value = current_int + 1
-                    except Exception:
-                        response = "-ERR value is not an integer or out of range"
-                        return response
-
-                db[k] = rdb_parser.Value(
-                    value=str(new_value).encode(),
-                    expiry=None,
-                )
-
-                response = new_value
-        case [b"SET", k, v, b"px", expiry_ms]:
-            if not queue_transaction(value, conn):
-                for rep in replication.connected_replicas:
-                    rep.send(encode_resp(value))
-                now = datetime.datetime.now()
-                expiry_ms = datetime.timedelta(
-                    milliseconds=int(expiry_ms.decode()),
-                )
-                db[k] = rdb_parser.Value(
-                    value=v,
-                    expiry=now + expiry_ms,
-                )
-                if not is_replica_conn:
-                    response = "OK"
-        case [b"SET", k, v]:
-            if not queue_transaction(value, conn):
-                for rep in replication.connected_replicas:
-                    rep.send(encode_resp(value))
-                db[k] = rdb_parser.Value(value=v, expiry=None)
-                if not is_replica_conn:
-                    response = "OK"
+                return "-ERR syntax error"
+        else:
+            return "-ERR syntax error"
+    except ValueError:
+        return "-ERR value is not an integer or out of range"
+    key_and_sequence = value[i:]
+    if not key_and_sequence or len(key_and_sequence) % 2:
+        return "-ERR Unbalanced 'xread' list of streams: for each stream key an ID or '$' must be specified."
+    keys, ids = extract_key_and_sequence(key_and_sequence)
+    try:
+        ids = [resolve_xread_id(key, entry_id) for key, entry_id in zip(keys, ids)]
+        resp = handle_xread(keys, ids, count)
+    except StreamError as e:
+        return str(e)
+    if resp or expiry_ms is None:
+        return resp if resp else None
+    last_seen = dict(zip(keys, ids))
+    return block_stream_read(
+        conn,
+        keys,
+        serve=lambda key: handle_xread([key], [last_seen[key]], count),
+        last_seen=last_seen.__getitem__,
+        expiry_ms=expiry_ms,
+    )
 
-        case [b"XADD", key, sequence, *kv]:
-            m_second, seq = extract_msec_and_sequence(sequence.decode())
-            err_msg = invalid_sequence(key, m_second, seq)
-            if err_msg!="":
-                response = err_msg
-            else:
-                m_second, seq = generate_sequence(key,m_second, seq)
-                temp = dict()
-                for i in range(0, len(kv), 2):
-                    temp[kv[i]] = kv[i + 1]
-                xadd_value = XADDValue(
-                    value=temp, milliseconds=int(m_second), sequence=seq
-                )
-
-                values_list: List[XADDValue] = []
-                existing = db.get(key)
-                if existing is not None and isinstance(existing.value, list):
-                    values_list = existing.value  # type: ignore[assignment]
-                values_list.append(xadd_value)
-                # Need to add value instead of replacing values
-                db[key] = rdb_parser.Value(value=values_list, expiry=None)
-
-                # Notify any blocking XREAD operations for this key
-                notify_blocking_xread(key)
-
-                response = f"{m_second}-{seq}".encode()
-        case [b"XRANGE", k, start, end]:
-            if k not in db or not isinstance(db[k].value, list):
-                response = []
+
+@command(b"XGROUP", -2, [commands.WRITE], 2, 2, 1)
+def cmd_xgroup(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    subcommand = value[1].upper()
+    try:
+        match [subcommand] + value[2:]:
+            case [b"CREATE", key, group_name, entry_id, *options]:
+                mkstream = [option.upper() for option in options] == [b"MKSTREAM"]
+                if options and not mkstream:
+                    return "-ERR syntax error"
+                stream = lookup_stream(key)
+                if stream is None:
+                    if not mkstream:
+                        return ("-ERR The XGROUP subcommand requires the key to exist. Note that for "
+                                "CREATE you may want to use the MKSTREAM option to create an empty "
+                                "stream automatically.")
+                    stream = Stream()
+                    db[key] = rdb_parser.Value(value=stream)
+                if group_name in stream.groups:
+                    return "-BUSYGROUP Consumer Group name already exists"
+                last_id = stream.last_id if entry_id == b"$" else stream_module.parse_id(entry_id)
+                stream.groups[group_name] = ConsumerGroup(group_name, last_id)
+                return "OK"
+            case [b"SETID", key, group_name, entry_id]:
+                stream, group = lookup_group(key, group_name)
+                group.last_id = stream.last_id if entry_id == b"$" else stream_module.parse_id(entry_id)
+                return "OK"
+            case [b"DESTROY", key, group_name]:
+                stream = lookup_stream(key)
+                if stream is None:
+                    return "-ERR The XGROUP subcommand requires the key to exist."
+                return 1 if stream.groups.pop(group_name, None) is not None else 0
+            case [b"CREATECONSUMER", key, group_name, consumer_name]:
+                _, group = lookup_group(key, group_name)
+                if consumer_name in group.consumers:
+                    return 0
+                group.consumer(consumer_name)
+                return 1
+            case [b"DELCONSUMER", key, group_name, consumer_name]:
+                _, group = lookup_group(key, group_name)
+                return group.delete_consumer(consumer_name)
+            case [b"HELP"]:
+                return [b"XGROUP <subcommand> [<arg> [value] [opt] ...]. Subcommands are:",
+                        b"CREATE", b"SETID", b"DESTROY", b"CREATECONSUMER", b"DELCONSUMER"]
+    except StreamError as e:
+        return str(e)
+    return f"-ERR unknown subcommand or wrong number of arguments for '{value[1].decode(errors='replace')}'"
+
+
+@command(b"XREADGROUP", -7, [commands.WRITE, commands.BLOCKING, commands.MOVABLE_KEYS],
+         getkeys=commands.streams_keys)
+def cmd_xreadgroup(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    if value[1].upper() != b"GROUP":
+        return "-ERR syntax error"
+    group_name, consumer_name = value[2], value[3]
+    count = None
+    expiry_ms = None
+    noack = False
+    i = 4
+    try:
+        while i < len(value):
+            option = value[i].upper()
+            if option == b"COUNT" and i + 1 < len(value):
+                count = int(value[i + 1])
+                count = count if count > 0 else None
+                i += 2
+            elif option == b"BLOCK" and i + 1 < len(value):
+                expiry_ms = int(value[i + 1])
+                if expiry_ms < 0:
+                    return "-ERR timeout is negative"
+                i += 2
+            elif option == b"NOACK":
+                noack = True
+                i += 1
+            elif option == b"STREAMS":
+                i += 1
+                break
             else:
-                start_id = start.decode()
-                end_id = end.decode()
+                return "-ERR syntax error"
+        else:
+            return "-ERR syntax error"
+    except ValueError:
+        return "-ERR value is not an integer or out of range"
+    key_and_sequence = value[i:]
+    if not key_and_sequence or len(key_and_sequence) % 2:
+        return "-ERR Unbalanced 'xreadgroup' list of streams: for each stream key an ID or '>' must be specified."
+    keys, ids = extract_key_and_sequence(key_and_sequence)
+    try:
+        for key in keys:
+            stream = lookup_stream(key)
+            if stream is None or group_name not in stream.groups:
+                return (f"-NOGROUP No such key '{key.decode(errors='replace')}' or consumer group "
+                        f"'{group_name.decode(errors='replace')}' in XREADGROUP with GROUP option")
+        ids = [entry_id if entry_id == b">" else stream_module.parse_id(entry_id) for entry_id in ids]
+    except StreamError as e:
+        return str(e)
+
+    def read():
+        return handle_xreadgroup(keys, ids, group_name, consumer_name, count, noack)
+
+    def serve(key: bytes):
+        return handle_xreadgroup([key], [b">"], group_name, consumer_name, count, noack)
+
+    def last_seen(key: bytes) -> StreamID:
+        # Other consumers move the group forward, so this is read at each (re)registration
+        stream = lookup_stream(key)
+        group = stream.groups.get(group_name) if stream is not None else None
+        return group.last_id if group is not None else stream_module.MAX_ID
+
+    resp = read()
+    if resp or expiry_ms is None or any(entry_id != b">" for entry_id in ids):
+        return resp if resp else None
+    return block_stream_read(conn, keys, serve=serve, last_seen=last_seen, expiry_ms=expiry_ms)
+
+
+@command(b"XACK", -4, [commands.WRITE], 1, 1, 1)
+def cmd_xack(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    key, group_name = value[1], value[2]
+    try:
+        entry_ids = [stream_module.parse_id(entry_id) for entry_id in value[3:]]
+        stream = lookup_stream(key)
+    except StreamError as e:
+        return str(e)
+    group = stream.groups.get(group_name) if stream is not None else None
+    if group is None:
+        return 0
+    return sum(1 for entry_id in entry_ids if group.ack(entry_id))
+
+
+@command(b"XPENDING", -3, [commands.READONLY], 1, 1, 1)
+def cmd_xpending(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    key, group_name, options = value[1], value[2], value[3:]
+    try:
+        _, group = lookup_group(key, group_name)
+        if not options:
+            if not group.pending:
+                return [0, None, None, NullArray(type=None)]
+            per_consumer = [
+                [consumer.name, str(len(consumer.pending)).encode()]
+                for consumer in group.consumers.values()
+                if consumer.pending
+            ]
+            return [
+                len(group.pending),
+                stream_module.format_id(group.pending.ids[0]),
+                stream_module.format_id(group.pending.ids[-1]),
+                per_consumer,
+            ]
+
+        min_idle = 0
+        if options[0].upper() == b"IDLE":
+            if len(options) < 2:
+                return "-ERR syntax error"
+            min_idle = int(options[1])
+            options = options[2:]
+        if len(options) not in (3, 4):
+            return "-ERR syntax error"
+        start = stream_module.parse_range_start(options[0])
+        end = stream_module.parse_range_end(options[1])
+        count = int(options[2])
+    except StreamError as e:
+        return str(e)
+    except ValueError:
+        return "-ERR value is not an integer or out of range"
+    if count <= 0:
+        return []
+    pending_list = group.pending
+    if len(options) == 4:
+        consumer = group.consumers.get(options[3])
+        if consumer is None:
+            return []
+        pending_list = consumer.pending
+
+    now = stream_module.now_ms()
+    response = []
+    # Without IDLE the first count IDs are the answer; with it, skip busy ones
+    for entry_id in pending_list.range(start, end, None if min_idle else count):
+        pending = pending_list.get(entry_id)
+        idle = now - pending.delivery_time
+        if idle < min_idle:
+            continue
+        response.append([
+            stream_module.format_id(entry_id),
+            pending.consumer.name,
+            idle,
+            pending.delivery_count,
+        ])
+        if len(response) == count:
+            break
+    return response
 
-                if start_id == "-":
-                    start_m_second, start_seq = -1, -1
-                else:
-                    s_ms, s_seq = extract_msec_and_sequence(start_id)
-                    start_m_second, start_seq = int(s_ms), int(s_seq)
 
-                if end_id == "+":
-                    end_m_second, end_seq = 2**63 - 1, 2**31 - 1
-                else:
-                    e_ms, e_seq = extract_msec_and_sequence(end_id)
-                    end_m_second, end_seq = int(e_ms), int(e_seq)
-
-                result: List[Any] = []
-                for item in db[k].value:  # type: ignore[index]
-                    if not isinstance(item, XADDValue):
-                        continue
-                    ms = int(item.milliseconds)
-                    sq = int(item.sequence)
-                    in_lower = (ms > start_m_second) or (ms == start_m_second and sq >= start_seq)
-                    in_upper = (ms < end_m_second) or (ms == end_m_second and sq <= end_seq)
-                    if in_lower and in_upper:
-                        entry_id = f"{ms}-{sq}".encode()
-                        fields_and_values: List[Any] = []
-                        for f, v in item.value.items():
-                            fields_and_values.append(f)
-                            fields_and_values.append(v)
-                        result.append([entry_id, fields_and_values])
-                response = result
-
-        case [b"XREAD", b"streams", *key_and_sequence]:
-            response = handle_xread(key_and_sequence)
-
-        case [b"XREAD", b"block", expiry_ms, b"streams", *key_and_sequence]:
-            resp = handle_xread(key_and_sequence, blocking=True)
-            if resp and key_and_sequence[1].decode() != "$":
-                response = resp
+@command(b"XCLAIM", -6, [commands.WRITE], 1, 1, 1)
+def cmd_xclaim(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    key, group_name, consumer_name = value[1:4]
+    now = stream_module.now_ms()
+    delivery_time = now
+    retry_count = None
+    force = justid = False
+    last_id = None
+    try:
+        min_idle = int(value[4])
+        entry_ids = []
+        i = 5
+        while i < len(value):
+            try:
+                entry_ids.append(stream_module.parse_id(value[i]))
+                i += 1
+            except StreamError:
+                break
+        if not entry_ids:
+            return stream_module.ERR_INVALID_ID
+        while i < len(value):
+            option = value[i].upper()
+            if option == b"IDLE" and i + 1 < len(value):
+                delivery_time = now - int(value[i + 1])
+                i += 2
+            elif option == b"TIME" and i + 1 < len(value):
+                delivery_time = int(value[i + 1])
+                i += 2
+            elif option == b"RETRYCOUNT" and i + 1 < len(value):
+                retry_count = int(value[i + 1])
+                i += 2
+            elif option == b"FORCE":
+                force = True
+                i += 1
+            elif option == b"JUSTID":
+                justid = True
+                i += 1
+            elif option == b"LASTID" and i + 1 < len(value):
+                last_id = stream_module.parse_id(value[i + 1])
+                i += 2
             else:
-                response = "custom"
-                keys, _ = extract_key_and_sequence(key_and_sequence)
-                block_event = threading.Event()
-                expiry_ms_decode = int(expiry_ms.decode())
-                if expiry_ms_decode:
-                    expiry = (int(expiry_ms.decode()) / 1000)
-                else:
-                    expiry = None
-                with xread_lock:
-                    for key in keys:
-                        if key not in xread_block_queue:
-                            xread_block_queue[key] = []
-                        xread_block_queue[key].append({
-                            'conn': conn,
-                            'keys': key_and_sequence,
-                            'expiry': expiry,
-                            'event': block_event
-                        })
-
-                threading.Thread(
-                    target=handle_xread_block,
-                    args=(conn, key_and_sequence, expiry, block_event),
-                    daemon=True
-                ).start()
-
-        case [b"ZRANK", zset_key, zset_member]:
-            popped_elements = []
-            if zset_key in sorted_set_dict:
-                i = 0
-                while len(sorted_set_dict[zset_key]) != 0:
-                    elem = heapq.heappop(sorted_set_dict[zset_key])
-                    popped_elements.append(elem)
-                    if elem[1] == zset_member:
-                        response = i
-                        push_elements_to_sorted_set(popped_elements, sorted_set_dict, zset_key)
-                        break
-                    i += 1
-                else:
-                    push_elements_to_sorted_set(popped_elements, sorted_set_dict, zset_key)
-                    response = None
+                return "-ERR syntax error"
+        stream, group = lookup_group(key, group_name)
+    except StreamError as e:
+        return str(e)
+    except ValueError:
+        return "-ERR value is not an integer or out of range"
+
+    if last_id is not None and last_id > group.last_id:
+        group.last_id = last_id
+    consumer = group.consumer(consumer_name)
+    response = []
+    for entry_id in entry_ids:
+        claimed, _ = group.claim(
+            stream, entry_id, consumer, min_idle, delivery_time, retry_count, force, justid
+        )
+        if claimed:
+            if justid:
+                response.append(stream_module.format_id(entry_id))
             else:
-                push_elements_to_sorted_set(popped_elements, sorted_set_dict, zset_key)
-                response = None
+                response.append(stream_module.entry_reply(stream.get(entry_id)))
+    return response
 
-        case [b"ZRANGE", zset_key, start_index, end_index]:
-            if zset_key not in sorted_set_dict:
-                response = []
-            else:
-                start_index, end_index = map(int, (start_index, end_index))
-                start_index, end_index = handle_neg_index(start_index, end_index, len(sorted_set_dict[zset_key]))
 
-                if start_index > end_index:
-                    response = []
-                else:
-                    popped_elements, response = [], []
-                    for i in range(0, end_index+1):
-                        ele = heapq.heappop(sorted_set_dict[zset_key])
-                        popped_elements.append(ele)
-                        if i >= start_index:
-                            response.append(ele[-1])
-                    push_elements_to_sorted_set(
-                        popped_elements, sorted_set_dict, zset_key
-                    )
-        
-        case [b"ZCARD", zset_key]:
-            if zset_key in sorted_set_dict:
-                response = len(sorted_set_dict[zset_key])
+@command(b"XAUTOCLAIM", -6, [commands.WRITE], 1, 1, 1)
+def cmd_xautoclaim(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    key, group_name, consumer_name = value[1:4]
+    count = 100
+    justid = False
+    try:
+        min_idle = int(value[4])
+        start = stream_module.parse_range_start(value[5])
+        i = 6
+        while i < len(value):
+            option = value[i].upper()
+            if option == b"COUNT" and i + 1 < len(value):
+                count = int(value[i + 1])
+                if count < 1:
+                    return "-ERR COUNT must be > 0"
+                i += 2
+            elif option == b"JUSTID":
+                justid = True
+                i += 1
             else:
-                response = 0
-
-        case [b"ZREM", zset_key, zset_member]:
-            if zset_key in sorted_set_dict:
-                for i in range(len(sorted_set_dict[zset_key])):
-                    v, k = sorted_set_dict[zset_key][i]
-                    if k == zset_member:
-                        response = 1
-                        sorted_set_dict[zset_key].remove((v, k))
-                        heapq.heapify(sorted_set_dict[zset_key])
-                        break
-                else:
-                    response = 0
+                return "-ERR syntax error"
+        stream, group = lookup_group(key, group_name)
+    except StreamError as e:
+        return str(e)
+    except ValueError:
+        return "-ERR value is not an integer or out of range"
+
+    consumer = group.consumer(consumer_name)
+    delivery_time = stream_module.now_ms()
+    # Like Redis, scan at most ten pending entries per requested claim
+    scanned = group.pending.range(start, stream_module.MAX_ID, count * 10 + 1)
+    next_start = stream_module.MIN_ID
+    if len(scanned) > count * 10:
+        next_start = scanned.pop()
+    claimed_entries = []
+    deleted = []
+    for entry_id in scanned:
+        if len(claimed_entries) == count:
+            next_start = entry_id
+            break
+        claimed, was_deleted = group.claim(
+            stream, entry_id, consumer, min_idle, delivery_time, justid=justid
+        )
+        if was_deleted:
+            deleted.append(stream_module.format_id(entry_id))
+        elif claimed:
+            if justid:
+                claimed_entries.append(stream_module.format_id(entry_id))
             else:
-                response = None
+                claimed_entries.append(stream_module.entry_reply(stream.get(entry_id)))
+    return [stream_module.format_id(next_start), claimed_entries, deleted]
 
-        case [b"ZSCORE", zset_key, zset_member]:
-            response = calculate_zscore(sorted_set_dict, zset_key, zset_member)
-            if response == "":
-                response = None
 
-        case [b"ZADD", zset_key, value, zset_member]:
-            response = add_to_sorted_set(zset_key, value, zset_member, is_geo=False)
+@command(b"ZRANK", 3, [commands.READONLY], 1, 1, 1)
+def cmd_zrank(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    zset_key, zset_member = value[1:]
+    zset = lookup_zset(zset_key)
+    if zset is None or zset is WRONGTYPE:
+        return zset
+    return zset.rank(zset_member)
 
-        case [b"GEOADD", geo_key, longitude, latitude, member]:
-            if not validate_latitude_longitude(latitude.decode(), longitude.decode()):
-                response = f"-ERR invalid longitude,latitude pair {longitude.decode()},{latitude.decode()}"
-            else:
-                response = add_to_sorted_set(geo_key, longitude, member, is_geo=True, latitude=latitude)
-
-        case [b"GEOPOS", geo_key, *members]:
-            if geo_key in sorted_set_dict:
-                response = []
-                for member in members:
-                    for i in range(len(sorted_set_dict[geo_key])):
-                        *v, k = sorted_set_dict[geo_key][i]
-                        if k == member:
-                            if len(v) > 1:
-                                response.append([str(v[1]).encode(), str(v[0]).encode()])
-                                break
-                            else:                                
-                                response.append(
-                                    [f"{x:.12f}".rstrip("0").rstrip(".").encode()
-                                     for x in decode_geo.decode(int(v[0]))]
-                                )
-                                break
-                    else:
-                        response.append(NullArray(type=None))
-            else:
-                response = [NullArray(type=None) for _ in members]
-
-        case [b"GEODIST", geo_key, member1, member2]:
-            coord1, coord2 = [],[]
-            for i in range(len(sorted_set_dict[geo_key])):
-                *v, k = sorted_set_dict[geo_key][i]
-                if k == member1:
-                    coord1 = v
-                if k == member2:
-                    coord2 = v
-            #wierdly works when i encode and decode the data
-            score_coord1 = encode_geo.encode(coord1[1], coord1[0])
-            score_coord2 = encode_geo.encode(coord2[1], coord2[0])
-            coord1 = decode_geo.decode(int(score_coord1))
-            coord2 = decode_geo.decode(int(score_coord2))
-            response = haversine.haversine(coord1[1], coord1[0], coord2[1], coord2[0])
-            print(response, round(response, 4), f"{response:.4f}".rstrip("0").rstrip("."))
-            response = f"{round(response, 4)}".rstrip("0").rstrip(".").encode()
-
-
-        case [b"GEOSEARCH", geo_key, b"FROMLONLAT", lat, lon, b"BYRADIUS", radius, b"m"]:
-            response = []
-            lat, lon, radius = float(lat.decode()), float(lon.decode()), float(radius.decode())
-            for member in sorted_set_dict[geo_key]:
-                *v, k = member
-                score_coord1 = encode_geo.encode(v[1], v[0])
-                coord1 = decode_geo.decode(int(score_coord1))
-                if haversine.haversine(coord1[1], coord1[0], lat, lon) <= radius:
-                    response.append(k)
-            
-        case [b"SUBSCRIBE", channel]:
-            response = ["subscribe", channel.decode()]
-            if channel not in subscribe_dict:
-                subscribe_dict[channel] = set()
-            if conn not in subscriber_dict:
-                subscriber_dict[conn] = 0
-
-            if conn not in subscribe_dict[channel]:
-                subscriber_dict[conn] += 1
-                response.append(subscriber_dict[conn])
-                subscribe_dict[channel].add(conn)
-            else:
-                response.append(subscriber_dict[conn])
 
-        case [b"PUBLISH", channel, message]:
-            if channel in subscribe_dict:
-                response = len(subscribe_dict[channel])
-                for conn in subscribe_dict[channel]:
-                    conn.send(encode_resp([b"message", channel, message]))
-            else:
-                response = 0
-        
-        case [b"UNSUBSCRIBE", channel]:
-            if channel in subscribe_dict:
-                if conn in subscribe_dict[channel]:
-                    subscribe_dict[channel].remove(conn)
-                    subscriber_dict[conn] -= 1
-                    response = [b"unsubscribe", channel, 1]
-                else:
-                    response = [b"unsubscribe", channel, 0]
+@command(b"ZRANGE", -4, [commands.READONLY], 1, 1, 1)
+def cmd_zrange(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    return zrange_generic(value[1], value[2], value[3], value[4:], by_score=False, reverse=False)
 
-        case _:
-            raise RuntimeError(f"Command not implemented: {value}")
 
+@command(b"ZRANGEBYSCORE", -4, [commands.READONLY], 1, 1, 1)
+def cmd_zrangebyscore(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    return zrange_generic(value[1], value[2], value[3], value[4:], by_score=True, reverse=False)
+
+
+@command(b"ZREVRANGEBYSCORE", -4, [commands.READONLY], 1, 1, 1)
+def cmd_zrevrangebyscore(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    return zrange_generic(value[1], value[2], value[3], value[4:], by_score=True, reverse=True)
+
+
+@command(b"ZCOUNT", 4, [commands.READONLY], 1, 1, 1)
+def cmd_zcount(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    zset_key, min_score, max_score = value[1:]
+    spec = parse_score_range(min_score, max_score)
+    if spec is None:
+        return "-ERR min or max is not a float"
+    zset = lookup_zset(zset_key)
+    if zset is WRONGTYPE:
+        return zset
+    return zset.count_in_range(spec) if zset is not None else 0
+
+
+@command(b"ZREMRANGEBYSCORE", 4, [commands.WRITE], 1, 1, 1)
+def cmd_zremrangebyscore(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    zset_key, min_score, max_score = value[1:]
+    spec = parse_score_range(min_score, max_score)
+    if spec is None:
+        return "-ERR min or max is not a float"
+    zset = lookup_zset(zset_key)
+    if zset is WRONGTYPE:
+        return zset
+    if zset is None:
+        return 0
+    removed = zset.remove_range_by_score(spec)
+    if not zset:
+        delete_key(zset_key)
+    return len(removed)
+
+
+@command(b"ZREMRANGEBYRANK", 4, [commands.WRITE], 1, 1, 1)
+def cmd_zremrangebyrank(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    zset_key, start_index, end_index = value[1:]
+    try:
+        start_index, end_index = int(start_index), int(end_index)
+    except ValueError:
+        return "-ERR value is not an integer or out of range"
+    zset = lookup_zset(zset_key)
+    if zset is WRONGTYPE:
+        return zset
+    if zset is None:
+        return 0
+    removed = zset.remove_range_by_rank(*clamp_rank_range(start_index, end_index, len(zset)))
+    if not zset:
+        delete_key(zset_key)
+    return len(removed)
+
+
+@command(b"ZPOPMIN", -2, [commands.WRITE], 1, 1, 1)
+def cmd_zpopmin(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    return zpop_generic(value, reverse=False)
+
+
+@command(b"ZPOPMAX", -2, [commands.WRITE], 1, 1, 1)
+def cmd_zpopmax(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    return zpop_generic(value, reverse=True)
+
+
+@command(b"ZCARD", 2, [commands.READONLY], 1, 1, 1)
+def cmd_zcard(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    zset = lookup_zset(value[1])
+    if zset is WRONGTYPE:
+        return zset
+    return len(zset) if zset is not None else 0
+
+
+@command(b"ZREM", 3, [commands.WRITE], 1, 1, 1)
+def cmd_zrem(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    zset_key, zset_member = value[1:]
+    zset = lookup_zset(zset_key)
+    if zset is WRONGTYPE:
+        return zset
+    if zset is None or not zset.remove(zset_member):
+        return 0
+    if not zset:
+        delete_key(zset_key)
+    return 1
+
+
+@command(b"ZSCORE", 3, [commands.READONLY], 1, 1, 1)
+def cmd_zscore(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    zset_key, zset_member = value[1:]
+    zset = lookup_zset(zset_key)
+    if zset is WRONGTYPE:
+        return zset
+    score = zset.score(zset_member) if zset is not None else None
+    if score is None:
+        return None
+    return format_score(score)
+
+
+@command(b"ZADD", 4, [commands.WRITE, commands.DENY_OOM], 1, 1, 1)
+def cmd_zadd(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    zset_key, score, zset_member = value[1:]
+    score = parse_score(score)
+    if score is None:
+        return "-ERR value is not a valid float"
+    if lookup_zset(zset_key) is WRONGTYPE:
+        return WRONGTYPE
+    return add_to_sorted_set(zset_key, score, zset_member)
+
+
+@command(b"GEOADD", -5, [commands.WRITE, commands.DENY_OOM], 1, 1, 1)
+def cmd_geoadd(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    geo_key = value[1]
+    nx = xx = ch = False
+    i = 2
+    while i < len(value):
+        option = value[i].upper()
+        if option == b"NX":
+            nx = True
+        elif option == b"XX":
+            xx = True
+        elif option == b"CH":
+            ch = True
+        else:
+            break
+        i += 1
+    triples = value[i:]
+    if not triples or len(triples) % 3:
+        return "-ERR syntax error"
+    if nx and xx:
+        return "-ERR XX and NX options at the same time are not compatible"
+    longitudes, latitudes, members = triples[0::3], triples[1::3], triples[2::3]
+    for longitude, latitude in zip(longitudes, latitudes):
+        try:
+            valid = validate_latitude_longitude(latitude.decode(), longitude.decode())
+        except ValueError:
+            return "-ERR value is not a valid float"
+        if not valid:
+            return f"-ERR invalid longitude,latitude pair {longitude.decode()},{latitude.decode()}"
+    latitudes = [float(latitude) for latitude in latitudes]
+    longitudes = [float(longitude) for longitude in longitudes]
+    if len(members) >= geo_search.BATCH_MIN:
+        scores = encode_geo.encode_many(latitudes, longitudes)
+    else:
+        scores = [encode_geo.encode(lat, lon) for lat, lon in zip(latitudes, longitudes)]
+
+    zset = lookup_zset(geo_key)
+    if zset is WRONGTYPE:
+        return zset
+    if zset is None:
+        if xx:
+            return 0
+        zset = SortedSet()
+    if not zset and len(members) >= geo_search.BATCH_MIN and len(set(members)) == len(members):
+        # Loading a new key: build the index in one pass
+        zset.bulk_load([(member, float(score)) for member, score in zip(members, scores)])
+        sorted_set_dict[geo_key] = zset
+        return len(members)
+
+    added = changed = 0
+    for member, score in zip(members, scores):
+        old = zset.score(member)
+        if (nx and old is not None) or (xx and old is None):
+            continue
+        if old is None:
+            added += 1
+        elif old != score:
+            changed += 1
+        zset.add(member, float(score))
+    if zset:
+        sorted_set_dict[geo_key] = zset
+    return added + changed if ch else added
+
+
+@command(b"GEOHASH", -2, [commands.READONLY], 1, 1, 1)
+def cmd_geohash(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    geo_key, members = value[1], value[2:]
+    zset = lookup_zset(geo_key)
+    if zset is WRONGTYPE:
+        return zset
+    response = []
+    for member in members:
+        score = zset.score(member) if zset is not None else None
+        if score is None:
+            response.append(None)
+        else:
+            longitude, latitude = geo_search.decode_score(score)
+            response.append(encode_geo.geohash_string(latitude, longitude).encode())
     return response
 
 
-def push_elements_to_sorted_set(popped_elements, sorted_set_dict, zset_key):
-    for ele in popped_elements:
-        heapq.heappush(sorted_set_dict[zset_key], ele)
+@command(b"GEOPOS", -2, [commands.READONLY], 1, 1, 1)
+def cmd_geopos(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    geo_key, members = value[1], value[2:]
+    zset = lookup_zset(geo_key)
+    if zset is WRONGTYPE:
+        return zset
+    scores = [zset.score(member) if zset is not None else None for member in members]
+    coordinates = iter(geo_search.decode_scores([score for score in scores if score is not None]))
+    response = []
+    for score in scores:
+        if score is None:
+            response.append(NullArray(type=None))
+        else:
+            response.append(format_coordinates(next(coordinates)))
+    return response
 
-def calculate_zscore(sorted_set_dict, zset_key, zset_member):
-    response  = ""
-    if zset_key in sorted_set_dict:
-        for i in range(len(sorted_set_dict[zset_key])):
-            *v, k = sorted_set_dict[zset_key][i]
-            if k == zset_member:
-                if len(v) > 1:
-                    response = str(encode_geo.encode(v[1], v[0])).encode()
-                else:
-                    response = str(v).encode()
+
+@command(b"GEODIST", 4, [commands.READONLY], 1, 1, 1)
+def cmd_geodist(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    geo_key, member1, member2 = value[1:]
+    zset = lookup_zset(geo_key)
+    if zset is WRONGTYPE:
+        return zset
+    if zset is None or member1 not in zset or member2 not in zset:
+        return None
+    coord1 = geo_search.decode_score(zset.score(member1))
+    coord2 = geo_search.decode_score(zset.score(member2))
+    response = haversine.haversine(coord1[1], coord1[0], coord2[1], coord2[0])
+    return f"{round(response, 4)}".rstrip("0").rstrip(".").encode()
+
+
+@command(b"GEOSEARCH", -7, [commands.READONLY], 1, 1, 1)
+def cmd_geosearch(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    return geo_search_generic(value[1], value[2:])
+
+
+@command(b"GEORADIUS", -6, [commands.READONLY], 1, 1, 1)
+def cmd_georadius(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    geo_key, longitude, latitude, radius, unit = value[1:6]
+    return geo_search_generic(
+        geo_key, [b"FROMLONLAT", longitude, latitude, b"BYRADIUS", radius, unit, *value[6:]]
+    )
+
+
+@command(b"GEORADIUSBYMEMBER", -5, [commands.READONLY], 1, 1, 1)
+def cmd_georadiusbymember(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    geo_key, member, radius, unit = value[1:5]
+    return geo_search_generic(
+        geo_key, [b"FROMMEMBER", member, b"BYRADIUS", radius, unit, *value[5:]]
+    )
+
+
+@command(b"SUBSCRIBE", 2, [commands.PUBSUB_ALLOWED])
+def cmd_subscribe(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    channel = value[1]
+    response = ["subscribe", channel.decode()]
+    if channel not in subscribe_dict:
+        subscribe_dict[channel] = set()
+    if conn not in subscriber_dict:
+        subscriber_dict[conn] = 0
+
+    if conn not in subscribe_dict[channel]:
+        subscriber_dict[conn] += 1
+        response.append(subscriber_dict[conn])
+        subscribe_dict[channel].add(conn)
+    else:
+        response.append(subscriber_dict[conn])
     return response
 
-def handle_xread(key_and_sequence, blocking=False):
-    global db
-    keys, values = extract_key_and_sequence(key_and_sequence)
+
+@command(b"PUBLISH", 3, [commands.PUBSUB_ALLOWED])
+def cmd_publish(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    channel, message = value[1:]
+    if channel not in subscribe_dict:
+        return 0
+    for subscriber in subscribe_dict[channel]:
+        subscriber.send(encode_resp([b"message", channel, message]))
+    return len(subscribe_dict[channel])
+
+
+@command(b"UNSUBSCRIBE", 2, [commands.PUBSUB_ALLOWED])
+def cmd_unsubscribe(args: Args, value: List, conn: socket.socket, is_replica_conn: bool):
+    channel = value[1]
+    if channel in subscribe_dict and conn in subscribe_dict[channel]:
+        subscribe_dict[channel].remove(conn)
+        subscriber_dict[conn] -= 1
+        return [b"unsubscribe", channel, 1]
+    return [b"unsubscribe", channel, 0]
+
+
+def parse_score(score: bytes) -> Optional[float]:
+    try:
+        value = float(score.decode())
+    except ValueError:
+        return None
+    return None if math.isnan(value) else value
+
+def lookup_stream(key: bytes) -> Optional[Stream]:
+    """Stream stored at key, or None; raises StreamError for other types"""
+    existing = db.get(key)
+    if existing is None:
+        if key in sorted_set_dict:
+            raise StreamError(WRONGTYPE)
+        return None
+    if not isinstance(existing.value, Stream):
+        raise StreamError(WRONGTYPE)
+    return existing.value
+
+
+def resolve_xread_id(key: bytes, entry_id: bytes) -> StreamID:
+    """XREAD ID argument; $ is the stream's last ID at the time of the call"""
+    if entry_id == b"$":
+        stream = lookup_stream(key)
+        return stream.last_id if stream is not None else stream_module.MIN_ID
+    return stream_module.parse_id(entry_id, 0)
+
+
+def lookup_group(key: bytes, group_name: bytes) -> Tuple[Stream, ConsumerGroup]:
+    stream = lookup_stream(key)
+    group = stream.groups.get(group_name) if stream is not None else None
+    if group is None:
+        raise StreamError(
+            f"-NOGROUP No such consumer group '{group_name.decode(errors='replace')}' "
+            f"for key name '{key.decode(errors='replace')}'"
+        )
+    return stream, group
+
+
+def xrange_generic(key: bytes, start: bytes, end: bytes, options: List, reverse: bool):
+    count = None
+    if options:
+        if len(options) != 2 or options[0].upper() != b"COUNT":
+            return "-ERR syntax error"
+        try:
+            count = max(0, int(options[1]))
+        except ValueError:
+            return "-ERR value is not an integer or out of range"
+    try:
+        start_id = stream_module.parse_range_start(start)
+        end_id = stream_module.parse_range_end(end)
+        stream = lookup_stream(key)
+    except StreamError as e:
+        return str(e)
+    if stream is None or count == 0:
+        return []
+    return [
+        stream_module.entry_reply(entry)
+        for entry in stream.range(start_id, end_id, count, reverse)
+    ]
+
+
+def handle_xread(keys: List[bytes], ids: List[StreamID], count: Optional[int] = None):
     response = []
-    
-    for key, value in zip(keys, values):
-        if key in db.keys():
-            db_value = db[key].value
-            sequence_str = value.decode()
-            m_second, seq = extract_msec_and_sequence(sequence_str)
-
-            target_ms = int(m_second) if m_second else 0
-            target_seq = int(seq) if seq else 0
-            
-            temp_key = []
-            for val in db_value:
-                if not isinstance(val, XADDValue):
-                    continue
-                    
-                val_ms = int(val.milliseconds)
-                val_seq = int(val.sequence)
-                
-                if (val_ms > target_ms) or (val_ms == target_ms and val_seq > target_seq):
-                    temp = []
-                    for k, v in val.value.items():
-                        temp.extend([k, v])
-                    entry_id = f"{val_ms}-{val_seq}".encode()
-                    temp_key.append([entry_id, temp])
-            
-            if temp_key:
-                if blocking:
-                    response.append([key, [temp_key[-1]]])
-                else:
-                    response.append([key, temp_key])
+    for key, entry_id in zip(keys, ids):
+        stream = lookup_stream(key)
+        if stream is None:
+            continue
+        entries = stream.after(entry_id, count)
+        if entries:
+            response.append([key, [stream_module.entry_reply(entry) for entry in entries]])
+    return response
 
+def handle_xreadgroup(keys: List[bytes], ids: List, group_name: bytes, consumer_name: bytes,
+                      count: Optional[int], noack: bool):
+    """XREADGROUP reply: new entries for > IDs, the consumer's history otherwise"""
+    response = []
+    for key, entry_id in zip(keys, ids):
+        stream = lookup_stream(key)
+        group = stream.groups.get(group_name) if stream is not None else None
+        if group is None:
+            continue
+        if consumer_name not in group.consumers:
+            propagate([b"XGROUP", b"CREATECONSUMER", key, group_name, consumer_name])
+        consumer = group.consumer(consumer_name)
+        if entry_id == b">":
+            entries = group.deliver_new(stream, consumer, count, noack)
+            if entries:
+                propagate_group_delivery(key, group, consumer, entries, noack)
+                response.append([key, [stream_module.entry_reply(entry) for entry in entries]])
+        else:
+            history = group.history(stream, consumer, entry_id, count)
+            redelivered = [entry for _, entry in history if entry is not None]
+            if redelivered:
+                propagate_group_delivery(key, group, consumer, redelivered, noack=False)
+            response.append([key, [
+                stream_module.entry_reply(entry) if entry is not None
+                else [stream_module.format_id(pending_id), None]
+                for pending_id, entry in history
+            ]])
     return response
 
+def propagate_group_delivery(key: bytes, group: ConsumerGroup, consumer: Consumer,
+                             entries: List, noack: bool):
+    """What XREADGROUP changed in the group, as replicas and the AOF replay
+    it: an XCLAIM for each entry it made pending, or with NOACK the cursor"""
+    last_id = stream_module.format_id(group.last_id)
+    if noack:
+        propagate([b"XGROUP", b"SETID", key, group.name, last_id])
+        return
+    for entry in entries:
+        entry_id = (entry.milliseconds, entry.sequence)
+        pending = group.pending.get(entry_id)
+        propagate([
+            b"XCLAIM", key, group.name, consumer.name, b"0", stream_module.format_id(entry_id),
+            b"TIME", b"%d" % pending.delivery_time, b"RETRYCOUNT", b"%d" % pending.delivery_count,
+            b"FORCE", b"JUSTID", b"LASTID", last_id,
+        ])
+
+
 def extract_key_and_sequence(key_and_sequence: list) -> tuple[list[Any], list[Any]]:
     return key_and_sequence[0:len(key_and_sequence)//2], key_and_sequence[len(key_and_sequence)//2:]
 
 
-def handle_xread_block(conn: socket.socket, key_and_sequence: list, timeout: float, block_event: threading.Event):
-    global xread_block_queue
-    
-    if block_event.wait(timeout=timeout):
-        resp = handle_xread(key_and_sequence, blocking=True)
-        if resp:
-            encoded_resp = encode_resp(resp)
-            conn.send(encoded_resp)
-    else:
-        encoded_resp = encode_resp(None)
-        conn.send(encoded_resp)
-    
-    remove_from_xread_queues(conn)
+@dataclasses.dataclass(eq=False)
+class BlockedRead:
+    """A client parked by XREAD or XREADGROUP BLOCK on one or more streams"""
+    conn: Any
+    keys: List[bytes]
+    serve: Callable[[bytes], Any]  # reply for a key with new entries, empty if there are none
+    last_seen: Callable[[bytes], StreamID]  # ID the client has read up to on a key
+    seq: int
+    after: Dict[bytes, StreamID] = dataclasses.field(default_factory=dict)
+    timer: Optional[TimerHandle] = None
+    done: bool = False
 
 
-def remove_from_xread_queues(conn: socket.socket):
-    """Remove a connection from all XREAD blocking queues"""
-    global xread_block_queue
-    
-    with xread_lock:
-        for key in list(xread_block_queue.keys()):
-            for op in xread_block_queue[key]:
-                if op['conn'] == conn:
-                    op['event'].set()
-            
-            xread_block_queue[key] = [op for op in xread_block_queue[key] if op['conn'] != conn]
-            if not xread_block_queue[key]:
-                del xread_block_queue[key]
-
-def notify_blocking_xread(key: bytes):
-    """Notify any blocking XREAD operations when new entries are added"""
-    global xread_block_queue
-    
-    if key not in xread_block_queue:
-        return
-    
+blocked_read_seq = itertools.count()
+
+
+def block_stream_read(conn: socket.socket, keys: List[bytes], serve: Callable, last_seen: Callable,
+                      expiry_ms: int) -> Optional[str]:
+    """Park conn until an XADD moves one of keys past last_seen(key), then reply with serve(key).
+
+    Inside EXEC nothing may wait, so there the reply is nil at once, as for
+    the list pops.
+    """
+    if conn in executing_transaction:
+        return None
+    blocked = BlockedRead(conn, keys, serve, last_seen, next(blocked_read_seq))
     with xread_lock:
-        operations = xread_block_queue[key][:]  # Copy list to avoid modification during iteration
-        
-        for operation in operations:
-            resp = handle_xread(operation['keys'], blocking=True)
-            if resp:
-                operation['event'].set()
-        
-        if not xread_block_queue[key]:
+        register_read(blocked)
+        if expiry_ms:
+            blocked.timer = call_later(expiry_ms / 1000, expire_blocked_read, blocked)
+    return "custom"
+
+
+def register_read(blocked: BlockedRead):
+    for key in blocked.keys:
+        blocked.after[key] = blocked.last_seen(key)
+        bisect.insort(xread_block_queue.setdefault(key, []), (blocked.after[key], blocked.seq, blocked))
+
+
+def unregister_read(blocked: BlockedRead):
+    for key, after in blocked.after.items():
+        waiters = xread_block_queue.get(key)
+        if waiters is None:
+            continue
+        i = bisect.bisect_left(waiters, (after, blocked.seq))
+        if i < len(waiters) and waiters[i][2] is blocked:
+            del waiters[i]
+        if not waiters:
             del xread_block_queue[key]
+    blocked.after.clear()
 
-def extract_msec_and_sequence(sequence:str):
-    if len(sequence) == 1 and (sequence == "*" or sequence == "$"):
-        m_second, seq = "", ""
-    else:
-        m_second, seq = sequence.split("-")
-    return m_second, seq
-
-
-def invalid_sequence(key, m_second, seq) -> str:
-    global db
-    if m_second != "":
-        if seq == "*":
-            m_second = int(m_second)
-            if key in db.keys():
-                if db[key].value[-1].milliseconds > m_second:
-                    return "-ERR The ID specified in XADD is equal or smaller than the target stream top item"
-            return ""
-
-    if m_second == "":
-        return ""
-
-    m_second, seq = int(m_second), int(seq)
-    if m_second == 0 and seq == 0:
-            return "-ERR The ID specified in XADD must be greater than 0-0"
-
-    if key in db.keys():
-        if db[key].value[-1].milliseconds > m_second:
-            return "-ERR The ID specified in XADD is equal or smaller than the target stream top item"
-        elif db[key].value[-1].milliseconds == m_second:
-            if db[key].value[-1].sequence >= seq:
-                return "-ERR The ID specified in XADD is equal or smaller than the target stream top item"
-    return ""
-
-def get_processed_bytes():
-    global processed_bytes
-    if processed_bytes - 37 < 0:
-        return 0
-    return processed_bytes - 37
 
+def expire_blocked_read(blocked: BlockedRead):
+    with xread_lock:
+        if blocked.done:
+            return
+        blocked.done = True
+        unregister_read(blocked)
+    blocked.conn.send(encode_resp(None))
 
-def queue_transaction(command: List, conn: socket.socket):
-    global transaction_enabled, transactions
-    if conn in transaction_enabled.keys() and transaction_enabled[conn] == True:
-        transactions[conn].append(command)
-        conn.send(encode_resp("QUEUED"))
-        return True
-    return False
+
+def signal_stream_ready(key: bytes, entry_id: StreamID):
+    """Mark key for serve_blocked_stream_reads() once the adding command has propagated"""
+    with xread_lock:
+        if key in xread_block_queue:
+            ready_streams.append((key, entry_id))
+
+
+def serve_blocked_stream_reads():
+    """Serve the readers blocked on the ready keys that have not seen the added IDs yet"""
+    with xread_lock:
+        while ready_streams:
+            key, entry_id = ready_streams.popleft()
+            serve_stream_readers(key, entry_id)
+
+
+def serve_stream_readers(key: bytes, entry_id: StreamID):
+    """Serve the readers blocked on key behind entry_id; call with xread_lock held"""
+    waiters = xread_block_queue.get(key)
+    if not waiters:
+        return
+    # Waiters are sorted by last seen ID, so the ones behind entry_id lead the list
+    behind = bisect.bisect_left(waiters, (entry_id,))
+    for _, _, blocked in waiters[:behind]:
+        unregister_read(blocked)
+        if blocked.conn.closed:
+            resp = None
+        else:
+            try:
+                resp = blocked.serve(key)
+            except StreamError as e:
+                resp = str(e)
+            if not resp:
+                # Another consumer of the group took the new entries first
+                register_read(blocked)
+                continue
+            blocked.conn.send(encode_resp(resp))
+        blocked.done = True
+        if blocked.timer is not None:
+            blocked.timer.cancel()
+
+@dataclasses.dataclass
+class BlockedWait:
+    """A client parked by WAIT until enough replicas acknowledge its last write"""
+    conn: Any
+    offset: int
+    min_replicas: int
+    timer: Optional[TimerHandle] = None
+    done: bool = False
+
+
+def count_acked_replicas(offset: int) -> int:
+    """Replicas that acknowledged offset; call with replication.lock held"""
+    return sum(1 for replica in replication.connected_replicas.values() if replica.ack_offset >= offset)
+
+
+def serve_blocked_waits():
+    """Answer the WAITs an ACK satisfied, and drop those of closed clients"""
+    replies = []
+    with replication.lock:
+        waiting = []
+        for blocked in replication.waiters:
+            acked = count_acked_replicas(blocked.offset)
+            if acked < blocked.min_replicas and not blocked.conn.closed:
+                waiting.append(blocked)
+                continue
+            blocked.done = True
+            if blocked.timer is not None:
+                blocked.timer.cancel()
+            replies.append((blocked.conn, acked))
+        replication.waiters = waiting
+    for conn, acked in replies:
+        conn.send(encode_resp(acked))
+
+
+def expire_blocked_wait(blocked: BlockedWait):
+    with replication.lock:
+        if blocked.done:
+            return
+        blocked.done = True
+        replication.waiters.remove(blocked)
+        acked = count_acked_replicas(blocked.offset)
+    blocked.conn.send(encode_resp(acked))
+
+
+def pop_generic(value: List, left: bool):
+    k, v = value[1], value[2:]
+    if len(v) > 1:
+        return "-ERR syntax error"
+    count = None
+    if v:
+        try:
+            count = int(v[0])
+        except ValueError:
+            return "-ERR value is not an integer or out of range"
+        if count < 0:
+            return "-ERR value is out of range, must be positive"
+    if lookup_list(k) is WRONGTYPE:
+        return WRONGTYPE
+    if not list_length(k):
+        return None
+    if count is None:
+        return list_pop(k, left)[0]
+    return list_pop(k, left, count)
+
+
+def parse_lmpop(argv: List):
+    """numkeys key [key ...] LEFT|RIGHT [COUNT n] -> (keys, left, count) or an error"""
+    try:
+        numkeys = int(argv[0])
+    except ValueError:
+        return "-ERR numkeys should be greater than 0"
+    if numkeys <= 0:
+        return "-ERR numkeys should be greater than 0"
+    if len(argv) < numkeys + 2:
+        return "-ERR syntax error"
+    keys = argv[1:numkeys + 1]
+    direction = argv[numkeys + 1].upper()
+    if direction not in (b"LEFT", b"RIGHT"):
+        return "-ERR syntax error"
+    options = argv[numkeys + 2:]
+    count = 1
+    if options:
+        if len(options) != 2 or options[0].upper() != b"COUNT":
+            return "-ERR syntax error"
+        try:
+            count = int(options[1])
+        except ValueError:
+            return "-ERR count should be greater than 0"
+        if count <= 0:
+            return "-ERR count should be greater than 0"
+    return keys, direction == b"LEFT", count
+
+
+def blocking_pop_generic(value: List, conn, left: bool):
+    keys = value[1:-1]
+    timeout = parse_timeout(value[-1])
+    if timeout is None:
+        return "-ERR timeout is not a float or out of range"
+    if timeout < 0:
+        return "-ERR timeout is negative"
+    error = wrong_list_type(keys)
+    if error:
+        return error
+
+    def serve(k: bytes):
+        propagate([b"LPOP" if left else b"RPOP", k])
+        return [k, list_pop(k, left)[0]]
+
+    with bl_pop_lock:
+        for k in keys:
+            if list_length(k):
+                return serve(k)
+        return block_for_lists(conn, keys, timeout, serve)
+
+
+def blocking_move_generic(conn, source: bytes, destination: bytes, wherefrom: bytes,
+                          whereto: bytes, timeout: bytes):
+    timeout = parse_timeout(timeout)
+    if timeout is None:
+        return "-ERR timeout is not a float or out of range"
+    if timeout < 0:
+        return "-ERR timeout is negative"
+    error = wrong_list_type([source, destination])
+    if error:
+        return error
+
+    def serve(k: bytes):
+        propagate([b"LMOVE", source, destination, wherefrom, whereto])
+        return list_move(source, destination, wherefrom, whereto)
+
+    with bl_pop_lock:
+        if not list_length(source):
+            return block_for_lists(conn, [source], timeout, serve, target=destination)
+        if destination in bl_pop_queue:
+            ready_lists.append(destination)
+        return serve(source)
+
+
+def lookup_string(k):
+    """String stored at k, None when missing, or the WRONGTYPE error reply"""
+    existing = db.get(k)
+    if existing is None:
+        return WRONGTYPE if k in sorted_set_dict else None
+    if not isinstance(existing.value, (bytes, str)):
+        return WRONGTYPE
+    return existing.value
+
+
+def expire_at_ms(when: int, unit: bytes) -> int:
+    """Absolute expiry in ms from an EX/PX/EXAT/PXAT argument"""
+    if unit == b"EX":
+        return expires_module.mstime() + when * 1000
+    if unit == b"PX":
+        return expires_module.mstime() + when
+    if unit == b"EXAT":
+        return when * 1000
+    return when
+
+
+def expire_generic(value: List, unit: bytes):
+    k = value[1]
+    try:
+        when = expire_at_ms(int(value[2]), unit)
+    except ValueError:
+        return "-ERR value is not an integer or out of range"
+    flags = set()
+    for option in value[3:]:
+        if option.upper() not in (b"NX", b"XX", b"GT", b"LT"):
+            return f"-ERR Unsupported option {option.decode(errors='replace')}"
+        flags.add(option.upper())
+    if b"NX" in flags and flags & {b"XX", b"GT", b"LT"}:
+        return "-ERR NX and XX, GT or LT options at the same time are not compatible"
+    if {b"GT", b"LT"} <= flags:
+        return "-ERR GT and LT options at the same time are not compatible"
+    unchanged = Propagated(0, [])
+    if not key_exists(k):
+        return unchanged
+    current = expires.get(k)
+    if b"NX" in flags and current is not None:
+        return unchanged
+    if b"XX" in flags and current is None:
+        return unchanged
+    # No TTL counts as an infinite one for GT and LT
+    if b"GT" in flags and (current is None or when <= current):
+        return unchanged
+    if b"LT" in flags and current is not None and when >= current:
+        return unchanged
+    if when <= expires_module.mstime():
+        delete_key(k)
+        return Propagated(1, [[b"DEL", k]])
+    expires.set(k, when)
+    # As an absolute time, so a replica or an AOF replay sets the same TTL
+    return Propagated(1, [[b"PEXPIREAT", k, b"%d" % when]])
+
+
+def ttl_ms(k) -> int:
+    """Milliseconds left on k; -2 when k is missing and -1 when it has no TTL"""
+    if not key_exists(k):
+        return -2
+    when = expires.get(k)
+    if when is None:
+        return -1
+    return max(0, when - expires_module.mstime())
 
 
 def handle_transaction(args: Args, conn: socket.socket, is_replica_conn: bool):
@@ -911,121 +2818,425 @@ def handle_transaction(args: Args, conn: socket.socket, is_replica_conn: bool):
         response.append(handle_command(args, transaction, conn, is_replica_conn))
     return response
 
-def add_to_sorted_set(zset_key: bytes, value: bytes, member: bytes, is_geo: bool = False, latitude: bytes = None):
-    global sorted_set_dict
-    
-    if zset_key in sorted_set_dict:
-        member_found = False
-        for i in range(len(sorted_set_dict[zset_key])):
-            *v, k = sorted_set_dict[zset_key][i]
-            if k == member:
-                response = 0
-                if is_geo:
-                    sorted_set_dict[zset_key][i] = (float(value.decode()), float(latitude.decode()), member)
-                else:
-                    sorted_set_dict[zset_key][i] = (float(value.decode()), member)
-                heapq.heapify(sorted_set_dict[zset_key])
-                member_found = True
-                break
-        if not member_found:
-            if is_geo:  
-                heapq.heappush(sorted_set_dict[zset_key], (float(value.decode()), float(latitude.decode()), member))
+def zrange_generic(zset_key: bytes, start: bytes, stop: bytes, options: List,
+                   by_score: bool, reverse: bool):
+    """Shared body of ZRANGE, ZRANGEBYSCORE and ZREVRANGEBYSCORE.
+
+    Only ZRANGE takes BYSCORE/REV; for the *BYSCORE forms they are implied by
+    the command name. Reverse score ranges take max before min.
+    """
+    zrange_options = not by_score
+    withscores = False
+    offset, count = 0, -1
+    limit = False
+    i = 0
+    while i < len(options):
+        option = options[i].upper()
+        if option == b"WITHSCORES":
+            withscores = True
+        elif option == b"BYSCORE" and zrange_options:
+            by_score = True
+        elif option == b"REV" and zrange_options:
+            reverse = True
+        elif option == b"LIMIT" and i + 2 < len(options):
+            try:
+                offset, count = int(options[i + 1]), int(options[i + 2])
+            except ValueError:
+                return "-ERR value is not an integer or out of range"
+            limit = True
+            i += 2
+        else:
+            return "-ERR syntax error"
+        i += 1
+    if limit and not by_score:
+        return "-ERR syntax error, LIMIT is only supported in combination with either BYSCORE or BYLEX"
+
+    if by_score:
+        spec = parse_score_range(stop, start) if reverse else parse_score_range(start, stop)
+        if spec is None:
+            return "-ERR min or max is not a float"
+    else:
+        try:
+            start_index, end_index = int(start), int(stop)
+        except ValueError:
+            return "-ERR value is not an integer or out of range"
+
+    zset = lookup_zset(zset_key)
+    if zset is WRONGTYPE:
+        return zset
+    if zset is None:
+        return []
+    if by_score:
+        items = zset.range_by_score(spec, reverse, offset, count)
+    else:
+        start_index, end_index = clamp_rank_range(start_index, end_index, len(zset))
+        items = zset.range_by_rank(start_index, end_index, reverse)
+    return zset_reply(items, withscores)
+
+
+def zpop_generic(value: List, reverse: bool):
+    if len(value) > 3:
+        return "-ERR syntax error"
+    count = 1
+    if len(value) == 3:
+        try:
+            count = int(value[2])
+        except ValueError:
+            return "-ERR value is not an integer or out of range"
+        if count < 0:
+            return "-ERR value is out of range, must be positive"
+    zset_key = value[1]
+    zset = lookup_zset(zset_key)
+    if zset is WRONGTYPE:
+        return zset
+    if zset is None or count == 0:
+        return []
+    items = zset.pop_max(count) if reverse else zset.pop_min(count)
+    if not zset:
+        delete_key(zset_key)
+    return zset_reply(items, withscores=True)
+
+
+def zset_reply(items: List, withscores: bool) -> List[bytes]:
+    if not withscores:
+        return [member for member, _ in items]
+    response = []
+    for member, score in items:
+        response.append(member)
+        response.append(format_score(score))
+    return response
+
+
+def geo_search_generic(geo_key: bytes, options: List):
+    """Parse GEOSEARCH options and run the search.
+
+    GEORADIUS and GEORADIUSBYMEMBER are rewritten into the same options, so
+    they accept the same modifiers in any order. STORE/STOREDIST are not
+    supported.
+    """
+    from_member = None
+    from_lonlat = None
+    shape_args = None
+    withdist = withcoord = withhash = False
+    count, any_match, descending = 0, False, None
+    try:
+        i = 0
+        while i < len(options):
+            option = options[i].upper()
+            remaining = len(options) - i - 1
+            if option == b"FROMMEMBER" and remaining >= 1 and from_lonlat is None:
+                from_member = options[i + 1]
+                i += 1
+            elif option == b"FROMLONLAT" and remaining >= 2 and from_member is None:
+                longitude, latitude = options[i + 1], options[i + 2]
+                if not validate_latitude_longitude(latitude.decode(), longitude.decode()):
+                    return f"-ERR invalid longitude,latitude pair {longitude.decode()},{latitude.decode()}"
+                from_lonlat = float(longitude), float(latitude)
+                i += 2
+            elif option == b"BYRADIUS" and remaining >= 2 and shape_args is None:
+                shape_args = (False, options[i + 1:i + 2], options[i + 2])
+                i += 2
+            elif option == b"BYBOX" and remaining >= 3 and shape_args is None:
+                shape_args = (True, options[i + 1:i + 3], options[i + 3])
+                i += 3
+            elif option == b"ASC":
+                descending = False
+            elif option == b"DESC":
+                descending = True
+            elif option == b"COUNT" and remaining >= 1:
+                count = int(options[i + 1])
+                if count <= 0:
+                    return "-ERR COUNT must be > 0"
+                i += 1
+                if remaining >= 2 and options[i + 1].upper() == b"ANY":
+                    any_match = True
+                    i += 1
+            elif option == b"WITHDIST":
+                withdist = True
+            elif option == b"WITHCOORD":
+                withcoord = True
+            elif option == b"WITHHASH":
+                withhash = True
             else:
-                heapq.heappush(sorted_set_dict[zset_key], (float(value.decode()), member))
-            response = 1
+                return "-ERR syntax error"
+            i += 1
+    except ValueError:
+        return "-ERR value is not an integer or out of range"
+    if from_member is None and from_lonlat is None:
+        return "-ERR exactly one of FROMMEMBER or FROMLONLAT can be specified for GEOSEARCH"
+    if shape_args is None:
+        return "-ERR exactly one of BYRADIUS and BYBOX can be specified for GEOSEARCH"
+
+    by_box, sizes, unit = shape_args
+    unit_meters = geo_search.UNITS.get(unit.lower())
+    if unit_meters is None:
+        return "-ERR unsupported unit provided. please use M, KM, FT, MI"
+    sizes = [parse_score(size) for size in sizes]
+    if None in sizes:
+        return "-ERR need numeric radius" if not by_box else "-ERR need numeric width and height"
+    if min(sizes) < 0:
+        return "-ERR radius cannot be negative" if not by_box else "-ERR height or width cannot be negative"
+
+    zset = lookup_zset(geo_key)
+    if zset is WRONGTYPE:
+        return zset
+    if zset is None:
+        return []
+    if from_member is not None:
+        score = zset.score(from_member)
+        if score is None:
+            return "-ERR could not decode requested zset member"
+        from_lonlat = geo_search.decode_score(score)
+    longitude, latitude = from_lonlat
+    if by_box:
+        shape = geo_search.GeoShape(
+            longitude, latitude,
+            width=sizes[0] * unit_meters, height=sizes[1] * unit_meters, by_box=True,
+        )
     else:
-        sorted_set_dict[zset_key] = []
-        if is_geo:
-            heapq.heappush(sorted_set_dict[zset_key], (float(value.decode()), float(latitude.decode()), member))
-        else:
-            heapq.heappush(sorted_set_dict[zset_key], (float(value.decode()), member))
-        response = 1
-    
+        shape = geo_search.GeoShape(longitude, latitude, radius=sizes[0] * unit_meters)
+
+    matches = geo_search.search(zset, shape, count, any_match, descending)
+    if not (withdist or withcoord or withhash):
+        return [member for member, _, _ in matches]
+    coordinates = geo_search.decode_scores([score for _, _, score in matches]) if withcoord else []
+    response = []
+    for i, (member, distance, score) in enumerate(matches):
+        item = [member]
+        if withdist:
+            item.append(f"{distance / unit_meters:.4f}".encode())
+        if withhash:
+            item.append(int(score))
+        if withcoord:
+            item.append(format_coordinates(coordinates[i]))
+        response.append(item)
     return response
 
 
+def format_coordinates(coordinates: Tuple[float, float]) -> List[bytes]:
+    """[longitude, latitude] as GEOPOS replies them"""
+    return [f"{x:.12f}".rstrip("0").rstrip(".").encode() for x in coordinates]
+
+
+def lookup_zset(k: bytes):
+    """Sorted set stored at k, None when missing, or the WRONGTYPE error reply"""
+    zset = sorted_set_dict.get(k)
+    if zset is None and k in db:
+        return WRONGTYPE
+    return zset
+
+
+def add_to_sorted_set(zset_key: bytes, score: float, member: bytes) -> int:
+    zset = sorted_set_dict.get(zset_key)
+    if zset is None:
+        zset = sorted_set_dict[zset_key] = SortedSet()
+    return 1 if zset.add(member, float(score)) else 0
+
+
+def load_snapshot(snapshot: rdb_loader.Snapshot):
+    """Replace the dataset with database 0 of a loaded RDB snapshot"""
+    for k in list(db) + list(sorted_set_dict):
+        delete_key(k)
+    for k, value in snapshot.databases.get(0, {}).items():
+        if isinstance(value, SortedSet):
+            sorted_set_dict[k] = value
+        else:
+            db[k] = rdb_parser.Value(value=value)
+        track_key(k)
+    for k, when in snapshot.expires.get(0, {}).items():
+        expires.set(k, when)
+    persistence.loaded(snapshot.keys_loaded, snapshot.keys_expired)
+    skipped = sum(len(keys) for number, keys in snapshot.databases.items() if number)
+    if skipped:
+        print(f"Skipped {skipped} keys in databases other than 0, which this server doesn't serve")
+
+
+def replay_command(args: Args, value: List):
+    """Apply one AOF command the way handle_command would, minus the replies"""
+    cmd = commands.lookup(value[0])
+    if cmd is None or not cmd.check_arity(len(value)):
+        raise aof_module.AofError(f"bad command in AOF: {value[:3]}")
+    value[0] = cmd.name
+    keys = cmd.keys(value)
+    cmd.handler(args, value, None, True)
+    for k in keys:
+        track_key(k)
+
+
+class MasterHandshake:
+    """The replica's side of the handshake and sync with its master, advanced
+    one reply at a time: the threaded link blocks on each reply, the event
+    loop feeds them from its readable callback. It ends in a partial resync
+    (+CONTINUE) when this replica synced before and the master's backlog
+    still covers its offset, otherwise in a full one that replaces the dataset"""
+
+    def __init__(self, args: Args, parser: RespParser):
+        self.parser = parser
+        self.requests: List[Tuple[List[bytes], str]] = [
+            ([b"PING"], "PONG"),
+            ([b"REPLCONF", b"listening-port", str(args.port).encode()], "OK"),
+            ([b"REPLCONF", b"capa", b"eof", b"capa", b"psync2"], "OK"),
+        ]
+        self.step = 0
+        self.psync_reply: Optional[str] = None
+        self.done = False
+
+    def request(self) -> bytes:
+        """The command whose reply on_reply() expects next"""
+        if self.step < len(self.requests):
+            return encode_resp(self.requests[self.step][0])
+        if replication.master_synced:
+            return encode_resp([b"PSYNC", replication.master_replid.encode(),
+                                str(replication.master_repl_offset + 1).encode()])
+        return encode_resp([b"PSYNC", b"?", b"-1"])
+
+    def on_reply(self, reply: Any) -> Optional[bytes]:
+        """Take the next reply (or the RDB payload) and return the next request to send"""
+        if self.psync_reply is not None:
+            # The RDB payload of a full resync
+            _, replid, offset = self.psync_reply.split()
+            load_snapshot(rdb_loader.parse(reply))
+            replication.master_replid = replid
+            replication.master_repl_offset = int(offset)
+            replication.master_synced = True
+            if aof is not None and not rewrite_append_only_file():
+                # The log has to describe the master's dataset from now on
+                aof.rewrite_scheduled = True
+            self._completed()
+            return None
+        if self.step < len(self.requests):
+            command, expected = self.requests[self.step]
+            if reply != expected:
+                raise ConnectionError(f"unexpected reply to {command[0].decode()} from master: {reply}")
+            self.step += 1
+            return self.request()
+        match reply.split() if isinstance(reply, str) else []:
+            case ["CONTINUE", *new_replid]:
+                # The missing part of the stream follows as ordinary commands
+                if new_replid:
+                    replication.master_replid = new_replid[0]
+                self.psync_reply = reply
+                self._completed()
+            case ["FULLRESYNC", _, offset] if offset.isdigit():
+                # The RDB payload is a bulk string without the trailing CRLF; anything
+                # pipelined after it stays in the parser for the replication loop.
+                self.parser.expect_rdb_payload()
+                self.psync_reply = reply
+            case _:
+                raise ConnectionError(f"unexpected reply to PSYNC from master: {reply}")
+        return None
+
+    def _completed(self):
+        self.done = True
+        replication.master_link_up = True
+        print(f"Handshake with master completed: resp={self.psync_reply!r}")
+
+
+# What a failed handshake or sync with the master raises; the link retries
+MASTER_SYNC_ERRORS = (OSError, rdb_loader.RdbError, ProtocolError)
+
+
+def connect_to_master(args: Args) -> Tuple[socket.socket, RespParser]:
+    """Connect to the master and sync with it, blocking until done"""
+    (host, port) = args.replicaof.split(" ")
+    master_conn = socket.create_connection((host, int(port)))
+    parser = RespParser(args.query_buffer_limit)
+    handshake = MasterHandshake(args, parser)
+    try:
+        master_conn.sendall(handshake.request())
+        while not handshake.done:
+            request = handshake.on_reply(parser.read_frame(master_conn))
+            if request is not None:
+                master_conn.sendall(request)
+    except BaseException:
+        master_conn.close()
+        raise
+    return master_conn, parser
+
+
+def replicate_from_master(args: Args, master_conn: Optional[socket.socket], parser: Optional[RespParser]):
+    """Apply the master's stream, reconnecting whenever the link drops"""
+    while True:
+        if master_conn is not None:
+            conn = replication.master_conn = ThreadedConnection(master_conn, stats)
+            try:
+                handle_conn(args, conn, True, parser)
+            except OSError as e:
+                print(f"Lost connection with master: {e}")
+            master_conn.close()
+            replication.master_link_up = False
+            replication.master_conn = None
+        time.sleep(REPLICA_RECONNECT_DELAY)
+        try:
+            master_conn, parser = connect_to_master(args)
+        except MASTER_SYNC_ERRORS as e:
+            print(f"Error syncing with master: {e}")
+            master_conn = None
+
+
 def main(args: Args):
-    global db, processed_bytes
-    db = rdb_parser.read_file_and_construct_kvm(args.dir, args.dbfilename)
+    global slowlog, maxmemory, aof
+    rdb_path = os.path.join(args.dir, args.dbfilename)
+    aof_path = os.path.join(args.dir, args.appendfilename)
+    aof_exists = args.appendonly and os.path.exists(aof_path)
+    if aof_exists:
+        # The AOF is the more complete record, so it wins over the RDB file
+        try:
+            aof_module.replay(aof_path, load_snapshot, lambda value: replay_command(args, value))
+        except (OSError, rdb_loader.RdbError, aof_module.AofError, ProtocolError) as e:
+            raise SystemExit(f"Failed loading AOF file {aof_path}: {e}")
+    elif os.path.exists(rdb_path):
+        try:
+            load_snapshot(rdb_loader.load(rdb_path, now_ms=expires_module.mstime()))
+        except (OSError, rdb_loader.RdbError) as e:
+            raise SystemExit(f"Failed loading RDB file {rdb_path}: {e}")
+    if args.appendonly:
+        aof = AppendOnlyFile(aof_path, args.appendfsync)
+        if not aof_exists:
+            # Start the log from the dataset just loaded, not from nothing
+            rewrite_append_only_file()
+    maxmemory = MaxMemory(args.maxmemory, args.maxmemory_policy, args.maxmemory_samples)
+    persistence.path = rdb_path
+    persistence.save_points = args.save
+    replication.output_buffer_limit = args.replica_output_buffer_limit
+    slowlog = Slowlog(args.slowlog_log_slower_than, args.slowlog_max_len)
+    replication.is_replica = args.replicaof is not None
+    if args.metrics_port is not None:
+        start_metrics_server(args.metrics_port, render_metrics)
     server_socket = socket.create_server(
         ("localhost", args.port),
         reuse_port=True,
     )
-    if args.replicaof is not None:
-        (host, port) = args.replicaof.split(" ")
-        port = int(port)
-        master_conn = socket.create_connection((host, port))
+    if args.event_loop:
+        # The master link, if any, is driven by the loop too
+        with server_socket:
+            serve_event_loop(args, server_socket)
+        return
 
-        t = threading.Thread(
-            target=handle_conn,
-            args=(args, master_conn, True),
+    if args.replicaof is not None:
+        try:
+            master_conn, parser = connect_to_master(args)
+        except MASTER_SYNC_ERRORS as e:
+            # The link retries in the background, as after a disconnect
+            print(f"Error syncing with master: {e}")
+            master_conn = parser = None
+        threading.Thread(
+            target=replicate_from_master,
+            args=(args, master_conn, parser),
             daemon=True,
-        )
-        # Handshake PING
-        master_conn.send(encode_resp([b"PING"]))
-        responses, _ = parse_next(master_conn.recv(65536))
-        resp = responses[0] if responses else None
-        assert resp == "PONG"
-        # Handshake REPLCONF listening-port
-        master_conn.send(
-            encode_resp(
-                [
-                    b"REPLCONF",
-                    b"listening-port",
-                    str(args.port).encode(),
-                ]
-            )
-        )
-        responses, _ = parse_next(master_conn.recv(65536))
-        resp = responses[0] if responses else None
-        assert resp == "OK"
-        # Handshake REPLCONF capabilities
-        master_conn.send(encode_resp([b"REPLCONF", b"capa", b"psync2"]))
-        responses, _ = parse_next(master_conn.recv(65536))
-        resp = responses[0] if responses else None
-        assert resp == "OK"
-
-        # Handshake PSYNC
-        master_conn.send(encode_resp([b"PSYNC", b"?", b"-1"]))
-
-        #Handling this since the tcp messages are broken in different permutations
-        responses, _ = parse_next(master_conn.recv(65536))
-        count = len(responses)
-        while True:
-            # print("loop responses: ", responses)
-            if count == 2:
-                # print("1")
-                break
-            if count > 2:
-                # print("2")
-                for command in responses[2:]:
-                    print(encode_resp(command), len(encode_resp(command)))
-                    processed_bytes += len(encode_resp(command))
-                    response = handle_command(args, command, master_conn, False)
-                    print(response)
-                    print("encode : ",encode_resp(response))
-                    master_conn.send(encode_resp(response))
-                break
-            else:
-                # print("3")
-                temp_resp, _ = parse_next(master_conn.recv(65536))
-                responses.extend(temp_resp)
-                count += len(responses)
-
-        print("PSYNC response", responses)
-
-        t.start()
-        print(f"Handshake with master completed: {resp=}")
-
+        ).start()
 
+    server_cron()
     with server_socket:
         while True:
             (conn, _) = server_socket.accept()
+            if not accept_client(args, conn):
+                continue
             threading.Thread(
                 target=handle_conn,
                 args=(
                     args,
-                    conn,
+                    ThreadedConnection(conn, stats),
                     False,
                 ),
                 daemon=True,
@@ -1038,6 +3249,20 @@ if __name__ == "__main__":
     args.add_argument("--replicaof", required=False)
     args.add_argument("--dir", default=".")
     args.add_argument("--dbfilename", default="empty.rdb")
+    args.add_argument("--client-query-buffer-limit", type=int, default=DEFAULT_QUERY_BUFFER_LIMIT)
+    args.add_argument("--event-loop", action="store_true")
+    args.add_argument("--slowlog-log-slower-than", type=int, default=DEFAULT_LOG_SLOWER_THAN)
+    args.add_argument("--slowlog-max-len", type=int, default=DEFAULT_MAX_LEN)
+    args.add_argument("--maxclients", type=int, default=10000)
+    args.add_argument("--metrics-port", type=int, required=False)
+    args.add_argument("--maxmemory", type=parse_memory, default=0)
+    args.add_argument("--maxmemory-policy", choices=POLICIES, default=DEFAULT_POLICY)
+    args.add_argument("--maxmemory-samples", type=int, default=DEFAULT_SAMPLES)
+    args.add_argument("--save", action="append", default=[])
+    args.add_argument("--appendonly", choices=["yes", "no"], default="no")
+    args.add_argument("--appendfilename", default=aof_module.DEFAULT_FILENAME)
+    args.add_argument("--appendfsync", choices=APPENDFSYNC, default=DEFAULT_APPENDFSYNC)
+    args.add_argument("--client-output-buffer-limit", type=parse_output_buffer_limit, default=OutputBufferLimit())
 
     parsed_args = args.parse_args()
 
@@ -1045,7 +3270,21 @@ if __name__ == "__main__":
         port=parsed_args.port,
         replicaof=parsed_args.replicaof,
         dir=parsed_args.dir,
-        dbfilename=parsed_args.dbfilename
+        dbfilename=parsed_args.dbfilename,
+        query_buffer_limit=parsed_args.client_query_buffer_limit,
+        event_loop=parsed_args.event_loop,
+        slowlog_log_slower_than=parsed_args.slowlog_log_slower_than,
+        slowlog_max_len=parsed_args.slowlog_max_len,
+        maxclients=parsed_args.maxclients,
+        metrics_port=parsed_args.metrics_port,
+        maxmemory=parsed_args.maxmemory,
+        maxmemory_policy=parsed_args.maxmemory_policy,
+        maxmemory_samples=parsed_args.maxmemory_samples,
+        save=parse_save_points(parsed_args.save),
+        appendonly=parsed_args.appendonly == "yes",
+        appendfilename=parsed_args.appendfilename,
+        appendfsync=parsed_args.appendfsync,
+        replica_output_buffer_limit=parsed_args.client_output_buffer_limit,
     )
 
     main(args)
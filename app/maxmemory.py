@@ -0,0 +1,231 @@
+"""Memory accounting and maxmemory eviction.
+
+Sizes are estimates, not measurements: strings are measured with
+sys.getsizeof, and a collection is its length times the average size of a
+few sampled items plus a fixed per-item overhead, which keeps re-estimating
+a key after each write O(1) however big it is. Like Redis' MEMORY USAGE
+with SAMPLES, this is close for values of similar sizes and wrong by
+however much the samples are unrepresentative.
+
+Every key carries an access clock for the LRU policies and a Morris counter
+for the LFU ones, both updated the way Redis does. Eviction samples a few
+keys (from the whole keyspace or only those with a TTL) and deletes the
+best candidate of the sample until the dataset fits again.
+"""
+import itertools
+import math
+import random
+import sys
+from typing import Any, Callable, Dict, List, Optional
+
+from app.expires import ExpireIndex, SampledKeys, mstime
+from app.quicklist import QuickList
+from app.sorted_set import SortedSet
+from app.stream import Stream
+
+POLICIES = (
+    "noeviction",
+    "allkeys-lru",
+    "allkeys-lfu",
+    "allkeys-random",
+    "volatile-lru",
+    "volatile-lfu",
+    "volatile-random",
+    "volatile-ttl",
+)
+DEFAULT_POLICY = "noeviction"
+DEFAULT_SAMPLES = 5
+
+# Items sampled to estimate the average item size of a collection
+SIZE_SAMPLES = 5
+# Dict entry, key object and value wrapper of every key
+KEY_OVERHEAD = 96
+# Per item: list slot, skiplist node and dict entry, stream index entry,
+# set or hash table entry
+LIST_ITEM_OVERHEAD = 8
+ZSET_ITEM_OVERHEAD = 200
+STREAM_ENTRY_OVERHEAD = 150
+HASH_ITEM_OVERHEAD = 100
+
+# LFU counters as in Redis: new keys start at LFU_INIT_VAL, hits raise the
+# counter logarithmically and it drops by one for every LFU_DECAY_TIME
+# minutes without a hit
+LFU_INIT_VAL = 5
+LFU_LOG_FACTOR = 10
+LFU_DECAY_TIME = 1
+LFU_MAX = 255
+
+UNITS = {b"": 1, b"b": 1, b"k": 1000, b"kb": 1024, b"m": 1000 ** 2, b"mb": 1024 ** 2,
+         b"g": 1000 ** 3, b"gb": 1024 ** 3}
+
+
+def parse_memory(text: str) -> int:
+    """Byte count from a Redis memory argument like 100mb or 1gb"""
+    raw = text.strip().lower().encode()
+    digits = raw.rstrip(b"abcdefghijklmnopqrstuvwxyz")
+    unit = raw[len(digits):]
+    if not digits or unit not in UNITS:
+        raise ValueError(f"invalid memory size: {text}")
+    return int(digits) * UNITS[unit]
+
+
+def format_memory(n: int) -> str:
+    """used_memory_human style: 1.50M"""
+    for unit, size in (("G", 1024 ** 3), ("M", 1024 ** 2), ("K", 1024)):
+        if n >= size:
+            return f"{n / size:.2f}{unit}"
+    return f"{n}B"
+
+
+def _average(sizes: List[int]) -> float:
+    return sum(sizes) / len(sizes) if sizes else 0
+
+
+def estimate_size(key, value) -> int:
+    """Approximate bytes held by key and its value"""
+    size = KEY_OVERHEAD + sys.getsizeof(key)
+    if isinstance(value, (bytes, str)):
+        return size + sys.getsizeof(value)
+    if isinstance(value, QuickList):
+        sample = value.chunks[0][:SIZE_SAMPLES] if value.chunks else []
+        per_item = _average([sys.getsizeof(item) for item in sample]) + LIST_ITEM_OVERHEAD
+        return size + int(len(value) * per_item)
+    if isinstance(value, SortedSet):
+        sample = itertools.islice(value.dict, SIZE_SAMPLES)
+        per_item = _average([sys.getsizeof(member) for member in sample]) + ZSET_ITEM_OVERHEAD
+        return size + int(len(value) * per_item)
+    if isinstance(value, Stream):
+        sample = [
+            sum(sys.getsizeof(field) + sys.getsizeof(data) for field, data in entry.value.items())
+            for entry in itertools.islice(value, SIZE_SAMPLES)
+        ]
+        return size + int(len(value) * (_average(sample) + STREAM_ENTRY_OVERHEAD))
+    if isinstance(value, (set, dict)):
+        sample = [
+            sys.getsizeof(item) + (sys.getsizeof(value[item]) if isinstance(value, dict) else 0)
+            for item in itertools.islice(value, SIZE_SAMPLES)
+        ]
+        return size + int(len(value) * (_average(sample) + HASH_ITEM_OVERHEAD))
+    return size + sys.getsizeof(value)
+
+
+def lfu_time_minutes() -> int:
+    return mstime() // 60000
+
+
+class KeyMeta:
+    __slots__ = ("size", "access_ms", "counter", "decay_minutes")
+
+    def __init__(self, size: int):
+        self.size = size
+        self.access_ms = mstime()
+        self.counter = LFU_INIT_VAL
+        self.decay_minutes = lfu_time_minutes()
+
+    def decayed_counter(self) -> int:
+        periods = (lfu_time_minutes() - self.decay_minutes) // LFU_DECAY_TIME
+        return max(0, self.counter - periods)
+
+    def touch(self):
+        self.access_ms = mstime()
+        counter = self.decayed_counter()
+        # Each hit is less likely to count the higher the counter already is
+        if counter < LFU_MAX:
+            base = max(0, counter - LFU_INIT_VAL)
+            if random.random() < 1.0 / (base * LFU_LOG_FACTOR + 1):
+                counter += 1
+        self.counter = counter
+        self.decay_minutes = lfu_time_minutes()
+
+
+class KeyUsage:
+    """Estimated size, access clock and frequency counter of every key"""
+
+    def __init__(self):
+        self.meta: Dict[Any, KeyMeta] = {}
+        self.sampled = SampledKeys()
+        self.used = 0
+        self.peak = 0
+
+    def __len__(self) -> int:
+        return len(self.meta)
+
+    def update(self, key, value):
+        """Re-estimate key after a write; value None means the key is gone"""
+        if value is None:
+            self.remove(key)
+            return
+        size = estimate_size(key, value)
+        meta = self.meta.get(key)
+        if meta is None:
+            meta = self.meta[key] = KeyMeta(size)
+            self.sampled.add(key)
+            self.used += size
+        else:
+            self.used += size - meta.size
+            meta.size = size
+        self.peak = max(self.peak, self.used)
+
+    def remove(self, key):
+        meta = self.meta.pop(key, None)
+        if meta is not None:
+            self.used -= meta.size
+            self.sampled.discard(key)
+
+    def touch(self, key):
+        meta = self.meta.get(key)
+        if meta is not None:
+            meta.touch()
+
+    def idle_seconds(self, key) -> Optional[int]:
+        meta = self.meta.get(key)
+        return None if meta is None else (mstime() - meta.access_ms) // 1000
+
+    def frequency(self, key) -> Optional[int]:
+        meta = self.meta.get(key)
+        return None if meta is None else meta.decayed_counter()
+
+    def size(self, key) -> Optional[int]:
+        meta = self.meta.get(key)
+        return None if meta is None else meta.size
+
+
+class MaxMemory:
+    def __init__(self, limit: int = 0, policy: str = DEFAULT_POLICY, samples: int = DEFAULT_SAMPLES):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown maxmemory policy: {policy}")
+        self.limit = limit
+        self.policy = policy
+        self.samples = samples
+
+    def choose_victim(self, usage: KeyUsage, expires: ExpireIndex) -> Optional[Any]:
+        """Best key to evict among a sample, or None if the policy has none"""
+        scope, _, rule = self.policy.partition("-")
+        if scope == "volatile":
+            candidates = [key for key in expires.sample(self.samples) if key in usage.meta]
+        else:
+            candidates = usage.sampled.sample(self.samples)
+        if not candidates:
+            return None
+        if rule == "random":
+            return candidates[0]
+        if rule == "lru":
+            return min(candidates, key=lambda key: usage.meta[key].access_ms)
+        if rule == "lfu":
+            return min(candidates, key=lambda key: (usage.meta[key].decayed_counter(),
+                                                    usage.meta[key].access_ms))
+        return min(candidates, key=lambda key: expires.get(key) or math.inf)
+
+    def free(self, usage: KeyUsage, expires: ExpireIndex, evict: Callable[[Any], None]) -> bool:
+        """Evict keys through evict() until usage fits the limit; False if it can't"""
+        if not self.limit:
+            return True
+        while usage.used > self.limit:
+            if self.policy == "noeviction":
+                return False
+            victim = self.choose_victim(usage, expires)
+            if victim is None:
+                return False
+            evict(victim)
+            usage.remove(victim)
+        return True
@@ -0,0 +1,193 @@
+"""List engine: a deque of small Python lists, like Redis' quicklist.
+
+Pushes and pops touch one end chunk, so they cost O(1) however long the
+list is; a chunk is split once it grows past CHUNK_SIZE and dropped once it
+is empty. Positional access walks whole chunks from the nearer end, which
+is O(n / CHUNK_SIZE), and ranges slice only the chunks they cover instead
+of copying the list.
+"""
+from collections import deque
+from typing import Deque, Iterable, Iterator, List, Tuple
+
+CHUNK_SIZE = 128
+
+
+class QuickList:
+    def __init__(self, items: Iterable[bytes] = ()):
+        self.chunks: Deque[List[bytes]] = deque()
+        self.length = 0
+        self.extend_right(items)
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __iter__(self) -> Iterator[bytes]:
+        for chunk in self.chunks:
+            yield from chunk
+
+    def __reversed__(self) -> Iterator[bytes]:
+        for chunk in reversed(self.chunks):
+            yield from reversed(chunk)
+
+    def push_left(self, item: bytes):
+        if not self.chunks or len(self.chunks[0]) >= CHUNK_SIZE:
+            self.chunks.appendleft([])
+        self.chunks[0].insert(0, item)
+        self.length += 1
+
+    def push_right(self, item: bytes):
+        if not self.chunks or len(self.chunks[-1]) >= CHUNK_SIZE:
+            self.chunks.append([])
+        self.chunks[-1].append(item)
+        self.length += 1
+
+    def extend_left(self, items: Iterable[bytes]):
+        """LPUSH order: each item becomes the new head in turn"""
+        for item in items:
+            self.push_left(item)
+
+    def extend_right(self, items: Iterable[bytes]):
+        for item in items:
+            self.push_right(item)
+
+    def append_chunk(self, items: List[bytes]):
+        """Append items as whole chunks, as a loader does with each node"""
+        for start in range(0, len(items), CHUNK_SIZE):
+            chunk = items[start:start + CHUNK_SIZE]
+            self.chunks.append(chunk)
+            self.length += len(chunk)
+
+    def pop_left(self) -> bytes:
+        chunk = self.chunks[0]
+        item = chunk.pop(0)
+        if not chunk:
+            self.chunks.popleft()
+        self.length -= 1
+        return item
+
+    def pop_right(self) -> bytes:
+        chunk = self.chunks[-1]
+        item = chunk.pop()
+        if not chunk:
+            self.chunks.pop()
+        self.length -= 1
+        return item
+
+    def _locate(self, index: int) -> Tuple[int, int]:
+        """(chunk number, offset in chunk) of a position in 0..length-1"""
+        if index < self.length // 2:
+            for i, chunk in enumerate(self.chunks):
+                if index < len(chunk):
+                    return i, index
+                index -= len(chunk)
+        else:
+            index = self.length - 1 - index
+            for i in range(len(self.chunks) - 1, -1, -1):
+                chunk = self.chunks[i]
+                if index < len(chunk):
+                    return i, len(chunk) - 1 - index
+                index -= len(chunk)
+        raise IndexError("list index out of range")
+
+    def _resolve(self, index: int) -> int:
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError("list index out of range")
+        return index
+
+    def __getitem__(self, index: int) -> bytes:
+        i, offset = self._locate(self._resolve(index))
+        return self.chunks[i][offset]
+
+    def __setitem__(self, index: int, item: bytes):
+        i, offset = self._locate(self._resolve(index))
+        self.chunks[i][offset] = item
+
+    def range(self, start: int, stop: int) -> List[bytes]:
+        """Items start..stop inclusive; both must already be inside the list"""
+        if start > stop:
+            return []
+        i, offset = self._locate(start)
+        remaining = stop - start + 1
+        result: List[bytes] = []
+        while remaining:
+            piece = self.chunks[i][offset:offset + remaining]
+            result.extend(piece)
+            remaining -= len(piece)
+            i += 1
+            offset = 0
+        return result
+
+    def trim(self, start: int, stop: int):
+        """Keep only items start..stop inclusive, like LTRIM after clamping"""
+        if start > stop or start >= self.length or stop < 0:
+            self.chunks.clear()
+            self.length = 0
+            return
+        drop_tail = self.length - 1 - stop
+        while drop_tail:
+            chunk = self.chunks[-1]
+            if len(chunk) <= drop_tail:
+                self.chunks.pop()
+                drop_tail -= len(chunk)
+            else:
+                del chunk[-drop_tail:]
+                drop_tail = 0
+        drop_head = start
+        while drop_head:
+            chunk = self.chunks[0]
+            if len(chunk) <= drop_head:
+                self.chunks.popleft()
+                drop_head -= len(chunk)
+            else:
+                del chunk[:drop_head]
+                drop_head = 0
+        self.length = stop - start + 1
+
+    def insert(self, index: int, item: bytes):
+        """Insert item before position index (0..length)"""
+        if index == 0:
+            self.push_left(item)
+            return
+        if index == self.length:
+            self.push_right(item)
+            return
+        i, offset = self._locate(index)
+        chunk = self.chunks[i]
+        chunk.insert(offset, item)
+        self.length += 1
+        if len(chunk) > CHUNK_SIZE:
+            half = len(chunk) // 2
+            self.chunks.insert(i + 1, chunk[half:])
+            del chunk[half:]
+
+    def index(self, item: bytes) -> int:
+        """Position of the first item equal to item, or -1"""
+        for position, candidate in enumerate(self):
+            if candidate == item:
+                return position
+        return -1
+
+    def remove(self, item: bytes, count: int = 0) -> int:
+        """LREM: drop up to |count| copies of item from the head (count > 0),
+        the tail (count < 0) or everywhere (0); returns how many went"""
+        limit = abs(count) or self.length
+        removed = 0
+        order = range(len(self.chunks)) if count >= 0 else range(len(self.chunks) - 1, -1, -1)
+        for i in order:
+            chunk = self.chunks[i]
+            positions = [p for p, candidate in enumerate(chunk) if candidate == item]
+            if count < 0:
+                positions.reverse()
+            positions = positions[:limit - removed]
+            for p in sorted(positions, reverse=True):
+                del chunk[p]
+            removed += len(positions)
+            if removed == limit:
+                break
+        if removed:
+            self.chunks = deque(chunk for chunk in self.chunks if chunk)
+            self.length -= removed
+        return removed
+
@@ -0,0 +1,557 @@
+"""RDB snapshot loader.
+
+Reads RDB files up to version 12 (Redis 7.4): strings (raw, integer and
+LZF-compressed), lists (linked, ziplist, quicklist of ziplists or
+listpacks), sets (plain, intset, listpack), sorted sets (plain, ZSET_2,
+ziplist, listpack), hashes (plain, zipmap, ziplist, listpack) and streams
+with their consumer groups, across every database in the file.
+
+Files are mapped with mmap rather than read into memory, so the page cache
+is the only copy of the raw bytes and the parser pulls each object straight
+out of the mapping with struct.unpack_from and slices. Progress is printed
+every PROGRESS_INTERVAL seconds while loading and once at the end.
+
+Anything the loader can't make sense of raises RdbError with the offset it
+got to, instead of returning a partial or empty dataset. The trailing
+CRC64 is not verified: checking it byte by byte in Python would cost more
+than the whole load.
+"""
+import dataclasses
+import mmap
+import os
+import struct
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from app import listpack
+from app.quicklist import QuickList
+from app.sorted_set import SortedSet
+from app.stream import Consumer, ConsumerGroup, PendingEntry, Stream, StreamID
+
+MAX_RDB_VERSION = 12
+
+OPCODE_SLOT_INFO = 0xF4
+OPCODE_FUNCTION2 = 0xF5
+OPCODE_FUNCTION_PRE_GA = 0xF6
+OPCODE_MODULE_AUX = 0xF7
+OPCODE_IDLE = 0xF8
+OPCODE_FREQ = 0xF9
+OPCODE_AUX = 0xFA
+OPCODE_RESIZEDB = 0xFB
+OPCODE_EXPIRETIME_MS = 0xFC
+OPCODE_EXPIRETIME = 0xFD
+OPCODE_SELECTDB = 0xFE
+OPCODE_EOF = 0xFF
+
+TYPE_STRING = 0
+TYPE_LIST = 1
+TYPE_SET = 2
+TYPE_ZSET = 3
+TYPE_HASH = 4
+TYPE_ZSET_2 = 5
+TYPE_MODULE_PRE_GA = 6
+TYPE_MODULE_2 = 7
+TYPE_HASH_ZIPMAP = 9
+TYPE_LIST_ZIPLIST = 10
+TYPE_SET_INTSET = 11
+TYPE_ZSET_ZIPLIST = 12
+TYPE_HASH_ZIPLIST = 13
+TYPE_LIST_QUICKLIST = 14
+TYPE_STREAM_LISTPACKS = 15
+TYPE_HASH_LISTPACK = 16
+TYPE_ZSET_LISTPACK = 17
+TYPE_LIST_QUICKLIST_2 = 18
+TYPE_STREAM_LISTPACKS_2 = 19
+TYPE_SET_LISTPACK = 20
+TYPE_STREAM_LISTPACKS_3 = 21
+
+ENCODING_INT8 = 0
+ENCODING_INT16 = 1
+ENCODING_INT32 = 2
+ENCODING_LZF = 3
+
+QUICKLIST_NODE_PLAIN = 1
+
+STREAM_ITEM_FLAG_DELETED = 1
+STREAM_ITEM_FLAG_SAMEFIELDS = 2
+
+PROGRESS_INTERVAL = 1.0
+# Keys loaded between looks at the clock for progress reports
+PROGRESS_CHECK_KEYS = 1024
+
+_I8 = struct.Struct("<b")
+_I16 = struct.Struct("<h")
+_I32 = struct.Struct("<i")
+_I64 = struct.Struct("<q")
+_U32_LE = struct.Struct("<I")
+_U32_BE = struct.Struct(">I")
+_U64_BE = struct.Struct(">Q")
+_DOUBLE = struct.Struct("<d")
+_STREAM_ID = struct.Struct(">QQ")
+
+
+class RdbError(Exception):
+    pass
+
+
+@dataclasses.dataclass
+class Snapshot:
+    """Everything loaded from one RDB file, by database number"""
+    databases: Dict[int, Dict[bytes, Any]] = dataclasses.field(default_factory=dict)
+    expires: Dict[int, Dict[bytes, int]] = dataclasses.field(default_factory=dict)
+    aux: Dict[bytes, bytes] = dataclasses.field(default_factory=dict)
+    version: int = 0
+    keys_loaded: int = 0
+    keys_expired: int = 0
+    size: int = 0
+    end: int = 0  # offset just past the checksum, where an AOF tail starts
+    seconds: float = 0.0
+
+
+def _to_bytes(element: listpack.Element) -> bytes:
+    return element if isinstance(element, bytes) else str(element).encode()
+
+
+def _all_bytes(elements: List[listpack.Element]) -> List[bytes]:
+    return [element if element.__class__ is bytes else b"%d" % element for element in elements]
+
+
+def lzf_decompress(data: bytes, length: int) -> bytes:
+    """Inverse of Redis' lzf_compress: literal runs and back references"""
+    out = bytearray()
+    i = 0
+    end = len(data)
+    while i < end:
+        ctrl = data[i]
+        i += 1
+        if ctrl < 32:  # literal run of ctrl + 1 bytes
+            out += data[i:i + ctrl + 1]
+            i += ctrl + 1
+            continue
+        ref_len = ctrl >> 5
+        if ref_len == 7:
+            ref_len += data[i]
+            i += 1
+        ref = len(out) - ((ctrl & 0x1F) << 8) - data[i] - 1
+        i += 1
+        ref_len += 2
+        if ref < 0:
+            raise RdbError("invalid LZF back reference")
+        if ref + ref_len <= len(out):
+            out += out[ref:ref + ref_len]
+        else:
+            # The copy overlaps its own output: it repeats the tail from ref
+            period = out[ref:]
+            out += (period * (ref_len // len(period) + 1))[:ref_len]
+    if len(out) != length:
+        raise RdbError(f"LZF data decompressed to {len(out)} bytes, expected {length}")
+    return bytes(out)
+
+
+def ziplist_decode(data: bytes) -> List[listpack.Element]:
+    """Entries of a ziplist, the pre-7.0 encoding of small collections"""
+    elements: List[listpack.Element] = []
+    pos = 10  # zlbytes, zltail, zllen
+    while data[pos] != 0xFF:
+        pos += 5 if data[pos] == 0xFE else 1  # previous entry length
+        encoding = data[pos]
+        kind = encoding >> 6
+        if kind == 0:
+            length = encoding & 0x3F
+            pos += 1
+        elif kind == 1:
+            length = ((encoding & 0x3F) << 8) | data[pos + 1]
+            pos += 2
+        elif kind == 2:
+            length = struct.unpack_from(">I", data, pos + 1)[0]
+            pos += 5
+        else:
+            pos += 1
+            if encoding == 0xC0:
+                elements.append(struct.unpack_from("<h", data, pos)[0])
+                pos += 2
+            elif encoding == 0xD0:
+                elements.append(struct.unpack_from("<i", data, pos)[0])
+                pos += 4
+            elif encoding == 0xE0:
+                elements.append(struct.unpack_from("<q", data, pos)[0])
+                pos += 8
+            elif encoding == 0xF0:
+                elements.append(int.from_bytes(data[pos:pos + 3], "little", signed=True))
+                pos += 3
+            elif encoding == 0xFE:
+                elements.append(struct.unpack_from("<b", data, pos)[0])
+                pos += 1
+            elif 0xF1 <= encoding <= 0xFD:  # 4-bit immediate 0..12
+                elements.append((encoding & 0x0F) - 1)
+            else:
+                raise ValueError(f"bad ziplist encoding byte {encoding:#x}")
+            continue
+        if pos + length > len(data):
+            raise ValueError("truncated ziplist entry")
+        elements.append(data[pos:pos + length])
+        pos += length
+    return elements
+
+
+def intset_decode(data: bytes) -> Tuple[int, ...]:
+    width, count = struct.unpack_from("<II", data)
+    code = {2: "h", 4: "i", 8: "q"}.get(width)
+    if code is None or 8 + width * count > len(data):
+        raise ValueError(f"bad intset of {count} {width}-byte integers")
+    return struct.unpack_from(f"<{count}{code}", data, 8)
+
+
+def zipmap_decode(data: bytes) -> Dict[bytes, bytes]:
+    """Field/value pairs of a zipmap, the pre-2.6 small hash encoding"""
+    pairs: Dict[bytes, bytes] = {}
+    pos = 1  # entry count, unreliable past 253
+
+    def read_length() -> int:
+        nonlocal pos
+        length = data[pos]
+        if length < 254:
+            pos += 1
+            return length
+        if length == 254:
+            pos += 5
+            return struct.unpack_from("<I", data, pos - 4)[0]
+        return -1
+
+    while True:
+        length = read_length()
+        if length < 0:
+            return pairs
+        field = data[pos:pos + length]
+        pos += length
+        length = read_length()
+        free = data[pos]
+        pos += 1
+        pairs[field] = data[pos:pos + length]
+        pos += length + free
+
+
+def _pairs(elements: List[listpack.Element]) -> List[Tuple[bytes, listpack.Element]]:
+    if len(elements) % 2:
+        raise ValueError("odd number of elements in a paired encoding")
+    return list(zip(map(_to_bytes, elements[0::2]), elements[1::2]))
+
+
+def _zset_from_pairs(pairs) -> SortedSet:
+    zset = SortedSet()
+    zset.bulk_load([(member, float(score)) for member, score in pairs])
+    return zset
+
+
+def _add_stream_node(stream: Stream, master_id: bytes, elements: List[listpack.Element]):
+    """Append the live entries of one radix-tree node to stream"""
+    if len(master_id) != 16:
+        raise ValueError("stream node key is not a 128-bit ID")
+    master_ms, master_seq = struct.unpack(">QQ", master_id)
+    master_count = elements[2]
+    master_fields = [_to_bytes(field) for field in elements[3:3 + master_count]]
+    i = 3 + master_count + 1  # past the master entry's terminating 0
+    while i < len(elements):
+        flags, ms_diff, seq_diff = elements[i:i + 3]
+        i += 3
+        if flags & STREAM_ITEM_FLAG_SAMEFIELDS:
+            values = elements[i:i + master_count]
+            i += master_count
+            fields = dict(zip(master_fields, map(_to_bytes, values)))
+        else:
+            count = elements[i]
+            pairs = elements[i + 1:i + 1 + 2 * count]
+            i += 1 + 2 * count
+            fields = dict(zip(map(_to_bytes, pairs[0::2]), map(_to_bytes, pairs[1::2])))
+        i += 1  # entry's element count, for walking backwards
+        if not flags & STREAM_ITEM_FLAG_DELETED:
+            stream.add((master_ms + ms_diff, master_seq + seq_diff), fields)
+
+
+class RdbReader:
+    """Cursor over the raw bytes of an RDB file"""
+
+    def __init__(self, buf):
+        self.buf = buf
+        self.pos = 0
+        self.end = len(buf)
+
+    def take(self, n: int) -> bytes:
+        pos = self.pos
+        if pos + n > self.end:
+            raise RdbError(f"unexpected end of file reading {n} bytes at {pos}")
+        self.pos = pos + n
+        return self.buf[pos:pos + n]
+
+    def byte(self) -> int:
+        if self.pos >= self.end:
+            raise RdbError(f"unexpected end of file at {self.pos}")
+        value = self.buf[self.pos]
+        self.pos += 1
+        return value
+
+    def unpack(self, fmt: struct.Struct) -> Tuple:
+        pos = self.pos
+        if pos + fmt.size > self.end:
+            raise RdbError(f"unexpected end of file at {pos}")
+        self.pos = pos + fmt.size
+        return fmt.unpack_from(self.buf, pos)
+
+    def length_or_encoding(self) -> Tuple[int, bool]:
+        """(length, False), or (string encoding, True) for special strings"""
+        first = self.byte()
+        kind = first >> 6
+        if kind == 0:
+            return first & 0x3F, False
+        if kind == 1:
+            return ((first & 0x3F) << 8) | self.byte(), False
+        if kind == 3:
+            return first & 0x3F, True
+        if first == 0x80:
+            return self.unpack(_U32_BE)[0], False
+        if first == 0x81:
+            return self.unpack(_U64_BE)[0], False
+        raise RdbError(f"bad length byte {first:#x} at {self.pos - 1}")
+
+    def length(self) -> int:
+        length, encoded = self.length_or_encoding()
+        if encoded:
+            raise RdbError(f"unexpected string encoding where a length belongs at {self.pos - 1}")
+        return length
+
+    def string(self) -> bytes:
+        pos = self.pos
+        if pos < self.end and self.buf[pos] < 0x40:
+            # Fast path for the common short string: one length byte
+            end = pos + 1 + self.buf[pos]
+            if end > self.end:
+                raise RdbError(f"unexpected end of file in string at {pos}")
+            self.pos = end
+            return self.buf[pos + 1:end]
+        length, encoded = self.length_or_encoding()
+        if not encoded:
+            return self.take(length)
+        if length == ENCODING_INT8:
+            return b"%d" % self.unpack(_I8)[0]
+        if length == ENCODING_INT16:
+            return b"%d" % self.unpack(_I16)[0]
+        if length == ENCODING_INT32:
+            return b"%d" % self.unpack(_I32)[0]
+        if length == ENCODING_LZF:
+            compressed_length = self.length()
+            raw_length = self.length()
+            return lzf_decompress(self.take(compressed_length), raw_length)
+        raise RdbError(f"unknown string encoding {length} at {self.pos - 1}")
+
+    def millisecond_time(self) -> int:
+        return self.unpack(_I64)[0]
+
+    def double_string(self) -> float:
+        """Score of the old ZSET type: a length-prefixed decimal string"""
+        length = self.byte()
+        if length == 253:
+            return float("nan")
+        if length == 254:
+            return float("inf")
+        if length == 255:
+            return float("-inf")
+        return float(self.take(length))
+
+    def binary_double(self) -> float:
+        return self.unpack(_DOUBLE)[0]
+
+    def stream_id(self) -> StreamID:
+        return self.unpack(_STREAM_ID)
+
+    def value(self, rdb_type: int):
+        if rdb_type == TYPE_STRING:
+            return self.string()
+        if rdb_type == TYPE_LIST:
+            return QuickList(self.string() for _ in range(self.length()))
+        if rdb_type == TYPE_SET:
+            return {self.string() for _ in range(self.length())}
+        if rdb_type == TYPE_ZSET:
+            return _zset_from_pairs([(self.string(), self.double_string()) for _ in range(self.length())])
+        if rdb_type == TYPE_ZSET_2:
+            return _zset_from_pairs([(self.string(), self.binary_double()) for _ in range(self.length())])
+        if rdb_type == TYPE_HASH:
+            return {self.string(): self.string() for _ in range(self.length())}
+        if rdb_type == TYPE_HASH_ZIPMAP:
+            return zipmap_decode(self.string())
+        if rdb_type == TYPE_LIST_ZIPLIST:
+            return QuickList(_all_bytes(ziplist_decode(self.string())))
+        if rdb_type == TYPE_SET_INTSET:
+            return {b"%d" % member for member in intset_decode(self.string())}
+        if rdb_type == TYPE_SET_LISTPACK:
+            return set(_all_bytes(listpack.decode(self.string())))
+        if rdb_type in (TYPE_ZSET_ZIPLIST, TYPE_ZSET_LISTPACK):
+            decode = ziplist_decode if rdb_type == TYPE_ZSET_ZIPLIST else listpack.decode
+            return _zset_from_pairs(_pairs(decode(self.string())))
+        if rdb_type in (TYPE_HASH_ZIPLIST, TYPE_HASH_LISTPACK):
+            decode = ziplist_decode if rdb_type == TYPE_HASH_ZIPLIST else listpack.decode
+            return {field: _to_bytes(value) for field, value in _pairs(decode(self.string()))}
+        if rdb_type == TYPE_LIST_QUICKLIST:
+            items = QuickList()
+            for _ in range(self.length()):
+                items.append_chunk(_all_bytes(ziplist_decode(self.string())))
+            return items
+        if rdb_type == TYPE_LIST_QUICKLIST_2:
+            items = QuickList()
+            for _ in range(self.length()):
+                if self.length() == QUICKLIST_NODE_PLAIN:
+                    items.push_right(self.string())
+                else:
+                    items.append_chunk(_all_bytes(listpack.decode(self.string())))
+            return items
+        if rdb_type in (TYPE_STREAM_LISTPACKS, TYPE_STREAM_LISTPACKS_2, TYPE_STREAM_LISTPACKS_3):
+            return self.stream(rdb_type)
+        if rdb_type in (TYPE_MODULE_PRE_GA, TYPE_MODULE_2):
+            raise RdbError("module data types are not supported")
+        raise RdbError(f"unknown value type {rdb_type}")
+
+    def stream(self, rdb_type: int) -> Stream:
+        stream = Stream()
+        for _ in range(self.length()):
+            master_id = self.string()
+            _add_stream_node(stream, master_id, listpack.decode(self.string()))
+        self.length()  # entry count
+        last_id = (self.length(), self.length())
+        if rdb_type >= TYPE_STREAM_LISTPACKS_2:
+            self.length(), self.length()  # first ID
+            stream.max_deleted_entry_id = (self.length(), self.length())
+            stream.entries_added = self.length()
+        stream.last_id = last_id
+        for _ in range(self.length()):
+            group = self.consumer_group(rdb_type)
+            stream.groups[group.name] = group
+        return stream
+
+    def consumer_group(self, rdb_type: int) -> ConsumerGroup:
+        group = ConsumerGroup(self.string(), (self.length(), self.length()))
+        if rdb_type >= TYPE_STREAM_LISTPACKS_2:
+            self.length()  # entries read
+        for _ in range(self.length()):
+            entry_id = self.stream_id()
+            delivery_time = self.millisecond_time()
+            group.pending.add(entry_id, PendingEntry(None, delivery_time, self.length()))
+        for _ in range(self.length()):
+            consumer = Consumer(self.string())
+            consumer.seen_time = self.millisecond_time()
+            if rdb_type >= TYPE_STREAM_LISTPACKS_3:
+                self.millisecond_time()  # active time
+            for _ in range(self.length()):
+                entry_id = self.stream_id()
+                pending = group.pending.get(entry_id)
+                if pending is None:
+                    raise RdbError(f"consumer pending entry {entry_id} missing from the group")
+                pending.consumer = consumer
+                consumer.pending.add(entry_id, pending)
+            group.consumers[consumer.name] = consumer
+        for entry_id in group.pending.ids:
+            if group.pending.get(entry_id).consumer is None:
+                # As Redis does: every delivery belongs to some consumer
+                raise RdbError(f"group pending entry {entry_id} has no consumer")
+        return group
+
+
+def _print_progress(snapshot: Snapshot, loaded_bytes: int, elapsed: float):
+    mb = loaded_bytes / (1 << 20)
+    print(
+        f"Loading RDB: {loaded_bytes * 100 // max(snapshot.size, 1)}% "
+        f"({mb:.1f} of {snapshot.size / (1 << 20):.1f} MB, {mb / max(elapsed, 1e-9):.1f} MB/s), "
+        f"{snapshot.keys_loaded} keys"
+    )
+
+
+def parse(
+    buf,
+    now_ms: Optional[int] = None,
+    progress: Optional[Callable[[Snapshot, int, float], None]] = None,
+) -> Snapshot:
+    """Load an RDB image from any buffer (bytes, mmap).
+
+    Keys whose expiry is at or before now_ms are skipped, as a master does
+    at startup; now_ms None keeps them all, as a replica does.
+    """
+    start = time.monotonic()
+    reader = RdbReader(buf)
+    snapshot = Snapshot(size=len(buf))
+    magic = reader.take(9)
+    if magic[:5] != b"REDIS" or not magic[5:].isdigit():
+        raise RdbError("not an RDB file")
+    snapshot.version = int(magic[5:])
+    if snapshot.version > MAX_RDB_VERSION:
+        raise RdbError(f"can't load RDB format version {snapshot.version}")
+    keys = snapshot.databases.setdefault(0, {})
+    expires = snapshot.expires.setdefault(0, {})
+    expiry_ms: Optional[int] = None
+    last_report = start
+    while True:
+        opcode_pos = reader.pos
+        opcode = reader.byte()
+        if opcode < OPCODE_SLOT_INFO:  # a value type: the next key follows
+            key = reader.string()
+            try:
+                value = reader.string() if opcode == TYPE_STRING else reader.value(opcode)
+            except (IndexError, ValueError, struct.error) as e:
+                raise RdbError(f"corrupt value of type {opcode} for key {key!r} at {opcode_pos}: {e}") from e
+            if expiry_ms is not None and now_ms is not None and expiry_ms <= now_ms:
+                snapshot.keys_expired += 1
+            else:
+                keys[key] = value
+                if expiry_ms is not None:
+                    expires[key] = expiry_ms
+                snapshot.keys_loaded += 1
+            expiry_ms = None
+            if progress is not None and snapshot.keys_loaded % PROGRESS_CHECK_KEYS == 0:
+                now = time.monotonic()
+                if now - last_report >= PROGRESS_INTERVAL:
+                    progress(snapshot, reader.pos, now - start)
+                    last_report = now
+        elif opcode == OPCODE_EOF:
+            # An 8-byte checksum follows since version 5
+            snapshot.end = min(reader.pos + 8, reader.end) if snapshot.version >= 5 else reader.pos
+            break
+        elif opcode == OPCODE_SELECTDB:
+            number = reader.length()
+            keys = snapshot.databases.setdefault(number, {})
+            expires = snapshot.expires.setdefault(number, {})
+        elif opcode == OPCODE_RESIZEDB:
+            reader.length(), reader.length()
+        elif opcode == OPCODE_AUX:
+            field = reader.string()
+            snapshot.aux[field] = reader.string()
+        elif opcode == OPCODE_EXPIRETIME_MS:
+            expiry_ms = reader.millisecond_time()
+        elif opcode == OPCODE_EXPIRETIME:
+            expiry_ms = reader.unpack(_U32_LE)[0] * 1000
+        elif opcode == OPCODE_IDLE:
+            reader.length()
+        elif opcode == OPCODE_FREQ:
+            reader.byte()
+        elif opcode == OPCODE_SLOT_INFO:
+            reader.length(), reader.length(), reader.length()
+        elif opcode == OPCODE_FUNCTION2:
+            reader.string()  # library code; there is no scripting to load it into
+        else:
+            raise RdbError(f"unsupported opcode {opcode:#x} at {opcode_pos}")
+    snapshot.seconds = time.monotonic() - start
+    return snapshot
+
+
+def load(path: str, now_ms: Optional[int] = None, verbose: bool = True) -> Snapshot:
+    """Load the RDB file at path through a read-only memory mapping"""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise RdbError("empty file")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            if hasattr(mmap, "MADV_SEQUENTIAL"):
+                buf.madvise(mmap.MADV_SEQUENTIAL)
+            snapshot = parse(buf, now_ms, _print_progress if verbose else None)
+    if verbose:
+        mb = snapshot.size / (1 << 20)
+        print(
+            f"Done loading RDB, keys loaded: {snapshot.keys_loaded}, keys expired: {snapshot.keys_expired}, "
+            f"{mb:.1f} MB in {snapshot.seconds:.2f} seconds ({mb / max(snapshot.seconds, 1e-9):.1f} MB/s)"
+        )
+    return snapshot
@@ -0,0 +1,334 @@
+"""RDB snapshot writer.
+
+Writes version 11 RDB files as Redis 7.2 does: strings as plain strings,
+lists as quicklists of listpacks (one per QuickList chunk), sorted sets as
+ZSET_2 (member and binary double), streams as radix-tree nodes of up to
+NODE_ENTRIES listpack-encoded entries with their consumer groups, and TTLs
+as millisecond expiry opcodes. Sets and hashes, which only arrive through
+another server's snapshot, are written back in their plain encodings. The
+checksum is written as zero, which Redis reads as "checksum disabled".
+
+save() writes to a temp file in the target directory, fsyncs it and renames
+it over the old snapshot, so a crash mid-save leaves the old file intact.
+write_sync_payload() frames the same image for a full resync.
+"""
+import dataclasses
+import io
+import itertools
+import os
+import struct
+import time
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple
+
+from app import listpack
+from app.expires import ExpireIndex
+from app.quicklist import QuickList
+from app.rdb_parser import XADDValue
+from app.sorted_set import SortedSet
+from app.stream import NODE_ENTRIES, ConsumerGroup, Stream, StreamID
+
+RDB_VERSION = 11
+
+OPCODE_AUX = 0xFA
+OPCODE_RESIZEDB = 0xFB
+OPCODE_EXPIRETIME_MS = 0xFC
+OPCODE_SELECTDB = 0xFE
+OPCODE_EOF = 0xFF
+
+TYPE_STRING = 0
+TYPE_SET = 2
+TYPE_HASH = 4
+TYPE_ZSET_2 = 5
+TYPE_LIST_QUICKLIST_2 = 18
+TYPE_STREAM_LISTPACKS_3 = 21
+
+QUICKLIST_NODE_PACKED = 2
+
+STREAM_ITEM_FLAG_NONE = 0
+STREAM_ITEM_FLAG_SAMEFIELDS = 2
+# Consumer group entries_read when it isn't tracked; Redis recomputes it
+ENTRIES_READ_UNKNOWN = (1 << 64) - 1
+
+
+def _raw(value) -> bytes:
+    return value.encode() if isinstance(value, str) else value
+
+
+class RdbWriter:
+    def __init__(self, out: BinaryIO):
+        self.out = out
+
+    def write(self, data: bytes):
+        self.out.write(data)
+
+    def length(self, n: int):
+        if n < 1 << 6:
+            self.write(bytes([n]))
+        elif n < 1 << 14:
+            self.write(bytes([0x40 | (n >> 8), n & 0xFF]))
+        elif n <= 0xFFFFFFFF:
+            self.write(b"\x80" + struct.pack(">I", n))
+        else:
+            self.write(b"\x81" + struct.pack(">Q", n))
+
+    def string(self, value):
+        value = _raw(value)
+        self.length(len(value))
+        self.write(value)
+
+    def millisecond_time(self, ms: int):
+        self.write(struct.pack("<q", ms))
+
+    def stream_id(self, entry_id: StreamID):
+        self.write(struct.pack(">QQ", *entry_id))
+
+    def header(self):
+        self.write(b"REDIS%04d" % RDB_VERSION)
+        for field, value in (
+            (b"redis-ver", b"7.2.0"),
+            (b"redis-bits", b"64"),
+            (b"ctime", str(int(time.time())).encode()),
+            (b"aof-base", b"0"),
+        ):
+            self.write(bytes([OPCODE_AUX]))
+            self.string(field)
+            self.string(value)
+
+    def key_value(self, key, value, expiry_ms: Optional[int]):
+        if expiry_ms is not None:
+            self.write(bytes([OPCODE_EXPIRETIME_MS]))
+            self.millisecond_time(expiry_ms)
+        if isinstance(value, QuickList):
+            self.write(bytes([TYPE_LIST_QUICKLIST_2]))
+            self.string(key)
+            self.list(value)
+        elif isinstance(value, SortedSet):
+            self.write(bytes([TYPE_ZSET_2]))
+            self.string(key)
+            self.zset(value)
+        elif isinstance(value, Stream):
+            self.write(bytes([TYPE_STREAM_LISTPACKS_3]))
+            self.string(key)
+            self.stream(value)
+        elif isinstance(value, set):
+            self.write(bytes([TYPE_SET]))
+            self.string(key)
+            self.length(len(value))
+            for member in value:
+                self.string(member)
+        elif isinstance(value, dict):
+            self.write(bytes([TYPE_HASH]))
+            self.string(key)
+            self.length(len(value))
+            for field, data in value.items():
+                self.string(field)
+                self.string(data)
+        else:
+            self.write(bytes([TYPE_STRING]))
+            self.string(key)
+            self.string(value)
+
+    def list(self, items: QuickList):
+        self.length(len(items.chunks))
+        for chunk in items.chunks:
+            self.length(QUICKLIST_NODE_PACKED)
+            self.string(listpack.encode(chunk))
+
+    def zset(self, zset: SortedSet):
+        self.length(len(zset))
+        for member, score in zset.dict.items():
+            self.string(member)
+            self.write(struct.pack("<d", score))
+
+    def stream(self, stream: Stream):
+        entries = iter(stream)
+        nodes = -(-len(stream) // NODE_ENTRIES)
+        self.length(nodes)
+        for _ in range(nodes):
+            node = list(itertools.islice(entries, NODE_ENTRIES))
+            self.string(struct.pack(">QQ", node[0].milliseconds, node[0].sequence))
+            self.string(stream_node(node))
+        self.length(len(stream))
+        for entry_id in (stream.last_id, stream.first_entry_id() or (0, 0), stream.max_deleted_entry_id):
+            self.length(entry_id[0])
+            self.length(entry_id[1])
+        self.length(stream.entries_added)
+        self.length(len(stream.groups))
+        for group in stream.groups.values():
+            self.consumer_group(group)
+
+    def consumer_group(self, group: ConsumerGroup):
+        self.string(group.name)
+        self.length(group.last_id[0])
+        self.length(group.last_id[1])
+        self.length(ENTRIES_READ_UNKNOWN)
+        self.length(len(group.pending))
+        for entry_id in group.pending.ids:
+            pending = group.pending.get(entry_id)
+            self.stream_id(entry_id)
+            self.millisecond_time(pending.delivery_time)
+            self.length(pending.delivery_count)
+        self.length(len(group.consumers))
+        for consumer in group.consumers.values():
+            self.string(consumer.name)
+            self.millisecond_time(consumer.seen_time)  # seen time
+            self.millisecond_time(consumer.seen_time)  # active time
+            self.length(len(consumer.pending))
+            for entry_id in consumer.pending.ids:
+                self.stream_id(entry_id)
+
+    def footer(self):
+        self.write(bytes([OPCODE_EOF]))
+        self.write(bytes(8))  # no checksum
+
+
+def stream_node(entries: List[XADDValue]) -> bytes:
+    """Listpack of consecutive stream entries, keyed by the first entry's ID"""
+    master_ms, master_seq = entries[0].milliseconds, entries[0].sequence
+    master_fields = list(entries[0].value)
+    elements: List[listpack.Element] = [len(entries), 0, len(master_fields)]
+    elements += master_fields
+    elements.append(0)
+    for entry in entries:
+        ms, seq = entry.milliseconds, entry.sequence
+        fields = list(entry.value)
+        same_fields = fields == master_fields
+        flags = STREAM_ITEM_FLAG_SAMEFIELDS if same_fields else STREAM_ITEM_FLAG_NONE
+        elements += [flags, ms - master_ms, seq - master_seq]
+        if same_fields:
+            elements += list(entry.value.values())
+            elements.append(len(fields) + 3)
+        else:
+            elements.append(len(fields))
+            for field, value in entry.value.items():
+                elements += [field, value]
+            elements.append(len(fields) * 2 + 4)
+    return listpack.encode(elements)
+
+
+def dump(out: BinaryIO, db: Dict[Any, Any], sorted_sets: Dict[bytes, SortedSet], expires: ExpireIndex):
+    """Write db (key -> Value) and sorted_sets as one RDB database to out"""
+    writer = RdbWriter(out)
+    writer.header()
+    writer.write(bytes([OPCODE_SELECTDB]))
+    writer.length(0)
+    writer.write(bytes([OPCODE_RESIZEDB]))
+    writer.length(len(db) + len(sorted_sets))
+    writer.length(len(expires))
+    for key, value in db.items():
+        writer.key_value(key, value.value, expires.get(key))
+    for key, zset in sorted_sets.items():
+        writer.key_value(key, zset, expires.get(key))
+    writer.footer()
+
+
+def dumps(db: Dict[Any, Any], sorted_sets: Dict[bytes, SortedSet], expires: ExpireIndex) -> bytes:
+    out = io.BytesIO()
+    dump(out, db, sorted_sets, expires)
+    return out.getvalue()
+
+
+class _ByteCounter:
+    """Write target that only counts"""
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data: bytes):
+        self.size += len(data)
+
+
+def write_sync_payload(out: BinaryIO, db: Dict[Any, Any], sorted_sets: Dict[bytes, SortedSet],
+                       expires: ExpireIndex, eof_mark: Optional[bytes] = None):
+    """The snapshot as a full sync sends it: a bulk string without the
+    trailing CRLF. With eof_mark it is framed $EOF:<mark> ... <mark>, so it
+    can stream before its size is known; replicas that didn't announce
+    REPLCONF capa eof get $<length>, which takes a first pass to count."""
+    if eof_mark is not None:
+        out.write(b"$EOF:%b\r\n" % eof_mark)
+        dump(out, db, sorted_sets, expires)
+        out.write(eof_mark)
+        return
+    counter = _ByteCounter()
+    dump(counter, db, sorted_sets, expires)
+    out.write(b"$%d\r\n" % counter.size)
+    dump(out, db, sorted_sets, expires)
+
+
+def save(path: str, db: Dict[Any, Any], sorted_sets: Dict[bytes, SortedSet], expires: ExpireIndex) -> int:
+    """Atomically replace the snapshot at path; returns its size in bytes"""
+    directory = os.path.dirname(path) or "."
+    temp_path = os.path.join(directory, f"temp-{os.getpid()}.rdb")
+    try:
+        with open(temp_path, "wb", buffering=1 << 20) as f:
+            dump(f, db, sorted_sets, expires)
+            f.flush()
+            os.fsync(f.fileno())
+            size = f.tell()
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+    return size
+
+
+@dataclasses.dataclass
+class Persistence:
+    """Snapshot state behind SAVE/BGSAVE, save points and INFO persistence"""
+    path: str = ""
+    save_points: List[Tuple[int, int]] = dataclasses.field(default_factory=list)
+    dirty: int = 0  # writes since the last successful save
+    last_save: int = dataclasses.field(default_factory=lambda: int(time.time()))
+    last_save_size: int = 0
+    last_bgsave_ok: bool = True
+    last_bgsave_try: float = 0.0
+    last_bgsave_seconds: int = -1
+    bgsave_pid: Optional[int] = None
+    bgsave_start: float = 0.0
+    dirty_at_bgsave: int = 0
+    last_load_keys_loaded: int = 0
+    last_load_keys_expired: int = 0
+
+    def save_point_due(self, now: float) -> bool:
+        # After a failed BGSAVE only retry every few seconds, as Redis does
+        if not self.last_bgsave_ok and now - self.last_bgsave_try < 5:
+            return False
+        return any(
+            self.dirty >= changes and now - self.last_save >= seconds
+            for seconds, changes in self.save_points
+        )
+
+    def saved(self, size: int, dirty_before: int):
+        self.dirty -= dirty_before
+        self.last_save = int(time.time())
+        self.last_save_size = size
+
+    def loaded(self, keys_loaded: int, keys_expired: int):
+        self.last_load_keys_loaded = keys_loaded
+        self.last_load_keys_expired = keys_expired
+
+    def info_lines(self) -> List[str]:
+        in_progress = self.bgsave_pid is not None
+        return [
+            "loading:0",
+            f"rdb_changes_since_last_save:{self.dirty}",
+            f"rdb_bgsave_in_progress:{int(in_progress)}",
+            f"rdb_last_save_time:{self.last_save}",
+            f"rdb_last_save_size:{self.last_save_size}",
+            f"rdb_last_bgsave_status:{'ok' if self.last_bgsave_ok else 'err'}",
+            f"rdb_last_bgsave_time_sec:{self.last_bgsave_seconds}",
+            f"rdb_current_bgsave_time_sec:{int(time.time() - self.bgsave_start) if in_progress else -1}",
+            f"rdb_last_load_keys_expired:{self.last_load_keys_expired}",
+            f"rdb_last_load_keys_loaded:{self.last_load_keys_loaded}",
+        ]
+
+
+def parse_save_points(values: List[str]) -> List[Tuple[int, int]]:
+    """--save "3600 1 300 100" (repeatable) -> [(3600, 1), (300, 100)]; "" disables"""
+    numbers = [int(n) for value in values for n in value.split()]
+    if len(numbers) % 2:
+        raise ValueError("--save takes pairs of <seconds> <changes>")
+    return list(zip(numbers[0::2], numbers[1::2]))
@@ -0,0 +1,221 @@
+"""Replicas attached to this master, each with its own output queue.
+
+Propagating a write only appends it to every replica's queue, so a slow
+replica never holds up the client whose command is being replicated. The
+I/O layer drains the queues with flush(): once per event-loop iteration,
+or at the end of every read batch with threads, where each replica has a
+sender thread that writes everything queued so far in one send.
+
+A full resync streams the snapshot without building it in the master's
+memory: a forked child writes the payload into a pipe, and the master
+reads the pipe and sends it on in RDB_CHUNK_SIZE chunks between serving
+clients, only reading on once the replica's socket has taken the last
+chunk. Everything propagated meanwhile waits in the queue and follows the
+payload, so the replica picks up the stream at the offset of the fork.
+
+A replica whose unsent output passes the hard limit, or stays above the
+soft limit for soft_seconds, is disconnected, as Redis does with
+client-output-buffer-limit replica. It can come back with a partial
+resync if the backlog still covers it.
+"""
+import dataclasses
+import io
+import os
+import signal
+import socket
+import threading
+import time
+from typing import BinaryIO, Callable, Optional
+
+from app.event_loop import EventLoop
+from app.maxmemory import parse_memory
+
+RDB_CHUNK_SIZE = 64 * 1024
+
+
+@dataclasses.dataclass
+class OutputBufferLimit:
+    hard: int = 256 * 1024 * 1024
+    soft: int = 64 * 1024 * 1024
+    soft_seconds: int = 60
+
+
+def parse_output_buffer_limit(text: str) -> OutputBufferLimit:
+    """--client-output-buffer-limit "replica 256mb 64mb 60"; 0 disables a limit"""
+    parts = text.split()
+    if len(parts) != 4 or parts[0].lower() not in ("replica", "slave"):
+        raise ValueError("expected: replica <hard limit> <soft limit> <soft seconds>")
+    return OutputBufferLimit(parse_memory(parts[1]), parse_memory(parts[2]), int(parts[3]))
+
+
+class Replica:
+    def __init__(self, conn, listening_port: int = 0, loop: Optional[EventLoop] = None):
+        self.conn = conn
+        self.listening_port = listening_port
+        self.queue = bytearray()  # propagated, not yet handed to the connection
+        self.in_flight = 0  # bytes the sender thread is writing
+        self.wanted = False  # flush() asked the sender thread for a send
+        self.closing = False
+        self.cond = threading.Condition()
+        self.ack_offset = 0
+        self.ack_time = time.monotonic()
+        self.soft_limit_since: Optional[float] = None
+        self.loop = loop  # None when serving with threads
+        self.threaded = loop is None
+        self.sync_pid: Optional[int] = None  # child writing the full sync payload
+        self.sync_fd = -1  # read end of its pipe
+        self.sync_paused = False
+        if self.threaded:
+            threading.Thread(target=self._send_queued, daemon=True).start()
+
+    def feed(self, data: bytes):
+        with self.cond:
+            if not self.closing:
+                self.queue += data
+
+    def pending(self) -> int:
+        """Bytes propagated to this replica and not yet written to its socket"""
+        return len(self.queue) + self.in_flight + len(self.conn.out)
+
+    def flush(self):
+        """Hand everything queued to the connection in one send"""
+        if self.sync_pid is not None:
+            # The stream waits for the payload; meanwhile pace the payload
+            if self.sync_paused and not self.conn.out:
+                self.sync_paused = False
+                self.loop.add_reader(self.sync_fd, self._on_payload_readable)
+            return
+        with self.cond:
+            if not self.queue:
+                return
+            if self.threaded:
+                self.wanted = True
+                self.cond.notify()
+                return
+            data, self.queue = self.queue, bytearray()
+        self.conn.send(bytes(data))
+
+    def _send_queued(self):
+        while True:
+            with self.cond:
+                while not self.wanted and not self.closing:
+                    self.cond.wait()
+                if self.closing:
+                    return
+                data, self.queue = self.queue, bytearray()
+                self.wanted = False
+                self.in_flight = len(data)
+            # Blocks only this thread while the replica catches up
+            self.conn.send(bytes(data))
+            with self.cond:
+                self.in_flight = 0
+
+    def start_full_sync(self, write_payload: Callable[[BinaryIO], None]):
+        """Send the payload write_payload(out) produces, from a forked child
+        through a pipe; the stream queued meanwhile follows it"""
+        if not hasattr(os, "fork"):
+            # No fork: build the payload here, as BGSAVE does without one
+            out = io.BytesIO()
+            write_payload(out)
+            self.conn.send(out.getvalue())
+            return
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            try:
+                with open(write_fd, "wb", buffering=RDB_CHUNK_SIZE) as out:
+                    write_payload(out)
+                code = 0
+            except BaseException:
+                code = 1
+            os._exit(code)
+        os.close(write_fd)
+        self.sync_pid, self.sync_fd = pid, read_fd
+        if self.threaded:
+            threading.Thread(target=self._stream_payload, daemon=True).start()
+        else:
+            os.set_blocking(read_fd, False)
+            self.loop.add_reader(read_fd, self._on_payload_readable)
+
+    def _stream_payload(self):
+        # Each blocking send paces the child through the pipe
+        while chunk := os.read(self.sync_fd, RDB_CHUNK_SIZE):
+            self.conn.send(chunk)
+        self._end_sync()
+
+    def _on_payload_readable(self):
+        try:
+            chunk = os.read(self.sync_fd, RDB_CHUNK_SIZE)
+        except BlockingIOError:
+            return
+        if not chunk:
+            self.loop.remove_reader(self.sync_fd)
+            self._end_sync()
+            return
+        self.conn.send(chunk)
+        self.conn.flush()
+        if self.conn.out:
+            # The socket is full: read on once flush() sees it drained
+            self.sync_paused = True
+            self.loop.remove_reader(self.sync_fd)
+
+    def _end_sync(self):
+        os.close(self.sync_fd)
+        _, status = os.waitpid(self.sync_pid, 0)
+        self.sync_pid = None
+        if self.closing:
+            return
+        if os.waitstatus_to_exitcode(status) != 0:
+            print("Full sync with replica failed: the child writing the payload exited with an error")
+            self.disconnect()
+            return
+        self.flush()
+
+    def over_limit(self, limit: OutputBufferLimit, now: float) -> bool:
+        pending = self.pending()
+        if limit.hard and pending > limit.hard:
+            return True
+        if not limit.soft or pending <= limit.soft:
+            self.soft_limit_since = None
+            return False
+        if self.soft_limit_since is None:
+            self.soft_limit_since = now
+        return now - self.soft_limit_since > limit.soft_seconds
+
+    def acked(self, offset: int):
+        self.ack_offset = max(self.ack_offset, offset)
+        self.ack_time = time.monotonic()
+
+    def stop(self):
+        with self.cond:
+            self.closing = True
+            self.queue.clear()
+            self.cond.notify()
+        if self.sync_pid is not None:
+            try:
+                os.kill(self.sync_pid, signal.SIGKILL)
+            except OSError:
+                pass
+            if not self.threaded:
+                # With threads the sender sees the pipe close and reaps the child
+                self.loop.remove_reader(self.sync_fd)
+                self._end_sync()
+
+    def disconnect(self):
+        """Stop sending and shut the socket down; the connection's reader
+        sees EOF and closes it through the usual path"""
+        self.stop()
+        try:
+            self.conn.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def info(self, index: int) -> str:
+        try:
+            ip = self.conn.getpeername()[0]
+        except OSError:
+            ip = "?"
+        state = "send_bulk" if self.sync_pid is not None else "online"
+        lag = int(time.monotonic() - self.ack_time)
+        return f"slave{index}:ip={ip},port={self.listening_port},state={state},offset={self.ack_offset},lag={lag}"
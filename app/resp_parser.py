@@ -0,0 +1,191 @@
+"""Incremental RESP parser.
+
+Bytes are received straight into a per-connection ``bytearray`` with
+``recv_into`` and decoded by offset, so a pipelined buffer is never split or
+re-sliced while it is parsed. When a frame is cut off the parser keeps its
+partial state (the open arrays and the length of a pending bulk string) and
+resumes from the same offset on the next read.
+"""
+from typing import Any, Iterator, List, Optional, Tuple
+
+CRLF = b"\r\n"
+READ_SIZE = 16 * 1024
+DEFAULT_QUERY_BUFFER_LIMIT = 1024 * 1024 * 1024
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+class QueryBufferLimitError(ProtocolError):
+    pass
+
+
+class RespParser:
+    def __init__(self, query_buffer_limit: int = DEFAULT_QUERY_BUFFER_LIMIT):
+        self.query_buffer_limit = query_buffer_limit
+        self.buf = bytearray(READ_SIZE)
+        self.base = 0  # stream offset of buf[0]
+        self.pos = 0  # next unparsed byte in buf
+        self.end = 0  # end of received data in buf
+        self._frame_start = 0  # stream offset where the current frame began
+        self._stack: List[List[Any]] = []  # [[items, remaining], ...] open arrays
+        self._bulk_len = -1  # length of a bulk string whose header is parsed
+        self._rdb_payload = False
+        self._eof_mark: Optional[bytes] = None  # ends an RDB payload sent as $EOF:<mark>
+        self._eof_scanned = 0  # payload bytes already searched for the mark
+
+    @property
+    def offset(self) -> int:
+        """Stream offset of the first byte that is not part of a complete frame"""
+        return self._frame_start
+
+    def recv_into(self, sock) -> int:
+        """Read from sock straight into the buffer, returning the byte count"""
+        self._reserve(READ_SIZE)
+        with memoryview(self.buf) as view:
+            n = sock.recv_into(view[self.end:])
+        self.end += n
+        return n
+
+    def feed(self, data: bytes):
+        self._reserve(len(data))
+        self.buf[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def expect_rdb_payload(self):
+        """The next bulk string is an RDB payload, sent without a trailing CRLF,
+        either as $<length> or, from a diskless sync, as $EOF:<mark> followed
+        by the payload and the same mark"""
+        self._rdb_payload = True
+
+    def frames(self) -> Iterator[Tuple[Any, int]]:
+        """Yield (value, size in bytes) for every complete frame received so far"""
+        while True:
+            done, value = self._parse_frame()
+            if not done:
+                self._check_limit()
+                return
+            size = self.base + self.pos - self._frame_start
+            self._frame_start = self.base + self.pos
+            yield value, size
+
+    def commands(self) -> Iterator[Any]:
+        for value, _ in self.frames():
+            yield value
+
+    def read_frame(self, sock) -> Any:
+        """Block on sock until one complete frame is parsed and return it"""
+        while True:
+            for value in self.commands():
+                return value
+            if not self.recv_into(sock):
+                raise ConnectionError("Connection closed while reading a reply")
+
+    def _reserve(self, n: int):
+        """Make room for n more bytes, dropping the bytes already parsed"""
+        if len(self.buf) - self.end >= n:
+            return
+        if self.pos:
+            del self.buf[:self.pos]
+            self.base += self.pos
+            self.end -= self.pos
+            self.pos = 0
+        missing = n - (len(self.buf) - self.end)
+        if missing > 0:
+            self.buf += bytearray(max(missing, len(self.buf)))
+
+    def _check_limit(self):
+        pending = self.base + self.end - self._frame_start
+        if pending > self.query_buffer_limit:
+            raise QueryBufferLimitError(
+                f"query buffer of {pending} bytes exceeds the {self.query_buffer_limit} bytes limit"
+            )
+
+    def _parse_frame(self) -> Tuple[bool, Any]:
+        buf = self.buf
+        while True:
+            if self._eof_mark is not None:
+                mark = self._eof_mark
+                found = buf.find(mark, self.pos + self._eof_scanned, self.end)
+                if found < 0:
+                    # Relative to pos, which _reserve() moves along with the data
+                    self._eof_scanned = max(0, self.end - self.pos - len(mark) + 1)
+                    return False, None
+                with memoryview(buf) as view:
+                    value = view[self.pos:found].tobytes()
+                self.pos = found + len(mark)
+                self._eof_mark = None
+                self._rdb_payload = False
+            elif self._bulk_len >= 0:
+                length = self._bulk_len
+                trailer = 0 if self._rdb_payload else 2
+                if self.end - self.pos < length + trailer:
+                    return False, None
+                with memoryview(buf) as view:
+                    value = view[self.pos:self.pos + length].tobytes()
+                if trailer and buf[self.pos + length:self.pos + length + 2] != CRLF:
+                    raise ProtocolError("expected CRLF after bulk string")
+                self.pos += length + trailer
+                self._bulk_len = -1
+                self._rdb_payload = False
+            else:
+                if self.pos >= self.end:
+                    return False, None
+                eol = buf.find(CRLF, self.pos, self.end)
+                if eol < 0:
+                    return False, None
+                kind = buf[self.pos]
+                line = buf[self.pos + 1:eol]
+                self.pos = eol + 2
+                if kind == 0x24 and self._rdb_payload and line.startswith(b"EOF:"):
+                    self._eof_mark = bytes(line[4:])
+                    self._eof_scanned = 0
+                    continue
+                if kind == 0x24:  # $ bulk string
+                    length = self._read_int(line)
+                    if length < 0:
+                        value = None
+                    else:
+                        if length > self.query_buffer_limit:
+                            raise QueryBufferLimitError(
+                                f"bulk length {length} exceeds the {self.query_buffer_limit} bytes limit"
+                            )
+                        self._bulk_len = length
+                        self._reserve(length + 2 - (self.end - self.pos))
+                        buf = self.buf
+                        continue
+                elif kind == 0x2A:  # * array
+                    count = self._read_int(line)
+                    if count < 0:
+                        value = None
+                    elif count == 0:
+                        value = []
+                    else:
+                        self._stack.append([[], count])
+                        continue
+                elif kind == 0x2B or kind == 0x2D:  # + simple string, - error
+                    value = line.decode()
+                elif kind == 0x3A:  # : integer
+                    value = self._read_int(line)
+                else:
+                    raise ProtocolError(f"unexpected type byte {bytes([kind])!r}")
+
+            # Attach the finished value to its enclosing arrays
+            while self._stack:
+                top = self._stack[-1]
+                top[0].append(value)
+                top[1] -= 1
+                if top[1]:
+                    break
+                self._stack.pop()
+                value = top[0]
+            else:
+                return True, value
+
+    @staticmethod
+    def _read_int(line: bytearray) -> int:
+        try:
+            return int(line)
+        except ValueError:
+            raise ProtocolError(f"invalid length {bytes(line)!r}")
@@ -0,0 +1,76 @@
+"""SLOWLOG: a bounded ring buffer of commands that ran longer than a threshold.
+
+Callers time every command and only call ``record`` once the threshold is
+crossed, so a fast command costs two clock reads and a comparison.
+"""
+import dataclasses
+import itertools
+import time
+from collections import deque
+from typing import Deque, List
+
+SLOWLOG_ENTRY_MAX_ARGC = 32
+SLOWLOG_ENTRY_MAX_STRING = 128
+DEFAULT_LOG_SLOWER_THAN = 10000  # microseconds
+DEFAULT_MAX_LEN = 128
+
+
+@dataclasses.dataclass
+class SlowlogEntry:
+    id: int
+    timestamp: int
+    duration_us: int
+    argv: List[bytes]
+    peer: bytes
+    client_name: bytes
+
+
+def truncate_argv(argv: List) -> List[bytes]:
+    """Keep the logged argv small, the same way Redis does"""
+    argc = min(len(argv), SLOWLOG_ENTRY_MAX_ARGC)
+    result = []
+    for i in range(argc):
+        if i == argc - 1 and argc != len(argv):
+            result.append(f"... ({len(argv) - argc + 1} more arguments)".encode())
+            break
+        arg = argv[i] if isinstance(argv[i], bytes) else str(argv[i]).encode()
+        if len(arg) > SLOWLOG_ENTRY_MAX_STRING:
+            more = len(arg) - SLOWLOG_ENTRY_MAX_STRING
+            arg = arg[:SLOWLOG_ENTRY_MAX_STRING] + f"... ({more} more bytes)".encode()
+        result.append(arg)
+    return result
+
+
+class Slowlog:
+    def __init__(self, log_slower_than: int = DEFAULT_LOG_SLOWER_THAN, max_len: int = DEFAULT_MAX_LEN):
+        # A negative threshold disables the log, zero logs every command
+        self.log_slower_than = log_slower_than
+        self.entries: Deque[SlowlogEntry] = deque(maxlen=max_len)
+        self._ids = itertools.count()
+
+    def is_slow(self, duration_us: int) -> bool:
+        return 0 <= self.log_slower_than <= duration_us
+
+    def record(self, argv: List, duration_us: int, peer: bytes, client_name: bytes = b""):
+        self.entries.appendleft(SlowlogEntry(
+            id=next(self._ids),
+            timestamp=int(time.time()),
+            duration_us=duration_us,
+            argv=truncate_argv(argv),
+            peer=peer,
+            client_name=client_name,
+        ))
+
+    def get(self, count: int = 10) -> List[list]:
+        """Newest entries first, in the SLOWLOG GET reply layout"""
+        entries = list(self.entries) if count < 0 else list(itertools.islice(self.entries, count))
+        return [
+            [e.id, e.timestamp, e.duration_us, e.argv, e.peer, e.client_name]
+            for e in entries
+        ]
+
+    def reset(self):
+        self.entries.clear()
+
+    def __len__(self) -> int:
+        return len(self.entries)
@@ -0,0 +1,398 @@
+"""Sorted set engine: a member -> score dict plus a skiplist ordered by
+(score, member).
+
+This is the structure Redis uses. Every skiplist link stores its span (how
+many nodes it skips), so rank lookups and rank-based ranges cost O(log n)
+to find the first node and O(1) per returned element after that. Score
+ranges work the same way: one descent finds the first node inside the range,
+and counting a range is two descents and a subtraction of ranks. Reads never
+modify the set.
+"""
+import dataclasses
+import math
+import random
+from typing import Dict, Iterator, List, Optional, Tuple
+
+MAX_LEVEL = 32
+P = 0.25
+
+
+class _Node:
+    __slots__ = ("member", "score", "forward", "span", "backward")
+
+    def __init__(self, level: int, score: float, member: Optional[bytes]):
+        self.member = member
+        self.score = score
+        self.forward: List[Optional["_Node"]] = [None] * level
+        self.span = [0] * level
+        self.backward: Optional["_Node"] = None
+
+
+@dataclasses.dataclass
+class ScoreRange:
+    """Score interval with optionally exclusive ends, like Redis' zrangespec"""
+    min: float
+    max: float
+    minex: bool = False
+    maxex: bool = False
+
+    def gte_min(self, score: float) -> bool:
+        return score > self.min if self.minex else score >= self.min
+
+    def lte_max(self, score: float) -> bool:
+        return score < self.max if self.maxex else score <= self.max
+
+    def is_empty(self) -> bool:
+        return self.min > self.max or (self.min == self.max and (self.minex or self.maxex))
+
+
+def _random_level() -> int:
+    level = 1
+    while level < MAX_LEVEL and random.random() < P:
+        level += 1
+    return level
+
+
+class SortedSet:
+    def __init__(self):
+        self.dict: Dict[bytes, float] = {}
+        self.header = _Node(MAX_LEVEL, 0, None)
+        self.tail: Optional[_Node] = None
+        self.level = 1
+        self.length = 0  # skiplist nodes; equals len(dict) between operations
+
+    def __len__(self) -> int:
+        return len(self.dict)
+
+    def __contains__(self, member: bytes) -> bool:
+        return member in self.dict
+
+    def __iter__(self) -> Iterator[Tuple[bytes, float]]:
+        x = self.header.forward[0]
+        while x is not None:
+            yield x.member, x.score
+            x = x.forward[0]
+
+    def score(self, member: bytes) -> Optional[float]:
+        return self.dict.get(member)
+
+    def add(self, member: bytes, score: float) -> bool:
+        """Insert member or move it to score; True when the member is new"""
+        old = self.dict.get(member)
+        if old is not None:
+            if old != score:
+                self._delete(old, member)
+                self._insert(score, member)
+                self.dict[member] = score
+            return False
+        self._insert(score, member)
+        self.dict[member] = score
+        return True
+
+    def bulk_load(self, items: List[Tuple[bytes, float]]):
+        """Fill an empty set from (member, score) pairs with distinct members.
+
+        The pairs are sorted once and linked level by level in a single pass,
+        instead of one top-down search per insert.
+        """
+        assert not self.dict
+        items = sorted(items, key=lambda item: (item[1], item[0]))
+        last = [self.header] * MAX_LEVEL
+        last_rank = [0] * MAX_LEVEL
+        prev = None
+        for rank, (member, score) in enumerate(items, 1):
+            level = _random_level()
+            x = _Node(level, score, member)
+            for i in range(level):
+                last[i].forward[i] = x
+                last[i].span[i] = rank - last_rank[i]
+                last[i] = x
+                last_rank[i] = rank
+            x.backward = prev
+            prev = x
+            self.dict[member] = score
+            if level > self.level:
+                self.level = level
+        for i in range(self.level):
+            last[i].span[i] = len(items) - last_rank[i]
+        self.tail = prev
+        self.length = len(items)
+
+    def remove(self, member: bytes) -> bool:
+        score = self.dict.pop(member, None)
+        if score is None:
+            return False
+        self._delete(score, member)
+        return True
+
+    def rank(self, member: bytes, reverse: bool = False) -> Optional[int]:
+        """0-based rank of member, or None when it is not in the set"""
+        score = self.dict.get(member)
+        if score is None:
+            return None
+        rank = 0
+        x = self.header
+        for i in range(self.level - 1, -1, -1):
+            while x.forward[i] is not None and (
+                x.forward[i].score < score
+                or (x.forward[i].score == score and x.forward[i].member <= member)
+            ):
+                rank += x.span[i]
+                x = x.forward[i]
+            if x.member == member:
+                break
+        return self.length - rank if reverse else rank - 1
+
+    def count_in_range(self, spec: ScoreRange) -> int:
+        first, first_rank = self._first_in_range(spec)
+        if first is None:
+            return 0
+        _, last_rank = self._last_in_range(spec)
+        return last_rank - first_rank + 1
+
+    def range_by_score(
+        self,
+        spec: ScoreRange,
+        reverse: bool = False,
+        offset: int = 0,
+        count: int = -1,
+    ) -> List[Tuple[bytes, float]]:
+        """Members inside spec in score order, after skipping offset of them"""
+        if offset < 0 or count == 0:
+            return []
+        if reverse:
+            x, rank = self._last_in_range(spec)
+            if x is not None and offset:
+                x = self._node_by_rank(rank - offset) if rank - offset > 0 else None
+        else:
+            x, rank = self._first_in_range(spec)
+            if x is not None and offset:
+                x = self._node_by_rank(rank + offset) if rank + offset <= self.length else None
+        result = []
+        while x is not None and count != 0:
+            if not (spec.gte_min(x.score) if reverse else spec.lte_max(x.score)):
+                break
+            result.append((x.member, x.score))
+            count -= 1
+            x = x.backward if reverse else x.forward[0]
+        return result
+
+    def remove_range_by_score(self, spec: ScoreRange) -> List[Tuple[bytes, float]]:
+        if spec.is_empty():
+            return []
+        update = self._find_update(lambda node: not spec.gte_min(node.score))
+        removed = []
+        x = update[0].forward[0]
+        while x is not None and spec.lte_max(x.score):
+            following = x.forward[0]
+            self._delete_node(x, update)
+            del self.dict[x.member]
+            removed.append((x.member, x.score))
+            x = following
+        return removed
+
+    def remove_range_by_rank(self, start: int, stop: int) -> List[Tuple[bytes, float]]:
+        """Remove 0-based ranks start..stop inclusive (already clamped)"""
+        if start > stop or start >= self.length:
+            return []
+        traversed = 0
+        update: List[_Node] = [self.header] * self.level
+        x = self.header
+        for i in range(self.level - 1, -1, -1):
+            while x.forward[i] is not None and traversed + x.span[i] <= start:
+                traversed += x.span[i]
+                x = x.forward[i]
+            update[i] = x
+        removed = []
+        x = x.forward[0]
+        for _ in range(stop - start + 1):
+            if x is None:
+                break
+            following = x.forward[0]
+            self._delete_node(x, update)
+            del self.dict[x.member]
+            removed.append((x.member, x.score))
+            x = following
+        return removed
+
+    def pop_min(self, count: int = 1) -> List[Tuple[bytes, float]]:
+        return self.remove_range_by_rank(0, count - 1)
+
+    def pop_max(self, count: int = 1) -> List[Tuple[bytes, float]]:
+        removed = self.remove_range_by_rank(max(0, self.length - count), self.length - 1)
+        removed.reverse()
+        return removed
+
+    def _first_in_range(self, spec: ScoreRange) -> Tuple[Optional[_Node], int]:
+        """First node inside spec and its 1-based rank"""
+        if spec.is_empty():
+            return None, 0
+        rank = 0
+        x = self.header
+        for i in range(self.level - 1, -1, -1):
+            while x.forward[i] is not None and not spec.gte_min(x.forward[i].score):
+                rank += x.span[i]
+                x = x.forward[i]
+        x = x.forward[0]
+        if x is None or not spec.lte_max(x.score):
+            return None, 0
+        return x, rank + 1
+
+    def _last_in_range(self, spec: ScoreRange) -> Tuple[Optional[_Node], int]:
+        """Last node inside spec and its 1-based rank"""
+        if spec.is_empty():
+            return None, 0
+        rank = 0
+        x = self.header
+        for i in range(self.level - 1, -1, -1):
+            while x.forward[i] is not None and spec.lte_max(x.forward[i].score):
+                rank += x.span[i]
+                x = x.forward[i]
+        if x is self.header or not spec.gte_min(x.score):
+            return None, 0
+        return x, rank
+
+    def range_by_rank(self, start: int, stop: int, reverse: bool = False) -> List[Tuple[bytes, float]]:
+        """Members with 0-based ranks start..stop inclusive (already clamped)"""
+        if start > stop or start >= self.length:
+            return []
+        if reverse:
+            x = self._node_by_rank(self.length - start)
+        else:
+            x = self._node_by_rank(start + 1)
+        result = []
+        for _ in range(stop - start + 1):
+            if x is None:
+                break
+            result.append((x.member, x.score))
+            x = x.backward if reverse else x.forward[0]
+        return result
+
+    def _node_by_rank(self, rank: int) -> Optional[_Node]:
+        """Node with the given 1-based rank"""
+        traversed = 0
+        x = self.header
+        for i in range(self.level - 1, -1, -1):
+            while x.forward[i] is not None and traversed + x.span[i] <= rank:
+                traversed += x.span[i]
+                x = x.forward[i]
+            if traversed == rank:
+                return x
+        return None
+
+    def _insert(self, score: float, member: bytes):
+        header = self.header
+        level = _random_level()
+        top = max(level, self.level)
+        update: List[_Node] = [header] * top
+        rank = [0] * top
+        x = header
+        traversed = 0
+        for i in range(self.level - 1, -1, -1):
+            forward = x.forward[i]
+            while forward is not None and (
+                forward.score < score or (forward.score == score and forward.member < member)
+            ):
+                traversed += x.span[i]
+                x = forward
+                forward = x.forward[i]
+            rank[i] = traversed
+            update[i] = x
+
+        if level > self.level:
+            for i in range(self.level, level):
+                header.span[i] = self.length
+            self.level = level
+
+        x = _Node(level, score, member)
+        for i in range(level):
+            prev = update[i]
+            x.forward[i] = prev.forward[i]
+            prev.forward[i] = x
+            x.span[i] = prev.span[i] - (traversed - rank[i])
+            prev.span[i] = (traversed - rank[i]) + 1
+        for i in range(level, self.level):
+            update[i].span[i] += 1
+
+        x.backward = None if update[0] is header else update[0]
+        if x.forward[0] is not None:
+            x.forward[0].backward = x
+        else:
+            self.tail = x
+        self.length += 1
+
+    def _find_update(self, before) -> List[_Node]:
+        """Rightmost node on every level for which before(node) holds"""
+        update: List[_Node] = [self.header] * self.level
+        x = self.header
+        for i in range(self.level - 1, -1, -1):
+            forward = x.forward[i]
+            while forward is not None and before(forward):
+                x = forward
+                forward = x.forward[i]
+            update[i] = x
+        return update
+
+    def _delete(self, score: float, member: bytes):
+        update = self._find_update(
+            lambda node: node.score < score or (node.score == score and node.member < member)
+        )
+        x = update[0].forward[0]
+        if x is None or x.score != score or x.member != member:
+            return
+        self._delete_node(x, update)
+
+    def _delete_node(self, x: _Node, update: List[_Node]):
+        for i in range(self.level):
+            if update[i].forward[i] is x:
+                update[i].span[i] += x.span[i] - 1
+                update[i].forward[i] = x.forward[i]
+            else:
+                update[i].span[i] -= 1
+        if x.forward[0] is not None:
+            x.forward[0].backward = x.backward
+        else:
+            self.tail = x.backward
+        while self.level > 1 and self.header.forward[self.level - 1] is None:
+            self.level -= 1
+        self.length -= 1
+
+
+def parse_score_range(min_bound: bytes, max_bound: bytes) -> Optional[ScoreRange]:
+    """Parse ZRANGEBYSCORE style bounds: a float, (float for exclusive, -inf/+inf"""
+    bounds = []
+    for bound in (min_bound, max_bound):
+        exclusive = bound.startswith(b"(")
+        try:
+            score = float(bound[1:] if exclusive else bound)
+        except ValueError:
+            return None
+        if math.isnan(score):
+            return None
+        bounds.append((score, exclusive))
+    (low, minex), (high, maxex) = bounds
+    return ScoreRange(low, high, minex, maxex)
+
+
+def clamp_rank_range(start: int, stop: int, length: int) -> Tuple[int, int]:
+    """Resolve negative ranks the way ZRANGE does; start > stop means empty"""
+    if start < 0:
+        start += length
+    if stop < 0:
+        stop += length
+    if start < 0:
+        start = 0
+    if stop >= length:
+        stop = length - 1
+    return start, stop
+
+
+def format_score(score: float) -> bytes:
+    """Shortest text that reads back as score, integers without a fraction"""
+    if score.is_integer() and abs(score) < 1e17:
+        return str(int(score)).encode()
+    if score == float("inf"):
+        return b"inf"
+    if score == float("-inf"):
+        return b"-inf"
+    return repr(score).encode()
@@ -0,0 +1,193 @@
+"""Server counters behind INFO stats/commandstats/latencystats and /metrics.
+
+Latencies go into log-bucketed histograms: values below 8us get their own
+bucket and every power of two above that is split into 8 linear buckets,
+so a percentile is within 12.5% of the true value while a histogram never
+holds more than a few hundred counters.
+"""
+import dataclasses
+import http.server
+import threading
+import time
+from typing import Callable, Dict, List, Tuple
+
+SUB_BUCKETS = 8
+PERCENTILES = (50.0, 99.0, 99.9)
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.buckets: Dict[int, int] = {}
+        self.count = 0
+
+    @staticmethod
+    def bucket_index(value: int) -> int:
+        if value < SUB_BUCKETS:
+            return value
+        shift = value.bit_length() - 4
+        return shift * SUB_BUCKETS + (value >> shift)
+
+    @staticmethod
+    def bucket_upper_bound(index: int) -> int:
+        if index < SUB_BUCKETS:
+            return index
+        shift, mantissa = divmod(index, SUB_BUCKETS)
+        shift -= 1
+        return ((mantissa + SUB_BUCKETS + 1) << shift) - 1
+
+    def record(self, value: int):
+        index = self.bucket_index(value)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+
+    def percentiles(self, percentiles=PERCENTILES) -> List[Tuple[float, int]]:
+        result = []
+        if not self.count:
+            return result
+        ordered = sorted(self.buckets.items())
+        for p in percentiles:
+            target = max(1, -(-self.count * p // 100))
+            seen = 0
+            for index, n in ordered:
+                seen += n
+                if seen >= target:
+                    result.append((p, self.bucket_upper_bound(index)))
+                    break
+        return result
+
+
+@dataclasses.dataclass
+class CommandStats:
+    calls: int = 0
+    usec: int = 0
+    rejected_calls: int = 0
+    failed_calls: int = 0
+    histogram: LatencyHistogram = dataclasses.field(default_factory=LatencyHistogram)
+
+
+@dataclasses.dataclass
+class Stats:
+    start_time: float = dataclasses.field(default_factory=time.time)
+    total_connections_received: int = 0
+    rejected_connections: int = 0
+    connected_clients: int = 0
+    total_commands_processed: int = 0
+    total_error_replies: int = 0
+    total_net_input_bytes: int = 0
+    total_net_output_bytes: int = 0
+    total_read_batches: int = 0
+    max_pipeline_depth: int = 0
+    expired_keys: int = 0
+    evicted_keys: int = 0
+    commands: Dict[str, CommandStats] = dataclasses.field(default_factory=dict)
+
+    def record_command(self, name: str, duration_us: int, failed: bool):
+        cmd = self.commands.get(name)
+        if cmd is None:
+            cmd = self.commands.setdefault(name, CommandStats())
+        cmd.calls += 1
+        cmd.usec += duration_us
+        if failed:
+            cmd.failed_calls += 1
+        cmd.histogram.record(duration_us)
+        self.total_commands_processed += 1
+
+    def record_rejected(self, name: str):
+        self.commands.setdefault(name, CommandStats()).rejected_calls += 1
+
+    def record_read_batch(self, depth: int):
+        if depth:
+            self.total_read_batches += 1
+            if depth > self.max_pipeline_depth:
+                self.max_pipeline_depth = depth
+
+    def stats_lines(self) -> List[str]:
+        batches = self.total_read_batches
+        return [
+            f"total_connections_received:{self.total_connections_received}",
+            f"total_commands_processed:{self.total_commands_processed}",
+            f"total_net_input_bytes:{self.total_net_input_bytes}",
+            f"total_net_output_bytes:{self.total_net_output_bytes}",
+            f"rejected_connections:{self.rejected_connections}",
+            f"total_error_replies:{self.total_error_replies}",
+            f"expired_keys:{self.expired_keys}",
+            f"evicted_keys:{self.evicted_keys}",
+            f"total_read_batches:{batches}",
+            f"avg_pipeline_depth:{self.total_commands_processed / batches if batches else 0:.2f}",
+            f"max_pipeline_depth:{self.max_pipeline_depth}",
+        ]
+
+    def commandstats_lines(self) -> List[str]:
+        lines = []
+        for name, cmd in sorted(self.commands.items()):
+            per_call = cmd.usec / cmd.calls if cmd.calls else 0
+            lines.append(
+                f"cmdstat_{name}:calls={cmd.calls},usec={cmd.usec},usec_per_call={per_call:.2f},"
+                f"rejected_calls={cmd.rejected_calls},failed_calls={cmd.failed_calls}"
+            )
+        return lines
+
+    def latencystats_lines(self) -> List[str]:
+        lines = []
+        for name, cmd in sorted(self.commands.items()):
+            percentiles = cmd.histogram.percentiles()
+            if percentiles:
+                values = ",".join(f"p{p:g}={v:.3f}" for p, v in percentiles)
+                lines.append(f"latency_percentiles_usec_{name}:{values}")
+        return lines
+
+    def prometheus(self, gauges: Dict[str, float]) -> str:
+        """Render the counters in the Prometheus text exposition format"""
+        out = []
+
+        def metric(name: str, kind: str, samples: List[Tuple[str, float]]):
+            out.append(f"# TYPE redis_{name} {kind}")
+            for labels, value in samples:
+                out.append(f"redis_{name}{labels} {value}")
+
+        metric("uptime_seconds", "gauge", [("", int(time.time() - self.start_time))])
+        for name, value in gauges.items():
+            metric(name, "gauge", [("", value)])
+        metric("connections_received_total", "counter", [("", self.total_connections_received)])
+        metric("rejected_connections_total", "counter", [("", self.rejected_connections)])
+        metric("commands_processed_total", "counter", [("", self.total_commands_processed)])
+        metric("error_replies_total", "counter", [("", self.total_error_replies)])
+        metric("net_input_bytes_total", "counter", [("", self.total_net_input_bytes)])
+        metric("net_output_bytes_total", "counter", [("", self.total_net_output_bytes)])
+        metric("read_batches_total", "counter", [("", self.total_read_batches)])
+
+        commands = sorted(self.commands.items())
+        metric("commands_total", "counter", [(f'{{cmd="{n}"}}', c.calls) for n, c in commands])
+        metric("commands_failed_total", "counter", [(f'{{cmd="{n}"}}', c.failed_calls) for n, c in commands])
+        metric("commands_rejected_total", "counter", [(f'{{cmd="{n}"}}', c.rejected_calls) for n, c in commands])
+        metric("commands_duration_seconds_total", "counter",
+               [(f'{{cmd="{n}"}}', c.usec / 1e6) for n, c in commands])
+        latency = []
+        for n, c in commands:
+            for p, v in c.histogram.percentiles():
+                latency.append((f'{{cmd="{n}",quantile="{p / 100:g}"}}', v / 1e6))
+        metric("command_latency_seconds", "summary", latency)
+        return "\n".join(out) + "\n"
+
+
+def start_metrics_server(port: int, render: Callable[[], str]) -> http.server.ThreadingHTTPServer:
+    """Serve render() as text on http://localhost:<port>/metrics from a daemon thread"""
+
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?", 1)[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("localhost", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,483 @@
+"""Stream storage: entries kept in ID order with a parallel list of IDs.
+
+Entry IDs are (milliseconds, sequence) tuples, which compare the same way
+stream IDs do, so every lookup by ID is a bisect over ``ids``. XRANGE and
+XREAD cost O(log n) to find their first entry plus the entries returned.
+
+Removing an entry never shifts the entries behind it: trimming moves a head
+offset past the oldest entries, and XDEL leaves None in the entry's slot.
+Once dead slots make up half the lists, one compaction drops them all, so
+an append that trims costs O(1) amortized.
+
+Consumer groups keep their pending entries (delivered, not yet acked) the
+same way: a sorted list of IDs for ranges plus a dict for lookups, once
+for the whole group and once per consumer.
+"""
+import bisect
+import itertools
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from app.rdb_parser import XADDValue
+
+StreamID = Tuple[int, int]
+
+MAX_ID: StreamID = (2**64 - 1, 2**64 - 1)
+MIN_ID: StreamID = (0, 0)
+# Approximate (~) trimming removes entries in blocks of this many, the size
+# of a Redis stream node, so a stream capped with MAXLEN ~ is trimmed once
+# per block of appends instead of on every append
+NODE_ENTRIES = 100
+# Dead slots are compacted away once there are this many and they are half
+# of the lists
+COMPACT_MIN_DEAD = 64
+
+ERR_INVALID_ID = "-ERR Invalid stream ID specified as stream command argument"
+ERR_ID_TOO_SMALL = "-ERR The ID specified in XADD is equal or smaller than the target stream top item"
+ERR_ID_ZERO = "-ERR The ID specified in XADD must be greater than 0-0"
+
+
+class StreamError(ValueError):
+    """Raised with the error reply to send"""
+
+
+def parse_id(text: bytes, missing_seq: int = 0) -> StreamID:
+    """Parse ms-seq or a bare ms; missing_seq fills in the sequence"""
+    ms, _, seq = text.partition(b"-")
+    try:
+        parsed = (int(ms), int(seq) if seq else missing_seq)
+    except ValueError:
+        raise StreamError(ERR_INVALID_ID)
+    if parsed[0] < 0 or parsed[1] < 0:
+        raise StreamError(ERR_INVALID_ID)
+    return parsed
+
+
+def parse_range_start(text: bytes) -> StreamID:
+    """XRANGE start: -, an ID, or (ID for exclusive"""
+    if text == b"-":
+        return MIN_ID
+    if text.startswith(b"("):
+        return increment_id(parse_id(text[1:], 0))
+    return parse_id(text, 0)
+
+
+def parse_range_end(text: bytes) -> StreamID:
+    """XRANGE end: +, an ID, or (ID for exclusive"""
+    if text == b"+":
+        return MAX_ID
+    if text.startswith(b"("):
+        return decrement_id(parse_id(text[1:], MAX_ID[1]))
+    return parse_id(text, MAX_ID[1])
+
+
+def increment_id(entry_id: StreamID) -> StreamID:
+    ms, seq = entry_id
+    if seq < MAX_ID[1]:
+        return ms, seq + 1
+    if ms < MAX_ID[0]:
+        return ms + 1, 0
+    raise StreamError(ERR_INVALID_ID)
+
+
+def decrement_id(entry_id: StreamID) -> StreamID:
+    ms, seq = entry_id
+    if seq > 0:
+        return ms, seq - 1
+    if ms > 0:
+        return ms - 1, MAX_ID[1]
+    raise StreamError(ERR_INVALID_ID)
+
+
+def format_id(entry_id: StreamID) -> bytes:
+    return b"%d-%d" % entry_id
+
+
+def now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+class Stream:
+    def __init__(self):
+        self.ids: List[StreamID] = []
+        self.entries: List[Optional[XADDValue]] = []  # None where XDEL deleted an entry
+        self.head = 0  # slots before head were trimmed; entries[head] is live
+        self.deleted = 0  # None slots from head on; the last slot is live
+        self.last_id: StreamID = MIN_ID  # kept when the top entry is deleted
+        # As Redis keeps them for the RDB: entries ever added, and the highest
+        # ID XDEL removed (trimming leaves no gap inside the stream)
+        self.entries_added = 0
+        self.max_deleted_entry_id: StreamID = MIN_ID
+        self.groups: Dict[bytes, "ConsumerGroup"] = {}
+
+    def __len__(self) -> int:
+        return len(self.ids) - self.head - self.deleted
+
+    def __iter__(self) -> Iterator[XADDValue]:
+        """Entries in ID order"""
+        for i in range(self.head, len(self.entries)):
+            if self.entries[i] is not None:
+                yield self.entries[i]
+
+    def first_entry_id(self) -> Optional[StreamID]:
+        return self.ids[self.head] if len(self) else None
+
+    def last_entry_id(self) -> Optional[StreamID]:
+        return self.ids[-1] if len(self) else None
+
+    def next_id(self, requested: bytes) -> StreamID:
+        """ID for XADD: *, ms-* or an explicit ID above last_id"""
+        last_ms, last_seq = self.last_id
+        if requested == b"*":
+            ms = max(round(time.time() * 1000), last_ms)
+            return (ms, last_seq + 1) if ms == last_ms else (ms, 0)
+        ms_text, _, seq_text = requested.partition(b"-")
+        if seq_text == b"*":
+            try:
+                ms = int(ms_text)
+            except ValueError:
+                raise StreamError(ERR_INVALID_ID)
+            if ms < last_ms:
+                raise StreamError(ERR_ID_TOO_SMALL)
+            if ms == last_ms and self.last_id != MIN_ID:
+                return ms, last_seq + 1
+            return ms, 1 if ms == 0 else 0
+        entry_id = parse_id(requested, 0)
+        if entry_id == MIN_ID:
+            raise StreamError(ERR_ID_ZERO)
+        if entry_id <= self.last_id:
+            raise StreamError(ERR_ID_TOO_SMALL)
+        return entry_id
+
+    def get(self, entry_id: StreamID) -> Optional[XADDValue]:
+        i = bisect.bisect_left(self.ids, entry_id, self.head)
+        if i < len(self.ids) and self.ids[i] == entry_id:
+            return self.entries[i]
+        return None
+
+    def add(self, entry_id: StreamID, fields: Dict[bytes, bytes]):
+        self.ids.append(entry_id)
+        self.entries.append(XADDValue(value=fields, milliseconds=entry_id[0], sequence=entry_id[1]))
+        self.last_id = entry_id
+        self.entries_added += 1
+
+    def range(
+        self,
+        start: StreamID,
+        end: StreamID,
+        count: Optional[int] = None,
+        reverse: bool = False,
+    ) -> List[XADDValue]:
+        """Entries with start <= ID <= end, newest first when reverse"""
+        low = bisect.bisect_left(self.ids, start, self.head)
+        high = bisect.bisect_right(self.ids, end, self.head)
+        return self._slots(low, high, count, reverse)
+
+    def after(self, entry_id: StreamID, count: Optional[int] = None) -> List[XADDValue]:
+        """Entries with an ID greater than entry_id, for XREAD"""
+        return self._slots(bisect.bisect_right(self.ids, entry_id, self.head), len(self.ids), count)
+
+    def _slots(self, low: int, high: int, count: Optional[int], reverse: bool = False) -> List[XADDValue]:
+        """Live entries in slots low..high-1, at most count of them"""
+        if low >= high:
+            return []
+        if self.deleted:
+            slots = range(high - 1, low - 1, -1) if reverse else range(low, high)
+            live = (self.entries[i] for i in slots if self.entries[i] is not None)
+            return list(itertools.islice(live, count))
+        if reverse:
+            if count is not None:
+                low = max(low, high - count)
+            return self.entries[high - 1:low - 1 if low else None:-1]
+        if count is not None:
+            high = min(high, low + count)
+        return self.entries[low:high]
+
+    def delete(self, entry_ids: List[StreamID]) -> int:
+        deleted = 0
+        for entry_id in entry_ids:
+            i = bisect.bisect_left(self.ids, entry_id, self.head)
+            if i < len(self.ids) and self.ids[i] == entry_id and self.entries[i] is not None:
+                self.entries[i] = None
+                self.deleted += 1
+                deleted += 1
+                self.max_deleted_entry_id = max(self.max_deleted_entry_id, entry_id)
+        self._drop_dead_ends()
+        return deleted
+
+    def trim_maxlen(self, maxlen: int, approx: bool = False, limit: Optional[int] = None) -> int:
+        return self._trim_head(len(self) - maxlen, approx, limit)
+
+    def trim_minid(self, min_id: StreamID, approx: bool = False, limit: Optional[int] = None) -> int:
+        end = bisect.bisect_left(self.ids, min_id, self.head)
+        below = end - self.head
+        if self.deleted:
+            below -= sum(1 for i in range(self.head, end) if self.entries[i] is None)
+        return self._trim_head(below, approx, limit)
+
+    def _trim_head(self, excess: int, approx: bool, limit: Optional[int]) -> int:
+        if limit is not None:
+            excess = min(excess, limit)
+        if approx:
+            excess -= excess % NODE_ENTRIES
+        if excess <= 0:
+            return 0
+        if not self.deleted:
+            self.head += excess
+        else:
+            removed = 0
+            while removed < excess:
+                if self.entries[self.head] is None:
+                    self.deleted -= 1
+                else:
+                    removed += 1
+                self.head += 1
+        self._drop_dead_ends()
+        return excess
+
+    def _drop_dead_ends(self):
+        """Restore the live first and last slots, compacting once half the slots are dead"""
+        while len(self.ids) > self.head and self.entries[-1] is None:
+            self.ids.pop()
+            self.entries.pop()
+            self.deleted -= 1
+        while self.head < len(self.ids) and self.entries[self.head] is None:
+            self.head += 1
+            self.deleted -= 1
+        dead = self.head + self.deleted
+        if dead < COMPACT_MIN_DEAD or dead * 2 < len(self.ids):
+            return
+        if self.deleted:
+            live = [i for i in range(self.head, len(self.ids)) if self.entries[i] is not None]
+            self.ids = [self.ids[i] for i in live]
+            self.entries = [self.entries[i] for i in live]
+        else:
+            del self.ids[:self.head]
+            del self.entries[:self.head]
+        self.head = self.deleted = 0
+
+
+class PendingEntry:
+    __slots__ = ("consumer", "delivery_time", "delivery_count")
+
+    def __init__(self, consumer: "Consumer", delivery_time: int, delivery_count: int = 1):
+        self.consumer = consumer
+        self.delivery_time = delivery_time
+        self.delivery_count = delivery_count
+
+
+class PendingList:
+    """Pending entries by ID: a sorted ID list for ranges, a dict for lookups"""
+
+    def __init__(self):
+        self.ids: List[StreamID] = []
+        self.entries: Dict[StreamID, PendingEntry] = {}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def get(self, entry_id: StreamID) -> Optional[PendingEntry]:
+        return self.entries.get(entry_id)
+
+    def add(self, entry_id: StreamID, pending: PendingEntry):
+        if entry_id not in self.entries:
+            # Deliveries arrive in ID order, so this is nearly always an append
+            if not self.ids or self.ids[-1] < entry_id:
+                self.ids.append(entry_id)
+            else:
+                bisect.insort(self.ids, entry_id)
+        self.entries[entry_id] = pending
+
+    def remove(self, entry_id: StreamID) -> Optional[PendingEntry]:
+        pending = self.entries.pop(entry_id, None)
+        if pending is not None:
+            del self.ids[bisect.bisect_left(self.ids, entry_id)]
+        return pending
+
+    def range(self, start: StreamID, end: StreamID, count: Optional[int] = None) -> List[StreamID]:
+        low = bisect.bisect_left(self.ids, start)
+        high = bisect.bisect_right(self.ids, end)
+        if count is not None:
+            high = min(high, low + count)
+        return self.ids[low:high]
+
+
+class Consumer:
+    def __init__(self, name: bytes):
+        self.name = name
+        self.seen_time = now_ms()
+        self.pending = PendingList()
+
+
+class ConsumerGroup:
+    def __init__(self, name: bytes, last_id: StreamID):
+        self.name = name
+        self.last_id = last_id  # last ID delivered to any consumer
+        self.pending = PendingList()
+        self.consumers: Dict[bytes, Consumer] = {}
+
+    def consumer(self, name: bytes) -> Consumer:
+        consumer = self.consumers.get(name)
+        if consumer is None:
+            consumer = self.consumers[name] = Consumer(name)
+        consumer.seen_time = now_ms()
+        return consumer
+
+    def delete_consumer(self, name: bytes) -> int:
+        """Drop a consumer and its pending entries; the number dropped"""
+        consumer = self.consumers.pop(name, None)
+        if consumer is None:
+            return 0
+        for entry_id in consumer.pending.ids:
+            self.pending.remove(entry_id)
+        return len(consumer.pending)
+
+    def has_new(self, stream: Stream) -> bool:
+        return len(stream) > 0 and stream.last_entry_id() > self.last_id
+
+    def deliver_new(
+        self, stream: Stream, consumer: Consumer, count: Optional[int], noack: bool
+    ) -> List[XADDValue]:
+        """Entries after the group cursor, recorded as pending for consumer"""
+        entries = stream.after(self.last_id, count)
+        if not entries:
+            return entries
+        self.last_id = (entries[-1].milliseconds, entries[-1].sequence)
+        if not noack:
+            now = now_ms()
+            for entry in entries:
+                entry_id = (entry.milliseconds, entry.sequence)
+                previous = self.pending.get(entry_id)
+                if previous is not None:  # possible after SETID moved the cursor back
+                    previous.consumer.pending.remove(entry_id)
+                pending = PendingEntry(consumer, now)
+                self.pending.add(entry_id, pending)
+                consumer.pending.add(entry_id, pending)
+        return entries
+
+    def history(
+        self, stream: Stream, consumer: Consumer, after_id: StreamID, count: Optional[int]
+    ) -> List[Tuple[StreamID, Optional[XADDValue]]]:
+        """The consumer's pending entries after after_id, delivered again; None
+        if deleted since. As in Redis a redelivery counts like a delivery"""
+        if after_id >= MAX_ID:
+            return []
+        entry_ids = consumer.pending.range(increment_id(after_id), MAX_ID, count)
+        now = now_ms()
+        history = []
+        for entry_id in entry_ids:
+            entry = stream.get(entry_id)
+            if entry is not None:
+                pending = consumer.pending.get(entry_id)
+                pending.delivery_time = now
+                pending.delivery_count += 1
+            history.append((entry_id, entry))
+        return history
+
+    def ack(self, entry_id: StreamID) -> bool:
+        pending = self.pending.remove(entry_id)
+        if pending is None:
+            return False
+        pending.consumer.pending.remove(entry_id)
+        return True
+
+    def claim(
+        self,
+        stream: Stream,
+        entry_id: StreamID,
+        consumer: Consumer,
+        min_idle: int,
+        delivery_time: int,
+        retry_count: Optional[int] = None,
+        force: bool = False,
+        justid: bool = False,
+    ) -> Tuple[bool, bool]:
+        """Move a pending entry to consumer: (claimed, deleted from stream)"""
+        pending = self.pending.get(entry_id)
+        if pending is None:
+            if not force or stream.get(entry_id) is None:
+                return False, False
+            pending = PendingEntry(consumer, delivery_time, 0)
+            self.pending.add(entry_id, pending)
+            consumer.pending.add(entry_id, pending)
+        elif min_idle and now_ms() - pending.delivery_time < min_idle:
+            return False, False
+        if stream.get(entry_id) is None:
+            self.ack(entry_id)
+            return False, True
+        if pending.consumer is not consumer:
+            pending.consumer.pending.remove(entry_id)
+            pending.consumer = consumer
+            consumer.pending.add(entry_id, pending)
+        pending.delivery_time = delivery_time
+        if retry_count is not None:
+            pending.delivery_count = retry_count
+        elif not justid:
+            pending.delivery_count += 1
+        return True, False
+
+
+def entry_reply(entry: XADDValue) -> list:
+    """[id, [field, value, ...]] as XRANGE and XREAD reply an entry"""
+    fields_and_values = []
+    for field, value in entry.value.items():
+        fields_and_values.append(field)
+        fields_and_values.append(value)
+    return [format_id((entry.milliseconds, entry.sequence)), fields_and_values]
+
+
+class TrimSpec:
+    """MAXLEN/MINID trimming options shared by XADD and XTRIM"""
+
+    def __init__(self, strategy: bytes, threshold, approx: bool, limit: Optional[int]):
+        self.strategy = strategy
+        self.threshold = threshold
+        self.approx = approx
+        self.limit = limit
+
+    def apply(self, stream: Stream) -> int:
+        if self.strategy == b"MAXLEN":
+            return stream.trim_maxlen(self.threshold, self.approx, self.limit)
+        return stream.trim_minid(self.threshold, self.approx, self.limit)
+
+    def exact_args(self, stream: Stream) -> List[bytes]:
+        """Options trimming a copy of stream exactly as apply() just trimmed
+        it, for propagation: with ~ the cut depends on the stream's blocks"""
+        if self.strategy == b"MAXLEN":
+            return [b"MAXLEN", b"=", b"%d" % len(stream)]
+        first_id = stream.first_entry_id()
+        return [b"MINID", b"=", format_id(first_id if first_id is not None else self.threshold)]
+
+
+def parse_trim(argv: list, i: int) -> Tuple[TrimSpec, int]:
+    """Parse MAXLEN|MINID [=|~] threshold [LIMIT count] starting at argv[i]"""
+    strategy = argv[i].upper()
+    i += 1
+    approx = False
+    if i < len(argv) and argv[i] in (b"=", b"~"):
+        approx = argv[i] == b"~"
+        i += 1
+    if i >= len(argv):
+        raise StreamError("-ERR syntax error")
+    if strategy == b"MAXLEN":
+        try:
+            threshold = int(argv[i])
+        except ValueError:
+            raise StreamError("-ERR value is not an integer or out of range")
+        if threshold < 0:
+            raise StreamError("-ERR The MAXLEN argument must be >= 0.")
+    else:
+        threshold = parse_id(argv[i], 0)
+    i += 1
+    limit = NODE_ENTRIES * 100 if approx else None
+    if i + 1 < len(argv) and argv[i].upper() == b"LIMIT":
+        if not approx:
+            raise StreamError("-ERR syntax error, LIMIT cannot be used without the special ~ option")
+        try:
+            limit = int(argv[i + 1])
+        except ValueError:
+            raise StreamError("-ERR value is not an integer or out of range")
+        if limit < 0:
+            raise StreamError("-ERR The LIMIT argument must be >= 0.")
+        i += 2
+    return TrimSpec(strategy, threshold, approx, limit), i
@@ -0,0 +1,51 @@
+"""Shared timer thread for the threaded server.
+
+Blocking commands used to start one thread per waiter just to notice a
+deadline. Instead every deadline goes into one heap served by a single
+daemon thread, which sleeps on a condition until the earliest deadline or
+until a new, earlier one is added. The event loop has its own heap and does
+not need this.
+"""
+import heapq
+import itertools
+import threading
+import time
+from typing import Any, Callable, List, Optional
+
+from app.event_loop import TimerHandle
+
+
+class TimerThread:
+    def __init__(self):
+        self.timers: List[TimerHandle] = []
+        self.condition = threading.Condition()
+        self.thread: Optional[threading.Thread] = None
+        self._seq = itertools.count()
+
+    def call_later(self, delay: float, callback: Callable, *args: Any) -> TimerHandle:
+        handle = TimerHandle(time.monotonic() + delay, next(self._seq), callback, args)
+        with self.condition:
+            heapq.heappush(self.timers, handle)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+            if self.timers[0] is handle:
+                self.condition.notify()
+        return handle
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while self.timers and self.timers[0].cancelled:
+                    heapq.heappop(self.timers)
+                if not self.timers:
+                    self.condition.wait()
+                    continue
+                delay = self.timers[0].when - time.monotonic()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                handle = heapq.heappop(self.timers)
+            # Callbacks run outside the condition so they may add timers
+            if not handle.cancelled:
+                handle.callback(*handle.args)
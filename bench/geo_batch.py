@@ -0,0 +1,61 @@
+"""Benchmark of the batch geo helpers against the per-point functions.
+
+Run from the repository root:
+
+    python -m bench.geo_batch [points ...]
+
+Each size (10k, 100k and 1M points by default) is encoded, decoded and
+measured against one center both ways; the results are checked to agree
+before the timings are printed.
+"""
+import random
+import sys
+import time
+
+from app import decode_geo, encode_geo
+from app.haversine import haversine, haversine_many
+
+
+def timed(fn, *fn_args):
+    start = time.perf_counter()
+    result = fn(*fn_args)
+    return result, time.perf_counter() - start
+
+
+def main(sizes):
+    backend = "numpy" if decode_geo.np is not None else "pure Python"
+    print(f"batch backend: {backend}")
+    rng = random.Random(10)
+
+    for n in sizes:
+        lats = [rng.uniform(encode_geo.MIN_LATITUDE, encode_geo.MAX_LATITUDE) for _ in range(n)]
+        lons = [rng.uniform(encode_geo.MIN_LONGITUDE, encode_geo.MAX_LONGITUDE) for _ in range(n)]
+
+        scalar_scores, scalar_encode = timed(
+            lambda: [encode_geo.encode(lat, lon) for lat, lon in zip(lats, lons)])
+        batch_scores, batch_encode = timed(encode_geo.encode_many, lats, lons)
+        assert scalar_scores == batch_scores
+
+        scalar_coords, scalar_decode = timed(
+            lambda: [decode_geo.decode(score) for score in scalar_scores])
+        batch_coords, batch_decode = timed(decode_geo.decode_many, scalar_scores)
+        assert all(abs(a - b) <= 1e-6
+                   for pair_a, pair_b in zip(scalar_coords, batch_coords)
+                   for a, b in zip(pair_a, pair_b))
+
+        scalar_dist, scalar_haversine = timed(
+            lambda: [haversine(41.9, 12.5, lat, lon) for lat, lon in zip(lats, lons)])
+        batch_dist, batch_haversine = timed(haversine_many, 41.9, 12.5, lats, lons)
+        assert all(abs(a - b) <= 1e-6 for a, b in zip(scalar_dist, batch_dist))
+
+        for name, scalar_time, batch_time in (
+            ("encode", scalar_encode, batch_encode),
+            ("decode", scalar_decode, batch_decode),
+            ("haversine", scalar_haversine, batch_haversine),
+        ):
+            print(f"{n:>9} points {name:<9} scalar {scalar_time * 1000:9.1f} ms"
+                  f"  batch {batch_time * 1000:9.1f} ms  x{scalar_time / batch_time:.1f}")
+
+
+if __name__ == "__main__":
+    main([int(n) for n in sys.argv[1:]] or [10_000, 100_000, 1_000_000])
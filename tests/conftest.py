@@ -0,0 +1,102 @@
+import socket
+import threading
+
+import pytest
+
+from app import main
+from app.backlog import ReplicationBacklog
+from app.connection import ThreadedConnection
+from app.resp_parser import RespParser
+
+
+class ReplyError(str):
+    """An error reply, told apart from a status reply with the same text"""
+
+
+class Client:
+    """Test end of a connection served by main.handle_conn, as with threads"""
+
+    def __init__(self, args: main.Args):
+        ours, self.sock = socket.socketpair()
+        self.sock.settimeout(5)
+        self.file = self.sock.makefile("rb")
+        threading.Thread(
+            target=main.handle_conn, args=(args, ThreadedConnection(ours)), daemon=True
+        ).start()
+
+    def send_raw(self, data: bytes):
+        self.sock.sendall(data)
+
+    def send(self, *args):
+        self.send_raw(main.encode_resp([a if isinstance(a, bytes) else str(a).encode() for a in args]))
+
+    def read(self):
+        line = self.file.readline()
+        assert line.endswith(b"\r\n"), line
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode()
+        if kind == b"-":
+            return ReplyError(rest.decode())
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            length = int(rest)
+            return None if length < 0 else self.file.read(length + 2)[:-2]
+        if kind == b"*":
+            length = int(rest)
+            return None if length < 0 else [self.read() for _ in range(length)]
+        raise AssertionError(f"unexpected reply {line!r}")
+
+    def __call__(self, *args):
+        self.send(*args)
+        return self.read()
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+
+@pytest.fixture
+def server_args(tmp_path) -> main.Args:
+    return main.Args(port=6379, replicaof=None, dir=str(tmp_path), dbfilename="dump.rdb")
+
+
+@pytest.fixture
+def connect(server_args):
+    """connect() opens another client; the dataset is emptied afterwards"""
+    clients = []
+
+    def connect() -> Client:
+        clients.append(Client(server_args))
+        return clients[-1]
+
+    yield connect
+    for client in clients:
+        client.close()
+    with main.write_lock:
+        for k in list(main.db) + list(main.sorted_set_dict):
+            main.delete_key(k)
+
+
+@pytest.fixture
+def client(connect) -> Client:
+    return connect()
+
+
+@pytest.fixture
+def propagated():
+    """propagated() returns the commands replicated since the fixture started,
+    read back from a fresh backlog"""
+    saved = main.replication.backlog, main.replication.master_repl_offset
+    backlog = main.replication.backlog = ReplicationBacklog(1 << 20)
+    backlog.end = main.replication.master_repl_offset
+    start = backlog.end
+
+    def propagated():
+        parser = RespParser()
+        parser.feed(backlog.read_from(start))
+        return list(parser.commands())
+
+    yield propagated
+    main.replication.backlog, main.replication.master_repl_offset = saved
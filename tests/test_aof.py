@@ -0,0 +1,177 @@
+import os
+import threading
+import time
+
+import pytest
+
+from app import aof as aof_module
+from app import main, rdb_writer
+from app.aof import AofError, AppendOnlyFile, absolute_expiry
+from app.expires import ExpireIndex
+from app.rdb_parser import Value
+from conftest import ReplyError
+
+
+def replayed(path: str):
+    snapshots, commands = [], []
+    aof_module.replay(path, snapshots.append, commands.append)
+    return snapshots, commands
+
+
+@pytest.fixture
+def fsyncs(monkeypatch):
+    calls = []
+    fsync = os.fsync
+    monkeypatch.setattr(aof_module.os, "fsync", lambda fd: calls.append(fd) or fsync(fd))
+    return calls
+
+
+def test_unknown_policy(tmp_path):
+    with pytest.raises(ValueError):
+        AppendOnlyFile(str(tmp_path / "a.aof"), "sometimes")
+
+
+@pytest.mark.parametrize("policy, synced", [("always", True), ("no", False)])
+def test_flush_writes_and_fsyncs_by_policy(tmp_path, fsyncs, policy, synced):
+    path = str(tmp_path / "a.aof")
+    aof = AppendOnlyFile(path, policy)
+    aof.feed(main.encode_resp([b"SET", b"k", b"v"]))
+    aof.feed(main.encode_resp([b"DEL", b"k"]))
+    assert os.path.getsize(path) == 0
+    aof.flush()
+    assert bool(fsyncs) == synced
+    assert replayed(path) == ([], [[b"SET", b"k", b"v"], [b"DEL", b"k"]])
+    assert aof.written == aof.fed == 2
+    # Nothing new: no write and no fsync
+    fsyncs.clear()
+    aof.flush()
+    assert not fsyncs
+    assert "aof_current_size:%d" % os.path.getsize(path) in aof.info_lines()
+
+
+def test_concurrent_flushes_share_writes(tmp_path, fsyncs):
+    path = str(tmp_path / "a.aof")
+    aof = AppendOnlyFile(path, "always")
+    late = []
+
+    def writer(n: int):
+        for i in range(100):
+            aof.feed(main.encode_resp([b"SET", b"k%d" % n, b"%d" % i]))
+            fed = aof.fed
+            aof.flush()
+            # Once flush() returns, the command is on disk, whoever wrote it
+            if aof.written < fed:
+                late.append((n, i))
+
+    threads = [threading.Thread(target=writer, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not late
+    _, commands = replayed(path)
+    assert len(commands) == 800
+    for n in range(8):
+        # Each writer's commands stay in order
+        assert [c[2] for c in commands if c[1] == b"k%d" % n] == [b"%d" % i for i in range(100)]
+    assert len(fsyncs) <= 800
+
+
+def test_replay_truncates_a_partial_last_command(tmp_path):
+    path = tmp_path / "a.aof"
+    whole = main.encode_resp([b"SET", b"k", b"v"])
+    path.write_bytes(whole + main.encode_resp([b"SET", b"k", b"w"])[:-3])
+    assert replayed(str(path)) == ([], [[b"SET", b"k", b"v"]])
+    assert path.read_bytes() == whole
+
+
+def test_replay_rejects_what_is_not_a_command(tmp_path):
+    path = tmp_path / "a.aof"
+    path.write_bytes(b":1\r\n")
+    with pytest.raises(AofError):
+        replayed(str(path))
+    path.write_bytes(b"")
+    assert replayed(str(path)) == ([], [])
+
+
+def test_relative_expiries_are_logged_as_absolute_times():
+    expiry = {b"k": 1234}.get
+    assert absolute_expiry([b"SET", b"k", b"v", b"EX", b"10"], expiry) == [b"SET", b"k", b"v", b"PXAT", b"1234"]
+    assert absolute_expiry([b"SET", b"k", b"v", b"NX", b"px", b"10", b"GET"], expiry) == [
+        b"SET", b"k", b"v", b"NX", b"PXAT", b"1234", b"GET"
+    ]
+    assert absolute_expiry([b"SET", b"k", b"v"], expiry) == [b"SET", b"k", b"v"]
+    assert absolute_expiry([b"PEXPIREAT", b"k", b"5"], expiry) == [b"PEXPIREAT", b"k", b"5"]
+
+
+def wait_for_rewrite(aof: AppendOnlyFile):
+    deadline = time.monotonic() + 10
+    while aof.rewrite_pid is not None:
+        assert time.monotonic() < deadline
+        aof.check_rewrite()
+        time.sleep(0.01)
+
+
+def test_rewrite_keeps_the_writes_made_meanwhile(tmp_path):
+    path = str(tmp_path / "a.aof")
+    aof = AppendOnlyFile(path, "no")
+    for i in range(50):
+        aof.feed(main.encode_resp([b"SET", b"old%d" % i, b"v"]))
+    aof.flush()
+    db = {b"base": Value(b"1")}
+    assert aof.start_rewrite(lambda temp: rdb_writer.save(temp, db, {}, ExpireIndex()))
+    assert not aof.start_rewrite(lambda temp: None)
+    aof.feed(main.encode_resp([b"SET", b"during", b"1"]))
+    aof.flush()
+    aof.feed(main.encode_resp([b"SET", b"unflushed", b"1"]))
+    wait_for_rewrite(aof)
+    assert aof.last_rewrite_ok
+    assert not os.path.exists(aof.temp_path(os.getpid()))
+    aof.feed(main.encode_resp([b"SET", b"after", b"1"]))
+    aof.flush()
+    snapshots, commands = replayed(path)
+    assert snapshots[0].databases[0] == {b"base": b"1"}
+    assert commands == [[b"SET", b"during", b"1"], [b"SET", b"unflushed", b"1"], [b"SET", b"after", b"1"]]
+    assert aof.base_size < os.path.getsize(path) == aof.current_size
+
+
+def test_failed_rewrite_keeps_the_old_file(tmp_path):
+    path = str(tmp_path / "a.aof")
+    aof = AppendOnlyFile(path, "no")
+    aof.feed(main.encode_resp([b"SET", b"k", b"v"]))
+    aof.flush()
+
+    def fail(temp: str):
+        raise OSError("disk full")
+
+    assert aof.start_rewrite(fail)
+    aof.feed(main.encode_resp([b"DEL", b"k"]))
+    aof.flush()
+    wait_for_rewrite(aof)
+    assert not aof.last_rewrite_ok and aof.rewrite_buffer is None
+    assert replayed(path) == ([], [[b"SET", b"k", b"v"], [b"DEL", b"k"]])
+
+
+def test_writes_are_logged_and_replayed(client, tmp_path, server_args, monkeypatch):
+    path = str(tmp_path / "server.aof")
+    monkeypatch.setattr(main, "aof", AppendOnlyFile(path, "always"))
+    assert client("SET", "k", "v", "EX", "100") == "OK"
+    assert client("RPUSH", "list", "a", "b") == 2
+    assert client("GET", "k") == b"v"
+    assert client("INCR", "n") == 1
+    _, commands = replayed(path)
+    assert [command[0] for command in commands] == [b"SET", b"RPUSH", b"INCR"]
+    assert commands[0][3] == b"PXAT"
+    with main.write_lock:
+        for k in list(main.db):
+            main.delete_key(k)
+    monkeypatch.setattr(main, "aof", None)
+    aof_module.replay(path, main.load_snapshot, lambda value: main.replay_command(server_args, value))
+    assert client("LRANGE", "list", "0", "-1") == [b"a", b"b"]
+    assert client("GET", "n") == b"1"
+    assert 99 <= client("TTL", "k") <= 100
+
+
+def test_bgrewriteaof_needs_an_append_only_file(client, monkeypatch):
+    monkeypatch.setattr(main, "aof", None)
+    assert isinstance(client("BGREWRITEAOF"), ReplyError)
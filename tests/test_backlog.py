@@ -0,0 +1,111 @@
+import random
+import socket
+
+import pytest
+
+from app import main
+from app.backlog import ReplicationBacklog
+from app.connection import ThreadedConnection
+
+
+def test_backlog_matches_whole_stream():
+    rng = random.Random(22)
+    for _ in range(200):
+        backlog = ReplicationBacklog(rng.randint(1, 64))
+        stream = b""
+        for _ in range(50):
+            data = rng.randbytes(rng.randint(0, 100))
+            backlog.append(data)
+            stream += data
+            assert backlog.end == len(stream)
+            assert backlog.histlen == min(len(stream), backlog.size)
+            offset = rng.randint(backlog.start, backlog.end)
+            assert backlog.covers(offset) and not backlog.covers(backlog.start - 1)
+            assert backlog.read_from(offset) == stream[offset:]
+
+
+def test_backlog_wraps_around():
+    backlog = ReplicationBacklog(8)
+    backlog.append(b"abcdef")
+    backlog.append(b"ghij")
+    assert (backlog.start, backlog.end) == (2, 10)
+    assert backlog.read_from(2) == b"cdefghij"
+    assert backlog.read_from(7) == b"hij"
+    assert not backlog.covers(1) and not backlog.covers(11)
+
+
+@pytest.fixture
+def master():
+    """main's replication state with a small backlog, restored afterwards;
+    attach() makes a connection for a replica and returns it with its peer"""
+    saved = main.replication.backlog, main.replication.master_repl_offset
+    main.replication.backlog = ReplicationBacklog(64)
+    main.replication.master_repl_offset = 0
+    attached = []
+
+    def attach():
+        ours, theirs = socket.socketpair()
+        theirs.settimeout(5)
+        attached.append((ThreadedConnection(ours), theirs))
+        return attached[-1]
+
+    yield attach
+    for conn, peer in attached:
+        main.drop_replica(conn)
+        conn.close()
+        peer.close()
+    main.replication.backlog, main.replication.master_repl_offset = saved
+
+
+def propagate_all(commands) -> bytes:
+    stream = b""
+    for command in commands:
+        encoded = main.encode_resp(command)
+        main.replicate(encoded)
+        stream += encoded
+    return stream
+
+
+def psync(conn, next_offset: int) -> bytes:
+    """What the master sends back to PSYNC <its replid> next_offset"""
+    replid = main.replication.master_replid.encode()
+    main.cmd_psync(None, [b"PSYNC", replid, b"%d" % next_offset], conn, False)
+    return b"+CONTINUE %b\r\n" % replid
+
+
+def receive(peer: socket.socket, n: int) -> bytes:
+    data = b""
+    while len(data) < n:
+        chunk = peer.recv(n - len(data))
+        assert chunk
+        data += chunk
+    return data
+
+
+def test_psync_continues_from_the_first_missing_byte(master):
+    stream = propagate_all([[b"SET", b"k%d" % i, b"v"] for i in range(5)])
+    assert main.replication.master_repl_offset == len(stream) > 64
+    conn, peer = master()
+    processed = len(stream) - 30
+    # A replica asks for the offset of the first byte it is missing, 1-based
+    continue_line = psync(conn, processed + 1)
+    expected = continue_line + stream[processed:]
+    assert receive(peer, len(expected)) == expected
+
+
+def test_psync_continue_with_nothing_missing(master):
+    stream = propagate_all([[b"SET", b"k", b"v"]])
+    conn, peer = master()
+    continue_line = psync(conn, len(stream) + 1)
+    assert receive(peer, len(continue_line)) == continue_line
+    assert conn in main.replication.connected_replicas
+
+
+def test_psync_continue_at_the_oldest_byte_held(master):
+    stream = propagate_all([[b"SET", b"k%d" % i, b"v"] for i in range(10)])
+    backlog = main.replication.backlog
+    assert backlog.start == len(stream) - 64
+    conn, peer = master()
+    continue_line = psync(conn, backlog.start + 1)
+    expected = continue_line + stream[backlog.start:]
+    assert receive(peer, len(expected)) == expected
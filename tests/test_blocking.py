@@ -0,0 +1,114 @@
+import time
+
+import pytest
+
+from app import main
+from conftest import ReplyError
+
+
+def no_waiters():
+    return not main.bl_pop_queue and not main.xread_block_queue
+
+
+@pytest.mark.parametrize("command", [
+    ["BLPOP", "q", "0"],
+    ["BRPOP", "q", "other", "0"],
+    ["BLMOVE", "q", "dest", "LEFT", "RIGHT", "0"],
+    ["BRPOPLPUSH", "q", "dest", "0"],
+    ["BLMPOP", "0", "2", "q", "other", "LEFT"],
+])
+def test_blocking_list_commands_do_not_block_inside_exec(connect, command):
+    client, pusher = connect(), connect()
+    assert client("MULTI") == "OK"
+    assert client(*command) == "QUEUED"
+    assert client("EXEC") == [None]
+    assert no_waiters()
+    # A later push must not reach the client with an unsolicited reply
+    assert pusher("RPUSH", "q", "a") == 1
+    assert client("PING") == "PONG"
+    assert pusher("LRANGE", "q", "0", "-1") == [b"a"]
+
+
+def test_blocking_list_commands_serve_inside_exec(client):
+    assert client("RPUSH", "q", "a", "b") == 2
+    assert client("MULTI") == "OK"
+    assert client("BLPOP", "q", "0") == "QUEUED"
+    assert client("BLMOVE", "q", "dest", "LEFT", "RIGHT", "0") == "QUEUED"
+    assert client("EXEC") == [[b"q", b"a"], b"b"]
+    assert client("LRANGE", "dest", "0", "-1") == [b"b"]
+    assert no_waiters()
+
+
+@pytest.mark.parametrize("command", [
+    ["XREAD", "BLOCK", "0", "STREAMS", "s", "$"],
+    ["XREAD", "COUNT", "1", "BLOCK", "100", "STREAMS", "s", "other", "$", "0-0"],
+    ["XREADGROUP", "GROUP", "g", "alice", "BLOCK", "0", "STREAMS", "s", ">"],
+])
+def test_blocking_stream_reads_do_not_block_inside_exec(connect, command):
+    client, writer = connect(), connect()
+    assert client("XGROUP", "CREATE", "s", "g", "$", "MKSTREAM") == "OK"
+    assert client("MULTI") == "OK"
+    assert client(*command) == "QUEUED"
+    assert client("EXEC") == [None]
+    assert no_waiters()
+    assert writer("XADD", "s", "1-1", "f", "v") == b"1-1"
+    assert client("PING") == "PONG"
+
+
+def wait_for_waiters(n: int):
+    deadline = time.monotonic() + 5
+    while sum(len(waiters) for waiters in main.bl_pop_queue.values()) < n:
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+
+def test_waiters_are_served_first_come_first_served(connect):
+    first, second, pusher = connect(), connect(), connect()
+    first.send("BLPOP", "q", "0")
+    wait_for_waiters(1)
+    second.send("BLPOP", "other", "q", "0")
+    wait_for_waiters(2)
+    assert pusher("RPUSH", "q", "a", "b", "c") == 3
+    assert first.read() == [b"q", b"a"]
+    assert second.read() == [b"q", b"b"]
+    assert pusher("LRANGE", "q", "0", "-1") == [b"c"]
+    assert no_waiters()
+
+
+def test_served_pops_propagate_as_plain_pops(connect, propagated):
+    client, pusher = connect(), connect()
+    client.send("BLMOVE", "q", "dest", "RIGHT", "LEFT", "0")
+    wait_for_waiters(1)
+    assert pusher("RPUSH", "q", "a", "b") == 2
+    assert client.read() == b"b"
+    assert propagated() == [[b"RPUSH", b"q", b"a", b"b"], [b"LMOVE", b"q", b"dest", b"RIGHT", b"LEFT"]]
+    assert pusher("LRANGE", "dest", "0", "-1") == [b"b"]
+
+
+def test_the_first_non_empty_key_wins(client):
+    assert client("RPUSH", "b", "1") == 1
+    assert client("RPUSH", "c", "2") == 1
+    assert client("BRPOP", "a", "b", "c", "0") == [b"b", b"1"]
+    assert client("BLMPOP", "0", "3", "a", "b", "c", "LEFT", "COUNT", "5") == [b"c", [b"2"]]
+
+
+def test_timeout_answers_nil(client):
+    start = time.monotonic()
+    assert client("BLPOP", "q", "0.05") is None
+    assert 0.04 < time.monotonic() - start < 2
+    assert no_waiters()
+    assert isinstance(client("BLPOP", "q", "-1"), ReplyError)
+    assert isinstance(client("BLPOP", "q", "soon"), ReplyError)
+
+
+def test_a_closed_client_stops_waiting(connect):
+    client, pusher = connect(), connect()
+    client.send("BLPOP", "q", "0")
+    wait_for_waiters(1)
+    client.close()
+    deadline = time.monotonic() + 5
+    while not no_waiters():
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+    assert pusher("RPUSH", "q", "a") == 1
+    assert pusher("LLEN", "q") == 1
@@ -0,0 +1,104 @@
+import time
+
+import pytest
+
+from app import commands, main
+from conftest import ReplyError
+
+
+@pytest.mark.parametrize("argv, keys", [
+    ([b"GET", b"k"], [b"k"]),
+    ([b"DEL", b"a", b"b", b"c"], [b"a", b"b", b"c"]),
+    ([b"BLPOP", b"a", b"b", b"0"], [b"a", b"b"]),
+    ([b"LMPOP", b"2", b"a", b"b", b"LEFT", b"COUNT", b"2"], [b"a", b"b"]),
+    ([b"BLMPOP", b"0", b"1", b"a", b"RIGHT"], [b"a"]),
+    ([b"LMPOP", b"x", b"a", b"LEFT"], []),
+    ([b"XREAD", b"COUNT", b"2", b"BLOCK", b"0", b"STREAMS", b"a", b"b", b"0", b"$"], [b"a", b"b"]),
+    ([b"XREAD", b"COUNT", b"STREAMS", b"STREAMS", b"a", b"0"], [b"a"]),
+    ([b"XREADGROUP", b"GROUP", b"g", b"c", b"NOACK", b"STREAMS", b"s", b">"], [b"s"]),
+    ([b"XREAD", b"STREAMS", b"a", b"b", b"0"], []),
+    ([b"PING"], []),
+])
+def test_command_keys(argv, keys):
+    assert commands.lookup(argv[0]).keys(argv) == keys
+
+
+def test_movable_keys_commands_have_getkeys():
+    for cmd in commands.COMMANDS.values():
+        assert (commands.MOVABLE_KEYS in cmd.flags) == (cmd.getkeys is not None), cmd.name
+
+
+def test_options_are_not_taken_for_keys(client, monkeypatch):
+    touched = []
+    touch = main.key_usage.touch
+    monkeypatch.setattr(main.key_usage, "touch", lambda k: touched.append(k) or touch(k))
+    assert client("SET", "COUNT", "v", "PX", "1") == "OK"
+    time.sleep(0.01)
+    touched.clear()
+    assert client("XREAD", "COUNT", "1", "STREAMS", "s", "0") is None
+    assert touched == [b"s"]
+    # Not lazily expired either: only the keys of a command are checked
+    assert b"COUNT" in main.db
+
+
+def test_command_getkeys(client):
+    assert client("COMMAND", "GETKEYS", "XREAD", "COUNT", "1", "STREAMS", "a", "b", "0", "0") == [b"a", b"b"]
+    assert client("COMMAND", "GETKEYS", "LMPOP", "1", "k", "LEFT") == [b"k"]
+    assert isinstance(client("COMMAND", "GETKEYS", "PING"), ReplyError)
+    assert isinstance(client("COMMAND", "GETKEYS", "NOPE", "k"), ReplyError)
+    assert isinstance(client("COMMAND", "GETKEYS", "GET"), ReplyError)
+
+
+def test_registered_arities_and_keys_are_consistent():
+    for cmd in commands.COMMANDS.values():
+        assert cmd.name == cmd.name.upper() and cmd.arity != 0, cmd.name
+        assert commands.lookup(cmd.name.lower()) is cmd
+        if cmd.first_key and cmd.getkeys is None:
+            assert cmd.step > 0 and cmd.last_key != 0, cmd.name
+        assert not (commands.WRITE in cmd.flags and commands.READONLY in cmd.flags), cmd.name
+    assert commands.lookup(b"nope") is None
+    assert commands.lookup("GET") is None
+
+
+@pytest.mark.parametrize("argv", [
+    ["GET"],
+    ["GET", "a", "b"],
+    ["SET", "k"],
+    ["ECHO"],
+    ["ZADD", "k", "1"],
+])
+def test_wrong_arity_is_rejected(client, argv):
+    rejected = main.stats.commands.get(argv[0].lower())
+    before = rejected.rejected_calls if rejected else 0
+    assert client(*argv) == f"ERR wrong number of arguments for '{argv[0].lower()}' command"
+    assert main.stats.commands[argv[0].lower()].rejected_calls == before + 1
+
+
+def test_names_are_case_insensitive(client):
+    assert client("set", "k", "v") == "OK"
+    assert client("gEt", "k") == b"v"
+    reply = client("NOPE", "a", "b")
+    assert reply == "ERR unknown command 'NOPE', with args beginning with: 'a' 'b'"
+
+
+def test_command_introspection(client):
+    assert client("COMMAND", "COUNT") == len(commands.COMMANDS)
+    assert len(client("COMMAND")) == len(commands.COMMANDS)
+    get, missing = client("COMMAND", "INFO", "get", "nope")
+    assert get[:6] == [b"get", 2, ["readonly"], 1, 1, 1]
+    assert missing is None
+    assert isinstance(client("COMMAND", "NOPE"), ReplyError)
+
+
+def test_flags_decide_propagation_and_queueing(client, propagated):
+    assert client("SET", "k", "v") == "OK"
+    assert client("GET", "k") == b"v"
+    assert propagated() == [[b"SET", b"k", b"v"]]
+    # MULTI and EXEC are no-multi: they run instead of being queued
+    assert client("MULTI") == "OK"
+    assert isinstance(client("MULTI"), ReplyError)
+    assert client("GET", "k") == "QUEUED"
+    assert client("EXEC") == [b"v"]
+    assert client("SUBSCRIBE", "ch") == ["subscribe", "ch", 1]
+    assert client("PING") == [b"pong", b""]
+    assert client("GET", "k") == "ERR Can't execute 'get' in subscribed mode"
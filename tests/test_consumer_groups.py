@@ -0,0 +1,142 @@
+import random
+import time
+
+import pytest
+
+from app.stream import ConsumerGroup, Stream
+from conftest import ReplyError
+
+
+def read_ids(reply):
+    """Entry IDs of an XREADGROUP reply on one stream"""
+    return [entry[0] for entry in reply[0][1]] if reply else []
+
+
+@pytest.fixture
+def stream(client):
+    for i in range(1, 6):
+        assert client("XADD", "s", "%d-0" % i, "n", str(i)) == b"%d-0" % i
+    assert client("XGROUP", "CREATE", "s", "g", "0") == "OK"
+    return client
+
+
+def test_pending_lists_stay_consistent():
+    rng = random.Random(13)
+    stream = Stream()
+    for i in range(1, 301):
+        stream.add((i, 0), {b"f": b"v"})
+    group = ConsumerGroup(b"g", (0, 0))
+    names = [b"alice", b"bob", b"carol"]
+    acked = set()
+    while group.last_id < (300, 0) or group.pending:
+        consumer = group.consumer(rng.choice(names))
+        op = rng.random()
+        if op < 0.4:
+            group.deliver_new(stream, consumer, rng.randint(1, 10), False)
+        elif op < 0.7 and group.pending:
+            entry_id = rng.choice(group.pending.ids)
+            assert group.ack(entry_id)
+            assert not group.ack(entry_id)
+            acked.add(entry_id)
+        elif group.pending:
+            entry_id = rng.choice(group.pending.ids)
+            assert group.claim(stream, entry_id, consumer, 0, 1000) == (True, False)
+            assert group.pending.get(entry_id).consumer is consumer
+        owned = [entry_id for c in group.consumers.values() for entry_id in c.pending.ids]
+        assert sorted(owned) == group.pending.ids
+        for c in group.consumers.values():
+            assert all(group.pending.get(entry_id).consumer is c for entry_id in c.pending.ids)
+    assert len(acked) == 300
+
+
+def test_read_ack_and_pending(stream):
+    client = stream
+    assert read_ids(client("XREADGROUP", "GROUP", "g", "alice", "COUNT", "2", "STREAMS", "s", ">")) == [
+        b"1-0", b"2-0"
+    ]
+    assert read_ids(client("XREADGROUP", "GROUP", "g", "bob", "STREAMS", "s", ">")) == [b"3-0", b"4-0", b"5-0"]
+    assert client("XREADGROUP", "GROUP", "g", "bob", "STREAMS", "s", ">") is None
+    # An ID instead of > rereads the consumer's own pending entries
+    assert read_ids(client("XREADGROUP", "GROUP", "g", "alice", "STREAMS", "s", "0")) == [b"1-0", b"2-0"]
+    assert client("XPENDING", "s", "g") == [5, b"1-0", b"5-0", [[b"alice", b"2"], [b"bob", b"3"]]]
+    assert client("XACK", "s", "g", "1-0", "3-0", "9-0") == 2
+    pending = client("XPENDING", "s", "g", "-", "+", "10")
+    assert [entry[:2] for entry in pending] == [[b"2-0", b"alice"], [b"4-0", b"bob"], [b"5-0", b"bob"]]
+    # Read twice: the second read of 2-0 bumped its delivery count
+    assert [entry[3] for entry in pending] == [2, 1, 1]
+    assert [entry[0] for entry in client("XPENDING", "s", "g", "-", "+", "10", "bob")] == [b"4-0", b"5-0"]
+    assert client("XPENDING", "s", "g", "IDLE", "100000", "-", "+", "10") == []
+
+
+def test_rereading_history_counts_as_a_delivery(stream, propagated):
+    client = stream
+    assert read_ids(client("XREADGROUP", "GROUP", "g", "alice", "COUNT", "1", "STREAMS", "s", ">")) == [b"1-0"]
+    assert read_ids(client("XREADGROUP", "GROUP", "g", "alice", "STREAMS", "s", "0")) == [b"1-0"]
+    assert client("XPENDING", "s", "g", "-", "+", "1")[0][3] == 2
+    claims = [command for command in propagated() if command[0] == b"XCLAIM"]
+    # Replicas get the same delivery count, and the cursor stays where it was
+    assert [claim[claim.index(b"RETRYCOUNT") + 1] for claim in claims] == [b"1", b"2"]
+    assert claims[-1][-1] == b"1-0"
+
+
+def test_noack_and_deleted_entries(stream):
+    client = stream
+    assert read_ids(client("XREADGROUP", "GROUP", "g", "alice", "NOACK", "STREAMS", "s", ">")) == [
+        b"1-0", b"2-0", b"3-0", b"4-0", b"5-0"
+    ]
+    assert client("XPENDING", "s", "g") == [0, None, None, None]
+    assert client("XADD", "s", "6-0", "n", "6") == b"6-0"
+    assert read_ids(client("XREADGROUP", "GROUP", "g", "alice", "STREAMS", "s", ">")) == [b"6-0"]
+    assert client("XDEL", "s", "6-0") == 1
+    # A pending entry deleted from the stream reads back as an empty entry
+    assert client("XREADGROUP", "GROUP", "g", "alice", "STREAMS", "s", "0") == [[b"s", [[b"6-0", None]]]]
+
+
+def test_claim_and_autoclaim(stream):
+    client = stream
+    assert len(read_ids(client("XREADGROUP", "GROUP", "g", "alice", "STREAMS", "s", ">"))) == 5
+    time.sleep(0.01)
+    assert client("XCLAIM", "s", "g", "bob", "100000", "1-0") == []
+    assert client("XCLAIM", "s", "g", "bob", "1", "1-0", "2-0", "JUSTID") == [b"1-0", b"2-0"]
+    assert [entry[0] for entry in client("XPENDING", "s", "g", "-", "+", "10", "bob")] == [b"1-0", b"2-0"]
+    assert client("XCLAIM", "s", "g", "carol", "0", "3-0", "RETRYCOUNT", "7") == [[b"3-0", [b"n", b"3"]]]
+    assert client("XPENDING", "s", "g", "3-0", "3-0", "1")[0][3] == 7
+    assert client("XDEL", "s", "5-0") == 1
+    next_start, claimed, deleted = client("XAUTOCLAIM", "s", "g", "dave", "0", "0", "COUNT", "2")
+    assert (next_start, [entry[0] for entry in claimed], deleted) == (b"3-0", [b"1-0", b"2-0"], [])
+    next_start, claimed, deleted = client("XAUTOCLAIM", "s", "g", "dave", "0", next_start, "JUSTID")
+    assert (next_start, claimed, deleted) == (b"0-0", [b"3-0", b"4-0"], [b"5-0"])
+    assert client("XPENDING", "s", "g")[3] == [[b"dave", b"4"]]
+
+
+def test_group_management(stream):
+    client = stream
+    assert client("XGROUP", "CREATE", "s", "g", "$") == "BUSYGROUP Consumer Group name already exists"
+    assert client("XGROUP", "CREATE", "s", "late", "$") == "OK"
+    assert client("XREADGROUP", "GROUP", "late", "c", "STREAMS", "s", ">") is None
+    assert isinstance(client("XGROUP", "SETID", "late", "s", "3-0"), ReplyError)
+    assert client("XGROUP", "SETID", "s", "late", "3-0") == "OK"
+    assert read_ids(client("XREADGROUP", "GROUP", "late", "c", "STREAMS", "s", ">")) == [b"4-0", b"5-0"]
+    assert client("XGROUP", "CREATECONSUMER", "s", "late", "c") == 0
+    assert client("XGROUP", "CREATECONSUMER", "s", "late", "d") == 1
+    assert client("XGROUP", "DELCONSUMER", "s", "late", "c") == 2
+    assert client("XPENDING", "s", "late")[0] == 0
+    assert client("XGROUP", "DESTROY", "s", "late") == 1
+    assert client("XGROUP", "DESTROY", "s", "late") == 0
+    assert client("XGROUP", "CREATE", "new", "g", "$", "MKSTREAM") == "OK"
+    assert client("XLEN", "new") == 0
+    reply = client("XGROUP", "CREATE", "missing", "g", "$")
+    assert isinstance(reply, ReplyError) and "MKSTREAM" in reply
+
+
+@pytest.mark.parametrize("command", [
+    ["XREADGROUP", "GROUP", "nope", "c", "STREAMS", "s", ">"],
+    ["XREADGROUP", "GROUP", "g", "c", "STREAMS", "missing", ">"],
+    ["XREADGROUP", "GROUP", "g", "c", "STREAMS", "s"],
+    ["XPENDING", "s", "nope"],
+    ["XPENDING", "s", "g", "-", "+"],
+    ["XCLAIM", "s", "g", "c", "x", "1-0"],
+    ["XCLAIM", "s", "g", "c", "0", "bad"],
+])
+def test_group_errors(stream, command):
+    assert isinstance(stream(*command), ReplyError)
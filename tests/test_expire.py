@@ -0,0 +1,147 @@
+import random
+import time
+
+import pytest
+
+from app import expires as expires_module
+from app import main
+from app.expires import ExpireIndex, SampledKeys
+from conftest import ReplyError
+
+
+def test_lazy_expiry_propagates_del(client, propagated):
+    assert client("SET", "k", "v", "PX", "1") == "OK"
+    time.sleep(0.01)
+    expired = main.stats.expired_keys
+    assert client("GET", "k") is None
+    assert main.stats.expired_keys == expired + 1
+    assert propagated()[-1] == [b"DEL", b"k"]
+
+
+def test_active_expiry_propagates_del(client, propagated):
+    for i in range(30):
+        assert client("SET", "k%d" % i, "v", "PX", "1") == "OK"
+    assert client("SET", "kept", "v", "EX", "100") == "OK"
+    time.sleep(0.01)
+    with main.write_lock:
+        expires_module.active_expire_cycle(main.expires, main.expire_key)
+    assert client("TTL", "kept") > 0
+    deleted = {command[1] for command in propagated() if command[0] == b"DEL"}
+    assert deleted == {b"k%d" % i for i in range(30)}
+    assert all(client("TTL", "k%d" % i) == -2 for i in range(30))
+
+
+def test_sampled_keys_stay_dense():
+    rng = random.Random(17)
+    keys = SampledKeys()
+    model = set()
+    for _ in range(3000):
+        key = rng.randrange(100)
+        if rng.random() < 0.5:
+            keys.add(key)
+            model.add(key)
+        else:
+            keys.discard(key)
+            model.discard(key)
+        assert len(keys) == len(model)
+    assert set(keys.keys) == model
+    assert all(keys.keys[position] == key for key, position in keys.positions.items())
+    assert set(keys.sample(1000)) == model
+
+
+def test_active_expiry_stops_on_a_mostly_live_index():
+    index = ExpireIndex()
+    now = expires_module.mstime()
+    for i in range(1000):
+        index.set(i, now + 100_000)
+    for i in range(1000, 1005):
+        index.set(i, now - 1)
+    expired = []
+    # A sample of live keys ends the cycle after one round
+    count = expires_module.active_expire_cycle(index, expired.append)
+    assert count == len(expired) <= 5
+    expired = []
+    index = ExpireIndex()
+    for i in range(500):
+        index.set(i, now - 1)
+    expires_module.active_expire_cycle(index, lambda key: (index.remove(key), expired.append(key)))
+    assert sorted(expired) == list(range(500))
+
+
+def test_mstime_tracks_the_wall_clock():
+    assert abs(expires_module.mstime() - time.time() * 1000) < 1000
+    first = expires_module.mstime()
+    assert expires_module.mstime() >= first
+
+
+def test_set_options(client):
+    assert client("SET", "k", "v", "NX") == "OK"
+    assert client("SET", "k", "w", "NX") is None
+    assert client("SET", "missing", "w", "XX") is None
+    assert client("SET", "k", "w", "XX", "GET") == b"v"
+    assert client("SET", "k", "x", "EX", "100") == "OK"
+    assert 99 <= client("TTL", "k") <= 100
+    assert client("SET", "k", "y", "KEEPTTL") == "OK"
+    assert 99_000 < client("PTTL", "k") <= 100_000
+    assert client("SET", "k", "z") == "OK"
+    assert client("TTL", "k") == -1
+    at = int(time.time() * 1000) + 50_000
+    assert client("SET", "k", "v", "PXAT", str(at)) == "OK"
+    assert 49 <= client("TTL", "k") <= 50
+    assert client("SET", "k", "v", "EXAT", str(at // 1000 + 10)) == "OK"
+    assert 58 <= client("TTL", "k") <= 60
+    assert client("SET", "k", "v", "PX", "1") == "OK"
+    time.sleep(0.01)
+    assert client("GET", "k") is None
+    assert client("TTL", "k") == -2
+
+
+@pytest.mark.parametrize("options", [
+    ["NX", "XX"],
+    ["EX", "10", "PX", "10"],
+    ["EX", "10", "KEEPTTL"],
+    ["EX"],
+    ["EX", "0"],
+    ["PX", "-5"],
+    ["EX", "soon"],
+    ["BOGUS"],
+])
+def test_set_option_errors(client, options):
+    assert isinstance(client("SET", "k", "v", *options), ReplyError)
+    assert client("GET", "k") is None
+
+
+def test_expire_flags(client):
+    assert client("EXPIRE", "missing", "10") == 0
+    assert client("SET", "k", "v") == "OK"
+    assert client("EXPIRE", "k", "100", "XX") == 0
+    assert client("EXPIRE", "k", "100", "NX") == 1
+    assert client("EXPIRE", "k", "200", "NX") == 0
+    assert client("EXPIRE", "k", "50", "GT") == 0
+    assert client("EXPIRE", "k", "200", "GT") == 1
+    assert client("EXPIRE", "k", "300", "LT") == 0
+    assert client("PEXPIRE", "k", "150000", "LT") == 1
+    assert 149 <= client("TTL", "k") <= 150
+    assert client("PERSIST", "k") == 1
+    assert client("PERSIST", "k") == 0
+    # Without a TTL, GT never applies and LT always does
+    assert client("EXPIRE", "k", "100", "GT") == 0
+    assert client("EXPIRE", "k", "100", "LT") == 1
+    assert isinstance(client("EXPIRE", "k", "1", "NX", "GT"), ReplyError)
+    assert isinstance(client("EXPIRE", "k", "1", "GT", "LT"), ReplyError)
+    assert isinstance(client("EXPIRE", "k", "1", "SOON"), ReplyError)
+
+
+def test_expiry_propagates_as_absolute_times(client, propagated):
+    assert client("SET", "k", "v") == "OK"
+    assert client("EXPIRE", "k", "100") == 1
+    assert client("EXPIREAT", "k", str(int(time.time()) - 1)) == 1
+    assert client("TTL", "k") == -2
+    at = expires_module.mstime() + 100_000
+    commands = propagated()
+    assert commands[1][:2] == [b"PEXPIREAT", b"k"] and abs(int(commands[1][2]) - at) < 1000
+    # An expiry time in the past deletes the key
+    assert commands[2] == [b"DEL", b"k"]
+    assert client("SET", "k", "v") == "OK"
+    assert client("PEXPIREAT", "k", "1") == 1
+    assert client("GET", "k") is None
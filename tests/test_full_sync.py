@@ -0,0 +1,188 @@
+import io
+import random
+import socket
+import time
+
+import pytest
+
+from app import main, rdb_loader, rdb_writer
+from app.backlog import ReplicationBacklog
+from app.connection import ThreadedConnection
+from app.expires import ExpireIndex
+from app.quicklist import QuickList
+from app.rdb_parser import Value
+from app.replica import RDB_CHUNK_SIZE, Replica
+from app.resp_parser import RespParser
+from app.sorted_set import SortedSet
+
+EOF_MARK = b"0123456789abcdef0123456789abcdef01234567"
+
+
+def dataset(rng: random.Random):
+    """A db, sorted sets and expires whose snapshot spans several chunks"""
+    db = {b"s%d" % i: Value(rng.randbytes(1000)) for i in range(300)}
+    items = QuickList()
+    for i in range(1000):
+        items.push_right(b"item%d" % i)
+    db[b"list"] = Value(items)
+    zset = SortedSet()
+    for i in range(200):
+        zset.add(b"m%d" % i, i / 3)
+    expires = ExpireIndex()
+    expires.set(b"s0", 4102444800000)
+    return db, {b"zset": zset}, expires
+
+
+def read_frames(parser: RespParser, data: bytes, rng: random.Random):
+    """Feed data in small random pieces and collect every frame"""
+    frames = []
+    pos = 0
+    while pos < len(data):
+        step = rng.randint(1, 4096)
+        parser.feed(data[pos:pos + step])
+        pos += step
+        frames.extend(parser.commands())
+    return frames
+
+
+def check_loaded(payload: bytes, db, sorted_sets, expires):
+    # Contents, not bytes: the ctime aux field differs between two dumps
+    snapshot = rdb_loader.parse(payload)
+    loaded = snapshot.databases[0]
+    assert loaded.keys() == db.keys() | sorted_sets.keys()
+    for k, value in db.items():
+        if isinstance(value.value, QuickList):
+            assert list(loaded[k]) == list(value.value)
+        else:
+            assert loaded[k] == value.value
+    for k, zset in sorted_sets.items():
+        assert list(loaded[k]) == list(zset)
+    assert snapshot.expires[0] == {b"s0": 4102444800000}
+
+
+@pytest.mark.parametrize("eof_mark", [None, EOF_MARK])
+def test_sync_payload_parses_back(eof_mark):
+    rng = random.Random(25)
+    db, sorted_sets, expires = dataset(rng)
+    out = io.BytesIO()
+    rdb_writer.write_sync_payload(out, db, sorted_sets, expires, eof_mark)
+    command = main.encode_resp([b"SET", b"after", b"sync"])
+    parser = RespParser()
+    parser.expect_rdb_payload()
+    frames = read_frames(parser, out.getvalue() + command, rng)
+    assert len(frames) == 2
+    assert frames[1] == [b"SET", b"after", b"sync"]
+    check_loaded(frames[0], db, sorted_sets, expires)
+
+
+def receive_frames(sock: socket.socket, count: int):
+    parser = RespParser()
+    parser.expect_rdb_payload()
+    frames = []
+    while len(frames) < count:
+        assert parser.recv_into(sock)
+        frames.extend(parser.commands())
+    return frames
+
+
+@pytest.mark.parametrize("eof_mark", [None, EOF_MARK])
+def test_full_sync_streams_the_payload_before_the_queue(eof_mark):
+    db, sorted_sets, expires = dataset(random.Random(25))
+    payload = rdb_writer.dumps(db, sorted_sets, expires)
+    assert len(payload) > 4 * RDB_CHUNK_SIZE
+    ours, theirs = socket.socketpair()
+    theirs.settimeout(5)
+    replica = Replica(ThreadedConnection(ours))
+    try:
+        replica.start_full_sync(
+            lambda out: rdb_writer.write_sync_payload(out, db, sorted_sets, expires, eof_mark)
+        )
+        # Propagated during the sync: waits for the payload
+        replica.feed(main.encode_resp([b"SET", b"during", b"sync"]))
+        replica.flush()
+        frames = receive_frames(theirs, 2)
+        check_loaded(frames[0], db, sorted_sets, expires)
+        assert frames[1] == [b"SET", b"during", b"sync"]
+        deadline = time.monotonic() + 5
+        while replica.sync_pid is not None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert replica.sync_pid is None
+    finally:
+        replica.stop()
+        ours.close()
+        theirs.close()
+
+
+@pytest.fixture
+def replication_state():
+    saved = main.replication.backlog, main.replication.master_repl_offset
+    main.replication.backlog = ReplicationBacklog(64)
+    main.replication.master_repl_offset = 0
+    yield
+    main.replication.backlog, main.replication.master_repl_offset = saved
+
+
+def test_psync_without_a_covered_offset_resyncs(replication_state, monkeypatch):
+    monkeypatch.setitem(main.db, b"key", Value(b"value"))
+    ours, theirs = socket.socketpair()
+    theirs.settimeout(5)
+    conn = ThreadedConnection(ours)
+    try:
+        main.cmd_psync(None, [b"PSYNC", b"?", b"-1"], conn, False)
+        fullresync, payload = receive_frames(theirs, 2)
+        replid = main.replication.master_replid
+        assert fullresync == f"FULLRESYNC {replid} 0"
+        assert rdb_loader.parse(payload).databases[0][b"key"] == b"value"
+    finally:
+        main.drop_replica(conn)
+        conn.close()
+        theirs.close()
+
+
+def decode(request: bytes):
+    parser = RespParser()
+    parser.feed(request)
+    return next(parser.commands())
+
+
+@pytest.fixture
+def replica_state(monkeypatch):
+    for field in ("master_replid", "master_repl_offset", "master_synced", "master_link_up"):
+        monkeypatch.setattr(main.replication, field, getattr(main.replication, field))
+
+
+def test_handshake_is_fed_one_reply_at_a_time(client, replica_state):
+    rng = random.Random(25)
+    args = main.Args(port=6380, replicaof="localhost 6379", dir=".", dbfilename="dump.rdb")
+    parser = RespParser()
+    handshake = main.MasterHandshake(args, parser)
+    sent = [handshake.request()]
+    for reply in ("+PONG\r\n", "+OK\r\n", "+OK\r\n"):
+        for frame in read_frames(parser, reply.encode(), rng):
+            sent.append(handshake.on_reply(frame))
+    assert [decode(request) for request in sent] == [
+        [b"PING"],
+        [b"REPLCONF", b"listening-port", b"6380"],
+        [b"REPLCONF", b"capa", b"eof", b"capa", b"psync2"],
+        [b"PSYNC", b"?", b"-1"],
+    ]
+
+    payload = rdb_writer.dumps({b"synced": Value(b"yes")}, {}, ExpireIndex())
+    data = b"+FULLRESYNC " + b"a" * 40 + b" 100\r\n$%d\r\n" % len(payload) + payload
+    data += main.encode_resp([b"SET", b"after", b"sync"])
+    # Cut anywhere, as the event loop receives it
+    pos = 0
+    while not handshake.done:
+        step = rng.randint(1, 64)
+        parser.feed(data[pos:pos + step])
+        pos += step
+        for frame, _ in parser.frames():
+            assert handshake.on_reply(frame) is None
+            if handshake.done:
+                break
+    parser.feed(data[pos:])
+    assert list(parser.commands()) == [[b"SET", b"after", b"sync"]]
+    assert main.replication.master_replid == "a" * 40
+    assert main.replication.master_repl_offset == 100
+    assert main.replication.master_link_up
+    assert client("GET", "synced") == b"yes"
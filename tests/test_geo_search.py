@@ -0,0 +1,89 @@
+import random
+
+import pytest
+
+from app import decode_geo, encode_geo, geo_search, haversine
+from app.geo_search import GeoShape
+from app.sorted_set import SortedSet
+
+
+def random_zset(rng: random.Random, center_lon: float, center_lat: float, spread: float, n: int) -> SortedSet:
+    zset = SortedSet()
+    for i in range(n):
+        lat = center_lat + rng.uniform(-spread, spread)
+        # Strictly inside the range: the top edge itself encodes past 26 bits
+        lat = min(max(lat, encode_geo.MIN_LATITUDE), encode_geo.MAX_LATITUDE - 1e-6)
+        lon = (center_lon + rng.uniform(-spread, spread) + 180) % 360 - 180
+        zset.add(b"m%d" % i, encode_geo.encode(lat, lon))
+    return zset
+
+
+def brute_force(zset: SortedSet, shape: GeoShape):
+    matches = {}
+    for member, score in zset:
+        distance = shape.distance_if_inside(*geo_search.decode_score(score))
+        if distance is not None:
+            matches[member] = distance
+    return matches
+
+
+@pytest.mark.parametrize("center", [(12.5, 41.9), (179.9, 0.0), (-179.9, -10.0), (20.0, 84.0)])
+@pytest.mark.parametrize("by_box", [False, True])
+def test_search_matches_brute_force(center, by_box):
+    lon, lat = center
+    rng = random.Random(9)
+    zset = random_zset(rng, lon, lat, 3.0, 2000)
+    for _ in range(20):
+        size = rng.choice([500.0, 20_000.0, 150_000.0, 400_000.0])
+        shape = GeoShape(
+            lon + rng.uniform(-1, 1), lat + rng.uniform(-0.5, 0.5),
+            radius=size, width=size * rng.uniform(0.5, 2), height=size, by_box=by_box,
+        )
+        expected = brute_force(zset, shape)
+        found = {member: distance for member, distance, _ in geo_search.search(zset, shape)}
+        assert found.keys() == expected.keys()
+        assert [found[member] for member in expected] == pytest.approx(list(expected.values()))
+
+        ranked = sorted(expected.values())
+        ascending = geo_search.search(zset, shape, descending=False)
+        assert [distance for _, distance, _ in ascending] == pytest.approx(ranked)
+        nearest = geo_search.search(zset, shape, count=5)
+        assert [distance for _, distance, _ in nearest] == pytest.approx(ranked[:5])
+        farthest = geo_search.search(zset, shape, count=5, descending=True)
+        assert [distance for _, distance, _ in farthest] == pytest.approx(ranked[::-1][:5])
+
+        some = geo_search.search(zset, shape, count=3, any_match=True)
+        assert len(some) == min(3, len(expected))
+        assert all(expected[member] == pytest.approx(distance) for member, distance, _ in some)
+
+
+@pytest.fixture(params=["numpy", "pure Python"])
+def backend(request, monkeypatch):
+    if request.param == "numpy":
+        if decode_geo.np is None:
+            pytest.skip("numpy is not installed")
+    else:
+        for module in (encode_geo, decode_geo, haversine):
+            monkeypatch.setattr(module, "np", None)
+    return request.param
+
+
+def test_batch_helpers_match_scalar(backend):
+    rng = random.Random(10)
+    lats = [rng.uniform(encode_geo.MIN_LATITUDE, encode_geo.MAX_LATITUDE) for _ in range(5000)]
+    lons = [rng.uniform(encode_geo.MIN_LONGITUDE, encode_geo.MAX_LONGITUDE) for _ in range(5000)]
+    lats += [encode_geo.MIN_LATITUDE, encode_geo.MAX_LATITUDE, 0.0]
+    lons += [encode_geo.MIN_LONGITUDE, encode_geo.MAX_LONGITUDE - 1e-9, 0.0]
+
+    scores = [encode_geo.encode(lat, lon) for lat, lon in zip(lats, lons)]
+    assert encode_geo.encode_many(lats, lons) == scores
+
+    coordinates = [decode_geo.decode(score) for score in scores]
+    for expected, got in zip(coordinates, decode_geo.decode_many(scores)):
+        assert got == pytest.approx(expected, abs=1e-9)
+
+    distances = [haversine.haversine(41.9, 12.5, lat, lon) for lat, lon in zip(lats, lons)]
+    assert haversine.haversine_many(41.9, 12.5, lats, lons) == pytest.approx(distances, abs=1e-6)
+    paired = [haversine.haversine(a, b, lat, lon)
+              for a, b, lat, lon in zip(lats[::-1], lons[::-1], lats, lons)]
+    assert haversine.haversine_many(lats[::-1], lons[::-1], lats, lons) == pytest.approx(paired, abs=1e-6)
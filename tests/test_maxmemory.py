@@ -0,0 +1,156 @@
+import random
+
+import pytest
+
+from app import main
+from app.expires import ExpireIndex, mstime
+from app.maxmemory import KEY_OVERHEAD, KeyUsage, MaxMemory, estimate_size, format_memory, parse_memory
+from app.quicklist import QuickList
+from app.sorted_set import SortedSet
+
+
+@pytest.mark.parametrize("text, size", [
+    ("100", 100), ("1k", 1000), ("1kb", 1024), ("2MB", 2 * 1024 ** 2), ("1g", 1000 ** 3),
+])
+def test_parse_memory(text, size):
+    assert parse_memory(text) == size
+
+
+@pytest.mark.parametrize("text", ["", "mb", "1tb", "1.5mb"])
+def test_parse_memory_errors(text):
+    with pytest.raises(ValueError):
+        parse_memory(text)
+
+
+def test_format_memory():
+    assert format_memory(512) == "512B"
+    assert format_memory(1536) == "1.50K"
+    assert format_memory(3 * 1024 ** 3) == "3.00G"
+
+
+def test_sizes_grow_with_the_value():
+    items = QuickList()
+    zset = SortedSet()
+    for i in range(1000):
+        items.push_right(b"x" * 10)
+        zset.add(b"m%d" % i, i)
+    assert estimate_size(b"k", b"v" * 1000) > estimate_size(b"k", b"v") > KEY_OVERHEAD
+    assert estimate_size(b"k", items) > 1000 * 10
+    assert estimate_size(b"k", zset) > estimate_size(b"k", items)
+
+
+def test_usage_accounting():
+    rng = random.Random(18)
+    usage = KeyUsage()
+    sizes = {}
+    for _ in range(2000):
+        key = b"k%d" % rng.randrange(50)
+        if rng.random() < 0.7:
+            value = b"v" * rng.randrange(100)
+            usage.update(key, value)
+            sizes[key] = estimate_size(key, value)
+        else:
+            usage.update(key, None)
+            sizes.pop(key, None)
+        assert usage.used == sum(sizes.values())
+        assert len(usage) == len(sizes)
+        assert usage.peak >= usage.used
+    assert set(usage.sampled.keys) == set(sizes)
+
+
+def usage_of(keys):
+    usage = KeyUsage()
+    for key in keys:
+        usage.update(key, b"v")
+    return usage
+
+
+@pytest.mark.parametrize("policy", ["allkeys-lru", "volatile-lru"])
+def test_lru_evicts_the_least_recently_used(policy):
+    usage = usage_of([b"a", b"b", b"c"])
+    expires = ExpireIndex()
+    for key in (b"a", b"b", b"c"):
+        expires.set(key, mstime() + 100_000)
+    for i, key in enumerate((b"b", b"a", b"c")):
+        usage.meta[key].access_ms = 1000 + i
+    assert MaxMemory(1, policy, samples=10).choose_victim(usage, expires) == b"b"
+
+
+def test_lfu_evicts_the_least_frequently_used():
+    usage = usage_of([b"a", b"b", b"c"])
+    usage.meta[b"a"].counter = 30
+    usage.meta[b"b"].counter = 2
+    usage.meta[b"c"].counter = 10
+    assert MaxMemory(1, "allkeys-lfu", samples=10).choose_victim(usage, ExpireIndex()) == b"b"
+
+
+def test_lfu_counters_rise_slowly_and_decay():
+    usage = usage_of([b"k"])
+    for _ in range(1000):
+        usage.touch(b"k")
+    counter = usage.frequency(b"k")
+    assert 5 < counter < 40
+    usage.meta[b"k"].decay_minutes -= 3
+    assert usage.frequency(b"k") == counter - 3
+
+
+def test_volatile_policies_only_evict_keys_with_a_ttl():
+    usage = usage_of([b"a", b"b", b"c"])
+    expires = ExpireIndex()
+    expires.set(b"b", mstime() + 50_000)
+    expires.set(b"c", mstime() + 10_000)
+    assert MaxMemory(1, "volatile-ttl", samples=10).choose_victim(usage, expires) == b"c"
+    assert MaxMemory(1, "volatile-random", samples=10).choose_victim(usage, expires) in (b"b", b"c")
+    assert MaxMemory(1, "volatile-lru", samples=10).choose_victim(usage, ExpireIndex()) is None
+
+
+def test_free_evicts_until_it_fits():
+    usage = usage_of([b"k%d" % i for i in range(100)])
+    limit = usage.used // 2
+    evicted = []
+    assert MaxMemory(limit, "allkeys-random").free(usage, ExpireIndex(), evicted.append)
+    assert usage.used <= limit
+    assert len(evicted) == 100 - len(usage)
+    assert not MaxMemory(1, "noeviction").free(usage, ExpireIndex(), evicted.append)
+    assert not MaxMemory(1, "volatile-lru").free(usage, ExpireIndex(), evicted.append)
+    assert MaxMemory(0, "noeviction").free(usage, ExpireIndex(), evicted.append)
+
+
+@pytest.fixture
+def maxmemory(monkeypatch):
+    def limit(size: int, policy: str):
+        monkeypatch.setattr(main, "maxmemory", MaxMemory(size, policy, samples=10))
+    return limit
+
+
+def test_writes_past_maxmemory_evict(client, maxmemory, propagated):
+    evicted = main.stats.evicted_keys
+    maxmemory(main.key_usage.used + 20 * 1200, "allkeys-lru")
+    for i in range(100):
+        assert client("SET", "k%d" % i, "x" * 1000) == "OK"
+    # Eviction runs before each command, so only the last write may overshoot
+    assert main.key_usage.used <= main.maxmemory.limit + main.key_usage.size(b"k99")
+    assert 70 <= main.stats.evicted_keys - evicted < 100
+    deleted = [command for command in propagated() if command[0] == b"DEL"]
+    assert len(deleted) == main.stats.evicted_keys - evicted
+    # The latest write is never the one evicted
+    assert client("GET", "k99") == b"x" * 1000
+
+
+def test_noeviction_refuses_writes_that_grow_the_dataset(client, maxmemory):
+    assert client("SET", "k", "v") == "OK"
+    maxmemory(1, "noeviction")
+    reply = client("SET", "other", "v")
+    assert reply.startswith("OOM")
+    assert client("GET", "k") == b"v"
+    # DEL doesn't grow the dataset, so it still runs
+    assert client("DEL", "k") == 1
+
+
+def test_object_idletime_and_freq(client):
+    assert client("SET", "k", "v") == "OK"
+    assert client("OBJECT", "IDLETIME", "k") == 0
+    assert client("OBJECT", "FREQ", "k") >= 5
+    assert client("OBJECT", "FREQ", "missing") is None
+    main.key_usage.meta[b"k"].access_ms -= 5000
+    assert client("OBJECT", "IDLETIME", "k") == 5
@@ -0,0 +1,41 @@
+import pytest
+
+from app import main
+from conftest import ReplyError
+
+
+@pytest.mark.parametrize("frame", [
+    b"*0\r\n",
+    b"*-1\r\n",
+    b":1\r\n",
+    b"+PING\r\n",
+    b"$4\r\nPING\r\n",
+    b"*2\r\n$4\r\nECHO\r\n:1\r\n",
+    b"*1\r\n*1\r\n$4\r\nPING\r\n",
+])
+def test_frames_that_are_not_commands_get_a_protocol_error(client, frame):
+    errors = main.stats.total_error_replies
+    client.send_raw(frame)
+    reply = client.read()
+    assert isinstance(reply, ReplyError) and reply.startswith("ERR Protocol error")
+    assert main.stats.total_error_replies == errors + 1
+    # The connection stays usable
+    assert client("PING") == "PONG"
+
+
+def test_a_failing_handler_costs_one_error_reply(client, monkeypatch):
+    def broken(args, value, conn, is_replica_conn):
+        raise KeyError("boom")
+
+    monkeypatch.setattr(main.commands.COMMANDS[b"ECHO"], "handler", broken)
+    reply = client("ECHO", "x")
+    assert isinstance(reply, ReplyError) and reply.startswith("ERR KeyError")
+    assert main.stats.commands["echo"].failed_calls >= 1
+    assert client("PING") == "PONG"
+
+
+def test_an_unencodable_reply_costs_one_error_reply(client, monkeypatch):
+    monkeypatch.setattr(main.commands.COMMANDS[b"ECHO"], "handler", lambda *_: object())
+    reply = client("ECHO", "x")
+    assert isinstance(reply, ReplyError) and reply.startswith("ERR RuntimeError")
+    assert client("PING") == "PONG"
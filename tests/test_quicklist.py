@@ -0,0 +1,75 @@
+import random
+from typing import List
+
+from app.quicklist import CHUNK_SIZE, QuickList
+
+
+def check(quick: QuickList, model: List[bytes]):
+    assert len(quick) == len(model) and list(quick) == model
+    assert list(reversed(quick)) == model[::-1]
+    assert all(len(chunk) <= CHUNK_SIZE and chunk for chunk in quick.chunks)
+
+
+def test_quicklist_matches_a_list():
+    rng = random.Random(16)
+    for _ in range(200):
+        model: List[bytes] = []
+        quick = QuickList()
+        for _ in range(600):
+            op = rng.random()
+            item = str(rng.randrange(20)).encode()
+            if op < 0.25:
+                quick.push_right(item)
+                model.append(item)
+            elif op < 0.45:
+                quick.push_left(item)
+                model.insert(0, item)
+            elif op < 0.55 and model:
+                assert quick.pop_left() == model.pop(0)
+            elif op < 0.65 and model:
+                assert quick.pop_right() == model.pop()
+            elif op < 0.75:
+                position = rng.randint(0, len(model))
+                quick.insert(position, item)
+                model.insert(position, item)
+            elif op < 0.8 and model:
+                position = rng.randrange(-len(model), len(model))
+                quick[position] = item
+                model[position] = item
+            elif op < 0.85:
+                count = rng.randint(-3, 3)
+                removed = quick.remove(item, count)
+                limit = abs(count) or len(model)
+                positions = [p for p, candidate in enumerate(model) if candidate == item]
+                positions = positions[:limit] if count >= 0 else positions[::-1][:limit]
+                for p in sorted(positions, reverse=True):
+                    del model[p]
+                assert removed == len(positions)
+            elif op < 0.87 and model:
+                start = rng.randint(0, len(model))
+                stop = rng.randint(-1, len(model) - 1)
+                quick.trim(start, stop)
+                model[:] = model[start:stop + 1]
+            if model:
+                start = rng.randrange(len(model))
+                stop = rng.randrange(start, len(model))
+                assert quick.range(start, stop) == model[start:stop + 1]
+            check(quick, model)
+
+
+def test_insert_into_a_full_chunk_splits_it():
+    model = [b"%d" % i for i in range(CHUNK_SIZE)]
+    quick = QuickList(model)
+    quick.insert(CHUNK_SIZE // 2, b"x")
+    model.insert(CHUNK_SIZE // 2, b"x")
+    check(quick, model)
+    assert len(quick.chunks) == 2
+
+
+def test_trim_across_chunks():
+    model = [b"%d" % i for i in range(CHUNK_SIZE * 3 + 5)]
+    quick = QuickList(model)
+    quick.trim(CHUNK_SIZE - 1, CHUNK_SIZE * 2 + 1)
+    check(quick, model[CHUNK_SIZE - 1:CHUNK_SIZE * 2 + 2])
+    quick.trim(5, 2)
+    check(quick, [])
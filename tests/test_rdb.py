@@ -0,0 +1,113 @@
+import random
+
+import pytest
+
+from app import rdb_loader, rdb_writer
+from app.expires import ExpireIndex
+from app.quicklist import QuickList
+from app.rdb_parser import Value
+from app.sorted_set import SortedSet
+from app.stream import ConsumerGroup, PendingEntry, Stream
+
+
+def entries(stream: Stream):
+    return [((entry.milliseconds, entry.sequence), entry.value) for entry in stream]
+
+
+def test_every_type_round_trips():
+    rng = random.Random(20)
+    items = QuickList()
+    for i in range(500):
+        items.push_right(rng.choice([b"item%d" % i, b"%d" % i, rng.randbytes(40)]))
+    zset = SortedSet()
+    for i in range(300):
+        zset.add(b"m%d" % i, rng.choice([i, i / 7, -i * 1e10]))
+    stream = Stream()
+    for i in range(1, 400):
+        stream.add((1000 + i // 3, i % 3), {b"field": b"%d" % i, b"other": rng.randbytes(8)})
+    stream.delete([(1001, 0), (1050, 1)])
+    group = ConsumerGroup(b"group", (0, 0))
+    stream.groups[b"group"] = group
+    group.deliver_new(stream, group.consumer(b"alice"), 10, False)
+    group.deliver_new(stream, group.consumer(b"bob"), 5, False)
+    group.consumer(b"idle")
+
+    db = {
+        b"string": Value(b"hello"),
+        b"number": Value(b"12345"),
+        b"negative": Value(b"-7"),
+        b"binary": Value(rng.randbytes(3000)),
+        b"list": Value(items),
+        b"set": Value({b"a", b"b", b"%d" % 42}),
+        b"hash": Value({b"f1": b"v1", b"f2": b"200"}),
+        b"stream": Value(stream),
+    }
+    expires = ExpireIndex()
+    expires.set(b"string", 4102444800000)
+    expires.set(b"zset", 4102444800123)
+
+    snapshot = rdb_loader.parse(rdb_writer.dumps(db, {b"zset": zset}, expires))
+    loaded = snapshot.databases[0]
+    assert snapshot.expires[0] == {b"string": 4102444800000, b"zset": 4102444800123}
+    for key in (b"string", b"number", b"negative", b"binary", b"set", b"hash"):
+        assert loaded[key] == db[key].value
+    assert list(loaded[b"list"]) == list(items)
+    assert list(loaded[b"zset"]) == list(zset)
+
+    loaded_stream = loaded[b"stream"]
+    assert entries(loaded_stream) == entries(stream)
+    assert loaded_stream.last_id == stream.last_id
+    loaded_group = loaded_stream.groups[b"group"]
+    assert loaded_group.last_id == group.last_id
+    assert loaded_group.consumers.keys() == {b"alice", b"bob", b"idle"}
+    for name, consumer in group.consumers.items():
+        assert loaded_group.consumers[name].pending.ids == consumer.pending.ids
+    assert loaded_group.pending.ids == group.pending.ids
+    for entry_id, pending in group.pending.entries.items():
+        loaded_pending = loaded_group.pending.get(entry_id)
+        assert loaded_pending.consumer.name == pending.consumer.name
+        assert loaded_pending.consumer is loaded_group.consumers[pending.consumer.name]
+        assert loaded_pending.delivery_time == pending.delivery_time
+        assert loaded_pending.delivery_count == pending.delivery_count
+
+
+def test_expired_keys_are_skipped_at_load():
+    db = {b"old": Value(b"1"), b"new": Value(b"2"), b"forever": Value(b"3")}
+    expires = ExpireIndex()
+    expires.set(b"old", 1000)
+    expires.set(b"new", 3000)
+    payload = rdb_writer.dumps(db, {}, expires)
+    assert rdb_loader.parse(payload).databases[0].keys() == db.keys()
+    snapshot = rdb_loader.parse(payload, now_ms=2000)
+    assert snapshot.databases[0].keys() == {b"new", b"forever"}
+    assert snapshot.keys_expired == 1
+
+
+def test_group_pending_entry_without_a_consumer_is_corrupt():
+    stream = Stream()
+    stream.add((1, 1), {b"f": b"v"})
+    group = stream.groups[b"group"] = ConsumerGroup(b"group", (1, 1))
+    group.consumer(b"alice")
+    # In the group's PEL but in no consumer's
+    group.pending.add((1, 1), PendingEntry(group.consumers[b"alice"], 1000))
+    payload = rdb_writer.dumps({b"stream": Value(stream)}, {}, ExpireIndex())
+    with pytest.raises(rdb_loader.RdbError, match="no consumer"):
+        rdb_loader.parse(payload)
+
+
+def test_stream_counters_round_trip():
+    stream = Stream()
+    for i in range(1, 11):
+        stream.add((i, 0), {b"f": b"%d" % i})
+    stream.delete([(4, 0), (8, 0), (7, 0)])
+    assert stream.max_deleted_entry_id == (8, 0)
+    stream.trim_maxlen(3)
+    # Deleting the top entry keeps last_id, and trimming leaves the counters be
+    stream.delete([(10, 0)])
+    assert (stream.entries_added, stream.max_deleted_entry_id) == (10, (10, 0))
+    payload = rdb_writer.dumps({b"stream": Value(stream)}, {}, ExpireIndex())
+    loaded = rdb_loader.parse(payload).databases[0][b"stream"]
+    assert entries(loaded) == entries(stream)
+    assert loaded.last_id == (10, 0)
+    assert loaded.entries_added == 10
+    assert loaded.max_deleted_entry_id == (10, 0)
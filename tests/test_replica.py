@@ -0,0 +1,171 @@
+import socket
+
+import pytest
+
+from app import main
+from app.backlog import ReplicationBacklog
+from app.connection import ThreadedConnection
+from app.event_loop import Connection, EventLoop
+from app.replica import OutputBufferLimit, Replica, parse_output_buffer_limit
+
+
+@pytest.mark.parametrize("text, limit", [
+    ("replica 256mb 64mb 60", OutputBufferLimit(256 * 1024 ** 2, 64 * 1024 ** 2, 60)),
+    ("slave 0 0 0", OutputBufferLimit(0, 0, 0)),
+    ("REPLICA 1kb 512 5", OutputBufferLimit(1024, 512, 5)),
+])
+def test_parse_output_buffer_limit(text, limit):
+    assert parse_output_buffer_limit(text) == limit
+
+
+@pytest.mark.parametrize("text", ["replica 1mb 1mb", "normal 1mb 1mb 60", "replica x 1mb 60", "replica 1 1 x"])
+def test_parse_output_buffer_limit_errors(text):
+    with pytest.raises(ValueError):
+        parse_output_buffer_limit(text)
+
+
+@pytest.fixture
+def looped():
+    """A replica on an event-loop connection, and the socket it sends to"""
+    ours, theirs = socket.socketpair()
+    ours.setblocking(False)
+    theirs.settimeout(5)
+    conn = Connection(EventLoop(), ours)
+    replica = Replica(conn, loop=conn.loop)
+    yield replica, theirs
+    replica.stop()
+    ours.close()
+    theirs.close()
+
+
+def receive(peer: socket.socket, n: int) -> bytes:
+    data = b""
+    while len(data) < n:
+        chunk = peer.recv(n - len(data))
+        assert chunk
+        data += chunk
+    return data
+
+
+def test_feeds_wait_for_one_flush(looped):
+    replica, peer = looped
+    commands = [main.encode_resp([b"SET", b"k%d" % i, b"v"]) for i in range(100)]
+    for encoded in commands:
+        replica.feed(encoded)
+    # Queued, not yet handed to the connection
+    assert not replica.conn.out
+    assert replica.pending() == sum(map(len, commands))
+    replica.flush()
+    assert not replica.queue
+    assert replica.conn.out == b"".join(commands)
+    assert replica.conn in replica.loop.pending_writes
+    replica.conn.flush()
+    assert receive(peer, sum(map(len, commands))) == b"".join(commands)
+    assert replica.pending() == 0
+    # Nothing queued: flush() doesn't touch the connection
+    replica.flush()
+    assert not replica.conn.out
+
+
+def test_threaded_sender_writes_the_queue_in_order():
+    ours, theirs = socket.socketpair()
+    theirs.settimeout(5)
+    replica = Replica(ThreadedConnection(ours))
+    try:
+        stream = b""
+        for batch in range(20):
+            for i in range(50):
+                encoded = main.encode_resp([b"SET", b"k%d" % i, b"%d" % batch])
+                replica.feed(encoded)
+                stream += encoded
+            replica.flush()
+        assert receive(theirs, len(stream)) == stream
+    finally:
+        replica.stop()
+        ours.close()
+        theirs.close()
+
+
+def test_stopped_replicas_drop_what_is_fed(looped):
+    replica, _ = looped
+    replica.feed(b"queued")
+    replica.stop()
+    replica.feed(b"late")
+    assert replica.pending() == 0
+    replica.flush()
+    assert not replica.conn.out
+
+
+def test_hard_and_soft_limits(looped):
+    replica, _ = looped
+    limit = OutputBufferLimit(hard=100, soft=50, soft_seconds=10)
+    replica.feed(b"x" * 60)
+    assert not replica.over_limit(limit, 1000.0)
+    assert not replica.over_limit(limit, 1010.0)
+    # Above the soft limit for longer than soft_seconds
+    assert replica.over_limit(limit, 1010.5)
+    replica.queue.clear()
+    assert not replica.over_limit(limit, 1011.0)
+    # Dropping below the soft limit resets the clock
+    replica.feed(b"x" * 60)
+    assert not replica.over_limit(limit, 1015.0)
+    replica.feed(b"x" * 41)
+    assert replica.over_limit(limit, 1015.0)
+    assert not replica.over_limit(OutputBufferLimit(0, 0, 0), 2000.0)
+
+
+@pytest.fixture
+def attached():
+    """Event-loop replicas attached to main's replication state"""
+    loop = EventLoop()
+    saved = main.replication.backlog, main.replication.master_repl_offset
+    main.replication.backlog = ReplicationBacklog(1 << 16)
+    main.replication.master_repl_offset = 0
+    pairs = []
+
+    def attach():
+        ours, theirs = socket.socketpair()
+        ours.setblocking(False)
+        theirs.settimeout(5)
+        conn = Connection(loop, ours)
+        main.replication.connected_replicas[conn] = Replica(conn, loop=loop)
+        pairs.append((conn, theirs))
+        return conn, theirs
+
+    yield attach
+    for conn, theirs in pairs:
+        main.drop_replica(conn)
+        conn.close()
+        theirs.close()
+    main.replication.backlog, main.replication.master_repl_offset = saved
+
+
+def test_flush_replicas_batches_each_queue(attached):
+    first, second = attached(), attached()
+    stream = b""
+    for i in range(10):
+        encoded = main.encode_resp([b"INCR", b"n%d" % i])
+        main.replicate(encoded)
+        stream += encoded
+    for conn, _ in (first, second):
+        assert not conn.out
+    main.flush_replicas()
+    for conn, peer in (first, second):
+        assert conn.out == stream
+        conn.flush()
+        assert receive(peer, len(stream)) == stream
+
+
+def test_replica_over_the_hard_limit_is_dropped(attached, monkeypatch):
+    monkeypatch.setattr(main.replication, "output_buffer_limit", OutputBufferLimit(1000, 0, 0))
+    slow, peer = attached()
+    fast, _ = attached()
+    main.replicate(main.encode_resp([b"SET", b"k", b"x" * 500]))
+    assert slow in main.replication.connected_replicas
+    # The fast replica drains its queue, the slow one doesn't
+    main.replication.connected_replicas[fast].flush()
+    fast.out.clear()
+    main.replicate(main.encode_resp([b"SET", b"k", b"x" * 600]))
+    assert slow not in main.replication.connected_replicas
+    assert fast in main.replication.connected_replicas
+    assert peer.recv(1) == b""
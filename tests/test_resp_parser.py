@@ -0,0 +1,108 @@
+import random
+import socket
+
+import pytest
+
+from app.main import encode_resp
+from app.resp_parser import READ_SIZE, ProtocolError, QueryBufferLimitError, RespParser
+
+FRAMES = [
+    [b"SET", b"key", b"value"],
+    [b"ECHO", b""],
+    [b"RPUSH", b"list"] + [b"item%d" % i for i in range(50)],
+    [b"SET", b"big", bytes(range(256)) * 300],
+    [b"PING"],
+]
+STREAM = b"".join(encode_resp(frame) for frame in FRAMES)
+
+
+def test_pipelined_frames_come_out_whole():
+    parser = RespParser()
+    parser.feed(STREAM)
+    frames = list(parser.frames())
+    assert [value for value, _ in frames] == FRAMES
+    assert [size for _, size in frames] == [len(encode_resp(frame)) for frame in FRAMES]
+    assert parser.offset == len(STREAM)
+
+
+def test_a_frame_cut_anywhere_resumes():
+    rng = random.Random(1)
+    for _ in range(50):
+        parser = RespParser()
+        frames = []
+        pos = 0
+        while pos < len(STREAM):
+            step = rng.choice([1, 2, 7, rng.randint(1, 2 * READ_SIZE)])
+            parser.feed(STREAM[pos:pos + step])
+            pos += step
+            frames.extend(parser.commands())
+            # Only complete frames move the offset
+            assert parser.offset <= pos
+        assert frames == FRAMES
+        assert parser.offset == len(STREAM)
+
+
+def test_values_of_every_type():
+    parser = RespParser()
+    parser.feed(b"+OK\r\n-ERR bad\r\n:-42\r\n$-1\r\n*-1\r\n*0\r\n*2\r\n*1\r\n:1\r\n$2\r\nab\r\n")
+    assert list(parser.commands()) == ["OK", "ERR bad", -42, None, None, [], [[1], b"ab"]]
+
+
+def test_recv_into_reads_from_the_socket():
+    ours, theirs = socket.socketpair()
+    with ours, theirs:
+        theirs.sendall(STREAM)
+        parser = RespParser()
+        frames = []
+        while len(frames) < len(FRAMES):
+            assert parser.recv_into(ours)
+            frames.extend(parser.commands())
+        assert frames == FRAMES
+
+
+@pytest.mark.parametrize("data", [
+    b"?1\r\n",
+    b":abc\r\n",
+    b"*x\r\n",
+    b"$3\r\nabcde\r\n",
+])
+def test_malformed_input_raises(data):
+    parser = RespParser()
+    parser.feed(data)
+    with pytest.raises(ProtocolError):
+        list(parser.frames())
+
+
+def test_query_buffer_limit():
+    parser = RespParser(query_buffer_limit=100)
+    parser.feed(b"$1000\r\n")
+    with pytest.raises(QueryBufferLimitError):
+        list(parser.frames())
+
+    # A frame that never ends is refused once it outgrows the limit
+    parser = RespParser(query_buffer_limit=100)
+    parser.feed(b"*2\r\n$3\r\nSET\r\n" + b"+" + b"x" * 200)
+    with pytest.raises(QueryBufferLimitError):
+        list(parser.frames())
+
+
+@pytest.mark.parametrize("eof_mark", [False, True])
+def test_rdb_payload_has_no_trailing_crlf(eof_mark):
+    payload = b"REDIS0011" + bytes(range(256)) * 10
+    mark = b"m" * 40
+    if eof_mark:
+        data = b"$EOF:" + mark + b"\r\n" + payload + mark
+    else:
+        data = b"$%d\r\n" % len(payload) + payload
+    data += encode_resp([b"PING"])
+    rng = random.Random(1)
+    parser = RespParser()
+    parser.expect_rdb_payload()
+    frames = []
+    pos = 0
+    while pos < len(data):
+        step = rng.randint(1, 50)
+        parser.feed(data[pos:pos + step])
+        pos += step
+        frames.extend(parser.commands())
+    assert frames == [payload, [b"PING"]]
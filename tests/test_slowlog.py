@@ -0,0 +1,67 @@
+import pytest
+
+from app import main
+from app.slowlog import SLOWLOG_ENTRY_MAX_ARGC, SLOWLOG_ENTRY_MAX_STRING, Slowlog, truncate_argv
+from conftest import ReplyError
+
+
+def test_threshold():
+    assert Slowlog(0).is_slow(0)
+    assert not Slowlog(100).is_slow(99) and Slowlog(100).is_slow(100)
+    # Negative disables the log
+    assert not Slowlog(-1).is_slow(10**9)
+
+
+def test_newest_first_and_bounded():
+    log = Slowlog(0, max_len=3)
+    for i in range(5):
+        log.record([b"SET", b"k%d" % i, b"v"], 100 + i, b"127.0.0.1:5000", b"name")
+    assert len(log) == 3
+    entries = log.get(-1)
+    assert [entry[0] for entry in entries] == [4, 3, 2]
+    assert entries[0][2:] == [104, [b"SET", b"k4", b"v"], b"127.0.0.1:5000", b"name"]
+    assert [entry[0] for entry in log.get(2)] == [4, 3]
+    log.reset()
+    assert len(log) == 0 and log.get() == []
+    # Ids keep counting after a reset
+    log.record([b"PING"], 1, b"")
+    assert log.get()[0][0] == 5
+
+
+def test_long_arguments_are_truncated():
+    argv = [b"x" * (SLOWLOG_ENTRY_MAX_STRING + 10)] + [b"%d" % i for i in range(40)]
+    logged = truncate_argv(argv)
+    assert len(logged) == SLOWLOG_ENTRY_MAX_ARGC
+    assert logged[0] == b"x" * SLOWLOG_ENTRY_MAX_STRING + b"... (10 more bytes)"
+    assert logged[-1] == b"... (10 more arguments)"
+    assert truncate_argv([b"GET", b"k"]) == [b"GET", b"k"]
+
+
+@pytest.fixture
+def log_everything(monkeypatch):
+    monkeypatch.setattr(main, "slowlog", Slowlog(0, 10))
+
+
+def test_slowlog_command(client, log_everything):
+    assert client("SET", "k", "v") == "OK"
+    assert client("GET", "k") == b"v"
+    assert client("SLOWLOG", "LEN") == 2
+    # Commands are logged after they run, SLOWLOG LEN included
+    entries = client("SLOWLOG", "GET", "2")
+    assert [entry[3] for entry in entries] == [[b"SLOWLOG", b"LEN"], [b"GET", b"k"]]
+    _, timestamp, duration, _, _, _ = entries[1]
+    assert timestamp > 0 and duration >= 0
+    assert entries[0][0] == entries[1][0] + 1
+    assert len(client("SLOWLOG", "GET", "-1")) == 4
+    assert client("SLOWLOG", "RESET") == "OK"
+    assert client("SLOWLOG", "LEN") == 1
+
+
+@pytest.mark.parametrize("command", [
+    ["SLOWLOG", "GET", "x"],
+    ["SLOWLOG", "GET", "-2"],
+    ["SLOWLOG", "NOPE"],
+    ["SLOWLOG", "LEN", "extra"],
+])
+def test_slowlog_errors(client, command):
+    assert isinstance(client(*command), ReplyError)
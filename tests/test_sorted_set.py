@@ -0,0 +1,213 @@
+import math
+import random
+from typing import Dict
+
+import pytest
+
+from app.sorted_set import ScoreRange, SortedSet, clamp_rank_range, parse_score_range
+from conftest import ReplyError
+
+
+def ordered(model: Dict[bytes, float]):
+    return sorted(model.items(), key=lambda item: (item[1], item[0]))
+
+
+def check(zset: SortedSet, model: Dict[bytes, float]):
+    expected = ordered(model)
+    assert len(zset) == zset.length == len(model)
+    assert list(zset) == expected
+    # Every span counts the level-0 nodes its link skips
+    ranks = {zset.header.member: 0}
+    x, rank = zset.header.forward[0], 1
+    while x is not None:
+        ranks[x.member] = rank
+        x, rank = x.forward[0], rank + 1
+    for level in range(zset.level):
+        x = zset.header
+        while x.forward[level] is not None:
+            assert x.span[level] == ranks[x.forward[level].member] - ranks[x.member]
+            x = x.forward[level]
+    backward = []
+    x = zset.tail
+    while x is not None:
+        backward.append((x.member, x.score))
+        x = x.backward
+    assert backward == expected[::-1]
+
+
+def test_sorted_set_matches_a_dict():
+    rng = random.Random(7)
+    zset = SortedSet()
+    model: Dict[bytes, float] = {}
+    for step in range(3000):
+        member = b"m%d" % rng.randrange(300)
+        op = rng.random()
+        if op < 0.6:
+            score = float(rng.randrange(-50, 50)) if rng.random() < 0.5 else rng.uniform(-1e6, 1e6)
+            assert zset.add(member, score) == (member not in model)
+            model[member] = score
+        elif op < 0.85:
+            assert zset.remove(member) == (member in model)
+            model.pop(member, None)
+        elif op < 0.9:
+            count = rng.randint(1, 5)
+            expected = ordered(model)
+            assert zset.pop_min(count) == expected[:count]
+            assert zset.pop_max(count) == expected[count:][::-1][:count]
+            for removed, _ in expected[:count] + expected[count:][::-1][:count]:
+                del model[removed]
+        else:
+            length = len(model)
+            start, stop = clamp_rank_range(
+                rng.randint(-length - 3, length + 3), rng.randint(-length - 3, length + 3), length
+            )
+            expected = ordered(model)
+            removed = zset.remove_range_by_rank(start, stop)
+            assert removed == (expected[start:stop + 1] if start <= stop else [])
+            for removed_member, _ in removed:
+                del model[removed_member]
+        assert zset.score(member) == model.get(member)
+        if step % 100 == 0:
+            check(zset, model)
+    check(zset, model)
+
+
+def test_rank_and_rank_ranges():
+    rng = random.Random(7)
+    zset = SortedSet()
+    for i in range(1000):
+        zset.add(b"m%d" % i, rng.choice([1.0, 2.0, rng.random()]))
+    expected = list(zset)
+    for rank, (member, _) in enumerate(expected):
+        assert zset.rank(member) == rank
+        assert zset.rank(member, reverse=True) == len(expected) - 1 - rank
+    assert zset.rank(b"missing") is None
+    for _ in range(200):
+        start, stop = sorted(rng.sample(range(1100), 2))
+        assert zset.range_by_rank(start, stop) == expected[start:stop + 1]
+        assert zset.range_by_rank(start, stop, reverse=True) == expected[::-1][start:stop + 1]
+    assert zset.range_by_rank(5, 4) == []
+
+
+def test_bulk_load_builds_the_same_list():
+    rng = random.Random(7)
+    items = [(b"m%d" % i, rng.choice([0.0, rng.uniform(-10, 10)])) for i in range(2000)]
+    loaded = SortedSet()
+    loaded.bulk_load(items)
+    check(loaded, dict(items))
+    # Still a working skiplist afterwards
+    model = dict(items)
+    for member, _ in items[:500]:
+        loaded.remove(member)
+        del model[member]
+    loaded.add(b"new", -100.0)
+    model[b"new"] = -100.0
+    check(loaded, model)
+    assert loaded.rank(b"new") == 0
+
+
+def test_clamp_rank_range():
+    assert clamp_rank_range(0, -1, 5) == (0, 4)
+    assert clamp_rank_range(-100, 100, 5) == (0, 4)
+    assert clamp_rank_range(-2, -1, 5) == (3, 4)
+    start, stop = clamp_rank_range(3, 1, 5)
+    assert start > stop
+
+
+def test_rank_commands(client):
+    for score, member in [("2", "b"), ("1", "a"), ("3", "c"), ("2", "bb")]:
+        assert client("ZADD", "z", score, member) == 1
+    assert client("ZADD", "z", "0", "c") == 0
+    assert client("ZRANGE", "z", "0", "-1") == [b"c", b"a", b"b", b"bb"]
+    assert client("ZRANGE", "z", "-2", "-1", "WITHSCORES") == [b"b", b"2", b"bb", b"2"]
+    assert client("ZRANGE", "z", "0", "0", "REV") == [b"bb"]
+    assert client("ZRANGE", "z", "3", "1") == []
+    assert client("ZRANK", "z", "b") == 2
+    assert client("ZRANK", "z", "missing") is None
+    assert client("ZSCORE", "z", "c") == b"0"
+    assert client("ZREM", "z", "a") == 1
+    assert client("ZREM", "z", "missing") == 0
+    assert client("ZCARD", "z") == 3
+    assert client("ZREMRANGEBYRANK", "z", "0", "1") == 2
+    assert client("ZRANGE", "z", "0", "-1") == [b"bb"]
+
+
+def test_score_ranges_match_a_filter():
+    rng = random.Random(8)
+    zset = SortedSet()
+    for i in range(500):
+        zset.add(b"m%d" % i, float(rng.randrange(100)))
+    items = list(zset)
+    bounds = [-math.inf, math.inf] + [float(b) for b in range(-1, 102)]
+    for _ in range(300):
+        spec = ScoreRange(rng.choice(bounds), rng.choice(bounds), rng.random() < 0.5, rng.random() < 0.5)
+        inside = [(m, s) for m, s in items if spec.gte_min(s) and spec.lte_max(s)]
+        assert zset.count_in_range(spec) == len(inside)
+        assert zset.range_by_score(spec) == inside
+        assert zset.range_by_score(spec, reverse=True) == inside[::-1]
+        offset, count = rng.randrange(0, 30), rng.choice([-1, 0, 1, 10])
+        end = None if count < 0 else offset + count
+        assert zset.range_by_score(spec, offset=offset, count=count) == inside[offset:end]
+        assert zset.range_by_score(spec, reverse=True, offset=offset, count=count) == inside[::-1][offset:end]
+
+
+def test_remove_range_by_score():
+    rng = random.Random(8)
+    zset = SortedSet()
+    model = {}
+    for i in range(300):
+        model[b"m%d" % i] = float(rng.randrange(50))
+        zset.add(b"m%d" % i, model[b"m%d" % i])
+    spec = ScoreRange(10, 20, minex=True)
+    removed = zset.remove_range_by_score(spec)
+    assert removed == [(m, s) for m, s in ordered(model) if 10 < s <= 20]
+    for member, _ in removed:
+        del model[member]
+    check(zset, model)
+    assert zset.remove_range_by_score(ScoreRange(5, 5, maxex=True)) == []
+
+
+@pytest.mark.parametrize("low, high, expected", [
+    (b"1", b"2", ScoreRange(1, 2)),
+    (b"(1", b"(2.5", ScoreRange(1, 2.5, True, True)),
+    (b"-inf", b"+inf", ScoreRange(-math.inf, math.inf)),
+    (b"(-inf", b"inf", ScoreRange(-math.inf, math.inf, minex=True)),
+    (b"x", b"1", None),
+    (b"1", b"(", None),
+    (b"nan", b"1", None),
+])
+def test_parse_score_range(low, high, expected):
+    assert parse_score_range(low, high) == expected
+
+
+def test_score_range_commands(client):
+    for score, member in [("1", "a"), ("2", "b"), ("2", "c"), ("3", "d"), ("4.5", "e")]:
+        assert client("ZADD", "z", score, member) == 1
+    assert client("ZRANGEBYSCORE", "z", "2", "3") == [b"b", b"c", b"d"]
+    assert client("ZRANGEBYSCORE", "z", "(2", "+inf", "WITHSCORES") == [b"d", b"3", b"e", b"4.5"]
+    assert client("ZRANGEBYSCORE", "z", "-inf", "+inf", "LIMIT", "1", "2") == [b"b", b"c"]
+    assert client("ZREVRANGEBYSCORE", "z", "3", "(1") == [b"d", b"c", b"b"]
+    assert client("ZREVRANGEBYSCORE", "z", "+inf", "-inf", "LIMIT", "0", "1", "WITHSCORES") == [b"e", b"4.5"]
+    assert client("ZRANGE", "z", "(1", "2", "BYSCORE") == [b"b", b"c"]
+    assert client("ZRANGE", "z", "5", "3", "BYSCORE", "REV") == [b"e", b"d"]
+    assert client("ZRANGEBYSCORE", "z", "3", "2") == []
+    assert client("ZRANGEBYSCORE", "missing", "0", "1") == []
+    assert client("ZCOUNT", "z", "2", "2") == 2
+    assert client("ZCOUNT", "z", "(2", "(2") == 0
+    assert client("ZCOUNT", "missing", "-inf", "+inf") == 0
+    assert client("ZREMRANGEBYSCORE", "z", "-inf", "(2") == 1
+    assert client("ZREMRANGEBYSCORE", "z", "0", "10") == 4
+    assert client("TYPE", "z") == "none"
+
+
+@pytest.mark.parametrize("command", [
+    ["ZRANGEBYSCORE", "z", "a", "1"],
+    ["ZCOUNT", "z", "1", "b"],
+    ["ZRANGEBYSCORE", "z", "0", "1", "LIMIT", "x", "1"],
+    ["ZRANGEBYSCORE", "z", "0", "1", "LIMIT", "0"],
+    ["ZRANGE", "z", "0", "1", "LIMIT", "0", "1"],
+    ["ZREMRANGEBYSCORE", "z", "nan", "1"],
+])
+def test_score_range_errors(client, command):
+    assert client("ZADD", "z", "1", "a") == 1
+    assert isinstance(client(*command), ReplyError)
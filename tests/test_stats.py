@@ -0,0 +1,109 @@
+import random
+import urllib.error
+import urllib.request
+
+import pytest
+
+from app import main
+from app.stats import SUB_BUCKETS, LatencyHistogram, Stats, start_metrics_server
+
+
+def test_buckets_bound_their_values_within_an_eighth():
+    previous = -1
+    for value in list(range(5000)) + [2**k + d for k in range(13, 40) for d in (-1, 0, 1)]:
+        index = LatencyHistogram.bucket_index(value)
+        upper = LatencyHistogram.bucket_upper_bound(index)
+        assert value <= upper <= max(value, value + value // SUB_BUCKETS)
+        # Bucket indexes grow with the value
+        assert index >= previous
+        previous = index
+
+
+def test_percentiles_match_the_sorted_values():
+    rng = random.Random(4)
+    values = [int(rng.lognormvariate(5, 2)) for _ in range(10000)]
+    histogram = LatencyHistogram()
+    for value in values:
+        histogram.record(value)
+    values.sort()
+    for p, estimate in histogram.percentiles((50.0, 99.0, 99.9, 100.0)):
+        rank = -(-len(values) * round(p * 10) // 1000)
+        exact = values[rank - 1]
+        assert exact <= estimate <= exact + exact // SUB_BUCKETS
+    assert LatencyHistogram().percentiles() == []
+
+
+def test_command_counters():
+    stats = Stats()
+    stats.record_command("get", 10, False)
+    stats.record_command("get", 30, True)
+    stats.record_rejected("set")
+    stats.record_read_batch(3)
+    stats.record_read_batch(0)
+    stats.record_read_batch(1)
+    assert stats.total_commands_processed == 2
+    assert "total_read_batches:2" in stats.stats_lines()
+    assert "max_pipeline_depth:3" in stats.stats_lines()
+    assert stats.commandstats_lines() == [
+        "cmdstat_get:calls=2,usec=40,usec_per_call=20.00,rejected_calls=0,failed_calls=1",
+        "cmdstat_set:calls=0,usec=0,usec_per_call=0.00,rejected_calls=1,failed_calls=0",
+    ]
+    assert stats.latencystats_lines() == ["latency_percentiles_usec_get:p50=10.000,p99=31.000,p99.9=31.000"]
+
+
+def test_prometheus_exposition():
+    stats = Stats()
+    stats.record_command("get", 2_000_000, False)
+    text = stats.prometheus({"connected_clients": 3})
+    assert "# TYPE redis_connected_clients gauge\nredis_connected_clients 3\n" in text
+    assert 'redis_commands_total{cmd="get"} 1\n' in text
+    assert 'redis_commands_duration_seconds_total{cmd="get"} 2.0\n' in text
+    assert '# TYPE redis_command_latency_seconds summary\n' in text
+    assert 'redis_command_latency_seconds{cmd="get",quantile="0.5"}' in text
+    assert text.endswith("\n")
+
+
+def test_metrics_endpoint():
+    server = start_metrics_server(0, lambda: "redis_up 1\n")
+    port = server.server_address[1]
+    try:
+        with urllib.request.urlopen(f"http://localhost:{port}/metrics", timeout=5) as response:
+            assert response.headers["Content-Type"].startswith("text/plain")
+            assert response.read() == b"redis_up 1\n"
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(f"http://localhost:{port}/other", timeout=5)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def info(client, *sections) -> dict:
+    fields = {}
+    for line in client("INFO", *sections).decode().splitlines():
+        if line and not line.startswith("#"):
+            name, _, value = line.partition(":")
+            fields[name] = value
+    return fields
+
+
+def test_info_sections(client):
+    assert client("SET", "k", "v") == "OK"
+    assert isinstance(client("INCR", "k"), str)
+    default = info(client)
+    assert "redis_version" in default and "used_memory" in default and "role" in default
+    assert not any(name.startswith("cmdstat_") for name in default)
+    stats = info(client, "stats")
+    assert int(stats["total_commands_processed"]) >= 2
+    assert int(stats["total_error_replies"]) >= 1
+    commandstats = info(client, "commandstats")
+    assert "failed_calls=" in commandstats["cmdstat_incr"]
+    assert info(client, "latencystats")["latency_percentiles_usec_set"].startswith("p50=")
+    everything = info(client, "all")
+    assert "cmdstat_set" in everything and "latency_percentiles_usec_set" in everything
+
+
+def test_render_metrics(client):
+    assert client("SET", "k", "v") == "OK"
+    text = main.render_metrics()
+    assert "redis_db_keys 1\n" in text
+    assert 'redis_commands_total{cmd="set"}' in text
@@ -0,0 +1,140 @@
+import random
+from typing import List, Tuple
+
+import pytest
+
+from app.stream import MAX_ID, MIN_ID, NODE_ENTRIES, Stream, StreamError, parse_range_end, parse_range_start
+from conftest import ReplyError
+
+
+def ids(entries) -> List[Tuple[int, int]]:
+    return [(entry.milliseconds, entry.sequence) for entry in entries]
+
+
+def test_stream_matches_a_list():
+    rng = random.Random(12)
+    stream = Stream()
+    model: List[Tuple[int, int]] = []
+    next_ms = 1
+    for step in range(5000):
+        op = rng.random()
+        if op < 0.55:
+            entry_id = (next_ms, rng.randrange(3))
+            next_ms += 1
+            stream.add(entry_id, {b"f": b"%d" % step})
+            model.append(entry_id)
+        elif op < 0.8 and model:
+            doomed = rng.sample(model, min(len(model), rng.randint(1, 5))) + [(0, 9)]
+            assert stream.delete(doomed) == len(set(doomed) & set(model))
+            model = [entry_id for entry_id in model if entry_id not in doomed]
+        elif op < 0.9:
+            maxlen = rng.randrange(len(model) + 2)
+            assert stream.trim_maxlen(maxlen) == max(0, len(model) - maxlen)
+            model = model[len(model) - maxlen:] if maxlen < len(model) else model
+        elif model:
+            min_id = rng.choice(model)
+            below = [entry_id for entry_id in model if entry_id < min_id]
+            assert stream.trim_minid(min_id) == len(below)
+            model = model[len(below):]
+        assert len(stream) == len(model)
+        assert stream.first_entry_id() == (model[0] if model else None)
+        assert stream.last_entry_id() == (model[-1] if model else None)
+        if step % 50 == 0:
+            assert ids(stream) == model
+            start, end = sorted([(rng.randrange(next_ms), 0), (rng.randrange(next_ms), 2)])
+            inside = [entry_id for entry_id in model if start <= entry_id <= end]
+            assert ids(stream.range(start, end)) == inside
+            assert ids(stream.range(start, end, reverse=True)) == inside[::-1]
+            assert ids(stream.range(start, end, count=3)) == inside[:3]
+            assert ids(stream.range(start, end, count=3, reverse=True)) == inside[::-1][:3]
+            assert ids(stream.after(start, 5)) == [entry_id for entry_id in model if entry_id > start][:5]
+            for entry_id in rng.sample(model, min(3, len(model))):
+                assert stream.get(entry_id).value is not None
+    # Dead slots never outnumber the live ones for long
+    assert stream.head + stream.deleted <= max(64, len(stream.ids) // 2 + 64)
+
+
+def test_approximate_trimming_cuts_whole_blocks():
+    stream = Stream()
+    for i in range(1, 3 * NODE_ENTRIES + 51):
+        stream.add((i, 0), {b"f": b"v"})
+    assert stream.trim_maxlen(10, approx=True) == 3 * NODE_ENTRIES
+    assert len(stream) == 50
+    assert stream.trim_maxlen(10, approx=True) == 0
+    assert stream.trim_maxlen(10, approx=True, limit=20) == 0
+    assert stream.trim_maxlen(10, limit=20) == 20
+    assert len(stream) == 30
+
+
+@pytest.mark.parametrize("text, start, end", [
+    (b"-", MIN_ID, None),
+    (b"+", None, MAX_ID),
+    (b"5", (5, 0), (5, MAX_ID[1])),
+    (b"5-3", (5, 3), (5, 3)),
+    (b"(5-3", (5, 4), (5, 2)),
+])
+def test_range_bounds(text, start, end):
+    if start is not None:
+        assert parse_range_start(text) == start
+    if end is not None:
+        assert parse_range_end(text) == end
+
+
+def test_next_id():
+    stream = Stream()
+    with pytest.raises(StreamError):
+        stream.next_id(b"0-0")
+    assert stream.next_id(b"0-*") == (0, 1)
+    stream.add((5, 5), {})
+    assert stream.next_id(b"5-*") == (5, 6)
+    assert stream.next_id(b"6-*") == (6, 0)
+    assert stream.next_id(b"*") > (5, 5)
+    for bad in (b"5-5", b"4-9", b"4-*", b"x"):
+        with pytest.raises(StreamError):
+            stream.next_id(bad)
+
+
+def test_stream_commands(client):
+    for i in range(1, 6):
+        assert client("XADD", "s", "%d-0" % i, "n", str(i)) == b"%d-0" % i
+    assert client("XADD", "s", "5-*", "n", "6") == b"5-1"
+    assert isinstance(client("XADD", "s", "5-1", "n", "x"), ReplyError)
+    assert client("XLEN", "s") == 6
+    assert client("XRANGE", "s", "-", "+", "COUNT", "2") == [[b"1-0", [b"n", b"1"]], [b"2-0", [b"n", b"2"]]]
+    assert [entry[0] for entry in client("XRANGE", "s", "(2-0", "4")] == [b"3-0", b"4-0"]
+    assert [entry[0] for entry in client("XREVRANGE", "s", "+", "(4-0")] == [b"5-1", b"5-0"]
+    assert client("XDEL", "s", "3-0", "9-0") == 1
+    assert [entry[0] for entry in client("XREAD", "COUNT", "2", "STREAMS", "s", "2-0")[0][1]] == [b"4-0", b"5-0"]
+    assert client("XTRIM", "s", "MAXLEN", "3") == 2
+    assert client("XTRIM", "s", "MINID", "5") == 1
+    assert [entry[0] for entry in client("XRANGE", "s", "-", "+")] == [b"5-0", b"5-1"]
+    assert client("XADD", "s", "MAXLEN", "1", "6-0", "n", "7") == b"6-0"
+    assert client("XLEN", "s") == 1
+    assert client("XADD", "missing", "NOMKSTREAM", "*", "f", "v") is None
+    assert client("XLEN", "missing") == 0
+
+
+def test_trimming_propagates_exact_arguments(client, propagated):
+    for i in range(1, 2 * NODE_ENTRIES + 11):
+        client.send("XADD", "s", "%d-1" % i, "f", "v")
+    for _ in range(2 * NODE_ENTRIES + 10):
+        client.read()
+    assert client("XADD", "s", "MAXLEN", "~", "5", "*", "f", "v") != b""
+    assert client("XTRIM", "s", "MINID", "~", "1000") == 0
+    commands = propagated()
+    assert commands[-2][:5] == [b"XADD", b"s", b"MAXLEN", b"=", b"11"]
+    assert commands[-1] == [b"XTRIM", b"s", b"MINID", b"=", b"201-1"]
+    assert client("XLEN", "s") == 11
+
+
+@pytest.mark.parametrize("command", [
+    ["XADD", "s", "MAXLEN", "-1", "*", "f", "v"],
+    ["XADD", "s", "MAXLEN", "1", "LIMIT", "10", "*", "f", "v"],
+    ["XADD", "s", "*", "f"],
+    ["XTRIM", "s", "LEN", "1"],
+    ["XTRIM", "s", "MAXLEN", "x"],
+    ["XRANGE", "s", "x", "+"],
+    ["XREAD", "STREAMS", "s"],
+])
+def test_stream_errors(client, command):
+    assert isinstance(client(*command), ReplyError)
@@ -0,0 +1,74 @@
+import pytest
+
+from conftest import ReplyError
+
+CREATE = {
+    "string": ["SET", "k", "1"],
+    "list": ["RPUSH", "k", "a"],
+    "zset": ["ZADD", "k", "1", "m"],
+    "stream": ["XADD", "k", "1-1", "f", "v"],
+}
+
+# (type the command works on, command)
+WRITES = [
+    ("string", ["INCR", "k"]),
+    ("list", ["LPUSH", "k", "b"]),
+    ("zset", ["ZADD", "k", "2", "n"]),
+    ("zset", ["GEOADD", "k", "13.36", "38.11", "palermo"]),
+    ("zset", ["ZREM", "k", "m"]),
+    ("stream", ["XADD", "k", "2-1", "f", "v"]),
+]
+
+READS = [
+    ("string", ["GET", "k"]),
+    ("list", ["LRANGE", "k", "0", "-1"]),
+    ("zset", ["ZRANGE", "k", "0", "-1"]),
+    ("zset", ["ZSCORE", "k", "m"]),
+    ("zset", ["ZCARD", "k"]),
+    ("zset", ["ZRANK", "k", "m"]),
+    ("zset", ["ZCOUNT", "k", "-inf", "+inf"]),
+    ("zset", ["GEOPOS", "k", "m"]),
+    ("zset", ["GEOSEARCH", "k", "FROMLONLAT", "0", "0", "BYRADIUS", "1", "km"]),
+    ("stream", ["XRANGE", "k", "-", "+"]),
+]
+
+
+def mismatched(commands):
+    """(existing type, command) for every command and every other type"""
+    return [
+        pytest.param(existing, command, id=f"{command[0]}-on-{existing}")
+        for kind, command in commands
+        for existing in CREATE
+        if existing != kind
+    ]
+
+
+def is_wrongtype(reply) -> bool:
+    return isinstance(reply, ReplyError) and reply.startswith("WRONGTYPE")
+
+
+@pytest.mark.parametrize("existing, command", mismatched(WRITES))
+def test_writes_refuse_a_key_of_another_type(client, existing, command):
+    assert not isinstance(client(*CREATE[existing]), ReplyError)
+    assert is_wrongtype(client(*command))
+    assert client("TYPE", "k") == existing
+
+
+@pytest.mark.parametrize("existing, command", mismatched(READS))
+def test_reads_refuse_a_key_of_another_type(client, existing, command):
+    assert not isinstance(client(*CREATE[existing]), ReplyError)
+    assert is_wrongtype(client(*command))
+
+
+def test_incr_on_a_string_that_is_not_a_number(client):
+    assert client("SET", "k", "abc") == "OK"
+    reply = client("INCR", "k")
+    assert isinstance(reply, ReplyError) and reply == "ERR value is not an integer or out of range"
+
+
+def test_set_replaces_any_type(client):
+    assert client("ZADD", "k", "1", "m") == 1
+    assert client("SET", "k", "v") == "OK"
+    assert client("TYPE", "k") == "string"
+    assert is_wrongtype(client("ZCARD", "k"))
+    assert client("GET", "k") == b"v"
@@ -0,0 +1,153 @@
+import socket
+import time
+
+import pytest
+
+from app import main
+from app.backlog import ReplicationBacklog
+from app.connection import ThreadedConnection
+from app.replica import Replica
+from app.resp_parser import RespParser
+from conftest import ReplyError
+
+
+class FakeReplica:
+    """The replica end of a link attached to main's replication state"""
+
+    def __init__(self, args: main.Args):
+        self.args = args
+        ours, self.sock = socket.socketpair()
+        self.sock.settimeout(5)
+        self.conn = ThreadedConnection(ours)
+        self.parser = RespParser()
+        main.replication.connected_replicas[self.conn] = Replica(self.conn)
+
+    def receive(self, count: int):
+        frames = []
+        while len(frames) < count:
+            assert self.parser.recv_into(self.sock)
+            frames.extend(self.parser.commands())
+        return frames
+
+    def ack(self, offset: int):
+        main.cmd_replconf(self.args, [b"REPLCONF", b"ACK", b"%d" % offset], self.conn, False)
+
+
+@pytest.fixture
+def replicas(server_args):
+    """replicas(n) attaches n replicas, detached again afterwards"""
+    saved = main.replication.backlog, main.replication.master_repl_offset
+    main.replication.backlog = ReplicationBacklog(1 << 16)
+    main.replication.master_repl_offset = 0
+    attached = []
+
+    def attach(n: int):
+        attached.extend(FakeReplica(server_args) for _ in range(n))
+        return attached[-n:]
+
+    yield attach
+    for replica in attached:
+        main.drop_replica(replica.conn)
+        replica.conn.close()
+        replica.sock.close()
+    main.replication.waiters.clear()
+    main.replication.getack_wanted = False
+    main.replication.getack_offset = 0
+    main.replication.backlog, main.replication.master_repl_offset = saved
+
+
+def wait_for(condition):
+    deadline = time.monotonic() + 5
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+
+def test_wait_without_replicas(client, replicas):
+    assert client("WAIT", "0", "0") == 0
+    assert client("SET", "k", "v") == "OK"
+    start = time.monotonic()
+    assert client("WAIT", "1", "100") == 0
+    assert time.monotonic() - start >= 0.09
+    assert not main.replication.waiters
+
+
+def test_wait_is_answered_by_the_ack_that_satisfies_it(client, replicas):
+    first, second = replicas(2)
+    assert client("SET", "k", "v") == "OK"
+    offset = main.replication.master_repl_offset
+    client.send("WAIT", "2", "0")
+    # One GETACK follows the write through the stream
+    for replica in (first, second):
+        assert replica.receive(2) == [[b"SET", b"k", b"v"], [b"REPLCONF", b"GETACK", b"*"]]
+    wait_for(lambda: main.replication.waiters)
+    first.ack(offset)
+    assert len(main.replication.waiters) == 1
+    # An ACK short of the write doesn't count
+    second.ack(offset - 1)
+    assert len(main.replication.waiters) == 1
+    second.ack(offset + 10)
+    assert client.read() == 2
+    assert not main.replication.waiters
+
+
+def test_replicas_already_caught_up_answer_at_once(client, replicas):
+    (replica,) = replicas(1)
+    assert client("SET", "k", "v") == "OK"
+    replica.ack(main.replication.master_repl_offset)
+    assert client("WAIT", "1", "0") == 1
+    assert not main.replication.getack_wanted
+    # Reads don't move what the client waits for
+    assert client("GET", "k") == b"v"
+    assert client("WAIT", "1", "0") == 1
+
+
+def test_timeout_reports_the_replicas_that_acked(client, replicas):
+    first, _ = replicas(2)
+    assert client("SET", "k", "v") == "OK"
+    offset = main.replication.master_repl_offset
+    client.send("WAIT", "2", "200")
+    wait_for(lambda: main.replication.waiters)
+    first.ack(offset)
+    assert client.read() == 1
+    assert not main.replication.waiters
+
+
+def test_waits_share_one_getack(connect, replicas):
+    (replica,) = replicas(1)
+    clients = [connect() for _ in range(3)]
+    for i, client in enumerate(clients):
+        assert client("SET", "k%d" % i, "v") == "OK"
+    assert replica.receive(3) == [[b"SET", b"k%d" % i, b"v"] for i in range(3)]
+    offset = main.replication.master_repl_offset
+    for client in clients:
+        client.send("WAIT", "1", "0")
+    wait_for(lambda: len(main.replication.waiters) == 3)
+    getacks = replica.receive(1)
+    assert getacks == [[b"REPLCONF", b"GETACK", b"*"]]
+    replica.ack(offset)
+    assert [client.read() for client in clients] == [1, 1, 1]
+    # The later WAITs were covered by the GETACK already sent
+    replica.sock.settimeout(0.1)
+    with pytest.raises(socket.timeout):
+        replica.receive(1)
+
+
+def test_closed_clients_stop_waiting(connect, replicas):
+    (replica,) = replicas(1)
+    client = connect()
+    assert client("SET", "k", "v") == "OK"
+    client.send("WAIT", "1", "0")
+    wait_for(lambda: main.replication.waiters)
+    conn = main.replication.waiters[0].conn
+    client.close()
+    wait_for(lambda: conn.closed)
+    replica.ack(0)
+    assert not main.replication.waiters
+
+
+def test_wait_errors(client, server_args):
+    assert isinstance(client("WAIT", "x", "0"), ReplyError)
+    assert isinstance(client("WAIT", "1", "-1"), ReplyError)
+    server_args.replicaof = "localhost 6379"
+    assert main.cmd_wait(server_args, [b"WAIT", b"0", b"0"], None, False).startswith("-ERR")